@@ -27,6 +27,86 @@ class SPAMSException(Exception):
     pass
 
 
+def shared_frames(shape, dtype):
+    """
+        Allocates an array of frames in shared memory with the layout that
+        spams.trainDL expects for X (each frame is a column of a Fortran
+        ordered matrix).
+
+        If the data is written into this array (e.g. by preprocessing in
+        place), it can be handed to spams.trainDL through
+        call_multiprocessing_array_spams_trainDL without being copied again.
+
+        Args:
+            shape(tuple of ints):                   shape of the frames (first
+                                                    axis is time).
+
+            dtype(type):                            type of the frames.
+
+        Returns:
+            numpy.ndarray:                          a C ordered view of the
+                                                    shared array with the
+                                                    given shape.
+
+        Examples:
+            >>> a = shared_frames((3, 2, 2), float)
+            >>> a.shape
+            (3, 2, 2)
+            >>> a.flags.c_contiguous
+            True
+    """
+
+    # Just to make sure this exists in the new process. Shouldn't be necessary.
+    import functools
+    import operator
+
+    num_pixels = functools.reduce(operator.mul, shape[1:], 1)
+
+    frames_array = npctypes.shared.ndarray(
+        (num_pixels, shape[0]), dtype, "F"
+    )
+
+    with npctypes.shared.as_ndarray(frames_array) as frames_array_numpy:
+        frames = frames_array_numpy.transpose().reshape(shape)
+
+    return(frames)
+
+
+def _get_shared_array(a):
+    """
+        Finds the shared array backing a Fortran ordered array (e.g. as made
+        by shared_frames) if it covers all of it or only leaves off some of
+        its last columns (e.g. frames held out at the end).
+
+        Args:
+            a(numpy.ndarray):                       array to check.
+
+        Returns:
+            ctypes.Array:                           shared array viewed by a or
+                                                    None if there isn't one.
+    """
+
+    import ctypes
+
+    a_base = a
+    while (a_base is not None) and not isinstance(a_base, ctypes.Array):
+        a_base = getattr(a_base, "base", None)
+
+    a_base_shape = getattr(a_base, "_shape_", None)
+    if (a_base is None) or \
+            (a_base_shape is None) or \
+            (len(a_base_shape) != a.ndim) or \
+            (tuple(a_base_shape[:-1]) != a.shape[:-1]) or \
+            (a_base_shape[-1] < a.shape[-1]) or \
+            (getattr(a_base, "_order_", None) != "F") or \
+            (not a.flags.f_contiguous) or \
+            (a.dtype.itemsize * a.size > ctypes.sizeof(a_base)) or \
+            (a.ctypes.data != ctypes.addressof(a_base)):
+        a_base = None
+
+    return(a_base)
+
+
 def run_multiprocessing_queue_spams_trainDL(out_queue, *args, **kwargs):
     """
         Designed to run spams.trainDL in a separate process.
@@ -123,6 +203,8 @@ def run_multiprocessing_array_spams_trainDL(result_array_type,
                                             D_is_arg=False,
                                             D_array_type=None,
                                             D_array=None,
+                                            X_num_columns=None,
+                                            model_arrays=None,
                                             *args,
                                             **kwargs):
     """
@@ -173,6 +255,17 @@ def run_multiprocessing_array_spams_trainDL(result_array_type,
                                                             the initial
                                                             dictionary.
 
+            X_num_columns(int):                             how many of the
+                                                            leading columns of
+                                                            X_array to use (all
+                                                            if None).
+
+            model_arrays(tuple):                            shared arrays to
+                                                            store the model's
+                                                            A, B, and iter in
+                                                            (if return_model
+                                                            is set).
+
             *args(list):                                    a list of position
                                                             arguments to pass
                                                             to spams.trainDL.
@@ -193,6 +286,9 @@ def run_multiprocessing_array_spams_trainDL(result_array_type,
     import spams
 
     with npctypes.shared.as_ndarray(X_array) as X:
+        if X_num_columns is not None:
+            X = X[:, :X_num_columns]
+
         with npctypes.shared.as_ndarray(result_array) as result:
             if D_array is not None:
                 with npctypes.shared.as_ndarray(D_array) as D:
@@ -201,9 +297,22 @@ def run_multiprocessing_array_spams_trainDL(result_array_type,
                     else:
                         kwargs["D"] = D
 
-                    result[:] = spams.trainDL(X, *args, **kwargs)
+                    new_result = spams.trainDL(X, *args, **kwargs)
             else:
-                result[:] = spams.trainDL(X, *args, **kwargs)
+                new_result = spams.trainDL(X, *args, **kwargs)
+
+            if model_arrays is not None:
+                new_result, new_model = new_result
+
+                A_array, B_array, iter_array = model_arrays
+                with npctypes.shared.as_ndarray(A_array) as A:
+                    A[...] = new_model["A"]
+                with npctypes.shared.as_ndarray(B_array) as B:
+                    B[...] = new_model["B"]
+                with npctypes.shared.as_ndarray(iter_array) as iter_:
+                    iter_[...] = new_model["iter"]
+
+            result[:] = new_result
 
 
 def call_multiprocessing_array_spams_trainDL(X, *args, **kwargs):
@@ -228,7 +337,10 @@ def call_multiprocessing_array_spams_trainDL(X, *args, **kwargs):
                                                     as used by spams.trainDL
                                                     (so if someone tries to use
                                                     it as a keyword
-                                                    argument...).
+                                                    argument...). If it is
+                                                    already in shared memory
+                                                    (see shared_frames), it is
+                                                    used without a copy.
 
             *args(list):                            a list of position
                                                     arguments to pass to
@@ -238,6 +350,13 @@ def call_multiprocessing_array_spams_trainDL(X, *args, **kwargs):
                                                     arguments to pass to
                                                     spams.trainDL.
 
+        Returns:
+            result(numpy.ndarray):                  the dictionary found and
+                                                    (if return_model is set)
+                                                    the model to continue
+                                                    from (a dict with A, B,
+                                                    and iter).
+
         Note:
             This is somewhat faster than using multiprocessing.Queue.
     """
@@ -257,39 +376,54 @@ def call_multiprocessing_array_spams_trainDL(X, *args, **kwargs):
     else:
         D = kwargs.pop("D", None)
 
-    # Create a shared array to contain X
-    X_array = npctypes.shared.ndarray(X.shape, X.dtype, "F")
+    # Reuse X if it is already in shared memory (e.g. from shared_frames).
+    X_array = _get_shared_array(X)
+    if X_array is None:
+        # Create a shared array to contain X
+        X_array = npctypes.shared.ndarray(X.shape, X.dtype, "F")
 
-    # Copy over the contents of X.
-    with npctypes.shared.as_ndarray(X_array) as X_array_numpy:
-        X_array_numpy[...] = X
-    del X_array_numpy
+        # Copy over the contents of X.
+        with npctypes.shared.as_ndarray(X_array) as X_array_numpy:
+            X_array_numpy[...] = X
+        del X_array_numpy
 
     len_D = kwargs.get("K", None)
     if D is not None:
-        # Create a shared array to contain D
-        D_array = npctypes.shared.ndarray(D.shape, D.dtype, "F")
+        D_array = _get_shared_array(D)
+        if D_array is None:
+            # Create a shared array to contain D
+            D_array = npctypes.shared.ndarray(D.shape, D.dtype, "F")
 
-        # Copy over the contents of D.
-        with npctypes.shared.as_ndarray(D_array) as D_array_numpy:
-            D_array_numpy[...] = D
-        del D_array_numpy
+            # Copy over the contents of D.
+            with npctypes.shared.as_ndarray(D_array) as D_array_numpy:
+                D_array_numpy[...] = D
+            del D_array_numpy
 
         len_D = D.shape[-1]
 
     # Create a shared array to contain the result
     result_array = npctypes.shared.ndarray((X.shape[0], len_D), X.dtype, "F")
 
+    # Create shared arrays to contain the model (i.e. A, B, and iter).
+    model_arrays = None
+    if kwargs.get("return_model", False):
+        model_arrays = (
+            npctypes.shared.ndarray((len_D, len_D), X.dtype, "F"),
+            npctypes.shared.ndarray((X.shape[0], len_D), X.dtype, "F"),
+            npctypes.shared.ndarray((1,), numpy.int64, "F"),
+        )
+
     new_args = (
         type(result_array),
         result_array,
         type(X_array),
         X_array,
+        D_is_arg,
+        type(D_array) if D is not None else None,
+        D_array if D is not None else None,
+        X.shape[-1],
+        model_arrays,
     )
-    if D is not None:
-        new_args = new_args + (
-            D_is_arg, type(D_array), D_array,
-        )
     p = multiprocessing.Process(
         target=run_multiprocessing_array_spams_trainDL,
         args=new_args,
@@ -307,6 +441,15 @@ def call_multiprocessing_array_spams_trainDL(X, *args, **kwargs):
     with npctypes.shared.as_ndarray(result_array) as result:
         result = result.copy()
 
+    if model_arrays is not None:
+        model = dict()
+        for k, k_array in zip(["A", "B", "iter"], model_arrays):
+            with npctypes.shared.as_ndarray(k_array) as k_array_numpy:
+                model[k] = k_array_numpy.copy()
+        model["iter"] = int(model["iter"][0])
+
+        result = (result, model)
+
     return(result)
 
 
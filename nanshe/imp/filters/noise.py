@@ -6,7 +6,9 @@ Overview
 ===============================================================================
 Provides a way of estimating noise based on what falls out of some multiple of
 the standard deviation and generate a mask that excludes the noise or the
-non-noise.
+non-noise. Alternatively, the noise can be estimated robustly using the median
+absolute deviation. Either estimate can be made on a subsample of the data to
+save time on large arrays.
 
 ===============================================================================
 API
@@ -28,15 +30,187 @@ from nanshe.util import prof
 # Get the logger
 trace_logger = prof.getTraceLogger(__name__)
 
+# Scales the median absolute deviation to the standard deviation of normally
+# distributed values (i.e. 1 / Phi^-1(3/4) ).
+MAD_TO_STD = 1.4826
+
 
 @prof.log_call(trace_logger)
-def estimate_noise(input_array, significance_threshold=3.0):
+def sample_values(input_array, sample_size=None, sample_method="strided"):
+    """
+        Gets a subsample of the values in the given array.
+
+        Args:
+            input_array(numpy.ndarray):         the array to sample from.
+
+            sample_size(int):                   about how many values to
+                                                sample (must be positive). If
+                                                None or at least as large as
+                                                the array, all values are
+                                                used. (Default None)
+
+            sample_method(str):                 either "strided" for
+                                                (deterministic) evenly spaced
+                                                values or "random" for values
+                                                chosen at random without
+                                                replacement.
+                                                (Default "strided")
+
+        Returns:
+            values(numpy.ndarray):              a flat array of values.
+
+
+        Examples:
+            >>> sample_values(numpy.arange(6).reshape(2, 3))
+            array([0, 1, 2, 3, 4, 5])
+
+            >>> sample_values(numpy.arange(10), 5)
+            array([0, 2, 4, 6, 8])
+
+            >>> sample_values(numpy.arange(10), 4)
+            array([0, 3, 6, 9])
+
+            >>> len(sample_values(numpy.arange(10), 4, "random"))
+            4
+
+            >>> sample_values(numpy.arange(10), 0)
+            Traceback (most recent call last):
+                ...
+            AssertionError: `sample_size` must be positive.
+
+            >>> sample_values(numpy.arange(10), 4, "other")
+            Traceback (most recent call last):
+                ...
+            ValueError: Unknown sample_method 'other'.
+    """
+
+    assert (sample_size is None) or (sample_size > 0), \
+        "`sample_size` must be positive."
+
+    values = input_array.ravel()
+
+    if (sample_size is None) or (sample_size >= values.size):
+        pass
+    elif sample_method == "strided":
+        stride = int(numpy.ceil(values.size / float(sample_size)))
+        values = values[::stride]
+    elif sample_method == "random":
+        values = values[numpy.random.choice(
+            values.size, sample_size, replace=False
+        )]
+    else:
+        raise ValueError(
+            "Unknown sample_method " + repr(sample_method) + "."
+        )
+
+    return(values)
+
+
+@prof.log_call(trace_logger)
+def noise_statistics(input_array,
+                     significance_threshold=3.0,
+                     estimator="std",
+                     sample_size=None,
+                     sample_method="strided"):
+    """
+        Estimates the center and the noise of the given array.
+
+        With the "std" estimator, the center is the mean and the noise is the
+        standard deviation of the values within the standard deviation of
+        the array times the significance threshold (as estimate_noise has
+        always done). With the "mad" estimator, the center is the median and
+        the noise is the median absolute deviation scaled to match the
+        standard deviation of normally distributed noise. The latter is
+        robust to the signal present; so, it does not need the
+        significance_threshold.
+
+        Args:
+            input_array(numpy.ndarray):         the array to estimate noise of.
+
+            significance_threshold(float):      the number of standard
+                                                deviations (of the whole
+                                                array), below which must be
+                                                noise ("std" only).
+
+            estimator(str):                     either "std" or "mad".
+                                                (Default "std")
+
+            sample_size(int):                   about how many values to
+                                                use for the estimate. By
+                                                default all. (Default None)
+
+            sample_method(str):                 how to subsample (see
+                                                sample_values).
+                                                (Default "strided")
+
+        Returns:
+            (float, float):                     the center and the noise.
+
+
+        Examples:
+            >>> noise_statistics(numpy.eye(2))
+            (0.5, 0.5)
+
+            >>> center, noise = noise_statistics(numpy.eye(2), estimator="mad")
+            >>> center
+            0.5
+            >>> round(float(noise), 4)
+            0.7413
+
+            >>> noise_statistics(numpy.eye(3), estimator="mad")
+            (0.0, 0.0)
+
+            >>> noise_statistics(numpy.eye(2), estimator="other")
+            Traceback (most recent call last):
+                ...
+            ValueError: Unknown estimator 'other'.
+    """
+
+    values = sample_values(
+        input_array, sample_size=sample_size, sample_method=sample_method
+    )
+
+    center = None
+    noise = None
+    if estimator == "std":
+        center = values.mean()
+        stddev = values.std()
+
+        # Find cells that are inside an acceptable range
+        # (3 std devs from the mean by default)
+        values_devs = numpy.abs(values - center)
+        insignificant_mask = values_devs < significance_threshold * stddev
+
+        # Those cells have noise. Estimate the standard deviation on them.
+        # That will be our noise unit size.
+        noise = values[insignificant_mask].std()
+    elif estimator == "mad":
+        center = numpy.median(values)
+
+        # Scale so that it is consistent with the standard deviation for
+        # normally distributed noise.
+        noise = MAD_TO_STD * numpy.median(numpy.abs(values - center))
+    else:
+        raise ValueError(
+            "Unknown estimator " + repr(estimator) + "."
+        )
+
+    return(center, noise)
+
+
+@prof.log_call(trace_logger)
+def estimate_noise(input_array,
+                   significance_threshold=3.0,
+                   estimator="std",
+                   sample_size=None,
+                   sample_method="strided"):
     """
         Estimates the noise in the given array.
 
         Using the array finds what the standard deviation is of some values in
         the array, which are within the standard deviation of the whole array
-        times the significance threshold.
+        times the significance threshold. Alternatively, uses the median
+        absolute deviation (see noise_statistics).
 
         Args:
             input_array(numpy.ndarray):         the array to estimate noise of.
@@ -45,6 +219,17 @@ def estimate_noise(input_array, significance_threshold=3.0):
                                                 array), below which must be
                                                 noise.
 
+            estimator(str):                     either "std" or "mad".
+                                                (Default "std")
+
+            sample_size(int):                   about how many values to
+                                                use for the estimate. By
+                                                default all. (Default None)
+
+            sample_method(str):                 how to subsample (see
+                                                sample_values).
+                                                (Default "strided")
+
         Returns:
             noise(float):                       The standard deviation of the
                                                 noise.
@@ -71,25 +256,52 @@ def estimate_noise(input_array, significance_threshold=3.0):
             >>> numpy.random.seed(10)
             >>> round(float(estimate_noise(numpy.random.random((2000,2000)), 3)), 3)
             0.289
-    """
 
-    mean = input_array.mean()
-    stddev = input_array.std()
+            >>> numpy.random.seed(10)
+            >>> a = numpy.random.normal(0, 2, (2000,2000))
+            >>> a_noise = estimate_noise(a, 3)
+            >>> round(float(a_noise), 2)
+            1.97
+            >>> abs(estimate_noise(a, 3, sample_size=10000) - a_noise) < 0.05
+            True
+            >>> abs(estimate_noise(a, estimator="mad") - a_noise) < 0.05
+            True
+            >>> abs(estimate_noise(
+            ...     a, estimator="mad", sample_size=10000, sample_method="random"
+            ... ) - a_noise) < 0.05
+            True
 
-    # Find cells that are inside an acceptable range
-    # (3 std devs from the mean by default)
-    input_array_devs = numpy.abs(input_array - mean)
-    insignificant_mask = input_array_devs < significance_threshold * stddev
+            >>> numpy.random.seed(10)
+            >>> a = numpy.random.normal(0, 2, (2000,2000))
+            >>> a[:100, :100] += 50
+            >>> a_noise = estimate_noise(a, 3)
+            >>> round(float(a_noise), 2)
+            2.0
+            >>> abs(estimate_noise(
+            ...     a, estimator="mad", sample_size=40000
+            ... ) - a_noise) < 0.05
+            True
+    """
 
-    # Those cells have noise. Estimate the standard deviation on them.
-    # That will be our noise unit size.
-    noise = input_array[insignificant_mask].std()
+    center, noise = noise_statistics(
+        input_array,
+        significance_threshold=significance_threshold,
+        estimator=estimator,
+        sample_size=sample_size,
+        sample_method=sample_method
+    )
 
     return(noise)
 
 
 @prof.log_call(trace_logger)
-def significant_mask(input_array, noise_threshold=6.0, noise_estimate=None):
+def significant_mask(input_array,
+                     noise_threshold=6.0,
+                     noise_estimate=None,
+                     center=None,
+                     out=None,
+                     scratch=None,
+                     **parameters):
     """
         Using estimate_noise, creates a mask that selects the non-noise and
         suppresses noise.
@@ -102,9 +314,28 @@ def significant_mask(input_array, noise_threshold=6.0, noise_estimate=None):
                                                 value determines the max value
                                                 to consider as noise (to zero).
 
-            in_place(bool):                     whether to modify input_array
-                                                directly or to return a copy
-                                                instead.
+            noise_estimate(float):              the noise of input_array.
+                                                If not provided, it is found
+                                                with noise_statistics.
+
+            center(float):                      the value from which
+                                                deviations are measured. If
+                                                not provided, it is found
+                                                along with the noise (the
+                                                mean if noise_estimate is
+                                                provided).
+
+            out(numpy.ndarray):                 bool array to store the mask
+                                                in (one is made if not
+                                                provided).
+
+            scratch(numpy.ndarray):             array with the same shape and
+                                                type as input_array to hold
+                                                the deviations in (one is
+                                                made if not provided).
+
+            **parameters(dict):                 passed to noise_statistics
+                                                if the noise must be found.
 
         Returns:
             result(numpy.ndarray): a numpy array with noise zeroed.
@@ -133,24 +364,61 @@ def significant_mask(input_array, noise_threshold=6.0, noise_estimate=None):
             array([[ True, False, False],
                    [False,  True, False],
                    [False, False,  True]], dtype=bool)
-    """
 
-    mean = input_array.mean()
+            >>> significant_mask(numpy.eye(3), 1.0, 0.47140452079103173, 0.0)
+            array([[ True, False, False],
+                   [False,  True, False],
+                   [False, False,  True]], dtype=bool)
 
-    # Estimate noise with the default estimate_noise function
-    # if a value is not provided.
+            >>> significant_mask(
+            ...     numpy.array([0., 1., 0., 1., 9.]), 3.0, estimator="mad"
+            ... )
+            array([False, False, False, False,  True], dtype=bool)
+
+            >>> m = numpy.zeros((2, 2), dtype=bool)
+            >>> significant_mask(numpy.eye(2), 1.0, 0.5, out=m) is m
+            True
+            >>> m
+            array([[ True,  True],
+                   [ True,  True]], dtype=bool)
+
+            >>> d = numpy.zeros((2, 2))
+            >>> significant_mask(numpy.eye(2), 1.0, 0.5, scratch=d)
+            array([[ True,  True],
+                   [ True,  True]], dtype=bool)
+            >>> d
+            array([[ 0.5,  0.5],
+                   [ 0.5,  0.5]])
+    """
+
+    # Estimate noise (and the center) with noise_statistics if a value is not
+    # provided.
     if noise_estimate is None:
-        noise_estimate = estimate_noise(input_array)
+        noise_center, noise_estimate = noise_statistics(
+            input_array, **parameters
+        )
+        if center is None:
+            center = noise_center
+    elif center is None:
+        center = input_array.mean()
 
     # Get all the noisy points in a mask and toss them.
-    input_array_devs = numpy.abs(input_array - mean)
-    significant_mask = input_array_devs >= noise_threshold * noise_estimate
+    # (reuses a single temporary for the deviations)
+    input_array_devs = numpy.subtract(input_array, center, out=scratch)
+    numpy.abs(input_array_devs, out=input_array_devs)
+    significant_mask = numpy.greater_equal(
+        input_array_devs, noise_threshold * noise_estimate, out=out
+    )
 
     return(significant_mask)
 
 
 @prof.log_call(trace_logger)
-def noise_mask(input_array, noise_threshold=6.0, noise_estimate=None):
+def noise_mask(input_array,
+               noise_threshold=6.0,
+               noise_estimate=None,
+               center=None,
+               **parameters):
     """
         Using estimate_noise, creates a mask that selects the noise and
         suppresses non-noise.
@@ -168,6 +436,15 @@ def noise_mask(input_array, noise_threshold=6.0, noise_estimate=None):
                                                 value determines the max value
                                                 to consider as noise (to zero).
 
+            noise_estimate(float):              the noise of input_array (see
+                                                significant_mask).
+
+            center(float):                      the value from which
+                                                deviations are measured (see
+                                                significant_mask).
+
+            **parameters(dict):                 passed to significant_mask.
+
         Returns:
             result(numpy.ndarray):              a numpy array with noise
                                                 zeroed.
@@ -197,7 +474,9 @@ def noise_mask(input_array, noise_threshold=6.0, noise_estimate=None):
     noisy_mask = significant_mask(
         input_array,
         noise_threshold=noise_threshold,
-        noise_estimate=noise_estimate
+        noise_estimate=noise_estimate,
+        center=center,
+        **parameters
     )
 
     # Invert the maske
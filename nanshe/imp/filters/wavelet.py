@@ -182,7 +182,8 @@ def transform(im0,
               scale=5,
               include_intermediates=False,
               include_lower_scales=False,
-              out=None):
+              out=None,
+              scratch=None):
     """
         Performs integral steps of the wavelet transform on im0 up to the given
         scale. If scale is an iterable, then
@@ -206,6 +207,16 @@ def transform(im0,
                                                  is False or an AssertionError
                                                  will be raised.)
 
+            scratch(tuple of numpy.ndarrays):    two float32 arrays with the
+                                                 shape of im0 to hold the
+                                                 previous and current
+                                                 smoothed images in (made if
+                                                 not provided and unused if
+                                                 include_intermediates is
+                                                 True). Must be float32 like
+                                                 the ones made (as im0 is cast
+                                                 to float32).
+
         Returns:
             W, out(tuple of numpy.ndarrays):     returns the final result of
                                                  the wavelet transform and
@@ -308,6 +319,17 @@ def transform(im0,
                     [-0.375  ,  0.625  , -0.375  ],
                     [-0.34375, -0.375  ,  0.59375]]])
 
+            >>> scratch = (numpy.empty((3, 3), dtype = numpy.float32),
+            ...            numpy.empty((3, 3), dtype = numpy.float32))
+            >>> transform(numpy.eye(3, dtype = numpy.float32),
+            ...     scale = 1,
+            ...     include_intermediates = False,
+            ...     include_lower_scales = True,
+            ...     scratch = scratch) # doctest: +NORMALIZE_WHITESPACE
+            array([[[ 0.59375, -0.375  , -0.34375],
+                    [-0.375  ,  0.625  , -0.375  ],
+                    [-0.34375, -0.375  ,  0.59375]]], dtype=float32)
+
             >>> out = numpy.eye(3, dtype = numpy.uint8)
             >>> transform(out,
             ...     scale = 1,
@@ -350,6 +372,15 @@ def transform(im0,
         scale = numpy.repeat([scale], im0.ndim)
 
 
+    if scratch is None:
+        scratch = (None, None)
+    else:
+        for each_scratch in scratch:
+            assert (each_scratch.shape == im0.shape), \
+                "Each scratch array should have the shape of im0."
+            assert issubclass(each_scratch.dtype.type, numpy.float32), \
+                "Each scratch array should have type float32."
+
     imPrev = None
     imCur = None
     if include_intermediates:
@@ -383,7 +414,9 @@ def transform(im0,
 
                 W = out
 
-            imPrev = numpy.empty_like(im0)
+            imPrev = scratch[0]
+            if imPrev is None:
+                imPrev = numpy.empty_like(im0)
         else:
             if out is not None:
                 assert (out.shape == im0.shape)
@@ -403,7 +436,11 @@ def transform(im0,
                 imPrev = numpy.empty_like(im0)
                 out = imPrev
 
-        imCur = im0.astype(numpy.float32)
+        imCur = scratch[1]
+        if imCur is None:
+            imCur = im0.astype(numpy.float32)
+        else:
+            imCur[...] = im0
 
 
     for i in irange(1, scale.max() + 1):
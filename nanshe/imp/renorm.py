@@ -7,7 +7,10 @@ Overview
 The ``renorm`` (or **renorm**\ alization) module provides a few simple utility
 methods for standardizing a set of images. The first is to recompute each frame
 so that its mean is 0. The second is to normalize each frame using an
-appropriate |L^p norm|_. Both have the ability of working in-place.
+appropriate |L^p norm|_. Both have the ability of working in-place. Both
+also work on blocks of frames at a time so that large stacks (including
+``h5py.Dataset``\ s) can be handled without per-frame Python overhead or
+full size temporaries.
 
 .. |L^p norm| replace:: L\ :sup:`p` norm
 .. _`L^p norm`: http://en.wikipedia.org/wiki/Lp_space
@@ -22,9 +25,13 @@ __author__ = "John Kirkham <kirkhamj@janelia.hhmi.org>"
 __date__ = "$Apr 30, 2014 17:14:50 EDT$"
 
 
+import multiprocessing.pool
+
 # Generally useful and fast to import so done immediately.
 import numpy
 
+import h5py
+
 from nanshe.util import iters
 
 # Need in order to have logging information no matter what.
@@ -36,7 +43,106 @@ trace_logger = prof.getTraceLogger(__name__)
 
 
 @prof.log_call(trace_logger)
-def zeroed_mean_images(input_array, output_array=None):
+def _apply_frame_blocks(block_op,
+                        input_array,
+                        output_array,
+                        block_frame_length=-1,
+                        num_threads=1):
+    """
+        Applies an in-place operation to blocks of frames.
+
+        Copies input_array into output_array (if they differ) a block of
+        frames at a time and applies the given operation to each block. If
+        output_array is not a NumPy array (e.g. an ``h5py.Dataset``), each
+        block is read into memory, modified, and written back.
+
+        Args:
+            block_op(callable):                 modifies a block of frames
+                                                (numpy.ndarray) in-place.
+
+            input_array(numpy.ndarray):         array images with time as the
+                                                first index.
+
+            output_array(numpy.ndarray):        where to store the result.
+
+            block_frame_length(int):            number of frames to work with
+                                                at a time. By default all.
+                                                (Default -1)
+
+            num_threads(int):                   number of threads to use for
+                                                processing blocks of in-memory
+                                                arrays. (Default 1)
+    """
+
+    num_frames = len(output_array)
+    if block_frame_length == -1:
+        block_frame_length = max(num_frames, 1)
+
+    is_in_place = (id(input_array) == id(output_array))
+    is_output_in_memory = isinstance(output_array, numpy.ndarray)
+
+    def apply_block(range_ij):
+        slice_ij = slice(range_ij.start, range_ij.stop)
+
+        output_array_ij = None
+        if is_output_in_memory:
+            output_array_ij = output_array[slice_ij]
+            if not is_in_place:
+                output_array_ij[...] = input_array[slice_ij]
+        elif is_in_place:
+            output_array_ij = output_array[slice_ij]
+        else:
+            output_array_ij = numpy.array(input_array[slice_ij])
+
+        block_op(output_array_ij)
+
+        if not is_output_in_memory:
+            output_array[slice_ij] = output_array_ij
+
+    frame_ranges = iters.subrange(0, num_frames, block_frame_length)
+
+    if (num_threads > 1) and \
+            is_output_in_memory and \
+            isinstance(input_array, numpy.ndarray):
+        thread_pool = multiprocessing.pool.ThreadPool(num_threads)
+        try:
+            thread_pool.map(apply_block, list(frame_ranges))
+        finally:
+            thread_pool.close()
+            thread_pool.join()
+    else:
+        for range_ij in frame_ranges:
+            apply_block(range_ij)
+
+    return(output_array)
+
+
+@prof.log_call(trace_logger)
+def _empty_output(input_array):
+    """
+        Provides an in-memory array to store the result in.
+
+        Args:
+            input_array(numpy.ndarray):         array images with time as the
+                                                first index.
+
+        Returns:
+            numpy.ndarray:                      an empty in-memory array with
+                                                the same shape and type.
+    """
+
+    if isinstance(input_array, numpy.ndarray):
+        return(numpy.empty_like(input_array))
+    else:
+        return(numpy.empty(input_array.shape, dtype=input_array.dtype))
+
+
+@prof.log_call(trace_logger)
+def zeroed_mean_images(input_array,
+                       output_array=None,
+                       block_frame_length=-1,
+                       dtype=None,
+                       num_threads=1):
     """
         Takes and finds the mean for each image. Where each image is
         new_numpy_array[i] with some index i.
@@ -48,6 +154,18 @@ def zeroed_mean_images(input_array, output_array=None):
             output_array(numpy.ndarray):        provides a location to store
                                                 the result (optional)
 
+            block_frame_length(int):            number of frames to work with
+                                                at a time. By default all.
+                                                (Default -1)
+
+            dtype(type):                        type to accumulate the means
+                                                in. By default the type of the
+                                                input. (Default None)
+
+            num_threads(int):                   number of threads to use for
+                                                processing blocks of in-memory
+                                                arrays. (Default 1)
+
         Returns:
             result(numpy.ndarray):              The same array with each images
                                                 mean removed. Where
@@ -111,33 +229,74 @@ def zeroed_mean_images(input_array, output_array=None):
             >>> a = numpy.array([[1.,2.],[3.,4.]])
             >>> numpy.all(a == zeroed_mean_images(a, output_array=a))
             True
+
+            >>> zeroed_mean_images(
+            ...     numpy.array([[1.,2.],[3.,4.],[5.,7.]]),
+            ...     block_frame_length=2
+            ... )
+            array([[-0.5,  0.5],
+                   [-0.5,  0.5],
+                   [-1. ,  1. ]])
+
+            >>> zeroed_mean_images(
+            ...     numpy.array([[1,2],[3,4]]).astype(numpy.float32),
+            ...     dtype=numpy.float64
+            ... )
+            array([[-0.5,  0.5],
+                   [-0.5,  0.5]], dtype=float32)
+
+            >>> f = h5py.File("renorm.h5", "w", driver="core",
+            ...               backing_store=False)
+            >>> d = f.create_dataset("a", data=numpy.array([[1.,2.],[3.,4.]]))
+            >>> zeroed_mean_images(d, output_array=d, block_frame_length=1)
+            <HDF5 dataset "a": shape (2, 2), type "<f8">
+            >>> d[...]
+            array([[-0.5,  0.5],
+                   [-0.5,  0.5]])
+            >>> f.close()
     """
 
     assert issubclass(input_array.dtype.type, numpy.floating)
 
     if output_array is None:
-        output_array = input_array.copy()
+        output_array = _empty_output(input_array)
     elif id(input_array) != id(output_array):
         assert issubclass(output_array.dtype.type, numpy.floating)
 
         assert (input_array.shape == output_array.shape)
 
-        output_array[:] = input_array
-
-    # find the mean for each frame.
-    means = output_array.mean(axis=tuple(iters.irange(1, output_array.ndim)))
+    def zero_block_mean(output_array_ij):
+        # find the mean for each frame.
+        means = output_array_ij.mean(
+            axis=tuple(iters.irange(1, output_array_ij.ndim)), dtype=dtype
+        )
 
-    # reshape means until it has the right number of dimensions to broadcast.
-    means = means.reshape(means.shape + (output_array.ndim - means.ndim)*(1,))
+        # reshape means until it has the right number of dimensions to
+        # broadcast.
+        means = means.reshape(
+            means.shape + (output_array_ij.ndim - means.ndim)*(1,)
+        )
 
-    # broadcast and subtract the means so that the mean of all values is zero
-    output_array[:] -= means
+        # broadcast and subtract the means so that the mean of all values is
+        # zero
+        output_array_ij -= means
 
-    return(output_array)
+    return(_apply_frame_blocks(
+        zero_block_mean,
+        input_array,
+        output_array,
+        block_frame_length=block_frame_length,
+        num_threads=num_threads
+    ))
 
 
 @prof.log_call(trace_logger)
-def renormalized_images(input_array, ord=2, output_array=None):
+def renormalized_images(input_array,
+                        ord=2,
+                        output_array=None,
+                        block_frame_length=-1,
+                        dtype=None,
+                        num_threads=1):
     """
         Takes and divide each image by its norm. Where each image is
         new_numpy_array[i] with some index i.
@@ -152,6 +311,18 @@ def renormalized_images(input_array, ord=2, output_array=None):
             output_array(numpy.ndarray):        provides a location to store
                                                 the result (optional)
 
+            block_frame_length(int):            number of frames to work with
+                                                at a time. By default all.
+                                                (Default -1)
+
+            dtype(type):                        type to accumulate the norms
+                                                in. By default the type of the
+                                                input. (Default None)
+
+            num_threads(int):                   number of threads to use for
+                                                processing blocks of in-memory
+                                                arrays. (Default 1)
+
         Returns:
             result(numpy.ndarray):              The same array with each images
                                                 normalized.
@@ -206,30 +377,98 @@ def renormalized_images(input_array, ord=2, output_array=None):
             >>> renormalized_images(numpy.zeros((2,3,)))
             array([[ 0.,  0.,  0.],
                    [ 0.,  0.,  0.]])
+
+            >>> renormalized_images(
+            ...     numpy.array([[1.,2.],[3.,4.],[0.,5.]]),
+            ...     block_frame_length=2
+            ... )
+            array([[ 0.4472136 ,  0.89442719],
+                   [ 0.6       ,  0.8       ],
+                   [ 0.        ,  1.        ]])
+
+            >>> renormalized_images(
+            ...     numpy.array([[1.,2.],[3.,4.]]), ord=1, num_threads=2,
+            ...     block_frame_length=1
+            ... )
+            array([[ 0.33333333,  0.66666667],
+                   [ 0.42857143,  0.57142857]])
+
+            >>> renormalized_images(
+            ...     numpy.array([[0,2],[3,4]], dtype=numpy.float32),
+            ...     dtype=numpy.float64
+            ... )
+            array([[ 0. ,  1. ],
+                   [ 0.6,  0.8]], dtype=float32)
+
+            >>> renormalized_images(
+            ...     numpy.array([[0.,2.],[3.,4.]]), dtype=numpy.float32
+            ... )
+            array([[ 0. ,  1. ],
+                   [ 0.6,  0.8]])
+
+            >>> f = h5py.File("renorm.h5", "w", driver="core",
+            ...               backing_store=False)
+            >>> d = f.create_dataset("a", data=numpy.array([[0.,2.],[3.,4.]]))
+            >>> renormalized_images(d, block_frame_length=1)
+            array([[ 0. ,  1. ],
+                   [ 0.6,  0.8]])
+            >>> d[...]
+            array([[ 0.,  2.],
+                   [ 3.,  4.]])
+            >>> f.close()
     """
 
     assert issubclass(input_array.dtype.type, numpy.floating)
 
     if output_array is None:
-        output_array = input_array.copy()
+        output_array = _empty_output(input_array)
     elif id(input_array) != id(output_array):
         assert issubclass(output_array.dtype.type, numpy.floating)
 
         assert (input_array.shape == output_array.shape)
 
-        output_array[:] = input_array
+    def renormalize_block(output_array_ij):
+        # Take each image in the block and turn the image into a vector.
+        # (only for reading so a copy here is ok)
+        output_array_ij_vectors = output_array_ij.reshape(
+            (len(output_array_ij), -1)
+        )
 
-    # Unfortunately, our version of numpy's function numpy.linalg.norm
-    # does not support the axis keyword. So, we must use a for loop.
-    # Take each image at each time and turn the image into a vector.
-    # Then, find the norm and divide each image by this norm.
-    for i in iters.irange(output_array.shape[0]):
-        output_array_i = output_array[i]
-        output_array_i_norm = numpy.linalg.norm(
-            output_array_i.ravel(), ord=ord
+        # Accumulate in the requested type (may be narrower than the input).
+        if dtype is not None:
+            output_array_ij_vectors = output_array_ij_vectors.astype(
+                dtype, copy=False
+            )
+
+        # Find the norm of all vectors at once.
+        if ord == 2:
+            output_array_ij_norms = numpy.sqrt(numpy.einsum(
+                "ij,ij->i",
+                output_array_ij_vectors,
+                output_array_ij_vectors
+            ))
+        else:
+            output_array_ij_norms = numpy.linalg.norm(
+                output_array_ij_vectors, ord=ord, axis=1
+            )
+
+        # Leave images with a zero norm alone.
+        output_array_ij_norms[output_array_ij_norms == 0] = 1
+
+        # reshape norms until it has the right number of dimensions to
+        # broadcast.
+        output_array_ij_norms = output_array_ij_norms.reshape(
+            output_array_ij_norms.shape +
+            (output_array_ij.ndim - output_array_ij_norms.ndim)*(1,)
         )
 
-        if output_array_i_norm != 0:
-            output_array_i /= output_array_i_norm
+        # Divide each image by its norm.
+        output_array_ij /= output_array_ij_norms
 
-    return(output_array)
+    return(_apply_frame_blocks(
+        renormalize_block,
+        input_array,
+        output_array,
+        block_frame_length=block_frame_length,
+        num_threads=num_threads
+    ))
@@ -12,6 +12,9 @@ other workflows. These primary sections can be grouped as follows
 
    a. registration correction (\
       :py:func:`~nanshe.imp.segment.remove_zeroed_lines` )
+   #. spatial and temporal binning (\
+      :py:func:`~nanshe.imp.segment.spatial_bin`,\
+      :py:func:`~nanshe.imp.segment.temporal_bin` )
    #. background estimation and subtraction (\
       :py:func:`~nanshe.imp.segment.estimate_f0`,\
       :py:func:`~nanshe.imp.segment.extract_f0` )
@@ -40,6 +43,10 @@ __date__ = "$Apr 30, 2014 17:23:37 EDT$"
 # Allows for type conversions for C/C++ functions.
 import ctypes
 
+import collections
+import hashlib
+import multiprocessing.pool
+import threading
 import warnings
 
 # Generally useful and fast to import so done immediately.
@@ -50,6 +57,9 @@ import scipy
 import scipy.interpolate
 import scipy.ndimage
 import scipy.ndimage.filters
+import scipy.sparse
+import scipy.sparse.csgraph
+import scipy.sparse.linalg
 import scipy.spatial
 import scipy.spatial.distance
 
@@ -62,9 +72,6 @@ import skimage.segmentation
 
 from nanshe.util import iters
 
-# To allow for more advanced iteration patterns
-import itertools
-
 # Allows for deep and shallow copies.
 import copy
 
@@ -79,6 +86,8 @@ import rank_filter
 # Need in order to have logging information no matter what.
 from nanshe.util import prof
 
+from nanshe.util import wrappers
+
 from nanshe.util import xnumpy
 
 # Short function to process image data.
@@ -568,6 +577,278 @@ def extract_f0(new_data,
         return(new_data_df_over_f)
 
 
+@prof.log_call(trace_logger)
+def _pool_blocks(new_data, factors, method, block_frame_length, out):
+    """
+        Pools non-overlapping bins of shape ``factors`` together working on a
+        block of frames at a time. Trailing values along any axis that do not
+        fill a whole bin are dropped.
+
+        Args:
+            new_data(numpy.ndarray):            data to pool (first axis is
+                                                time). May also be an HDF5
+                                                dataset.
+
+            factors(tuple of ints):             size of a bin along each axis.
+
+            method(str):                        how to pool each bin (either
+                                                "mean" or "max").
+
+            block_frame_length(int):            number of frames to read at a
+                                                time (rounded down to a
+                                                multiple of ``factors[0]``).
+                                                If negative, all frames are
+                                                read at once.
+
+            out(numpy.ndarray):                 where the final results will be
+                                                stored (if None, a new array is
+                                                allocated). May also be an
+                                                HDF5 dataset.
+
+        Returns:
+            numpy.ndarray:                      the pooled data.
+    """
+
+    factors = tuple(int(_) for _ in factors)
+
+    if len(factors) != new_data.ndim:
+        raise ValueError(
+            "Expected one factor per axis (" + repr(new_data.ndim) + "). " +
+            "Instead got \"" + repr(factors) + "\"."
+        )
+
+    if any(_ < 1 for _ in factors):
+        raise ValueError(
+            "The factors must be positive integers. Instead got \"" +
+            repr(factors) + "\"."
+        )
+
+    if method not in ["mean", "max"]:
+        raise ValueError(
+            "Unknown method \"" + repr(method) + "\". " +
+            "Expected either \"mean\" or \"max\"."
+        )
+
+    out_shape = tuple(
+        each_len // each_factor
+        for each_len, each_factor in zip(new_data.shape, factors)
+    )
+
+    if out is None:
+        out_dtype = new_data.dtype
+        if (method == "mean") and \
+                not issubclass(out_dtype.type, numpy.floating):
+            out_dtype = numpy.float64
+
+        out = numpy.empty(out_shape, dtype=out_dtype)
+    else:
+        assert (tuple(out.shape) == out_shape)
+
+    # Crops each spatial axis to a multiple of its factor.
+    spatial_slice = tuple(
+        slice(0, each_len * each_factor)
+        for each_len, each_factor in zip(out_shape[1:], factors[1:])
+    )
+
+    # Interleaves each binned axis with the axis to pool over.
+    block_interleaved_shape = sum(
+        [(each_len, each_factor)
+         for each_len, each_factor in zip(out_shape[1:], factors[1:])],
+        tuple()
+    )
+    pooled_axes = tuple(iters.irange(1, 2 * new_data.ndim, 2))
+
+    num_bins = out_shape[0]
+    block_bin_length = num_bins
+    if block_frame_length > 0:
+        block_bin_length = max(1, block_frame_length // factors[0])
+
+    for i in iters.irange(0, num_bins, block_bin_length):
+        j = min(i + block_bin_length, num_bins)
+
+        new_data_block = numpy.asarray(
+            new_data[(slice(i * factors[0], j * factors[0]),) + spatial_slice]
+        )
+        new_data_block = new_data_block.reshape(
+            (j - i, factors[0]) + block_interleaved_shape
+        )
+
+        out_block = None
+        if isinstance(out, numpy.ndarray):
+            out_block = out[i:j]
+
+        if method == "mean":
+            out_block = numpy.mean(
+                new_data_block, axis=pooled_axes, out=out_block
+            )
+        elif method == "max":
+            out_block = numpy.max(
+                new_data_block, axis=pooled_axes, out=out_block
+            )
+
+        if not isinstance(out, numpy.ndarray):
+            out[i:j] = out_block
+
+    return(out)
+
+
+@prof.log_call(trace_logger)
+@hdf5.record.static_array_debug_recorder
+def temporal_bin(new_data,
+                 factor,
+                 method="mean",
+                 block_frame_length=-1,
+                 out=None,
+                 **parameters):
+    """
+        Pools consecutive frames together in bins of ``factor`` frames. This
+        reduces the number of frames (e.g. when the indicator kinetics are
+        much slower than the frame rate). Any trailing frames that do not
+        fill a whole bin are dropped.
+
+        Args:
+            new_data(numpy.ndarray):            data to bin (first axis is
+                                                time). May also be an HDF5
+                                                dataset.
+
+            factor(int):                        number of frames per bin.
+
+            method(str):                        how to pool each bin (either
+                                                "mean" or "max").
+
+            block_frame_length(int):            number of frames to read at a
+                                                time (rounded down to a
+                                                multiple of ``factor``). If
+                                                negative, all frames are read
+                                                at once.
+
+            out(numpy.ndarray):                 where the final results will be
+                                                stored (first axis must have
+                                                ``len(new_data) // factor``
+                                                frames). May also be an HDF5
+                                                dataset.
+
+            **parameters(dict):                 essentially unused (catches
+                                                unneeded arguments).
+
+        Returns:
+            numpy.ndarray:                      a new array with the binned
+                                                frames.
+
+        Examples:
+            >>> a = numpy.arange(14, dtype=float).reshape(7, 1, 2)
+            >>> temporal_bin(a, 2)
+            array([[[  1.,   2.]],
+            <BLANKLINE>
+                   [[  5.,   6.]],
+            <BLANKLINE>
+                   [[  9.,  10.]]])
+
+            >>> temporal_bin(a, 3, method="max")
+            array([[[  4.,   5.]],
+            <BLANKLINE>
+                   [[ 10.,  11.]]])
+
+            >>> b = numpy.zeros((3, 1, 2), dtype=float)
+            >>> temporal_bin(a, 2, block_frame_length=3, out=b)
+            array([[[  1.,   2.]],
+            <BLANKLINE>
+                   [[  5.,   6.]],
+            <BLANKLINE>
+                   [[  9.,  10.]]])
+            >>> b
+            array([[[  1.,   2.]],
+            <BLANKLINE>
+                   [[  5.,   6.]],
+            <BLANKLINE>
+                   [[  9.,  10.]]])
+    """
+
+    factors = (factor,) + (new_data.ndim - 1) * (1,)
+
+    out = _pool_blocks(new_data, factors, method, block_frame_length, out)
+
+    return(out)
+
+
+@prof.log_call(trace_logger)
+@hdf5.record.static_array_debug_recorder
+def spatial_bin(new_data,
+                factor,
+                method="mean",
+                block_frame_length=-1,
+                out=None,
+                **parameters):
+    """
+        Pools neighboring pixels of each frame together in bins of ``factor``
+        pixels along each spatial axis. This reduces the size of each frame
+        (e.g. for large fields of view). Any trailing pixels along an axis
+        that do not fill a whole bin are dropped.
+
+        Args:
+            new_data(numpy.ndarray):            data to bin (first axis is
+                                                time). May also be an HDF5
+                                                dataset.
+
+            factor(int or tuple of ints):       number of pixels per bin along
+                                                each spatial axis (either one
+                                                for all or one for each).
+
+            method(str):                        how to pool each bin (either
+                                                "mean" or "max").
+
+            block_frame_length(int):            number of frames to read at a
+                                                time. If negative, all frames
+                                                are read at once.
+
+            out(numpy.ndarray):                 where the final results will be
+                                                stored. May also be an HDF5
+                                                dataset.
+
+            **parameters(dict):                 essentially unused (catches
+                                                unneeded arguments).
+
+        Returns:
+            numpy.ndarray:                      a new array with the binned
+                                                frames.
+
+        Examples:
+            >>> a = numpy.arange(30, dtype=float).reshape(2, 3, 5)
+            >>> spatial_bin(a, 2)
+            array([[[  3.,   5.]],
+            <BLANKLINE>
+                   [[ 18.,  20.]]])
+
+            >>> spatial_bin(a, (1, 2), method="max")
+            array([[[  1.,   3.],
+                    [  6.,   8.],
+                    [ 11.,  13.]],
+            <BLANKLINE>
+                   [[ 16.,  18.],
+                    [ 21.,  23.],
+                    [ 26.,  28.]]])
+
+            >>> b = numpy.zeros((2, 1, 2), dtype=float)
+            >>> spatial_bin(a, 2, block_frame_length=1, out=b)
+            array([[[  3.,   5.]],
+            <BLANKLINE>
+                   [[ 18.,  20.]]])
+            >>> b
+            array([[[  3.,   5.]],
+            <BLANKLINE>
+                   [[ 18.,  20.]]])
+    """
+
+    spatial_factors = numpy.ones((new_data.ndim - 1,), dtype=int)
+    spatial_factors[...] = factor
+
+    factors = (1,) + tuple(spatial_factors)
+
+    out = _pool_blocks(new_data, factors, method, block_frame_length, out)
+
+    return(out)
+
+
 @prof.log_call(trace_logger)
 @hdf5.record.static_array_debug_recorder
 def normalize_data(new_data, out=None, **parameters):
@@ -581,6 +862,7 @@ def normalize_data(new_data, out=None, **parameters):
                                                     is time).
 
             **parameters(dict):                     contains arguments for
+                                                    zeroed_mean_images and
                                                     renormalized_images.
 
         Returns:
@@ -632,6 +914,22 @@ def normalize_data(new_data, out=None, **parameters):
             <BLANKLINE>
                    [[-0.28867513, -0.28867513],
                     [-0.28867513,  0.8660254 ]]])
+            >>> a = numpy.zeros((2,2,2,))
+            >>> a[1,1,1] = 1
+            >>> a[0,0,0] = 1
+            >>> normalize_data(
+            ...     a, **{
+            ...         "zeroed_mean_images" : { "block_frame_length" : 1 },
+            ...         "renormalized_images" : {
+            ...             "ord" : 2, "block_frame_length" : 1
+            ...         }
+            ...     }
+            ... )
+            array([[[ 0.8660254 , -0.28867513],
+                    [-0.28867513, -0.28867513]],
+            <BLANKLINE>
+                   [[-0.28867513, -0.28867513],
+                    [-0.28867513,  0.8660254 ]]])
     """
 
     # Make a copy of new_data or copy its contents if both arrays are not the
@@ -644,7 +942,8 @@ def normalize_data(new_data, out=None, **parameters):
     # Remove the mean of each row vector
     zeroed_mean_images(
         out,
-        output_array=out
+        output_array=out,
+        **parameters.get("zeroed_mean_images", {})
     )
 
     # Renormalize each row vector using some specified normalization
@@ -663,7 +962,14 @@ def preprocess_data(new_data, out=None, **parameters):
     """
         Performs all preprocessing steps that are specified.
 
-        (e.g. remove_zeroed_lines, bias, extract_f0, and wavelet.transform).
+        (e.g. remove_zeroed_lines, spatial_bin, bias, extract_f0,
+        temporal_bin, and wavelet.transform).
+
+        Binning with spatial_bin happens right after remove_zeroed_lines.
+        Binning with temporal_bin happens right before extract_f0 unless
+        ``after_extract_f0`` is set in its parameters. As binning reduces the
+        size of the data, the result will not be stored in ``out`` in that
+        case. So, the returned array should always be used.
 
         Args:
             new_data(numpy.ndarray):            array of data for generating a
@@ -677,7 +983,7 @@ def preprocess_data(new_data, out=None, **parameters):
                                                 step of preprocessing.
 
         Returns:
-            dict:                               the dictionary found.
+            numpy.ndarray:                      the preprocessed data.
     """
 
     if out is None:
@@ -685,6 +991,28 @@ def preprocess_data(new_data, out=None, **parameters):
     elif id(new_data) != id(out):
         out[:] = new_data
 
+    temporal_bin_after_f0 = False
+    if "temporal_bin" in parameters:
+        temporal_bin_after_f0 = parameters["temporal_bin"].get(
+            "after_extract_f0", False
+        )
+
+    def bin_frames(new_data_unbinned):
+        temporal_bin.recorders.array_debug_recorder = preprocess_data.recorders.array_debug_recorder
+        new_data_binned = temporal_bin(
+            new_data_unbinned,
+            **parameters["temporal_bin"]
+        )
+        preprocess_data.recorders.array_debug_recorder["images_temporal_binned"] = new_data_binned
+        if preprocess_data.recorders.array_debug_recorder:
+            preprocess_data.recorders.array_debug_recorder["images_temporal_binned_max"] = xnumpy.add_singleton_op(
+                numpy.max,
+                new_data_binned,
+                axis=0
+            )
+
+        return(new_data_binned)
+
     # Remove lines
     new_data_maybe_lines_removed = out
     if "remove_zeroed_lines" in parameters:
@@ -702,7 +1030,26 @@ def preprocess_data(new_data, out=None, **parameters):
                 axis=0
             )
 
-    new_data_maybe_f0_result = new_data_maybe_lines_removed
+    new_data_maybe_spatially_binned = new_data_maybe_lines_removed
+    if "spatial_bin" in parameters:
+        spatial_bin.recorders.array_debug_recorder = preprocess_data.recorders.array_debug_recorder
+        new_data_maybe_spatially_binned = spatial_bin(
+            new_data_maybe_spatially_binned,
+            **parameters["spatial_bin"]
+        )
+        preprocess_data.recorders.array_debug_recorder["images_spatial_binned"] = new_data_maybe_spatially_binned
+        if preprocess_data.recorders.array_debug_recorder:
+            preprocess_data.recorders.array_debug_recorder["images_spatial_binned_max"] = xnumpy.add_singleton_op(
+                numpy.max,
+                new_data_maybe_spatially_binned,
+                axis=0
+            )
+
+    new_data_maybe_binned = new_data_maybe_spatially_binned
+    if ("temporal_bin" in parameters) and not temporal_bin_after_f0:
+        new_data_maybe_binned = bin_frames(new_data_maybe_binned)
+
+    new_data_maybe_f0_result = new_data_maybe_binned
     if "extract_f0" in parameters:
         extract_f0.recorders.array_debug_recorder = preprocess_data.recorders.array_debug_recorder
         extract_f0(
@@ -718,6 +1065,9 @@ def preprocess_data(new_data, out=None, **parameters):
                 axis=0
             )
 
+    if ("temporal_bin" in parameters) and temporal_bin_after_f0:
+        new_data_maybe_f0_result = bin_frames(new_data_maybe_f0_result)
+
     new_data_maybe_wavelet_result = new_data_maybe_f0_result
     if "wavelet.transform" in parameters:
         wavelet.transform.recorders.array_debug_recorder = preprocess_data.recorders.array_debug_recorder
@@ -752,620 +1102,1695 @@ def preprocess_data(new_data, out=None, **parameters):
             axis=0
         )
 
-    return(out)
+    return(new_data_normalized)
 
 
 @prof.log_call(trace_logger)
-@hdf5.record.static_array_debug_recorder
-def generate_dictionary(new_data,
-                        initial_dictionary=None,
-                        n_components=None,
-                        **parameters):
+def correlation_image(new_data, block_frame_length=-1):
     """
-        Generates a dictionary using the data and parameters given for trainDL.
+        Computes the mean correlation of each pixel's trace with the traces of
+        its neighbors (one step along each axis). Cells tend to stand out as
+        their pixels are correlated with each other, but not the background.
 
         Args:
-            new_data(numpy.ndarray):            array of data for generating a
-                                                dictionary (first axis is
-                                                time).
+            new_data(numpy.ndarray):            data to find the correlation
+                                                image of (first axis is time).
+                                                May also be an HDF5 dataset.
 
-            initial_dictionary(numpy.ndarray):  dictionary to start the
-                                                algorithm with.
+            block_frame_length(int):            number of frames to read at a
+                                                time. If negative, all frames
+                                                are read at once.
 
-            n_components(int):                  number of components for the
-                                                dictionary to use.
+        Returns:
+            numpy.ndarray:                      the correlation image (same
+                                                shape as a frame).
 
-            **parameters(dict):                 passed directly to
-                                                spams.trainDL.
+        Examples:
+            >>> a = numpy.zeros((4, 2, 3))
+            >>> a[:, 0, 0] = [1, 2, 3, 4]
+            >>> a[:, 0, 1] = [2, 4, 6, 8]
+            >>> a[:, 1, 0] = [4, 3, 2, 1]
+            >>> correlation_image(a)
+            array([[ 0.        ,  0.33333333,  0.        ],
+                   [-0.5       ,  0.        ,  0.        ]])
+
+            >>> correlation_image(a, block_frame_length=3)
+            array([[ 0.        ,  0.33333333,  0.        ],
+                   [-0.5       ,  0.        ,  0.        ]])
+    """
 
-        Returns:
-            dict:                               the dictionary found.
+    num_frames = len(new_data)
+    frame_shape = tuple(new_data.shape[1:])
+
+    if block_frame_length <= 0:
+        block_frame_length = num_frames
+
+    # Sum of values, sum of squares, and sum of products with the next pixel
+    # along each axis.
+    frame_sum = numpy.zeros(frame_shape, dtype=numpy.float64)
+    frame_sum_squares = numpy.zeros(frame_shape, dtype=numpy.float64)
+    frame_sum_neighbor_products = []
+    for each_axis in iters.irange(len(frame_shape)):
+        each_shape = list(frame_shape)
+        each_shape[each_axis] = max(0, each_shape[each_axis] - 1)
+        frame_sum_neighbor_products.append(
+            numpy.zeros(each_shape, dtype=numpy.float64)
+        )
+
+    for i in iters.irange(0, num_frames, block_frame_length):
+        new_data_block = numpy.asarray(
+            new_data[i:i + block_frame_length], dtype=numpy.float64
+        )
+
+        frame_sum += new_data_block.sum(axis=0)
+        frame_sum_squares += numpy.einsum(
+            "i...,i...->...", new_data_block, new_data_block
+        )
+        for each_axis in iters.irange(len(frame_shape)):
+            each_lower = [slice(None)] * new_data_block.ndim
+            each_upper = [slice(None)] * new_data_block.ndim
+            each_lower[1 + each_axis] = slice(None, -1)
+            each_upper[1 + each_axis] = slice(1, None)
+
+            frame_sum_neighbor_products[each_axis] += numpy.einsum(
+                "i...,i...->...",
+                new_data_block[tuple(each_lower)],
+                new_data_block[tuple(each_upper)]
+            )
+
+    frame_mean = frame_sum / num_frames
+    frame_std = numpy.sqrt(numpy.maximum(
+        frame_sum_squares / num_frames - frame_mean ** 2, 0
+    ))
+
+    corr_sum = numpy.zeros(frame_shape, dtype=numpy.float64)
+    corr_count = numpy.zeros(frame_shape, dtype=numpy.float64)
+    for each_axis in iters.irange(len(frame_shape)):
+        each_lower = [slice(None)] * len(frame_shape)
+        each_upper = [slice(None)] * len(frame_shape)
+        each_lower[each_axis] = slice(None, -1)
+        each_upper[each_axis] = slice(1, None)
+        each_lower = tuple(each_lower)
+        each_upper = tuple(each_upper)
+
+        each_cov = frame_sum_neighbor_products[each_axis] / num_frames - \
+                   frame_mean[each_lower] * frame_mean[each_upper]
+        each_std_product = frame_std[each_lower] * frame_std[each_upper]
+
+        # Constant traces are treated as uncorrelated.
+        each_corr = numpy.zeros_like(each_cov)
+        each_nonzero = (each_std_product != 0)
+        each_corr[each_nonzero] = each_cov[each_nonzero] / \
+                                  each_std_product[each_nonzero]
+
+        corr_sum[each_lower] += each_corr
+        corr_sum[each_upper] += each_corr
+        corr_count[each_lower] += 1
+        corr_count[each_upper] += 1
+
+    corr_count[corr_count == 0] = 1
+    corr_image = corr_sum / corr_count
+
+    return(corr_image)
+
+
+@prof.log_call(trace_logger)
+@hdf5.record.static_array_debug_recorder
+def initialize_dictionary(new_data,
+                          n_components,
+                          summary_image="correlation",
+                          min_peak_distance=0.0,
+                          block_frame_length=-1):
     """
+        Generates an initial dictionary for generate_dictionary. Each basis
+        image is seeded from a local maximum of a summary image (either the
+        correlation image or the max projection) by correlating the trace at
+        that point with all other traces. Brighter peaks are used first. If
+        there are not enough peaks, the rest are randomly selected frames
+        (as is done with no initial dictionary). All basis images are
+        normalized.
 
-    import nanshe.box
+        Args:
+            new_data(numpy.ndarray):            array of data for generating a
+                                                dictionary (first axis is
+                                                time).
 
-    # Sync the number of components with the method.
-    if n_components is None:
-        if "spams.trainDL" in parameters:
-            n_components = parameters["spams.trainDL"]["K"]
-        elif "sklearn.decomposition.dict_learning_online" in parameters:
-            n_components = parameters["sklearn.decomposition.dict_learning_online"]["n_components"]
-        else:
-            assert False, "Unknown algorithm must define `n_components`."
-    else:
-        if "spams.trainDL" in parameters:
-            assert parameters["spams.trainDL"].get("K", n_components) == n_components,\
-                "If `n_components` and `spams.trainDL[\"K\"]` are defined," \
-                " they should be defined the same."
-            parameters["spams.trainDL"]["K"] = n_components
-        elif "sklearn.decomposition.dict_learning_online" in parameters:
-            assert parameters["sklearn.decomposition.dict_learning_online"].get("n_components", n_components) == n_components,\
-                "If `n_components` and " \
-                "`sklearn.decomposition.dict_learning_online[\"n_components\"]`" \
-                " are defined, they should be defined the same."
-            parameters["sklearn.decomposition.dict_learning_online"]["n_components"] = n_components
-        else:
-            assert False, "Unknown algorithm cannot use `n_components`."
+            n_components(int):                  number of basis images to
+                                                generate.
 
-    # Needs to be floating point.
-    # However, it need not be double precision as there is single precision
-    # function signature.
-    float_dtype = None
-    float_ctype = None
-    if not issubclass(new_data.dtype.type, numpy.floating):
-        float_dtype = numpy.dtype(numpy.float32)
-        float_ctype = ctypes.c_float
-    elif new_data.dtype.itemsize > numpy.dtype(numpy.float32).itemsize:
-        float_dtype = numpy.dtype(numpy.float64)
-        float_ctype = ctypes.c_double
-    else:
-        float_dtype = numpy.dtype(numpy.float32)
-        float_ctype = ctypes.c_float
+            summary_image(str):                 which image to find peaks in
+                                                (either "correlation" or
+                                                "max_projection").
 
-    # Want to support NumPy types in parameters. However, SPAMS expects normal
-    # C types. So, we convert them in advance. This was needed for the
-    # Ilastik-based GUI.
-    for _k, _v in parameters.get("spams.trainDL", {}).items():
-        _v = numpy.array(_v)[()] # Convert to NumPy type
-        if isinstance(_v, numpy.integer):
-            _v = int(_v)
-        elif isinstance(_v, numpy.floating):
-            _v = float_ctype(_v).value
-        elif isinstance(_v, numpy.bool_):
-            _v = bool(_v)
+            min_peak_distance(float):           peaks closer than this to a
+                                                brighter peak are skipped.
 
-        parameters["spams.trainDL"][_k] = _v
+            block_frame_length(int):            number of frames to read at a
+                                                time. If negative, all frames
+                                                are read at once.
 
-    # Requires floating point type.
-    new_data_processed = numpy.asarray(new_data, dtype=float_dtype)
+        Returns:
+            numpy.ndarray:                      the initial dictionary (first
+                                                axis is basis images).
 
-    # Reshape data into a matrix (each image is now a column vector)
-    new_data_processed = xnumpy.array_to_matrix(new_data_processed)
-    new_data_processed = numpy.asmatrix(new_data_processed)
+        Examples:
+            >>> data = numpy.zeros((20, 6, 7))
+            >>> data[:10, 1, 2] = 2
+            >>> data[10:, 4, 5] = 3
+            >>> d = initialize_dictionary(
+            ...     data, 2, summary_image="max_projection"
+            ... )
+            >>> d.shape
+            (2, 6, 7)
+            >>> (d != 0).sum(axis=2).sum(axis=1)
+            array([1, 1])
+            >>> d[0, 4, 5]
+            1.0
+            >>> d[1, 1, 2]
+            1.0
+    """
 
-    # Spams requires all matrices to be fortran.
-    if "spams.trainDL" in parameters:
-        new_data_processed = new_data_processed.transpose()
-        new_data_processed = numpy.asfortranarray(new_data_processed)
+    num_frames = len(new_data)
+    frame_shape = tuple(new_data.shape[1:])
 
-    # If there is an initial dictionary provided, go ahead and process it.
-    initial_dictionary_processed = initial_dictionary
-    if initial_dictionary_processed is not None:
-        # Go ahead and make the dictionary the same type as the input data.
-        # TODO: Add a warning if it needs to be down cast
-        initial_dictionary_processed = numpy.asarray(
-            initial_dictionary_processed, dtype=float_dtype
-        )
+    if block_frame_length <= 0:
+        block_frame_length = num_frames
 
-        # Reshape dictionary into a matrix (each image is now a column vector)
-        initial_dictionary_processed = xnumpy.array_to_matrix(
-            initial_dictionary_processed
+    if summary_image == "correlation":
+        new_summary_image = correlation_image(
+            new_data, block_frame_length=block_frame_length
         )
-        initial_dictionary_processed = numpy.asmatrix(
-            initial_dictionary_processed
+    elif summary_image == "max_projection":
+        new_summary_image = xnumpy.add_singleton_op(
+            numpy.max, new_data, axis=0
+        )[0]
+    else:
+        raise ValueError(
+            "Unknown summary_image \"" + repr(summary_image) + "\". " +
+            "Expected either \"correlation\" or \"max_projection\"."
         )
 
-        if "spams.trainDL" in parameters:
-            initial_dictionary_processed = initial_dictionary_processed.transpose()
+    initialize_dictionary.recorders.array_debug_recorder["summary_image"] = new_summary_image
+
+    # Find peaks from brightest to dimmest.
+    local_maxima_mask = generate_local_maxima(new_summary_image)
+    local_maxima_mask &= (new_summary_image > 0)
+    local_maxima_points = numpy.array(local_maxima_mask.nonzero()).T
+    local_maxima_values = new_summary_image[local_maxima_mask]
+    local_maxima_points = local_maxima_points[
+        numpy.argsort(-local_maxima_values, kind="mergesort")
+    ]
+
+    peak_points = []
+    for each_point in local_maxima_points:
+        if len(peak_points) == n_components:
+            break
 
-            # Spams requires all matrices to be fortran.
-            initial_dictionary_processed = numpy.asfortranarray(
-                initial_dictionary_processed
+        if peak_points and (min_peak_distance > 0):
+            each_distances = numpy.sqrt(
+                ((numpy.array(peak_points) - each_point) ** 2).sum(axis=1)
             )
+            if (each_distances < min_peak_distance).any():
+                continue
 
-    # Simply trains the dictionary. Does not return sparse code.
-    # Need to look into generating the sparse code given the dictionary,
-    # spams.nmf? (may be too slow))
-    if "sklearn.decomposition.dict_learning_online" in parameters:
-        # sklearn needs to be boxed so it doesn't cause us issues.
-        import sklearn
-        import sklearn.decomposition
+        peak_points.append(each_point)
 
-        parameters["sklearn.decomposition.dict_learning_online"]["return_code"] = parameters["sklearn.decomposition.dict_learning_online"].get("return_code", False)
-        assert not parameters["sklearn.decomposition.dict_learning_online"]["return_code"],\
-            "Returning the sparse code is not supported by this function's API."
+    peak_points = numpy.array(peak_points, dtype=int).reshape(
+        -1, len(frame_shape)
+    )
+    peak_indices = numpy.ravel_multi_index(tuple(peak_points.T), frame_shape)
 
-        parameters["sklearn.decomposition.dict_learning_online"]["return_inner_stats"] = parameters["sklearn.decomposition.dict_learning_online"].get("return_inner_stats", False)
-        assert not parameters["sklearn.decomposition.dict_learning_online"]["return_inner_stats"],\
-            "Returning the internal stats is not supported by this function's API."
+    logger.debug(
+        "Seeding " + str(len(peak_points)) + " of " + str(n_components) +
+        " basis images from peaks."
+    )
 
-        new_dictionary = sklearn.decomposition.dict_learning_online(
-            X=new_data_processed, dict_init=initial_dictionary_processed,
-            **parameters["sklearn.decomposition.dict_learning_online"]
-        )
-    elif "spams.trainDL" in parameters:
-        new_dictionary = nanshe.box.spams_sandbox.call_multiprocessing_array_spams_trainDL(
-            X=new_data_processed, D=initial_dictionary_processed,
-            **parameters["spams.trainDL"]
+    # Project all traces onto each peak's (zero mean) trace.
+    peak_traces = numpy.empty((num_frames, len(peak_indices)))
+    for i in iters.irange(0, num_frames, block_frame_length):
+        new_data_block = numpy.asarray(new_data[i:i + block_frame_length])
+        peak_traces[i:i + len(new_data_block)] = new_data_block.reshape(
+            len(new_data_block), -1
+        )[:, peak_indices]
+    peak_traces -= peak_traces.mean(axis=0)
+
+    new_dictionary = numpy.zeros(
+        (n_components, int(numpy.prod(frame_shape))), dtype=numpy.float64
+    )
+    for i in iters.irange(0, num_frames, block_frame_length):
+        new_data_block = numpy.asarray(new_data[i:i + block_frame_length])
+        new_dictionary[:len(peak_indices)] += peak_traces[
+            i:i + len(new_data_block)
+        ].T.dot(
+            new_data_block.reshape(len(new_data_block), -1)
         )
 
-        # Fix dictionary so that the first index will be the particular image.
-        new_dictionary = new_dictionary.transpose()
-    else:
-        assert False,\
-            "Must select a supported matrix factorization algorithm."
+    # Only positive correlations are useful for finding cells.
+    numpy.maximum(new_dictionary, 0, out=new_dictionary)
 
-    # Fix the rest will be the shape of an image (same as input shape).
-    new_dictionary = numpy.asarray(new_dictionary, dtype=new_data.dtype.type)
-    new_dictionary = new_dictionary.reshape(
-        (-1,) + new_data.shape[1:]
-    )
+    # Fill the rest with random frames.
+    num_random = n_components - len(peak_indices)
+    if num_random > 0:
+        random_frames = numpy.sort(numpy.random.choice(
+            num_frames, num_random, replace=(num_random > num_frames)
+        ))
+        for j, each_frame in enumerate(random_frames, start=len(peak_indices)):
+            new_dictionary[j] = numpy.asarray(new_data[each_frame]).ravel()
+
+    new_dictionary = new_dictionary.reshape((n_components,) + frame_shape)
+    new_dictionary = renormalized_images(new_dictionary)
+
+    float_dtype = new_data.dtype
+    if not issubclass(float_dtype.type, numpy.floating):
+        float_dtype = numpy.float32
+    new_dictionary = new_dictionary.astype(float_dtype)
 
     return(new_dictionary)
 
 
 @prof.log_call(trace_logger)
-def region_properties_scikit_image(new_label_image, *args, **kwargs):
+def reduce_rank(new_data,
+                rank,
+                num_oversamples=10,
+                num_power_iterations=2,
+                include_negatives=True,
+                block_frame_length=-1,
+                frames=None):
     """
-        Grabs region properties from a label image.
+        Compresses the data along time to its leading temporal components
+        using a randomized SVD, which streams over blocks of frames. Each
+        component is returned as a frame (its singular value times its right
+        singular vector). All of them are scaled by the same amount so that
+        their root mean square norm is 1 (like preprocessed frames). So, each
+        component keeps its weight relative to the others and dictionary
+        learning can be run on these instead of all frames, which makes its
+        cost scale with the rank instead of the number of frames. As the
+        basis images found are still images, no projection back is needed.
 
         Args:
-            new_label_image(numpy.ndarray):      label image used for
-                                                 generating properties.
+            new_data(numpy.ndarray):            array of data to compress
+                                                (first axis is time). May also
+                                                be an HDF5 dataset.
 
-            args(list):                          additional position arguments
-                                                 to pass
-                                                 skimage.measure.regionprops.
+            rank(int):                          number of temporal components
+                                                to keep.
 
-            **parameters(dict):                  additional keyword arguments
-                                                 to pass
-                                                 skimage.measure.regionprops.
+            num_oversamples(int):               extra random vectors used to
+                                                improve the estimate.
 
-        Note:
-            Uses all the same options in skimage.measure.regionprops. If a
-            property is not specified, then it won't be returned.
+            num_power_iterations(int):          number of power iterations
+                                                (more passes over the data,
+                                                but more accurate).
+
+            include_negatives(bool):            whether to also include the
+                                                negation of each component
+                                                (as their signs are arbitrary
+                                                and dictionary learning may be
+                                                constrained to be positive).
+
+            block_frame_length(int):            number of frames to read at a
+                                                time. If negative, all frames
+                                                are read at once.
+
+            frames(numpy.ndarray):              indices of the frames to use
+                                                (in increasing order). If
+                                                None, all frames are used.
 
         Returns:
-            numpy.ndarray:                       a structured array of all the
-                                                 properties found for each
-                                                 label.
+            numpy.ndarray:                      the components as frames (
+                                                first axis is the component).
 
         Examples:
+            >>> numpy.random.seed(0)
+            >>> a = numpy.random.random((20, 2)).dot(
+            ...     numpy.random.random((2, 12))
+            ... ).reshape(20, 3, 4)
+            >>> b = reduce_rank(a, 2, include_negatives=False)
+            >>> b.shape
+            (2, 3, 4)
+            >>> a_m = a.reshape(len(a), -1)
+            >>> b_m = b.reshape(len(b), -1)
+            >>> b_n = b_m / numpy.linalg.norm(b_m, axis=1)[:, None]
+            >>> numpy.allclose(a_m - a_m.dot(b_n.T).dot(b_n), 0)
+            True
+            >>> round((b_m ** 2).sum(axis=1).mean(), 8)
+            1.0
+
+            >>> reduce_rank(a, 2, block_frame_length=3).shape
+            (4, 3, 4)
+
+            >>> c = reduce_rank(a, 2, include_negatives=False, frames=[0, 5])
+            >>> c_m = c.reshape(len(c), -1)
+            >>> c_n = c_m / numpy.linalg.norm(c_m, axis=1)[:, None]
+            >>> numpy.allclose(a_m[[0, 5]] - a_m[[0, 5]].dot(c_n.T).dot(c_n), 0)
+            True
+    """
 
-            >>> numpy.set_printoptions(
-            ...     formatter={"float": lambda x: str(float(x))}
-            ... )
+    if frames is not None:
+        frames = numpy.asarray(frames, dtype=int)
 
-            >>> region_properties_scikit_image(
-            ...     numpy.zeros((2,2), dtype=int)
-            ... ) # doctest: +NORMALIZE_WHITESPACE
-            array([],
-                  dtype=[('label', '<i8'), ('area', '<f8'), ('centroid', '<f8', (2,))])
+    num_frames = len(new_data) if frames is None else len(frames)
+    frame_shape = tuple(new_data.shape[1:])
+    num_pixels = int(numpy.prod(frame_shape))
 
-            >>> region_properties_scikit_image(
-            ...     numpy.ones((2,2), dtype=int)
-            ... ) # doctest: +NORMALIZE_WHITESPACE
-            array([(1, 4.0, [0.5, 0.5])],
-                  dtype=[('label', '<i8'), ('area', '<f8'), ('centroid', '<f8', (2,))])
+    if block_frame_length <= 0:
+        block_frame_length = num_frames
 
-            >>> region_properties_scikit_image(
-            ...     numpy.ones((3,3), dtype=int)
-            ... ) # doctest: +NORMALIZE_WHITESPACE
-            array([(1, 9.0, [1.0, 1.0])],
-                  dtype=[('label', '<i8'), ('area', '<f8'), ('centroid', '<f8', (2,))])
+    float_dtype = new_data.dtype
+    if not issubclass(float_dtype.type, numpy.floating):
+        float_dtype = numpy.dtype(numpy.float32)
 
-            >>> region_properties_scikit_image(
-            ...     numpy.eye(3, dtype=int)
-            ... ) # doctest: +NORMALIZE_WHITESPACE
-            array([(1, 3.0, [1.0, 1.0])],
-                  dtype=[('label', '<i8'), ('area', '<f8'), ('centroid', '<f8', (2,))])
+    rank = min(rank, num_frames, num_pixels)
+    num_samples = min(rank + num_oversamples, num_frames, num_pixels)
 
-            >>> region_properties_scikit_image(
-            ...     numpy.eye(3, dtype=int), ["area", "centroid"]
-            ... ) # doctest: +NORMALIZE_WHITESPACE
-            array([(1, 3.0, [1.0, 1.0])],
-                  dtype=[('label', '<i8'), ('area', '<f8'), ('centroid', '<f8', (2,))])
+    def frame_blocks():
+        for i in iters.irange(0, num_frames, block_frame_length):
+            if frames is None:
+                each_frames = slice(i, i + block_frame_length)
+            else:
+                each_frames = frames[i:i + block_frame_length].tolist()
 
-            >>> region_properties_scikit_image(
-            ...     numpy.eye(3, dtype=int), properties=["area", "centroid"]
-            ... ) # doctest: +NORMALIZE_WHITESPACE
-            array([(1, 3.0, [1.0, 1.0])],
-                  dtype=[('label', '<i8'), ('area', '<f8'), ('centroid', '<f8', (2,))])
+            new_data_block = numpy.asarray(
+                new_data[each_frames], dtype=float_dtype
+            )
+            new_data_block = new_data_block.reshape(len(new_data_block), -1)
 
-            >>> numpy.set_printoptions()
-    """
+            yield (slice(i, i + len(new_data_block)), new_data_block)
 
-    region_properties_type_dict = {
-        "area": numpy.float64,
-        "bbox": numpy.int64,
-        "centroid": numpy.float64,
-        "convex_area": numpy.int64,
-        "convex_image": numpy.bool_,
-        "coords": numpy.int64,
-        "eccentricity": numpy.float64,
-        "equivalent_diameter": numpy.float64,
-        "euler_number": numpy.int64,
-        "filled_area": numpy.int64,
-        "filled_image": numpy.bool_,
-        "image": numpy.bool_,
-        "inertia_tensor": numpy.float64,
-        "inertia_tensor_eigvals": numpy.float64,
-        "intensity_image": numpy.float64,
-        "label": numpy.int64,
-        "local_centroid": numpy.float64,
-        "major_axis_length": numpy.float64,
-        "max_intensity": numpy.float64,
-        "mean_intensity": numpy.float64,
-        "min_intensity": numpy.float64,
-        "minor_axis_length": numpy.float64,
-        "moments": numpy.float64,
-        "moments_central": numpy.float64,
-        "moments_hu": numpy.float64,
-        "moments_normalized": numpy.float64,
-        "orientation": numpy.float64,
-        "perimeter": numpy.float64,
-        "solidity": numpy.float64,
-        "weighted_centroid": numpy.float64,
-        "weighted_local_centroid": numpy.float64,
-        "weighted_moments": numpy.float64,
-        "weighted_moments_central": numpy.float64,
-        "weighted_moments_hu": numpy.float64,
-        "weighted_moments_normalized": numpy.float64
-    }
+    # Find the range of the data (over time) from random projections.
+    random_projection = numpy.random.standard_normal(
+        (num_pixels, num_samples)
+    ).astype(float_dtype)
 
-    region_properties_shape_dict = {
-        "area": (),
-        "bbox": (4,),
-        "centroid": (new_label_image.ndim,),
-        "convex_area": (),
-        "convex_image": (-1, -1),
-        "coords": (-1, 2),
-        "eccentricity": (),
-        "equivalent_diameter": (),
-        "euler_number": (),
-        "filled_area": (),
-        "filled_image": (-1, -1),
-        "image": (-1, -1),
-        "inertia_tensor": (2, 2),
-        "inertia_tensor_eigvals": (2,),
-        "intensity_image": (-1, -1),
-        "label": (),
-        "local_centroid": (2,),
-        "major_axis_length": (),
-        "max_intensity": (),
-        "mean_intensity": (),
-        "min_intensity": (),
-        "minor_axis_length": (),
-        "moments": (4, 4),
-        "moments_central": (4, 4),
-        "moments_hu": (7,),
-        "moments_normalized": (4, 4),
-        "orientation": (),
-        "perimeter": (),
-        "solidity": (),
-        "weighted_centroid": (2,),
-        "weighted_local_centroid": (2,),
-        "weighted_moments": (4, 4),
-        "weighted_moments_central": (4, 4),
-        "weighted_moments_hu": (7,),
-        "weighted_moments_normalized": (4, 4)
-    }
+    temporal_range = numpy.empty((num_frames, num_samples), dtype=float_dtype)
+    for each_slice, each_block in frame_blocks():
+        temporal_range[each_slice] = each_block.dot(random_projection)
 
-    region_properties_ndim_dict = {
-        "area": 0,
-        "bbox": 1,
-        "centroid": 1,
-        "convex_area": 0,
-        "convex_image": 2,
-        "coords": 2,
-        "eccentricity": 0,
-        "equivalent_diameter": 0,
-        "euler_number": 0,
-        "filled_area": 0,
-        "filled_image": 2,
-        "image": 2,
-        "inertia_tensor": 2,
-        "inertia_tensor_eigvals": 1,
-        "intensity_image": 2,
-        "label": 0,
-        "local_centroid": 1,
-        "major_axis_length": 0,
-        "max_intensity": 0,
-        "mean_intensity": 0,
-        "min_intensity": 0,
-        "minor_axis_length": 0,
-        "moments": 2,
-        "moments_central": 2,
-        "moments_hu": 1,
-        "moments_normalized": 2,
-        "orientation": 0,
-        "perimeter": 0,
-        "solidity": 0,
-        "weighted_centroid": 1,
-        "weighted_local_centroid": 1,
-        "weighted_moments": 2,
-        "weighted_moments_central": 2,
-        "weighted_moments_hu": 1,
-        "weighted_moments_normalized": 2
-    }
+    # Refine with power iterations (re-orthonormalizing to stay stable).
+    for i in iters.irange(num_power_iterations):
+        temporal_range = numpy.linalg.qr(temporal_range)[0]
 
-    array_properties = [
-        _k for _k, _v in region_properties_ndim_dict.items() if _v > 0
-    ]
-    fixed_shape_properties = [
-        _k for _k, _v in region_properties_shape_dict.items() if -1 not in _v
-    ]
-    varied_shape_properties = [
-        _k for _k, _v in region_properties_shape_dict.items() if -1 in _v
-    ]
+        spatial_range = numpy.zeros(
+            (num_pixels, num_samples), dtype=float_dtype
+        )
+        for each_slice, each_block in frame_blocks():
+            spatial_range += each_block.T.dot(temporal_range[each_slice])
 
-    new_label_image_props = None
-    new_label_image_props_with_arrays = None
-    new_label_image_props_with_arrays_values = None
-    new_label_image_props_with_arrays_dtype = None
+        spatial_range = numpy.linalg.qr(spatial_range)[0]
 
-    properties = None
-    if (len(args)) and (args[0]):
-        properties = args[0]
-        properties = [str(_) for _ in properties]
-        args = args[1:]
-    elif (len(kwargs)) and ("properties" in kwargs):
-        properties = kwargs["properties"]
-        properties = [str(_) for _ in properties]
-        del kwargs["properties"]
-    else:
-        properties = ["area", "centroid"]
+        for each_slice, each_block in frame_blocks():
+            temporal_range[each_slice] = each_block.dot(spatial_range)
 
-    if ((properties == "all") or (properties is None)):
-        properties = list(region_properties_type_dict.keys())
+    temporal_range = numpy.linalg.qr(temporal_range)[0]
 
-    intensity_image = None
-    if (len(args)) and (args[0]):
-        intensity_image = args[0]
-        args = args[1:]
-    elif (len(kwargs)) and ("intensity_image" in kwargs):
-        intensity_image = kwargs["intensity_image"]
-        del kwargs["intensity_image"]
-    else:
-        pass
+    # Project the data onto the range and find the leading components.
+    new_data_projected = numpy.zeros(
+        (num_samples, num_pixels), dtype=float_dtype
+    )
+    for each_slice, each_block in frame_blocks():
+        new_data_projected += temporal_range[each_slice].T.dot(each_block)
 
-    # Remove duplicates and make sure label is at the front.
-    properties = set(properties)
-    allowed_properties = set(region_properties_type_dict.keys())
-    disallowed_properties = properties.difference(allowed_properties)
+    singular_values, spatial_components = numpy.linalg.svd(
+        new_data_projected, full_matrices=False
+    )[1:]
 
-    if len(disallowed_properties):
-        disallowed_properties = sorted(disallowed_properties)
-        raise Exception(
-            "Recieved \"" + repr(len(disallowed_properties)) +
-            "\" properties that are not allowed, which are \"" +
-            repr(disallowed_properties) + "\"."
-        )
+    new_data_reduced = singular_values[:rank, None] * spatial_components[:rank]
 
-    properties.discard("label")
-    properties = ["label"] + sorted(properties)
+    # Scale all components together (not each separately) to keep their
+    # relative weights.
+    new_data_reduced_norm = numpy.sqrt((singular_values[:rank] ** 2).mean())
+    if new_data_reduced_norm > 0:
+        new_data_reduced /= new_data_reduced_norm
 
-    if new_label_image.size:
-        # This gives a list of dictionaries. However, this is not very usable.
-        # So, we will convert this to a structured NumPy array.
-        # In future versions, the properties argument will be removed.
-        # It does not need to be passed to retain functionality of this
-        # function.
-        new_label_image_props = skimage.measure.regionprops(
-            label_image=new_label_image,
-            intensity_image=intensity_image,
-            *args, **kwargs
-        )
+    if include_negatives:
+        new_data_reduced = numpy.vstack([
+            new_data_reduced, -new_data_reduced
+        ])
 
-        new_label_image_props_with_arrays = []
-        for i in iters.irange(len(new_label_image_props)):
-            new_label_image_props_with_arrays.append({})
+    new_data_reduced = new_data_reduced.reshape(
+        (len(new_data_reduced),) + frame_shape
+    )
 
-            for each_key in properties:
-                if each_key in array_properties:
-                    new_label_image_props_with_arrays[i][each_key] = numpy.array(
-                        new_label_image_props[i][each_key],
-                        dtype=region_properties_type_dict[each_key]
-                    )
-                else:
-                    new_label_image_props_with_arrays[i][each_key] = region_properties_type_dict[each_key](
-                        new_label_image_props[i][each_key]
-                    )
+    new_data_reduced = new_data_reduced.astype(float_dtype)
 
-        # Holds the values from props.
-        new_label_image_props_with_arrays_values = []
+    return(new_data_reduced)
 
-        # Holds the types from props.
-        new_label_image_props_with_arrays_dtype = []
 
-        if len(new_label_image_props_with_arrays):
-            # Get types for all properties as a dictionary
-            for each_name in properties:
-                each_sample_value = new_label_image_props_with_arrays[
-                    0][each_name]
-                each_type = type(each_sample_value)
-                each_shape = tuple()
+@prof.log_call(trace_logger)
+def dictionary_objective(new_data,
+                         dictionary,
+                         lambda1=0.0,
+                         positive=False,
+                         num_code_iterations=50):
+    """
+        Estimates how well the dictionary represents the data by finding
+        sparse codes for each frame (with a fixed number of iterative
+        shrinkage-thresholding steps) and computing the mean objective of
+        ``0.5 * ||x - a D||_2^2 + lambda1 * ||a||_1`` over frames.
 
-                if isinstance(each_sample_value, numpy.ndarray) and \
-                        (each_name in fixed_shape_properties):
-                    each_type = each_sample_value.dtype
-                    each_shape = each_sample_value.shape
-                else:
-                    each_type = numpy.dtype(each_type)
+        Args:
+            new_data(numpy.ndarray):            frames to represent (first
+                                                axis is time).
 
-                new_label_image_props_with_arrays_dtype.append(
-                    (each_name, each_type, each_shape)
-                )
+            dictionary(numpy.ndarray):          basis images (first axis is
+                                                the basis image).
 
-            # Store the values to place in NumPy structured array in order.
-            new_label_image_props_with_arrays_values = []
-            for j in iters.irange(len(new_label_image_props_with_arrays)):
-                # Add all values in order of keys from the dictionary.
-                new_label_image_props_with_arrays_values.append([])
-                for each_new_label_image_props_with_arrays_dtype in new_label_image_props_with_arrays_dtype:
-                    each_name, each_type, each_shape = each_new_label_image_props_with_arrays_dtype
+            lambda1(float):                     weight of the sparsity term.
 
-                    if each_shape:
-                        new_label_image_props_with_arrays_values[j].append(
-                            new_label_image_props_with_arrays[j][each_name].tolist())
-                    else:
-                        new_label_image_props_with_arrays_values[j].append(
-                            new_label_image_props_with_arrays[j][each_name])
+            positive(bool):                     whether to constrain codes to
+                                                be non-negative.
 
-                # NumPy will expect a tuple for each set of values.
-                new_label_image_props_with_arrays_values[j] = tuple(
-                    new_label_image_props_with_arrays_values[j]
+            num_code_iterations(int):           number of steps used to find
+                                                the codes.
+
+        Returns:
+            float:                              mean objective over frames.
+
+        Examples:
+            >>> a = numpy.eye(3)[:2]
+            >>> dictionary_objective(a, numpy.eye(3))
+            0.0
+
+            >>> round(dictionary_objective(a, numpy.eye(3)[:1]), 8)
+            0.25
+
+            >>> round(dictionary_objective(a, numpy.eye(3), lambda1=0.5), 8)
+            0.375
+    """
+
+    new_data = xnumpy.array_to_matrix(numpy.asarray(new_data, dtype=float))
+    dictionary = xnumpy.array_to_matrix(
+        numpy.asarray(dictionary, dtype=float)
+    )
+
+    dictionary_gram = dictionary.dot(dictionary.T)
+    data_dictionary_products = new_data.dot(dictionary.T)
+
+    # Step size comes from the Lipschitz constant of the gradient.
+    lipschitz_constant = numpy.linalg.eigvalsh(dictionary_gram)[-1]
+
+    codes = numpy.zeros(data_dictionary_products.shape)
+    if lipschitz_constant > 0:
+        threshold = lambda1 / lipschitz_constant
+        for i in iters.irange(num_code_iterations):
+            codes -= (
+                codes.dot(dictionary_gram) - data_dictionary_products
+            ) / lipschitz_constant
+
+            if positive:
+                codes = numpy.maximum(codes - threshold, 0)
+            else:
+                codes = numpy.sign(codes) * numpy.maximum(
+                    numpy.abs(codes) - threshold, 0
                 )
 
-    if (not new_label_image.size) or \
-            (not len(new_label_image_props_with_arrays)):
-        new_label_image_props_with_arrays_dtype = []
-        for each_key in properties:
-            each_type = region_properties_type_dict[each_key]
-            each_shape = region_properties_shape_dict[each_key]
+    squared_errors = (
+        (new_data ** 2).sum(axis=1) -
+        2 * (codes * data_dictionary_products).sum(axis=1) +
+        (codes.dot(dictionary_gram) * codes).sum(axis=1)
+    )
+    squared_errors = numpy.maximum(squared_errors, 0)
 
-            if each_key in varied_shape_properties:
-                each_type = numpy.object_
-                each_shape = tuple()
+    objective = 0.5 * squared_errors + lambda1 * numpy.abs(codes).sum(axis=1)
+    objective = float(objective.mean())
 
-            new_label_image_props_with_arrays_dtype.append(
-                (each_key, each_type, each_shape)
+    return(objective)
+
+
+@prof.log_call(trace_logger)
+@hdf5.record.static_array_debug_recorder
+@wrappers.static_variables(backends=dict())
+def generate_dictionary(new_data,
+                        initial_dictionary=None,
+                        n_components=None,
+                        **parameters):
+    """
+        Generates a dictionary using the data and parameters given for the
+        selected dictionary learning backend.
+
+        Backends are registered with
+        register_dictionary_learning_backend. One is selected by including
+        its name as a key in ``parameters`` with its arguments as the value.
+        Those included are "spams.trainDL",
+        "sklearn.decomposition.dict_learning_online", and
+        "sklearn.decomposition.MiniBatchDictionaryLearning".
+
+        Args:
+            new_data(numpy.ndarray):            array of data for generating a
+                                                dictionary (first axis is
+                                                time).
+
+            initial_dictionary(numpy.ndarray):  dictionary to start the
+                                                algorithm with (e.g. from a
+                                                previous run). Fewer
+                                                iterations are typically
+                                                needed when provided.
+
+            n_components(int):                  number of components for the
+                                                dictionary to use.
+
+            **parameters(dict):                 contains the arguments for the
+                                                selected backend. If
+                                                ``initialize_dictionary`` is
+                                                included (and no
+                                                initial_dictionary is given),
+                                                it is used to generate the
+                                                initial dictionary. If
+                                                ``reduce_rank`` is included,
+                                                the dictionary is learned from
+                                                the data's leading temporal
+                                                components instead. If
+                                                ``early_stopping`` is included,
+                                                training is run in chunks of
+                                                ``num_iterations`` until the
+                                                objective on held out frames
+                                                improves by less than
+                                                ``tolerance`` (relatively).
+                                                With ``reduce_rank``, frames
+                                                are held out before reducing.
+                                                Resumable backends continue
+                                                from their state (e.g. the
+                                                optimizer's statistics) each
+                                                chunk, others restart from the
+                                                last dictionary.
+
+        Returns:
+            dict:                               the dictionary found.
+    """
+
+    # Find the backend selected.
+    backend_names = [
+        _k for _k in parameters if _k in generate_dictionary.backends
+    ]
+    assert (len(backend_names) == 1),\
+        "Must select one supported matrix factorization algorithm from " \
+        + repr(sorted(generate_dictionary.backends.keys())) + "."
+
+    backend_name = backend_names[0]
+    backend, n_components_name, num_iterations_name, resumable = generate_dictionary.backends[backend_name]
+    backend_parameters = parameters[backend_name]
+
+    # Sync the number of components with the method.
+    if n_components is None:
+        n_components = backend_parameters[n_components_name]
+    else:
+        assert backend_parameters.get(n_components_name, n_components) == n_components,\
+            "If `n_components` and `" + backend_name + "[\"" + \
+            n_components_name + "\"]` are defined, they should be defined " \
+            "the same."
+        backend_parameters[n_components_name] = n_components
+
+    # Seed the dictionary from peaks in the data instead of randomly.
+    if (initial_dictionary is None) and \
+            ("initialize_dictionary" in parameters):
+        initialize_dictionary.recorders.array_debug_recorder = generate_dictionary.recorders.array_debug_recorder
+        initial_dictionary = initialize_dictionary(
+            new_data, n_components, **parameters["initialize_dictionary"]
+        )
+
+    # When stopping early, the frames to hold out have to be picked before
+    # reducing the rank. Otherwise, components (not frames) would be held out
+    # and the held out frames would still leak into the training components.
+    held_out_frames = None
+    if ("early_stopping" in parameters) and ("reduce_rank" in parameters):
+        num_held_out_frames = min(
+            parameters["early_stopping"].get("num_held_out_frames", 100),
+            len(new_data) // 2
+        )
+        held_out_frames = numpy.sort(numpy.random.choice(
+            len(new_data), num_held_out_frames, replace=False
+        ))
+
+    # Learn from the leading temporal components instead of all frames.
+    new_data_maybe_reduced = new_data
+    if "reduce_rank" in parameters:
+        reduce_rank_parameters = dict(parameters["reduce_rank"])
+        if held_out_frames is not None:
+            reduce_rank_parameters["frames"] = numpy.setdiff1d(
+                numpy.arange(len(new_data)), held_out_frames
             )
 
-    new_label_image_props_with_arrays_dtype = numpy.dtype(
-        new_label_image_props_with_arrays_dtype
+        new_data_maybe_reduced = reduce_rank(
+            new_data, **reduce_rank_parameters
+        )
+
+        generate_dictionary.recorders.array_debug_recorder["reduced_data"] = new_data_maybe_reduced
+
+    # Needs to be floating point.
+    # However, it need not be double precision as there is single precision
+    # function signature.
+    float_dtype = None
+    if not issubclass(new_data.dtype.type, numpy.floating):
+        float_dtype = numpy.dtype(numpy.float32)
+    elif new_data.dtype.itemsize > numpy.dtype(numpy.float32).itemsize:
+        float_dtype = numpy.dtype(numpy.float64)
+    else:
+        float_dtype = numpy.dtype(numpy.float32)
+
+    # Requires floating point type.
+    new_data_processed = numpy.asarray(
+        new_data_maybe_reduced, dtype=float_dtype
     )
 
-    # Replace the properties with the structured array.
-    new_label_image_props_with_arrays = numpy.array(
-        new_label_image_props_with_arrays_values,
-        dtype=new_label_image_props_with_arrays_dtype
+    # Reshape data into a matrix (each image is now a row vector)
+    new_data_processed = xnumpy.array_to_matrix(new_data_processed)
+
+    # If there is an initial dictionary provided, go ahead and process it.
+    initial_dictionary_processed = initial_dictionary
+    if initial_dictionary_processed is not None:
+        assert (len(initial_dictionary_processed) == n_components), \
+            "The initial dictionary must have `n_components` basis images."
+        assert (tuple(initial_dictionary_processed.shape[1:]) == tuple(new_data.shape[1:])), \
+            "The initial dictionary must have the same image shape as the data."
+
+        # Go ahead and make the dictionary the same type as the input data.
+        # TODO: Add a warning if it needs to be down cast
+        initial_dictionary_processed = numpy.asarray(
+            initial_dictionary_processed, dtype=float_dtype
+        )
+
+        # Reshape dictionary into a matrix (each image is now a row vector)
+        initial_dictionary_processed = xnumpy.array_to_matrix(
+            initial_dictionary_processed
+        )
+
+    if "early_stopping" in parameters:
+        early_stopping_parameters = dict(parameters["early_stopping"])
+        num_iterations_chunk = early_stopping_parameters.pop("num_iterations")
+        tolerance = early_stopping_parameters.pop("tolerance", 1e-3)
+        num_held_out_frames = early_stopping_parameters.pop(
+            "num_held_out_frames", 100
+        )
+
+        assert (num_iterations_name is not None), \
+            "The backend `" + backend_name + "` does not support " \
+            "`early_stopping`."
+
+        num_iterations_total = backend_parameters[num_iterations_name]
+        assert (num_iterations_total > 0) and (num_iterations_chunk > 0), \
+            "Can only use `early_stopping` with a positive number of " \
+            "iterations."
+
+        if held_out_frames is not None:
+            # Train on all of the components of the training frames and
+            # evaluate on the held out frames themselves.
+            swapped_frames = []
+            new_data_training = new_data_processed
+            new_data_held_out = xnumpy.array_to_matrix(numpy.asarray(
+                new_data[held_out_frames.tolist()], dtype=float_dtype
+            ))
+        else:
+            # Hold out some frames to evaluate the dictionary on.
+            num_held_out_frames = min(
+                num_held_out_frames, len(new_data_processed) // 2
+            )
+            num_training_frames = len(new_data_processed) - num_held_out_frames
+            held_out_frames = numpy.random.choice(
+                len(new_data_processed), num_held_out_frames, replace=False
+            )
+
+            # Swap the held out frames with those at the end so that both
+            # sets are views (e.g. of shared_frames) instead of copies. They
+            # are swapped back afterwards.
+            swapped_frames = list(iters.izip(
+                numpy.sort(
+                    held_out_frames[held_out_frames < num_training_frames]
+                ),
+                numpy.setdiff1d(
+                    numpy.arange(num_training_frames, len(new_data_processed)),
+                    held_out_frames
+                )
+            ))
+            if not new_data_processed.flags.writeable:
+                new_data_processed = new_data_processed.copy()
+
+            for i, j in swapped_frames:
+                new_data_processed[[i, j]] = new_data_processed[[j, i]]
+
+            new_data_training = new_data_processed[:num_training_frames]
+            new_data_held_out = new_data_processed[num_training_frames:]
+
+        try:
+            # Train in chunks until the objective stops improving enough or
+            # all iterations are used.
+            objectives = []
+            new_dictionary = initial_dictionary_processed
+            state = None
+            num_iterations_done = 0
+            while num_iterations_done < num_iterations_total:
+                backend_parameters_chunk = dict(backend_parameters)
+                backend_parameters_chunk[num_iterations_name] = min(
+                    num_iterations_chunk,
+                    num_iterations_total - num_iterations_done
+                )
+
+                if resumable:
+                    new_dictionary, state = backend(
+                        new_data_training,
+                        new_dictionary,
+                        state=state,
+                        return_state=True,
+                        **backend_parameters_chunk
+                    )
+                else:
+                    new_dictionary = backend(
+                        new_data_training,
+                        new_dictionary,
+                        **backend_parameters_chunk
+                    )
+                new_dictionary = numpy.asarray(
+                    new_dictionary, dtype=float_dtype
+                )
+                num_iterations_done += backend_parameters_chunk[num_iterations_name]
+
+                objectives.append(dictionary_objective(
+                    new_data_held_out,
+                    new_dictionary,
+                    **early_stopping_parameters
+                ))
+                logger.info(
+                    "Objective on held out frames after " +
+                    repr(num_iterations_done) + " iterations is " +
+                    repr(objectives[-1]) + "."
+                )
+
+                if (len(objectives) > 1) and \
+                        ((objectives[-2] - objectives[-1]) <
+                         (tolerance * abs(objectives[-2]))):
+                    logger.info(
+                        "Stopping early as the objective improved by less "
+                        "than " + repr(tolerance) + " (relatively)."
+                    )
+                    break
+        finally:
+            for i, j in swapped_frames:
+                new_data_processed[[i, j]] = new_data_processed[[j, i]]
+
+        generate_dictionary.recorders.array_debug_recorder["objectives"] = numpy.array(objectives)
+    else:
+        # Simply trains the dictionary. Does not return sparse code.
+        new_dictionary = backend(
+            new_data_processed,
+            initial_dictionary_processed,
+            **backend_parameters
+        )
+
+    # Fix the rest will be the shape of an image (same as input shape).
+    new_dictionary = numpy.asarray(new_dictionary, dtype=new_data.dtype.type)
+    new_dictionary = new_dictionary.reshape(
+        (-1,) + new_data.shape[1:]
     )
 
-    return(new_label_image_props_with_arrays)
+    return(new_dictionary)
 
 
 @prof.log_call(trace_logger)
-def region_properties_vigra(new_label_image, *args, **kwargs):
+def register_dictionary_learning_backend(name,
+                                        n_components_name,
+                                        num_iterations_name=None,
+                                        resumable=False):
     """
-        Grabs region properties from a label image.
+        Returns a decorator that registers a dictionary learning backend with
+        generate_dictionary under the given name.
+
+        A backend is called with the data as a C-ordered matrix (each row is a
+        frame), an initial dictionary (each row is a basis image) or None, and
+        the arguments given in the config. It must return the dictionary as a
+        matrix (each row is a basis image).
+
+        A resumable backend also takes ``state`` (None to start fresh) and
+        ``return_state``. If ``return_state`` is set, it returns the
+        dictionary and a state to continue training from (e.g. the
+        optimizer's statistics), which early stopping passes to the next
+        chunk.
 
         Args:
-            new_label_image(numpy.ndarray):      label image used for
-                                                 generating properties.
+            name(str):                          key to select the backend by
+                                                in generate_dictionary's
+                                                parameters.
 
-            args(list):                          additional position arguments
-                                                 to pass
-                                                 skimage.measure.regionprops.
+            n_components_name(str):             name of the argument the
+                                                backend takes for the number
+                                                of basis images.
 
-            **parameters(dict):                  additional keyword arguments
-                                                 to pass
-                                                 skimage.measure.regionprops.
+            num_iterations_name(str):           name of the argument the
+                                                backend takes for the number
+                                                of iterations (needed for
+                                                early stopping).
 
-        Note:
-            Uses all the same options in skimage.measure.regionprops. If a
-            property is not specified, then it won't be returned.
+            resumable(bool):                    whether the backend takes
+                                                ``state`` and
+                                                ``return_state``.
 
         Returns:
-            numpy.ndarray:                       a structured array of all the
-                                                 properties found for each
-                                                 label.
+            (decorator):                        registers the backend and
+                                                returns it unchanged.
 
         Examples:
-
-            >>> numpy.set_printoptions(
-            ...     formatter={"float": lambda x: str(float(x))}
+            >>> @register_dictionary_learning_backend("first_frames", "K")
+            ... def first_frames(new_data, initial_dictionary, K):
+            ...     return(new_data[:K])
+            >>> generate_dictionary(
+            ...     numpy.arange(12.0).reshape(3, 2, 2),
+            ...     **{"first_frames" : {"K" : 2}}
             ... )
+            array([[[ 0.,  1.],
+                    [ 2.,  3.]],
+            <BLANKLINE>
+                   [[ 4.,  5.],
+                    [ 6.,  7.]]])
+            >>> del generate_dictionary.backends["first_frames"]
+    """
 
-            >>> region_properties_vigra(
-            ...     numpy.zeros((2,2), dtype=int)
-            ... ) # doctest: +NORMALIZE_WHITESPACE
-            array([],
-                  dtype=[('label', '<i8'), ('area', '<f8'), ('centroid', '<f8', (2,))])
+    def register_dictionary_learning_backend_tie(backend):
+        generate_dictionary.backends[name] = (
+            backend, n_components_name, num_iterations_name, resumable
+        )
 
-            >>> region_properties_vigra(
-            ...     numpy.ones((2,2), dtype=int)
-            ... ) # doctest: +NORMALIZE_WHITESPACE
-            array([(1, 4.0, [0.5, 0.5])],
-                  dtype=[('label', '<i8'), ('area', '<f8'), ('centroid', '<f8', (2,))])
+        return(backend)
 
-            >>> region_properties_vigra(
-            ...     numpy.ones((3,3), dtype=int)
-            ... ) # doctest: +NORMALIZE_WHITESPACE
-            array([(1, 9.0, [1.0, 1.0])],
-                  dtype=[('label', '<i8'), ('area', '<f8'), ('centroid', '<f8', (2,))])
+    return(register_dictionary_learning_backend_tie)
 
-            >>> region_properties_vigra(
-            ...     numpy.eye(3, dtype=int)
-            ... ) # doctest: +NORMALIZE_WHITESPACE
-            array([(1, 3.0, [1.0, 1.0])],
-                  dtype=[('label', '<i8'), ('area', '<f8'), ('centroid', '<f8', (2,))])
 
-            >>> region_properties_vigra(
-            ...     numpy.eye(3, dtype=int), ["area", "centroid"]
-            ... ) # doctest: +NORMALIZE_WHITESPACE
-            array([(1, 3.0, [1.0, 1.0])],
-                  dtype=[('label', '<i8'), ('area', '<f8'), ('centroid', '<f8', (2,))])
+@register_dictionary_learning_backend(
+    "spams.trainDL", "K", "iter", resumable=True
+)
+@prof.log_call(trace_logger)
+def dictionary_learning_spams_trainDL(new_data,
+                                      initial_dictionary,
+                                      state=None,
+                                      return_state=False,
+                                      **parameters):
+    """
+        Dictionary learning backend using SPAMS's trainDL (run in a separate
+        process).
 
-            >>> region_properties_vigra(
-            ...     numpy.eye(3, dtype=int), properties=["area", "centroid"]
-            ... ) # doctest: +NORMALIZE_WHITESPACE
-            array([(1, 3.0, [1.0, 1.0])],
-                  dtype=[('label', '<i8'), ('area', '<f8'), ('centroid', '<f8', (2,))])
+        Args:
+            new_data(numpy.ndarray):            data as a matrix (each row is
+                                                a frame).
 
-            >>> numpy.set_printoptions()
+            initial_dictionary(numpy.ndarray):  dictionary to start with (each
+                                                row is a basis image) or None.
+
+            state(dict):                        model (A, B, and iter) to
+                                                continue training from or
+                                                None.
+
+            return_state(bool):                 whether to also return the
+                                                model.
+
+            **parameters(dict):                 passed directly to
+                                                spams.trainDL.
+
+        Returns:
+            numpy.ndarray:                      the dictionary found (each row
+                                                is a basis image) and the
+                                                model (if return_state).
     """
 
-    region_properties_type_dict = {
-        "area": numpy.float64,
-        "centroid": numpy.float64,
-        "eccentricity": numpy.float64,
-        "label": numpy.int64,
-        "major_axis_length": numpy.float64,
-        "minor_axis_length": numpy.float64,
-    }
+    import nanshe.box
 
-    region_properties_shape_dict = {
-        "area": (),
-        "centroid": (new_label_image.ndim,),
-        "eccentricity": (),
-        "label": (),
-        "major_axis_length": (),
-        "minor_axis_length": (),
-    }
+    float_ctype = ctypes.c_float
+    if new_data.dtype == numpy.float64:
+        float_ctype = ctypes.c_double
 
-    region_properties_ndim_dict = {
-        "area": 0,
-        "centroid": 1,
-        "eccentricity": 0,
-        "label": 0,
-        "major_axis_length": 0,
-        "minor_axis_length": 0,
-    }
+    # Want to support NumPy types in parameters. However, SPAMS expects normal
+    # C types. So, we convert them in advance. This was needed for the
+    # Ilastik-based GUI.
+    for _k, _v in parameters.items():
+        _v = numpy.array(_v)[()] # Convert to NumPy type
+        if isinstance(_v, numpy.integer):
+            _v = int(_v)
+        elif isinstance(_v, numpy.floating):
+            _v = float_ctype(_v).value
+        elif isinstance(_v, numpy.bool_):
+            _v = bool(_v)
 
-    # region_properties_type_dict = {
-    #     "area": numpy.float64,
-    #     "bbox": numpy.int64,
-    #     "centroid": numpy.float64,
-    #     "convex_area": numpy.int64,
-    #     "convex_image": numpy.bool_,
-    #     "coords": numpy.int64,
-    #     "eccentricity": numpy.float64,
-    #     "equivalent_diameter": numpy.float64,
-    #     "euler_number": numpy.int64,
-    #     "filled_area": numpy.int64,
-    #     "filled_image": numpy.bool_,
-    #     "image": numpy.bool_,
+        parameters[_k] = _v
+
+    # Spams requires all matrices to be fortran (each image is a column).
+    new_data = numpy.asfortranarray(new_data.transpose())
+
+    if initial_dictionary is not None:
+        initial_dictionary = numpy.asfortranarray(
+            initial_dictionary.transpose()
+        )
+
+    if return_state:
+        parameters["return_model"] = True
+        if state is not None:
+            parameters["model"] = state
+
+    new_dictionary = nanshe.box.spams_sandbox.call_multiprocessing_array_spams_trainDL(
+        X=new_data, D=initial_dictionary, **parameters
+    )
+
+    if return_state:
+        new_dictionary, state = new_dictionary
+
+    # Fix dictionary so that the first index will be the particular image.
+    new_dictionary = new_dictionary.transpose()
+
+    if return_state:
+        return(new_dictionary, state)
+
+    return(new_dictionary)
+
+
+@register_dictionary_learning_backend(
+    "sklearn.decomposition.dict_learning_online",
+    "n_components",
+    "n_iter",
+    resumable=True
+)
+@prof.log_call(trace_logger)
+def dictionary_learning_sklearn_dict_learning_online(new_data,
+                                                     initial_dictionary,
+                                                     state=None,
+                                                     return_state=False,
+                                                     **parameters):
+    """
+        Dictionary learning backend using scikit-learn's
+        dict_learning_online.
+
+        Args:
+            new_data(numpy.ndarray):            data as a matrix (each row is
+                                                a frame).
+
+            initial_dictionary(numpy.ndarray):  dictionary to start with (each
+                                                row is a basis image) or None.
+
+            state(tuple):                       inner stats and iteration
+                                                offset to continue training
+                                                from or None.
+
+            return_state(bool):                 whether to also return the
+                                                inner stats and iteration
+                                                offset.
+
+            **parameters(dict):                 passed directly to
+                                                dict_learning_online.
+
+        Returns:
+            numpy.ndarray:                      the dictionary found (each row
+                                                is a basis image) and the
+                                                state (if return_state).
+    """
+
+    # sklearn needs to be boxed so it doesn't cause us issues.
+    import sklearn
+    import sklearn.decomposition
+
+    parameters["return_code"] = parameters.get("return_code", False)
+    assert not parameters["return_code"],\
+        "Returning the sparse code is not supported by this function's API."
+
+    parameters["return_inner_stats"] = parameters.get(
+        "return_inner_stats", False
+    )
+    assert not parameters["return_inner_stats"],\
+        "Returning the internal stats is not supported by this function's API."
+
+    if return_state:
+        parameters["return_inner_stats"] = True
+        if state is not None:
+            parameters["inner_stats"], parameters["iter_offset"] = state
+
+    new_dictionary = sklearn.decomposition.dict_learning_online(
+        X=new_data, dict_init=initial_dictionary, **parameters
+    )
+
+    if return_state:
+        new_dictionary, inner_stats = new_dictionary
+        iter_offset = parameters.get("iter_offset", 0) + \
+            parameters.get("n_iter", 100)
+
+        return(new_dictionary, (inner_stats, iter_offset))
+
+    return(new_dictionary)
+
+
+@register_dictionary_learning_backend(
+    "sklearn.decomposition.MiniBatchDictionaryLearning",
+    "n_components",
+    "num_epochs",
+    resumable=True
+)
+@prof.log_call(trace_logger)
+def dictionary_learning_sklearn_MiniBatchDictionaryLearning(
+        new_data,
+        initial_dictionary,
+        block_frame_length=-1,
+        num_epochs=1,
+        state=None,
+        return_state=False,
+        **parameters):
+    """
+        Dictionary learning backend using scikit-learn's
+        MiniBatchDictionaryLearning (e.g. to use ``n_jobs``). If
+        ``block_frame_length`` is positive, the data is streamed to it in
+        blocks of frames with partial_fit instead.
+
+        Args:
+            new_data(numpy.ndarray):            data as a matrix (each row is
+                                                a frame).
+
+            initial_dictionary(numpy.ndarray):  dictionary to start with (each
+                                                row is a basis image) or None.
+
+            block_frame_length(int):            number of frames to give to
+                                                partial_fit at a time. If
+                                                negative, fit is used on all
+                                                frames.
+
+            num_epochs(int):                    number of passes over the
+                                                blocks (only when streaming).
+                                                Early stopping checks between
+                                                epochs.
+
+            state(MiniBatchDictionaryLearning): estimator to continue
+                                                training or None.
+
+            return_state(bool):                 whether to also return the
+                                                estimator (requires
+                                                streaming).
+
+            **parameters(dict):                 passed directly to
+                                                MiniBatchDictionaryLearning.
+
+        Returns:
+            numpy.ndarray:                      the dictionary found (each row
+                                                is a basis image) and the
+                                                estimator (if return_state).
+    """
+
+    # sklearn needs to be boxed so it doesn't cause us issues.
+    import sklearn
+    import sklearn.decomposition
+
+    assert (not return_state) or (block_frame_length > 0), \
+        "Can only continue training (e.g. for `early_stopping`) when " \
+        "streaming with a positive `block_frame_length`."
+
+    estimator = state
+    if estimator is None:
+        estimator = sklearn.decomposition.MiniBatchDictionaryLearning(
+            dict_init=initial_dictionary, **parameters
+        )
+
+    if block_frame_length > 0:
+        for i in iters.irange(num_epochs):
+            for j in iters.irange(0, len(new_data), block_frame_length):
+                estimator.partial_fit(new_data[j:j + block_frame_length])
+    else:
+        estimator.fit(new_data)
+
+    new_dictionary = estimator.components_
+
+    if return_state:
+        return(new_dictionary.copy(), estimator)
+
+    return(new_dictionary)
+
+
+@prof.log_call(trace_logger)
+def region_properties_scikit_image(new_label_image, *args, **kwargs):
+    """
+        Grabs region properties from a label image.
+
+        Args:
+            new_label_image(numpy.ndarray):      label image used for
+                                                 generating properties.
+
+            args(list):                          additional position arguments
+                                                 to pass
+                                                 skimage.measure.regionprops.
+
+            **parameters(dict):                  additional keyword arguments
+                                                 to pass
+                                                 skimage.measure.regionprops.
+
+        Note:
+            Uses all the same options in skimage.measure.regionprops. If a
+            property is not specified, then it won't be returned.
+
+        Returns:
+            numpy.ndarray:                       a structured array of all the
+                                                 properties found for each
+                                                 label.
+
+        Examples:
+
+            >>> numpy.set_printoptions(
+            ...     formatter={"float": lambda x: str(float(x))}
+            ... )
+
+            >>> region_properties_scikit_image(
+            ...     numpy.zeros((2,2), dtype=int)
+            ... ) # doctest: +NORMALIZE_WHITESPACE
+            array([],
+                  dtype=[('label', '<i8'), ('area', '<f8'), ('centroid', '<f8', (2,))])
+
+            >>> region_properties_scikit_image(
+            ...     numpy.ones((2,2), dtype=int)
+            ... ) # doctest: +NORMALIZE_WHITESPACE
+            array([(1, 4.0, [0.5, 0.5])],
+                  dtype=[('label', '<i8'), ('area', '<f8'), ('centroid', '<f8', (2,))])
+
+            >>> region_properties_scikit_image(
+            ...     numpy.ones((3,3), dtype=int)
+            ... ) # doctest: +NORMALIZE_WHITESPACE
+            array([(1, 9.0, [1.0, 1.0])],
+                  dtype=[('label', '<i8'), ('area', '<f8'), ('centroid', '<f8', (2,))])
+
+            >>> region_properties_scikit_image(
+            ...     numpy.eye(3, dtype=int)
+            ... ) # doctest: +NORMALIZE_WHITESPACE
+            array([(1, 3.0, [1.0, 1.0])],
+                  dtype=[('label', '<i8'), ('area', '<f8'), ('centroid', '<f8', (2,))])
+
+            >>> region_properties_scikit_image(
+            ...     numpy.eye(3, dtype=int), ["area", "centroid"]
+            ... ) # doctest: +NORMALIZE_WHITESPACE
+            array([(1, 3.0, [1.0, 1.0])],
+                  dtype=[('label', '<i8'), ('area', '<f8'), ('centroid', '<f8', (2,))])
+
+            >>> region_properties_scikit_image(
+            ...     numpy.eye(3, dtype=int), properties=["area", "centroid"]
+            ... ) # doctest: +NORMALIZE_WHITESPACE
+            array([(1, 3.0, [1.0, 1.0])],
+                  dtype=[('label', '<i8'), ('area', '<f8'), ('centroid', '<f8', (2,))])
+
+            >>> numpy.set_printoptions()
+    """
+
+    region_properties_type_dict = {
+        "area": numpy.float64,
+        "bbox": numpy.int64,
+        "centroid": numpy.float64,
+        "convex_area": numpy.int64,
+        "convex_image": numpy.bool_,
+        "coords": numpy.int64,
+        "eccentricity": numpy.float64,
+        "equivalent_diameter": numpy.float64,
+        "euler_number": numpy.int64,
+        "filled_area": numpy.int64,
+        "filled_image": numpy.bool_,
+        "image": numpy.bool_,
+        "inertia_tensor": numpy.float64,
+        "inertia_tensor_eigvals": numpy.float64,
+        "intensity_image": numpy.float64,
+        "label": numpy.int64,
+        "local_centroid": numpy.float64,
+        "major_axis_length": numpy.float64,
+        "max_intensity": numpy.float64,
+        "mean_intensity": numpy.float64,
+        "min_intensity": numpy.float64,
+        "minor_axis_length": numpy.float64,
+        "moments": numpy.float64,
+        "moments_central": numpy.float64,
+        "moments_hu": numpy.float64,
+        "moments_normalized": numpy.float64,
+        "orientation": numpy.float64,
+        "perimeter": numpy.float64,
+        "solidity": numpy.float64,
+        "weighted_centroid": numpy.float64,
+        "weighted_local_centroid": numpy.float64,
+        "weighted_moments": numpy.float64,
+        "weighted_moments_central": numpy.float64,
+        "weighted_moments_hu": numpy.float64,
+        "weighted_moments_normalized": numpy.float64
+    }
+
+    region_properties_shape_dict = {
+        "area": (),
+        "bbox": (4,),
+        "centroid": (new_label_image.ndim,),
+        "convex_area": (),
+        "convex_image": (-1, -1),
+        "coords": (-1, 2),
+        "eccentricity": (),
+        "equivalent_diameter": (),
+        "euler_number": (),
+        "filled_area": (),
+        "filled_image": (-1, -1),
+        "image": (-1, -1),
+        "inertia_tensor": (2, 2),
+        "inertia_tensor_eigvals": (2,),
+        "intensity_image": (-1, -1),
+        "label": (),
+        "local_centroid": (2,),
+        "major_axis_length": (),
+        "max_intensity": (),
+        "mean_intensity": (),
+        "min_intensity": (),
+        "minor_axis_length": (),
+        "moments": (4, 4),
+        "moments_central": (4, 4),
+        "moments_hu": (7,),
+        "moments_normalized": (4, 4),
+        "orientation": (),
+        "perimeter": (),
+        "solidity": (),
+        "weighted_centroid": (2,),
+        "weighted_local_centroid": (2,),
+        "weighted_moments": (4, 4),
+        "weighted_moments_central": (4, 4),
+        "weighted_moments_hu": (7,),
+        "weighted_moments_normalized": (4, 4)
+    }
+
+    region_properties_ndim_dict = {
+        "area": 0,
+        "bbox": 1,
+        "centroid": 1,
+        "convex_area": 0,
+        "convex_image": 2,
+        "coords": 2,
+        "eccentricity": 0,
+        "equivalent_diameter": 0,
+        "euler_number": 0,
+        "filled_area": 0,
+        "filled_image": 2,
+        "image": 2,
+        "inertia_tensor": 2,
+        "inertia_tensor_eigvals": 1,
+        "intensity_image": 2,
+        "label": 0,
+        "local_centroid": 1,
+        "major_axis_length": 0,
+        "max_intensity": 0,
+        "mean_intensity": 0,
+        "min_intensity": 0,
+        "minor_axis_length": 0,
+        "moments": 2,
+        "moments_central": 2,
+        "moments_hu": 1,
+        "moments_normalized": 2,
+        "orientation": 0,
+        "perimeter": 0,
+        "solidity": 0,
+        "weighted_centroid": 1,
+        "weighted_local_centroid": 1,
+        "weighted_moments": 2,
+        "weighted_moments_central": 2,
+        "weighted_moments_hu": 1,
+        "weighted_moments_normalized": 2
+    }
+
+    array_properties = [
+        _k for _k, _v in region_properties_ndim_dict.items() if _v > 0
+    ]
+    fixed_shape_properties = [
+        _k for _k, _v in region_properties_shape_dict.items() if -1 not in _v
+    ]
+    varied_shape_properties = [
+        _k for _k, _v in region_properties_shape_dict.items() if -1 in _v
+    ]
+
+    new_label_image_props = None
+    new_label_image_props_with_arrays = None
+    new_label_image_props_with_arrays_values = None
+    new_label_image_props_with_arrays_dtype = None
+
+    properties = None
+    if (len(args)) and (args[0]):
+        properties = args[0]
+        properties = [str(_) for _ in properties]
+        args = args[1:]
+    elif (len(kwargs)) and ("properties" in kwargs):
+        properties = kwargs["properties"]
+        properties = [str(_) for _ in properties]
+        del kwargs["properties"]
+    else:
+        properties = ["area", "centroid"]
+
+    if ((properties == "all") or (properties is None)):
+        properties = list(region_properties_type_dict.keys())
+
+    intensity_image = None
+    if (len(args)) and (args[0]):
+        intensity_image = args[0]
+        args = args[1:]
+    elif (len(kwargs)) and ("intensity_image" in kwargs):
+        intensity_image = kwargs["intensity_image"]
+        del kwargs["intensity_image"]
+    else:
+        pass
+
+    # Remove duplicates and make sure label is at the front.
+    properties = set(properties)
+    allowed_properties = set(region_properties_type_dict.keys())
+    disallowed_properties = properties.difference(allowed_properties)
+
+    if len(disallowed_properties):
+        disallowed_properties = sorted(disallowed_properties)
+        raise Exception(
+            "Recieved \"" + repr(len(disallowed_properties)) +
+            "\" properties that are not allowed, which are \"" +
+            repr(disallowed_properties) + "\"."
+        )
+
+    properties.discard("label")
+    properties = ["label"] + sorted(properties)
+
+    if new_label_image.size:
+        # This gives a list of dictionaries. However, this is not very usable.
+        # So, we will convert this to a structured NumPy array.
+        # In future versions, the properties argument will be removed.
+        # It does not need to be passed to retain functionality of this
+        # function.
+        new_label_image_props = skimage.measure.regionprops(
+            label_image=new_label_image,
+            intensity_image=intensity_image,
+            *args, **kwargs
+        )
+
+        new_label_image_props_with_arrays = []
+        for i in iters.irange(len(new_label_image_props)):
+            new_label_image_props_with_arrays.append({})
+
+            for each_key in properties:
+                if each_key in array_properties:
+                    new_label_image_props_with_arrays[i][each_key] = numpy.array(
+                        new_label_image_props[i][each_key],
+                        dtype=region_properties_type_dict[each_key]
+                    )
+                else:
+                    new_label_image_props_with_arrays[i][each_key] = region_properties_type_dict[each_key](
+                        new_label_image_props[i][each_key]
+                    )
+
+        # Holds the values from props.
+        new_label_image_props_with_arrays_values = []
+
+        # Holds the types from props.
+        new_label_image_props_with_arrays_dtype = []
+
+        if len(new_label_image_props_with_arrays):
+            # Get types for all properties as a dictionary
+            for each_name in properties:
+                each_sample_value = new_label_image_props_with_arrays[
+                    0][each_name]
+                each_type = type(each_sample_value)
+                each_shape = tuple()
+
+                if isinstance(each_sample_value, numpy.ndarray) and \
+                        (each_name in fixed_shape_properties):
+                    each_type = each_sample_value.dtype
+                    each_shape = each_sample_value.shape
+                else:
+                    each_type = numpy.dtype(each_type)
+
+                new_label_image_props_with_arrays_dtype.append(
+                    (each_name, each_type, each_shape)
+                )
+
+            # Store the values to place in NumPy structured array in order.
+            new_label_image_props_with_arrays_values = []
+            for j in iters.irange(len(new_label_image_props_with_arrays)):
+                # Add all values in order of keys from the dictionary.
+                new_label_image_props_with_arrays_values.append([])
+                for each_new_label_image_props_with_arrays_dtype in new_label_image_props_with_arrays_dtype:
+                    each_name, each_type, each_shape = each_new_label_image_props_with_arrays_dtype
+
+                    if each_shape:
+                        new_label_image_props_with_arrays_values[j].append(
+                            new_label_image_props_with_arrays[j][each_name].tolist())
+                    else:
+                        new_label_image_props_with_arrays_values[j].append(
+                            new_label_image_props_with_arrays[j][each_name])
+
+                # NumPy will expect a tuple for each set of values.
+                new_label_image_props_with_arrays_values[j] = tuple(
+                    new_label_image_props_with_arrays_values[j]
+                )
+
+    if (not new_label_image.size) or \
+            (not len(new_label_image_props_with_arrays)):
+        new_label_image_props_with_arrays_dtype = []
+        for each_key in properties:
+            each_type = region_properties_type_dict[each_key]
+            each_shape = region_properties_shape_dict[each_key]
+
+            if each_key in varied_shape_properties:
+                each_type = numpy.object_
+                each_shape = tuple()
+
+            new_label_image_props_with_arrays_dtype.append(
+                (each_key, each_type, each_shape)
+            )
+
+    new_label_image_props_with_arrays_dtype = numpy.dtype(
+        new_label_image_props_with_arrays_dtype
+    )
+
+    # Replace the properties with the structured array.
+    new_label_image_props_with_arrays = numpy.array(
+        new_label_image_props_with_arrays_values,
+        dtype=new_label_image_props_with_arrays_dtype
+    )
+
+    return(new_label_image_props_with_arrays)
+
+
+@prof.log_call(trace_logger)
+def _region_features_key(new_label_image):
+    """
+        Identifies a label image by its contents (so it is still found if
+        the same labels are in a different array or the array is changed).
+
+        Args:
+            new_label_image(numpy.ndarray):      label image to identify.
+
+        Returns:
+            tuple:                               key for the label image.
+    """
+
+    new_label_image = numpy.ascontiguousarray(
+        new_label_image, dtype=numpy.uint32
+    )
+
+    return((
+        new_label_image.shape,
+        hashlib.sha1(new_label_image.view(numpy.uint8)).hexdigest()
+    ))
+
+
+@prof.log_call(trace_logger)
+@wrappers.static_variables(
+    cache=collections.OrderedDict(), cache_size=8, lock=threading.Lock()
+)
+def _region_features(new_label_image, cached_only=False):
+    """
+        Gets the region features (from vigra) of a label image for all labels
+        (excluding the background). The features of the most recently used
+        label images are kept (keyed by their contents, guarded by a lock,
+        and dropped with clear_region_features). So, asking for the same
+        label image again (even for different properties) does not find them
+        again.
+
+        Note:
+            None of the features depend on intensities. So, only the label
+            image is needed.
+
+        Args:
+            new_label_image(numpy.ndarray):      label image to get the
+                                                 features of.
+
+            cached_only(bool):                   whether to only return
+                                                 features that are already
+                                                 known (None if they aren't).
+
+        Returns:
+            dict:                                feature names with an array
+                                                 of values (one per label).
+    """
+
+    new_label_image_key = _region_features_key(new_label_image)
+
+    with _region_features.lock:
+        new_label_image_features = _region_features.cache.pop(
+            new_label_image_key, None
+        )
+
+    if new_label_image_features is None:
+        if cached_only:
+            return(None)
+
+        new_label_image_uint32 = new_label_image.astype(numpy.uint32)
+        new_label_image_vigra_features = vigra.analysis.extractRegionFeatures(
+            new_label_image_uint32.astype(numpy.float32),
+            new_label_image_uint32,
+            features=["Count", "RegionCenter", "RegionRadii"]
+        )
+
+        # Drop the background.
+        new_label_image_features = dict()
+        for each_feature in ["Count", "RegionCenter", "RegionRadii"]:
+            new_label_image_features[each_feature] = numpy.array(
+                new_label_image_vigra_features[each_feature]
+            )[1:]
+
+    _cache_region_features(new_label_image_key, new_label_image_features)
+
+    return(new_label_image_features)
+
+
+@prof.log_call(trace_logger)
+def _cache_region_features(new_label_image_key, new_label_image_features):
+    """
+        Keeps the region features for a label image (dropping the least
+        recently used ones if there are too many).
+
+        Args:
+            new_label_image_key(tuple):          key for the label image
+                                                 (from _region_features_key).
+
+            new_label_image_features(dict):      feature names with an array
+                                                 of values (one per label).
+    """
+
+    with _region_features.lock:
+        _region_features.cache[new_label_image_key] = new_label_image_features
+
+        while len(_region_features.cache) > _region_features.cache_size:
+            _region_features.cache.popitem(last=False)
+
+
+@prof.log_call(trace_logger)
+def clear_region_features():
+    """
+        Drops all of the region features kept for label images (e.g. to free
+        memory once they are no longer needed).
+
+        Examples:
+            >>> _cache_region_features(
+            ...     _region_features_key(numpy.ones((2, 2), dtype=int)),
+            ...     {"Count": numpy.array([4])}
+            ... )
+            >>> len(_region_features.cache) > 0
+            True
+            >>> clear_region_features()
+            >>> len(_region_features.cache)
+            0
+    """
+
+    with _region_features.lock:
+        _region_features.cache.clear()
+
+
+@prof.log_call(trace_logger)
+def region_properties_vigra(new_label_image, *args, **kwargs):
+    """
+        Grabs region properties from a label image.
+
+        Args:
+            new_label_image(numpy.ndarray):      label image used for
+                                                 generating properties.
+
+            args(list):                          additional position arguments
+                                                 to pass
+                                                 skimage.measure.regionprops.
+
+            **parameters(dict):                  additional keyword arguments
+                                                 to pass
+                                                 skimage.measure.regionprops.
+
+        Note:
+            Uses all the same options in skimage.measure.regionprops. If a
+            property is not specified, then it won't be returned.
+
+        Returns:
+            numpy.ndarray:                       a structured array of all the
+                                                 properties found for each
+                                                 label.
+
+        Examples:
+
+            >>> numpy.set_printoptions(
+            ...     formatter={"float": lambda x: str(float(x))}
+            ... )
+
+            >>> region_properties_vigra(
+            ...     numpy.zeros((2,2), dtype=int)
+            ... ) # doctest: +NORMALIZE_WHITESPACE
+            array([],
+                  dtype=[('label', '<i8'), ('area', '<f8'), ('centroid', '<f8', (2,))])
+
+            >>> region_properties_vigra(
+            ...     numpy.ones((2,2), dtype=int)
+            ... ) # doctest: +NORMALIZE_WHITESPACE
+            array([(1, 4.0, [0.5, 0.5])],
+                  dtype=[('label', '<i8'), ('area', '<f8'), ('centroid', '<f8', (2,))])
+
+            >>> region_properties_vigra(
+            ...     numpy.ones((3,3), dtype=int)
+            ... ) # doctest: +NORMALIZE_WHITESPACE
+            array([(1, 9.0, [1.0, 1.0])],
+                  dtype=[('label', '<i8'), ('area', '<f8'), ('centroid', '<f8', (2,))])
+
+            >>> region_properties_vigra(
+            ...     numpy.eye(3, dtype=int)
+            ... ) # doctest: +NORMALIZE_WHITESPACE
+            array([(1, 3.0, [1.0, 1.0])],
+                  dtype=[('label', '<i8'), ('area', '<f8'), ('centroid', '<f8', (2,))])
+
+            >>> region_properties_vigra(
+            ...     numpy.eye(3, dtype=int), ["area", "centroid"]
+            ... ) # doctest: +NORMALIZE_WHITESPACE
+            array([(1, 3.0, [1.0, 1.0])],
+                  dtype=[('label', '<i8'), ('area', '<f8'), ('centroid', '<f8', (2,))])
+
+            >>> region_properties_vigra(
+            ...     numpy.eye(3, dtype=int), properties=["area", "centroid"]
+            ... ) # doctest: +NORMALIZE_WHITESPACE
+            array([(1, 3.0, [1.0, 1.0])],
+                  dtype=[('label', '<i8'), ('area', '<f8'), ('centroid', '<f8', (2,))])
+
+            >>> numpy.set_printoptions()
+    """
+
+    region_properties_type_dict = {
+        "area": numpy.float64,
+        "centroid": numpy.float64,
+        "eccentricity": numpy.float64,
+        "label": numpy.int64,
+        "major_axis_length": numpy.float64,
+        "minor_axis_length": numpy.float64,
+    }
+
+    region_properties_shape_dict = {
+        "area": (),
+        "centroid": (new_label_image.ndim,),
+        "eccentricity": (),
+        "label": (),
+        "major_axis_length": (),
+        "minor_axis_length": (),
+    }
+
+    region_properties_ndim_dict = {
+        "area": 0,
+        "centroid": 1,
+        "eccentricity": 0,
+        "label": 0,
+        "major_axis_length": 0,
+        "minor_axis_length": 0,
+    }
+
+    # region_properties_type_dict = {
+    #     "area": numpy.float64,
+    #     "bbox": numpy.int64,
+    #     "centroid": numpy.float64,
+    #     "convex_area": numpy.int64,
+    #     "convex_image": numpy.bool_,
+    #     "coords": numpy.int64,
+    #     "eccentricity": numpy.float64,
+    #     "equivalent_diameter": numpy.float64,
+    #     "euler_number": numpy.int64,
+    #     "filled_area": numpy.int64,
+    #     "filled_image": numpy.bool_,
+    #     "image": numpy.bool_,
     #     "inertia_tensor": numpy.float64,
     #     "inertia_tensor_eigvals": numpy.float64,
     #     "intensity_image": numpy.float64,
@@ -1467,1604 +2892,2766 @@ def region_properties_vigra(new_label_image, *args, **kwargs):
     #     "weighted_moments_normalized": 2
     # }
 
-    array_properties = [
-        _k for _k, _v in region_properties_ndim_dict.items() if _v > 0
-    ]
-    fixed_shape_properties = [
-        _k for _k, _v in region_properties_shape_dict.items() if -1 not in _v
-    ]
-    varied_shape_properties = [
-        _k for _k, _v in region_properties_shape_dict.items() if -1 in _v
-    ]
+    varied_shape_properties = [
+        _k for _k, _v in region_properties_shape_dict.items() if -1 in _v
+    ]
+
+    new_label_image_props = None
+    new_label_image_props_with_arrays = None
+    new_label_image_props_with_arrays_dtype = None
+
+    properties = None
+    if (len(args)) and (args[0]):
+        properties = args[0]
+        properties = [str(_) for _ in properties]
+        args = args[1:]
+    elif (len(kwargs)) and ("properties" in kwargs):
+        properties = kwargs["properties"]
+        properties = [str(_) for _ in properties]
+        del kwargs["properties"]
+    else:
+        properties = ["area", "centroid"]
+
+    if ((properties == "all") or (properties is None)):
+        properties = list(region_properties_type_dict.keys())
+
+    intensity_image = None
+    if (len(args)) and (args[0]):
+        intensity_image = args[0]
+        args = args[1:]
+    elif (len(kwargs)) and ("intensity_image" in kwargs):
+        intensity_image = kwargs["intensity_image"]
+        del kwargs["intensity_image"]
+    else:
+        pass
+
+    # Remove duplicates and make sure label is at the front.
+    properties = set(properties)
+    allowed_properties = set(region_properties_type_dict.keys())
+    disallowed_properties = properties.difference(allowed_properties)
+
+    if len(disallowed_properties):
+        disallowed_properties = sorted(disallowed_properties)
+        raise Exception(
+            "Recieved \"" + repr(len(disallowed_properties)) +
+            "\" properties that are not allowed, which are \"" +
+            repr(disallowed_properties) + "\"."
+        )
+
+    properties.discard("label")
+    properties = ["label"] + sorted(properties)
+
+    new_label_image_props_with_arrays_dtype = []
+    for each_key in properties:
+        each_type = region_properties_type_dict[each_key]
+        each_shape = region_properties_shape_dict[each_key]
+
+        if each_key in varied_shape_properties:
+            each_type = numpy.object_
+            each_shape = tuple()
+
+        new_label_image_props_with_arrays_dtype.append(
+            (each_key, each_type, each_shape)
+        )
+
+    new_label_image_props_with_arrays_dtype = numpy.dtype(
+        new_label_image_props_with_arrays_dtype
+    )
+
+    # The features are found once for all labels (or reused if they were
+    # already found for this label image). Then, each property is computed
+    # for all labels at once.
+    new_label_image_props = dict()
+    if new_label_image.size:
+        new_label_image_props = _region_features(new_label_image)
+
+    num_labels = len(new_label_image_props.get("Count", []))
+
+    new_label_image_props_with_arrays = numpy.zeros(
+        (num_labels,), dtype=new_label_image_props_with_arrays_dtype
+    )
+
+    if num_labels:
+        region_radii = new_label_image_props["RegionRadii"].astype(
+            numpy.float64
+        )
+
+        for each_key in properties:
+            if each_key == "label":
+                each_value = numpy.arange(1, num_labels + 1)
+            elif each_key == "area":
+                each_value = new_label_image_props["Count"]
+            elif each_key == "centroid":
+                each_value = new_label_image_props["RegionCenter"]
+            elif each_key == "eccentricity":
+                each_value = (
+                    1 - (
+                        region_radii.min(axis=1) / region_radii.max(axis=1)
+                    )**2
+                )**.5
+            elif each_key == "major_axis_length":
+                each_value = 4 * region_radii.max(axis=1)
+            elif each_key == "minor_axis_length":
+                each_value = 4 * region_radii.min(axis=1)
+            else:
+                # Should have already checked and removed these.
+                assert False
+
+            new_label_image_props_with_arrays[each_key] = each_value
+
+    return(new_label_image_props_with_arrays)
+
+
+@prof.log_call(trace_logger)
+def region_properties(new_label_image, *args, **kwargs):
+    """
+        Grabs region properties from a label image.
+
+        Args:
+            new_label_image(numpy.ndarray):      label image used for
+                                                 generating properties.
+
+            args(list):                          additional position arguments
+                                                 to pass
+                                                 skimage.measure.regionprops.
+
+            **parameters(dict):                  additional keyword arguments
+                                                 to pass
+                                                 skimage.measure.regionprops.
+
+        Note:
+            Uses all the same options in skimage.measure.regionprops. If a
+            property is not specified, then it won't be returned.
+
+        Returns:
+            numpy.ndarray:                       a structured array of all the
+                                                 properties found for each
+                                                 label.
+
+
+        Examples:
+
+            >>> numpy.set_printoptions(
+            ...     formatter={"float": lambda x: str(float(x))}
+            ... )
+
+            >>> region_properties(
+            ...     numpy.zeros((2,2), dtype=int)
+            ... ) # doctest: +NORMALIZE_WHITESPACE
+            array([],
+                  dtype=[('label', '<i8'), ('area', '<f8'), ('centroid', '<f8', (2,))])
+
+            >>> region_properties(
+            ...     numpy.ones((2,2), dtype=int)
+            ... ) # doctest: +NORMALIZE_WHITESPACE
+            array([(1, 4.0, [0.5, 0.5])],
+                  dtype=[('label', '<i8'), ('area', '<f8'), ('centroid', '<f8', (2,))])
+
+            >>> region_properties(
+            ...     numpy.ones((3,3), dtype=int)
+            ... ) # doctest: +NORMALIZE_WHITESPACE
+            array([(1, 9.0, [1.0, 1.0])],
+                  dtype=[('label', '<i8'), ('area', '<f8'), ('centroid', '<f8', (2,))])
+
+            >>> region_properties(
+            ...     numpy.eye(3, dtype=int)
+            ... ) # doctest: +NORMALIZE_WHITESPACE
+            array([(1, 3.0, [1.0, 1.0])],
+                  dtype=[('label', '<i8'), ('area', '<f8'), ('centroid', '<f8', (2,))])
+
+            >>> region_properties(
+            ...     numpy.eye(3, dtype=int), ["area", "centroid"]
+            ... ) # doctest: +NORMALIZE_WHITESPACE
+            array([(1, 3.0, [1.0, 1.0])],
+                  dtype=[('label', '<i8'), ('area', '<f8'), ('centroid', '<f8', (2,))])
+
+            >>> region_properties(
+            ...     numpy.eye(3, dtype=int), properties=["area", "centroid"]
+            ... ) # doctest: +NORMALIZE_WHITESPACE
+            array([(1, 3.0, [1.0, 1.0])],
+                  dtype=[('label', '<i8'), ('area', '<f8'), ('centroid', '<f8', (2,))])
+
+            >>> numpy.set_printoptions()
+    """
+
+    return(region_properties_vigra(new_label_image, *args, **kwargs))
+
+
+@prof.log_call(trace_logger)
+def get_neuron_dtype(shape, dtype):
+    """
+        Gets the type based on properties of an image.
+
+        Args:
+            new_image(numpy.ndarray):     a single sample image (only spatial
+                                          dimension).
+
+        Returns:
+            list:                         a list that can be converted to a
+                                          numpy.dtype using numpy.ndtype's
+                                          constructor.
+
+        Examples:
+            >>> get_neuron_dtype(
+            ...     (3,), numpy.float64
+            ... ) #doctest: +NORMALIZE_WHITESPACE, +ELLIPSIS
+            [('mask', <... 'numpy.bool_'>, (3,)),
+             ('contour', <... 'numpy.bool_'>, (3,)),
+             ('image', <... 'numpy.float64'>, (3,)),
+             ('area', <... 'numpy.float64'>),
+             ('max_F', <... 'numpy.float64'>),
+             ('gaussian_mean', <... 'numpy.float64'>, (1,)),
+             ('gaussian_cov', <... 'numpy.float64'>, (1, 1)),
+             ('centroid', <... 'numpy.float64'>, (1,))]
+
+
+            >>> get_neuron_dtype(
+            ...     (2, 3), numpy.float64
+            ... ) #doctest: +NORMALIZE_WHITESPACE, +ELLIPSIS
+            [('mask', <... 'numpy.bool_'>, (2, 3)),
+             ('contour', <... 'numpy.bool_'>, (2, 3)),
+             ('image', <... 'numpy.float64'>, (2, 3)),
+             ('area', <... 'numpy.float64'>),
+             ('max_F', <... 'numpy.float64'>),
+             ('gaussian_mean', <... 'numpy.float64'>, (2,)),
+             ('gaussian_cov', <... 'numpy.float64'>, (2, 2)),
+             ('centroid', <... 'numpy.float64'>, (2,))]
+    """
+
+    ndim = len(shape)
+    dtype = numpy.dtype(dtype)
+    dtype_type = dtype.type
+
+    neurons_dtype = [("mask", numpy.bool8, shape),
+                     ("contour", numpy.bool8, shape),
+                     ("image", dtype_type, shape),
+                     ("area", numpy.float64),
+                     ("max_F", dtype_type),
+                     ("gaussian_mean", numpy.float64, (ndim,)),
+                     ("gaussian_cov", numpy.float64, (ndim, ndim,)),
+                     ("centroid", numpy.float64, (ndim,))]
+
+    return(neurons_dtype)
+
+
+@prof.log_call(trace_logger)
+def get_empty_neuron(shape, dtype):
+    """
+        Gets a numpy structured array using the type from get_neuron_dtype that
+        has no contents.
+
+        Args:
+            new_image(numpy.ndarray):     an empty numpy structured array with
+                                          all types needed for a neuron.
+
+        Returns:
+            numpy.ndarray:                a numpy structured array with no
+                                          contents and type from
+                                          get_neuron_dtype.
+
+        Examples:
+            >>> get_empty_neuron(
+            ...     (3,), numpy.float64
+            ... ) #doctest: +NORMALIZE_WHITESPACE
+            array([], dtype=[('mask', '?', (3,)),
+                             ('contour', '?', (3,)),
+                             ('image', '<f8', (3,)),
+                             ('area', '<f8'),
+                             ('max_F', '<f8'),
+                             ('gaussian_mean', '<f8', (1,)),
+                             ('gaussian_cov', '<f8', (1, 1)),
+                             ('centroid', '<f8', (1,))])
+
+            >>> get_empty_neuron(
+            ...     (2, 3), numpy.float64
+            ... ) #doctest: +NORMALIZE_WHITESPACE
+            array([], dtype=[('mask', '?', (2, 3)),
+                             ('contour', '?', (2, 3)),
+                             ('image', '<f8', (2, 3)),
+                             ('area', '<f8'),
+                             ('max_F', '<f8'),
+                             ('gaussian_mean', '<f8', (2,)),
+                             ('gaussian_cov', '<f8', (2, 2)),
+                             ('centroid', '<f8', (2,))])
+    """
+
+    neurons_dtype = get_neuron_dtype(shape=shape, dtype=dtype)
+    neurons = numpy.zeros((0,), dtype=neurons_dtype)
+
+    return(neurons)
+
+
+@prof.log_call(trace_logger)
+def get_one_neuron(shape, dtype):
+    """
+        Gets a numpy structured array using the type from get_neuron_dtype that
+        has one neuron with all zeros.
+
+        Args:
+            new_image(numpy.ndarray):     an empty numpy structured array with
+                                          all types needed for a neuron.
+
+        Returns:
+            numpy.ndarray:                a numpy structured array with one
+                                          neuron using type from
+                                          get_neuron_dtype.
+
+        Examples:
+            >>> numpy.set_printoptions(
+            ...     formatter={"float": lambda x: str(float(x))}
+            ... )
+            >>> get_one_neuron(
+            ...     (3,), numpy.float64
+            ... ) #doctest: +NORMALIZE_WHITESPACE
+            array([ ([False, False, False],
+                     [False, False, False],
+                     [0.0, 0.0, 0.0],
+                     0.0,
+                     0.0,
+                     [0.0],
+                     [[0.0]],
+                     [0.0])],
+                   dtype=[('mask', '?', (3,)),
+                          ('contour', '?', (3,)),
+                          ('image', '<f8', (3,)),
+                          ('area', '<f8'),
+                          ('max_F', '<f8'),
+                          ('gaussian_mean', '<f8', (1,)),
+                          ('gaussian_cov', '<f8', (1, 1)),
+                          ('centroid', '<f8', (1,))])
+
+            >>> get_one_neuron(
+            ...     (2, 3), numpy.float64
+            ... ) #doctest: +NORMALIZE_WHITESPACE
+            array([ ([[False, False, False],
+                      [False, False, False]],
+                     [[False, False, False],
+                      [False, False, False]],
+                     [[0.0, 0.0, 0.0],
+                      [0.0, 0.0, 0.0]],
+                     0.0,
+                     0.0,
+                     [0.0, 0.0],
+                    [[0.0, 0.0],
+                     [0.0, 0.0]],
+                    [0.0, 0.0])],
+                   dtype=[('mask', '?', (2, 3)),
+                          ('contour', '?', (2, 3)),
+                          ('image', '<f8', (2, 3)),
+                          ('area', '<f8'),
+                          ('max_F', '<f8'),
+                          ('gaussian_mean', '<f8', (2,)),
+                          ('gaussian_cov', '<f8', (2, 2)),
+                          ('centroid', '<f8', (2,))])
+
+            >>> numpy.set_printoptions()
+    """
+
+    neurons_dtype = get_neuron_dtype(shape=shape, dtype=dtype)
+    neurons = numpy.zeros((1,), dtype=neurons_dtype)
+
+    return(neurons)
+
+
+@prof.log_call(trace_logger)
+def generate_local_maxima_vigra(new_intensity_image):
+    """
+        Creates a mask the same size as the intensity image with local maxima
+        as True and background False. Uses vigra's
+        vigra.analysis.extendedLocalMaxima for 2D and
+        vigra's vigra.analysis.extendedLocalMaxima3D for 3D.
+
+        Args:
+            new_intensity_image(numpy.ndarray):     The image to find local
+                                                    maxima for (ideally, all
+                                                    axes are spatial; however,
+                                                    it will treat all axes the
+                                                    same).
+
+        Returns:
+            numpy.ndarray:                          A mask of the local maxima.
+    """
+
+    local_maxima_mask = None
+    if new_intensity_image.ndim == 2:
+        local_maxima_mask = vigra.analysis.extendedLocalMaxima(
+            new_intensity_image.astype(numpy.float32)).astype(bool)
+    elif new_intensity_image.ndim == 3:
+        local_maxima_mask = vigra.analysis.extendedLocalMaxima3D(
+            new_intensity_image.astype(numpy.float32)).astype(bool)
+    else:
+        assert False
+
+    return(local_maxima_mask)
+
+
+@prof.log_call(trace_logger)
+def generate_local_maxima_scikit_image(new_intensity_image,
+                                       local_max_neighborhood_size=1):
+    """
+        Creates a mask the same size as the intensity image with local maxima
+        as True and background False. Uses scikit image's
+        skimage.feature.peak_local_max.
+
+        Args:
+            new_intensity_image(numpy.ndarray):     The image to find local
+                                                    maxima for (ideally, all
+                                                    axes are spatial; however,
+                                                    it will treat all axes the
+                                                    same).
+
+            local_max_neighborhood_size(int):       Size of the neighborhood to
+                                                    check for a local maxima.
+
+        Returns:
+            numpy.ndarray:                          A mask of the local maxima.
+    """
+
+    local_maxima_neighborhood = numpy.ones(
+        (2 * local_max_neighborhood_size + 1,) * new_intensity_image.ndim
+    )
+    local_maxima_mask = skimage.feature.peak_local_max(
+        new_intensity_image,
+        footprint=local_maxima_neighborhood,
+        labels=(new_intensity_image > 0),
+        indices=False
+    )
+
+    return(local_maxima_mask)
+
+
+@prof.log_call(trace_logger)
+def generate_local_maxima(new_intensity_image):
+    """
+        Creates a mask the same size as the intensity image with local maxima
+        as True and background False.
+
+        Args:
+            new_intensity_image(numpy.ndarray):     The image to find local
+                                                    maxima for (ideally, all
+                                                    axes are spatial; however,
+                                                    it will treat all axes the
+                                                    same).
+
+        Returns:
+            numpy.ndarray:                          A mask of the local maxima.
+    """
+
+    return(generate_local_maxima_vigra(new_intensity_image))
+
+
+@prof.log_call(trace_logger)
+def extended_region_local_maxima_properties(
+        new_intensity_image,
+        new_label_image,
+        **kwargs
+):
+    """
+        Generates local maxima along with other properties for each labeled
+        region (therefore at least one entry per label). Gets a label image if
+        not provided by using the threshold (if not provided is zero).
+
+        Note:
+            This is similar to region_properties. It differs in that it keeps
+            track of all local maxima. So, it is no longer one-to-one in
+            labels, but is one-to-one in local maxima.
+
+        Args:
+            new_intensity_image(numpy.ndarray):     The intensity image to find
+                                                    local maxima for (ideally,
+                                                    all axes are spatial;
+                                                    however, it will treat all
+                                                    axes the same).
+
+            new_label_image(numpy.ndarray):         The label image to find
+                                                    local maxima for (ideally,
+                                                    all axes are spatial;
+                                                    however, it will treat all
+                                                    axes the same).
+
+        Returns:
+            numpy.ndarray:                          A mask of the local maxima.
+    """
+
+    # Remove the background
+    new_image_mask = (new_label_image != 0)
+    new_intensity_image_masked = (~new_image_mask * new_intensity_image.min()) + \
+                                 (new_image_mask * new_intensity_image)
+
+    # Get a mask of the local maxima
+    # that only includes local maxima not in the background
+    local_maxima_mask = generate_local_maxima(new_intensity_image_masked)
+
+    # Count the local maxima and give them different labels
+    local_maxima_labeled = scipy.ndimage.label(
+        local_maxima_mask
+    )[0]
+
+    # Generate the properties of the labeled regions
+    labeled_props = region_properties(new_label_image, **kwargs)
+
+    # Generate the properties of the local maxima
+    local_maxima_props = region_properties(
+        local_maxima_labeled, properties=["label", "centroid"]
+    )
+
+    # We want to have a few more type present in our NumPy structured array.
+    # To do this, we collect the existing types into a list and
+    # add our new types onto the end. Finally,
+    # we make the new structured array type from the list we have.
+    props_dtype = []
+
+    # Place on the label props dtype first
+    labeled_props_dtype = xnumpy.numpy_structured_array_dtype_list(
+        labeled_props
+    )
+    props_dtype.extend(labeled_props_dtype)
+
+    # Then add new fields.
+    props_dtype.append(("local_max", int, new_intensity_image.ndim))
+    props_dtype.append(("intensity", new_intensity_image.dtype))
+
+    # Makes a new properties array that contains enough entries to hold the
+    # old one and has all the types we desire.
+    new_local_maxima_props = numpy.zeros(
+        local_maxima_props.shape, dtype=numpy.dtype(props_dtype)
+    )
+
+    # Take the centroids and old labels as the label and local max
+    new_local_maxima_props["label"] = local_maxima_props["label"]
+    new_local_maxima_props["local_max"] = local_maxima_props["centroid"].round().astype(int)
+
+    # Replace the old structured array with the enlarged version.
+    local_maxima_props = new_local_maxima_props
+
+    # Stores the intensity at the local max for easy retrieval
+    # Replace the labels by using the values from the label image
+    if local_maxima_props.size:
+        local_maxima_props_indices = tuple(local_maxima_props["local_max"].T)
+        local_maxima_props["intensity"] = new_intensity_image[local_maxima_props_indices]
+        local_maxima_props["label"] = new_label_image[local_maxima_props_indices]
+
+    # Now, we want to merge the other properties in with our local maxima
+    # But, we will skip it if there are no local maxima.
+    # Each local max is matched with its label's properties all at once.
+    if local_maxima_props.size and labeled_props.size:
+        labeled_props_indices = numpy.searchsorted(
+            labeled_props["label"], local_maxima_props["label"]
+        ).clip(0, len(labeled_props) - 1)
+        labeled_props_found = (
+            labeled_props["label"][labeled_props_indices] ==
+            local_maxima_props["label"]
+        )
+        labeled_props_indices = labeled_props_indices[labeled_props_found]
+
+        for each_new_prop_name, _, __ in labeled_props_dtype:
+            local_maxima_props[each_new_prop_name][labeled_props_found] = labeled_props[each_new_prop_name][labeled_props_indices]
+
+    return(local_maxima_props)
+
+
+@prof.log_class(trace_logger)
+@hdf5.record.class_static_array_debug_recorder
+class ExtendedRegionProps(object):
+    """
+        Using the results of extended_region_local_maxima_properties with given
+        intensity and label images, the ExtendedRegionProps attempts to make it
+        easy to get information about local maxima in the image. Further, it
+        provides methods to allow removal of local maxima. When removing local
+        maxima, it will updated the given label image to reflect labels that
+        have been removed completely and will automatically renumber the label
+        image (as some functions expect a label image with sequential
+        numbering, no missing label number). This provides a simple way to
+        maintain a label image, whose local maxima one is more interested in
+        directly manipulating.
+
+        Note:
+            Adding local maxima is not allowed for and wouldn't make sense
+            given its dependency on the intensity image.
+    """
+
+    def __init__(self,
+                 new_intensity_image,
+                 new_label_image,
+                 properties=["centroid"],
+                 copy=True):
+        """
+            Construct an ExtendedRegionProps instance.
+
+            This uses extended_region_local_maxima_properties to determine
+            local maxima and properties for the labeled region. After doing
+            this, it is possible to remove local maxima and update the label
+            image to reflect this change.
+
+            Args:
+                new_intensity_image(numpy.ndarray):     The intensity image to
+                                                        find local maxima for
+                                                        (ideally, all axes are
+                                                        spatial; however, it
+                                                        will treat all axes
+                                                        the same).
+
+                new_label_image(numpy.ndarray):         The label image to find
+                                                        local maxima for (
+                                                        ideally, all axes are
+                                                        spatial; however, it
+                                                        will treat all axes the
+                                                        same).
+
+                properties(list):                       used to generate
+                                                        initial properties.
+
+                copy(bool):                             whether to copy the
+                                                        images (if not, they
+                                                        are changed when local
+                                                        maxima are removed).
+        """
+
+        # Copied to ensure purity. Would not want to change outside values.
+        self.intensity_image = new_intensity_image
+        self.label_image = new_label_image
+        if copy:
+            self.intensity_image = self.intensity_image.copy()
+            self.label_image = self.label_image.copy()
+
+        self.image_mask = (self.label_image > 0)
+        self.props = None
+        self.count = None
+
+        logger.debug("Finding the local maxima and properties...")
+
+        self.props = extended_region_local_maxima_properties(
+            self.intensity_image,
+            self.label_image,
+            properties=properties
+        )
+
+        logger.debug("Found the local maxima and properties.")
+
+        # Remove maxima in the background
+        background_maxima_mask = (self.props["label"] == 0)
+        if (numpy.any(background_maxima_mask)):
+            # There shouldn't be any maximums in the background. This should
+            # never happen.
+            logger.warning(
+                "Found \"" + (background_maxima_mask).sum() +
+                "\" maximum(s) found in the background (label 0)."
+            )
+            # Remove the 0 labels
+            self.props = self.props[background_maxima_mask]
+
+        del background_maxima_mask
+
+        # Stores the number of times a particular label maxima appears.
+        self.count = numpy.empty(
+            (self.label_image.max(),), dtype=[("label", int), ("count", int)])
+        # Get all the labels used in the label image
+        self.count["label"] = numpy.arange(1, self.label_image.max() + 1)
+        # Get the count of those labels (excluding zero as it is background)
+        self.count["count"] = numpy.bincount(
+            self.props["label"], minlength=len(self.count) + 1)[1:]
+
+        if self.count.size and numpy.any(self.count["count"] == 0):
+            # All labels should have a local maximum. If they don't, this could
+            # be a problem.
+
+            failed_labels = self.count["label"][self.count["count"] == 0]
+            failed_labels_list = failed_labels.tolist()
+            failed_label_msg = "Label(s) not found in local maxima." + \
+                               " For labels = " + repr(failed_labels_list) + "."
+
+            logger.warning(failed_label_msg)
+
+            ExtendedRegionProps.recorders.array_debug_recorder["intensity_image"] = self.intensity_image[None]
+            ExtendedRegionProps.recorders.array_debug_recorder["label_image"] = self.label_image[None]
+
+            if self.props.size:
+                ExtendedRegionProps.recorders.array_debug_recorder["props"] = self.props
+
+            ExtendedRegionProps.recorders.array_debug_recorder["count"] = self.count
+            if ExtendedRegionProps.recorders.array_debug_recorder:
+                ExtendedRegionProps.recorders.array_debug_recorder["masks"] = \
+                    xnumpy.all_permutations_equal(
+                            failed_labels, self.label_image
+                    )
+            ExtendedRegionProps.recorders.array_debug_recorder["masks_labels"] = failed_labels
+
+            # Renumber labels.
+            # This way there are no labels without local maxima.
+            self.renumber_labels()
+
+        logger.debug("Refinined properties for local maxima.")
+
+
+    def get_local_max_index_array(self):
+        """
+            Gets a numpy style index array from the local maxima present.
+
+            Returns:
+                tuple:      a numpy styled index array, which can be used on
+                            the intensity image, or label image.
+        """
+
+        return(tuple(self.props["local_max"].T))
+
+
+    def get_local_max_mask(self):
+        """
+            Gets a bool numpy array that is True at the locations of the local
+            maxima.
+
+            Returns:
+                numpy.ndarray:      a bool numpy array that is True where a
+                                    local max is and False everywhere else.
+        """
 
-    new_label_image_props = None
-    new_label_image_props_with_arrays = None
-    new_label_image_props_with_arrays_values = None
-    new_label_image_props_with_arrays_dtype = None
+        # Returns a label image containing each local max and its label.
+        new_local_max_mask = numpy.zeros(
+            self.label_image.shape, dtype=self.label_image.dtype
+        )
 
-    properties = None
-    if (len(args)) and (args[0]):
-        properties = args[0]
-        properties = [str(_) for _ in properties]
-        args = args[1:]
-    elif (len(kwargs)) and ("properties" in kwargs):
-        properties = kwargs["properties"]
-        properties = [str(_) for _ in properties]
-        del kwargs["properties"]
-    else:
-        properties = ["area", "centroid"]
+        # Set the given local maxima to be the same as their labels
+        new_local_max_mask[self.get_local_max_index_array()] = True
 
-    if ((properties == "all") or (properties is None)):
-        properties = list(region_properties_type_dict.keys())
+        return(new_local_max_mask)
 
-    intensity_image = None
-    if (len(args)) and (args[0]):
-        intensity_image = args[0]
-        args = args[1:]
-    elif (len(kwargs)) and ("intensity_image" in kwargs):
-        intensity_image = kwargs["intensity_image"]
-        del kwargs["intensity_image"]
-    else:
-        pass
 
-    # Remove duplicates and make sure label is at the front.
-    properties = set(properties)
-    allowed_properties = set(region_properties_type_dict.keys())
-    disallowed_properties = properties.difference(allowed_properties)
+    def get_local_max_label_image(self):
+        """
+            Gets an int numpy array that contains the labels of the local
+            maxima.
 
-    if len(disallowed_properties):
-        disallowed_properties = sorted(disallowed_properties)
-        raise Exception(
-            "Recieved \"" + repr(len(disallowed_properties)) +
-            "\" properties that are not allowed, which are \"" +
-            repr(disallowed_properties) + "\"."
+            Returns:
+                numpy.ndarray:      an int numpy array that contains the labels
+                                    of the local maxima and is zero in the
+                                    background.
+        """
+
+        # Returns a label image containing each local max and its labels.
+        new_local_max_label_image = numpy.zeros(
+            self.label_image.shape, dtype=self.label_image.dtype
         )
 
-    properties.discard("label")
-    properties = ["label"] + sorted(properties)
+        # Set the given local maxima to be the same as their labels
+        new_local_max_label_image[self.get_local_max_index_array()] = self.props["label"]
+
+        return(new_local_max_label_image)
+
+
+    def remove_prop_mask(self, remove_prop_indices_mask):
+        """
+            Removes the local maxima by the mask over their indices (only False
+            elements will be kept).
+
+            Note:
+                If a label is removed completely, the label image, intensity
+                image, and image mask will be updated. Also, the count (of
+                local maxima per label) will be updated, regardless.
+
+            Args:
+                remove_prop_indices_mask(numpy.ndarray):     A mask of the
+                                                             indices to drop
+                                                             (True for the ones
+                                                             to remove, and
+                                                             False for the ones
+                                                             to keep).
+        """
+
+        # Get the labels to remove
+        remove_labels = self.props["label"][remove_prop_indices_mask]
+        # Get how many of each label to remove
+        label_count_to_remove = numpy.bincount(
+            remove_labels, minlength=len(self.count) + 1
+        )[1:]
 
+        # Take a subset of the label props that does not include the removal
+        # mask (copying may not be necessary as the mask may be as effective).
+        self.props = self.props[~remove_prop_indices_mask]
+        # Reduce the count by the number of each label
+        self.count["count"] -= label_count_to_remove
 
-    class VigraProperties(object):
-        def __init__(self, label_image, intensity_image=None):
-            self.label_image = label_image
-            self.intensity_image = intensity_image
+        # Mask over self.count to find labels that do not have local maxima
+        inactive_label_count_mask = (self.count["count"] == 0)
 
-            if self.intensity_image is None:
-                self.intensity_image = self.label_image
+        # Are there labels that do not exist now? If so, we will dump them.
+        if inactive_label_count_mask.any():
+            # Features of the remaining regions will not change. So, if they
+            # are known, they are carried over instead of being found again.
+            label_image_features = _region_features(
+                self.label_image, cached_only=True
+            )
+            labels_to_keep = self.count["label"][~inactive_label_count_mask]
 
-            self.props = vigra.analysis.extractRegionFeatures(
-                self.intensity_image.astype(numpy.float32),
-                self.label_image.astype(numpy.uint32),
-                features=["Count", "RegionCenter", "RegionRadii"]
+            # Find the labels to remove from the label image and mask and
+            # remove them
+            labels_to_remove = self.count["label"][inactive_label_count_mask]
+            labels_to_remove_mask = xnumpy.contains(
+                self.label_image, labels_to_remove
             )
+            self.label_image[labels_to_remove_mask] = 0
+            self.image_mask[labels_to_remove_mask] = 0
+            self.intensity_image[labels_to_remove_mask] = 0
 
-        def __len__(self):
-            return(len(self.props["Count"]) - 1)
+            # Renumber all labels sequentially starting with the label image
+            self.renumber_labels()
 
-        def __getitem__(self, item):
-            result = None
+            # Kept labels are renumbered in order.
+            if label_image_features is not None:
+                new_label_image_features = dict()
+                for each_feature, each_values in label_image_features.items():
+                    new_label_image_features[each_feature] = each_values[labels_to_keep - 1]
 
-            if item == "label":
-                result = numpy.arange(0, len(self) + 1)
-            elif item == "area":
-                result = self.props["Count"].astype(numpy.float64)
-            elif item == "centroid":
-                result = self.props["RegionCenter"].astype(numpy.float64)
-            elif item == "eccentricity":
-                result = (
-                    1 - (
-                        self.props["RegionRadii"].min(axis=1).astype(numpy.float64) /
-                        self.props["RegionRadii"].max(axis=1).astype(numpy.float64)
-                    )**2
-                )**.5
-            elif item == "major_axis_length":
-                result = 4 * \
-                    self.props["RegionRadii"].max(axis=1).astype(numpy.float64)
-            elif item == "minor_axis_length":
-                result = 4 * \
-                    self.props["RegionRadii"].min(axis=1).astype(numpy.float64)
-            else:
-                # Should have already checked and removed these.
-                assert False
+                _cache_region_features(
+                    _region_features_key(self.label_image),
+                    new_label_image_features
+                )
 
-            result = result[1:]
 
-            return(result)
+    def remove_prop_indices(self, *i):
+        """
+            Removes the local maxima of the indices listed (like
+            remove_prop_mask except with indices).
 
-    if new_label_image.size:
-        # This gives a list of dictionaries. However, this is not very usable.
-        # So, we will convert this to a structured NumPy array.
-        # In future versions, the properties argument will be removed.
-        # It does not need to be passed to retain functionality of this
-        # function.
-        new_label_image_props = VigraProperties(
-            new_label_image, intensity_image)
+            Note:
+                If a label is removed completely, the label image, intensity
+                image, and image mask will be updated. Also, the count (of
+                local maxima per label) will be updated, regardless.
 
-        new_label_image_props_with_arrays = []
-        for i in iters.irange(len(new_label_image_props)):
-            new_label_image_props_with_arrays.append({})
+            Args:
+                *i(int):     A mask of the indices to drop (True for the ones
+                             to remove, and False for the ones to keep).
+        """
 
-            for each_key in properties:
-                if each_key in array_properties:
-                    new_label_image_props_with_arrays[i][each_key] = numpy.array(
-                        new_label_image_props[each_key][i])
-                else:
-                    new_label_image_props_with_arrays[i][
-                        each_key] = new_label_image_props[each_key][i]
+        # A mask of the indices to remove
+        remove_prop_indices_mask = numpy.zeros((len(self.props),), dtype=bool)
+        remove_prop_indices_mask[numpy.array(i)] = True
 
-        # Holds the values from props.
-        new_label_image_props_with_arrays_values = []
+        self.remove_prop_mask(remove_prop_indices_mask)
 
-        # Holds the types from props.
-        new_label_image_props_with_arrays_dtype = []
+    def renumber_labels(self):
+        """
+            An internal method to be called after a label is completely removed
+            from the local maxima.
 
-        if len(new_label_image_props_with_arrays):
-            # Get types for all properties as a dictionary
-            for each_name in properties:
-                each_sample_value = new_label_image_props_with_arrays[0][each_name]
-                each_type = type(each_sample_value)
-                each_shape = tuple()
+            Ensures all labels are in sequential order in the label image,
+            count, and that all local maxima have their labels updated.
 
-                if isinstance(each_sample_value, numpy.ndarray) and \
-                        (each_name in fixed_shape_properties):
-                    each_type = each_sample_value.dtype
-                    each_shape = each_sample_value.shape
-                else:
-                    each_type = numpy.dtype(each_type)
 
-                new_label_image_props_with_arrays_dtype.append(
-                    (each_name, each_type, each_shape)
-                )
+            Note:
+                Calling this externally will not make a difference as long as
+                removal has occurred through the usual mechanisms.
+        """
+
+        # Renumber all labels sequentially starting with the label image
+        self.label_image[:], forward_label_mapping, reverse_label_mapping = skimage.segmentation.relabel_sequential(
+            self.label_image
+        )
+
+        # Remove zero from the mappings as it is background and remains the
+        # same
+        forward_label_mapping = forward_label_mapping[forward_label_mapping != 0]
+        reverse_label_mapping = reverse_label_mapping[reverse_label_mapping != 0]
+
+        # Replace the old labels in self.props["label"] with the new ones.
+        # The new labels must range from 1 to the length of
+        # reverse_label_mapping (skipping 0 as it is the background).
+        self.props["label"] = xnumpy.remap_labels(
+            self.props["label"], reverse_label_mapping
+        )
+
+        # Get a mask over the labels to find what is contained
+        new_count_mask = xnumpy.contains(
+            self.count["label"], reverse_label_mapping
+        )
+        # Move the values of the count into the proper lower labels and zero
+        # everything else
+        self.count["count"][:len(reverse_label_mapping)] = self.count["count"][new_count_mask]
+        self.count["count"][len(reverse_label_mapping):] = 0
+
+        # (copying may not be necessary as the slice may be as effective)
+        self.count = self.count[:len(reverse_label_mapping)].copy()
+
+
+@prof.log_call(trace_logger)
+def remove_low_intensity_local_maxima(local_maxima,
+                                      percentage_pixels_below_max,
+                                      **parameters):
+    """
+        Removes the local maxima for regions, which have too many pixels that
+        are below the intensity of their local maxima.
+
+        Args:
+            local_maxima(ExtendedRegionProps):      The local maxima to refine
+
+            percentage_pixels_below_max(float):     The percentage of pixels
+                                                    out of a region that are
+                                                    below the local maxima of
+                                                    the region
+
+            **parameters(dict):                     essentially unused (catches
+                                                    unneeded arguments).
+
+        Returns:
+            ExtendedRegionProps:                    a new instance with the
+                                                    local maxima removed
+    """
+
+    # Deleting local maxima that does not exceed the 90th percentile of the
+    # pixel intensities
+
+    # Rank each intensity so that it can be combined with its label into one
+    # integer key. Sorting the keys groups each region's pixels by intensity.
+    # So, all regions are handled together.
+    labels_flat = local_maxima.label_image.ravel().astype(numpy.int64)
+    intensities_unique, intensities_ranks = numpy.unique(
+        local_maxima.intensity_image.ravel(), return_inverse=True
+    )
+    num_ranks = numpy.int64(len(intensities_unique) + 1)
+
+    pixel_keys = labels_flat * num_ranks + intensities_ranks.ravel()
+    pixel_keys.sort()
+
+    local_maxima_labels = local_maxima.props["label"].astype(numpy.int64)
+
+    # Get the number of pixels in each region
+    each_region_image_wavelet_num_pixels = numpy.bincount(
+        labels_flat,
+        minlength=int(numpy.concatenate([[0], local_maxima_labels]).max()) + 1
+    )[local_maxima_labels].astype(float)
+
+    # Get the number of pixels below each max for its region
+    each_region_image_wavelet_num_pixels_below_max = (
+        numpy.searchsorted(
+            pixel_keys,
+            local_maxima_labels * num_ranks + numpy.searchsorted(
+                intensities_unique, local_maxima.props["intensity"], "left"
+            ),
+            "left"
+        ) -
+        numpy.searchsorted(
+            pixel_keys, local_maxima_labels * num_ranks, "left"
+        )
+    ).astype(float)
+
+    # Get a ratio of the number of pixels below that max for that region
+    each_region_image_wavelet_ratio_pixels = each_region_image_wavelet_num_pixels_below_max / \
+        each_region_image_wavelet_num_pixels
+
+    # If the ratio clears our threshold, keep this label. Otherwise,
+    # eliminate it.
+    low_intensities__local_maxima_label_mask__to_remove = (
+        each_region_image_wavelet_ratio_pixels < percentage_pixels_below_max
+    )
+
+    new_local_maxima = copy.copy(local_maxima)
+
+    new_local_maxima.remove_prop_mask(
+        low_intensities__local_maxima_label_mask__to_remove)
+
+    logger.debug("Removed low intensity maxima that are too close.")
+
+    return(new_local_maxima)
+
+
+@prof.log_call(trace_logger)
+def remove_too_close_local_maxima(local_maxima,
+                                  min_local_max_distance,
+                                  **parameters):
+    """
+        Removes local maxima that are too close to each other.
 
-            # Store the values to place in NumPy structured array in order.
-            new_label_image_props_with_arrays_values = []
-            for j in iters.irange(len(new_label_image_props_with_arrays)):
-                # Add all values in order of keys from the dictionary.
-                new_label_image_props_with_arrays_values.append([])
-                for each_new_label_image_props_with_arrays_dtype in new_label_image_props_with_arrays_dtype:
-                    each_name, each_type, each_shape = each_new_label_image_props_with_arrays_dtype
+        Args:
+            local_maxima(ExtendedRegionProps):      The local maxima to refine
 
-                    if each_shape:
-                        new_label_image_props_with_arrays_values[j].append(
-                            new_label_image_props_with_arrays[j][each_name].tolist()
-                        )
-                    else:
-                        new_label_image_props_with_arrays_values[j].append(
-                            new_label_image_props_with_arrays[j][each_name]
-                        )
+            min_local_max_distance(float):          The minimum allowed
+                                                    distance between local
+                                                    maxima
 
-                # NumPy will expect a tuple for each set of values.
-                new_label_image_props_with_arrays_values[j] = tuple(
-                    new_label_image_props_with_arrays_values[j]
-                )
+            **parameters(dict):                     essentially unused (catches
+                                                    unneeded arguments).
 
-    if (not new_label_image.size) or \
-            (not len(new_label_image_props_with_arrays)):
-        new_label_image_props_with_arrays_dtype = []
-        for each_key in properties:
-            each_type = region_properties_type_dict[each_key]
-            each_shape = region_properties_shape_dict[each_key]
+        Returns:
+            ExtendedRegionProps:                    a new instance with the
+                                                    local maxima removed
+    """
 
-            if each_key in varied_shape_properties:
-                each_type = numpy.object_
-                each_shape = tuple()
+    # Deleting close local maxima below 16 pixels
+    too_close__local_maxima_label_mask__to_remove = numpy.zeros(
+        local_maxima.props.shape, dtype=bool)
 
-            new_label_image_props_with_arrays_dtype.append(
-                (each_key, each_type, each_shape)
-            )
+    # Find only the pairs of local max within the distance (efficiently)
+    local_maxima_points = numpy.asarray(
+        local_maxima.props["local_max"], dtype=float
+    )
+    local_maxima_pairs = numpy.array(
+        sorted(scipy.spatial.cKDTree(local_maxima_points).query_pairs(
+            min_local_max_distance
+        )),
+        dtype=int
+    ).reshape(-1, 2)
+
+    # Only strictly closer pairs count.
+    local_maxima_distances = numpy.sqrt((
+        (local_maxima_points[local_maxima_pairs[:, 0]] -
+         local_maxima_points[local_maxima_pairs[:, 1]]) ** 2
+    ).sum(axis=1))
+    too_close_local_maxima_pairs = local_maxima_pairs[
+        local_maxima_distances < min_local_max_distance
+    ]
 
-    new_label_image_props_with_arrays_dtype = numpy.dtype(
-        new_label_image_props_with_arrays_dtype
+    # Of too close pairs in the same region, remove the dimmer one.
+    first_props_index, second_props_index = too_close_local_maxima_pairs.T
+    same_label = (
+        local_maxima.props["label"][first_props_index] ==
+        local_maxima.props["label"][second_props_index]
     )
+    first_props_index = first_props_index[same_label]
+    second_props_index = second_props_index[same_label]
 
-    # Replace the properties with the structured array.
-    new_label_image_props_with_arrays = numpy.array(
-        new_label_image_props_with_arrays_values,
-        dtype=new_label_image_props_with_arrays_dtype
+    first_dimmer = (
+        local_maxima.props["intensity"][first_props_index] <
+        local_maxima.props["intensity"][second_props_index]
     )
+    too_close__local_maxima_label_mask__to_remove[first_props_index[first_dimmer]] = True
+    too_close__local_maxima_label_mask__to_remove[second_props_index[~first_dimmer]] = True
 
-    return(new_label_image_props_with_arrays)
+    new_local_maxima = copy.copy(local_maxima)
+
+    new_local_maxima.remove_prop_mask(too_close__local_maxima_label_mask__to_remove)
+
+    logger.debug("Removed local maxima that are too close.")
+
+    return(new_local_maxima)
 
 
 @prof.log_call(trace_logger)
-def region_properties(new_label_image, *args, **kwargs):
+@hdf5.record.static_array_debug_recorder
+def wavelet_thresholding(new_image,
+                         significance_threshold,
+                         wavelet_scale,
+                         noise_threshold,
+                         out=None,
+                         scratch=None,
+                         **parameters):
     """
-        Grabs region properties from a label image.
+        Finds a thresholding using a noise estimate and the wavelet transform.
 
         Args:
-            new_label_image(numpy.ndarray):      label image used for
-                                                 generating properties.
-
-            args(list):                          additional position arguments
-                                                 to pass
-                                                 skimage.measure.regionprops.
-
-            **parameters(dict):                  additional keyword arguments
-                                                 to pass
-                                                 skimage.measure.regionprops.
+            new_image(numpy.ndarray):                   image to threshold.
 
-        Note:
-            Uses all the same options in skimage.measure.regionprops. If a
-            property is not specified, then it won't be returned.
+            significance_threshold(float):              threshold above which
+                                                        everything is
+                                                        considered significant
+                                                        for the purpose of
+                                                        noise estimation.
 
-        Returns:
-            numpy.ndarray:                       a structured array of all the
-                                                 properties found for each
-                                                 label.
+            wavelet_scale(int):                         the scale of wavelet
+                                                        transform to use.
 
+            noise_threshold(float):                     a ratio to which the
+                                                        noise estimate scales
+                                                        (e.g. 1.0 means the
+                                                        noise computed is the
+                                                        noise used).
 
-        Examples:
+            out(tuple of numpy.ndarray):                arrays to store the
+                                                        wavelet transformed
+                                                        array (float32) and
+                                                        the mask (bool) in
+                                                        (made if not
+                                                        provided).
+
+            scratch(tuple of numpy.ndarray):            temporaries for
+                                                        wavelet.transform (a
+                                                        pair of float32
+                                                        images) and for
+                                                        significant_mask
+                                                        (float32 with the
+                                                        shape of the wavelet
+                                                        transformed array)
+                                                        (made if not
+                                                        provided).
+
+            **parameters(dict):                         additional arguments
+                                                        for estimate_noise
+                                                        (e.g. estimator or
+                                                        sample_size).
 
-            >>> numpy.set_printoptions(
-            ...     formatter={"float": lambda x: str(float(x))}
-            ... )
+        Returns:
+            tuple of numpy.ndarray:                     a wavelet transformed
+                                                        array and a mask.
+    """
 
-            >>> region_properties(
-            ...     numpy.zeros((2,2), dtype=int)
-            ... ) # doctest: +NORMALIZE_WHITESPACE
-            array([],
-                  dtype=[('label', '<i8'), ('area', '<f8'), ('centroid', '<f8', (2,))])
+    new_wavelet_transformed_image = None
+    new_wavelet_transformed_image_significant_mask = None
 
-            >>> region_properties(
-            ...     numpy.ones((2,2), dtype=int)
-            ... ) # doctest: +NORMALIZE_WHITESPACE
-            array([(1, 4.0, [0.5, 0.5])],
-                  dtype=[('label', '<i8'), ('area', '<f8'), ('centroid', '<f8', (2,))])
+    # Contains a bool array with significant values True and noise False.
+    new_image_noise_estimate = estimate_noise(
+        new_image,
+        significance_threshold=significance_threshold,
+        **parameters
+    )
 
-            >>> region_properties(
-            ...     numpy.ones((3,3), dtype=int)
-            ... ) # doctest: +NORMALIZE_WHITESPACE
-            array([(1, 9.0, [1.0, 1.0])],
-                  dtype=[('label', '<i8'), ('area', '<f8'), ('centroid', '<f8', (2,))])
+    # Dictionary with wavelet transform applied. Wavelet transform is the
+    # first index.
+    if out is None:
+        out = (None, None)
 
-            >>> region_properties(
-            ...     numpy.eye(3, dtype=int)
-            ... ) # doctest: +NORMALIZE_WHITESPACE
-            array([(1, 3.0, [1.0, 1.0])],
-                  dtype=[('label', '<i8'), ('area', '<f8'), ('centroid', '<f8', (2,))])
+    if scratch is None:
+        scratch = (None, None)
 
-            >>> region_properties(
-            ...     numpy.eye(3, dtype=int), ["area", "centroid"]
-            ... ) # doctest: +NORMALIZE_WHITESPACE
-            array([(1, 3.0, [1.0, 1.0])],
-                  dtype=[('label', '<i8'), ('area', '<f8'), ('centroid', '<f8', (2,))])
+    new_wavelet_transformed_image = wavelet.transform(
+        new_image,
+        include_intermediates=False,
+        include_lower_scales=True,
+        scale=wavelet_scale,
+        out=out[0],
+        scratch=scratch[0]
+    )
 
-            >>> region_properties(
-            ...     numpy.eye(3, dtype=int), properties=["area", "centroid"]
-            ... ) # doctest: +NORMALIZE_WHITESPACE
-            array([(1, 3.0, [1.0, 1.0])],
-                  dtype=[('label', '<i8'), ('area', '<f8'), ('centroid', '<f8', (2,))])
+    if wavelet_thresholding.recorders.array_debug_recorder:
+        for i in iters.irange(len(new_wavelet_transformed_image)):
+            wavelet_thresholding.recorders.array_debug_recorder["new_wavelet_transformed_image"] = \
+                new_wavelet_transformed_image[i][None]
 
-            >>> numpy.set_printoptions()
-    """
+    # Contains a bool array with significant values True and noise False for
+    # all wavelet transforms.
+    new_wavelet_transformed_image_significant_mask = significant_mask(
+        new_wavelet_transformed_image,
+        noise_estimate=new_image_noise_estimate,
+        noise_threshold=noise_threshold,
+        out=out[1],
+        scratch=scratch[1]
+    )
 
-    return(region_properties_vigra(new_label_image, *args, **kwargs))
+    return(
+        new_wavelet_transformed_image,
+        new_wavelet_transformed_image_significant_mask
+    )
 
 
 @prof.log_call(trace_logger)
-def get_neuron_dtype(shape, dtype):
+@hdf5.record.static_array_debug_recorder
+def match_regions_properties(props, constraints):
     """
-        Gets the type based on properties of an image.
+        Returns a mask selecting the regions with matching properties.
 
         Args:
-            new_image(numpy.ndarray):     a single sample image (only spatial
-                                          dimension).
+            props(numpy.ndarray):           properties of each labeled region.
+
+            constraints(dict):              dictionary containing each property
+                                            with optional ``min`` and ``max``
+                                            for each value.
 
         Returns:
-            list:                         a list that can be converted to a
-                                          numpy.dtype using numpy.ndtype's
-                                          constructor.
+            numpy.ndarray:                  mask with each region property that
+                                            matches marked as ``True`` and the
+                                            rest marked as ``False``.
+    """
 
-        Examples:
-            >>> get_neuron_dtype(
-            ...     (3,), numpy.float64
-            ... ) #doctest: +NORMALIZE_WHITESPACE, +ELLIPSIS
-            [('mask', <... 'numpy.bool_'>, (3,)),
-             ('contour', <... 'numpy.bool_'>, (3,)),
-             ('image', <... 'numpy.float64'>, (3,)),
-             ('area', <... 'numpy.float64'>),
-             ('max_F', <... 'numpy.float64'>),
-             ('gaussian_mean', <... 'numpy.float64'>, (1,)),
-             ('gaussian_cov', <... 'numpy.float64'>, (1, 1)),
-             ('centroid', <... 'numpy.float64'>, (1,))]
+    within_bound = numpy.ones(props.shape, dtype=bool)
 
+    # Go through each property and make sure they are within the bounds
+    for each_prop, each_prop_constraints in constraints.items():
+        # If there is a lower bound, checks to see which are above it.
+        is_lower_bounded_maybe = None
+        if "min" in each_prop_constraints:
+            lower_bound = each_prop_constraints["min"]
+            is_lower_bounded_maybe = (
+                lower_bound <= props[each_prop]
+            )
+        else:
+            is_lower_bounded_maybe = numpy.ones(
+                props.shape, dtype=bool
+            )
 
-            >>> get_neuron_dtype(
-            ...     (2, 3), numpy.float64
-            ... ) #doctest: +NORMALIZE_WHITESPACE, +ELLIPSIS
-            [('mask', <... 'numpy.bool_'>, (2, 3)),
-             ('contour', <... 'numpy.bool_'>, (2, 3)),
-             ('image', <... 'numpy.float64'>, (2, 3)),
-             ('area', <... 'numpy.float64'>),
-             ('max_F', <... 'numpy.float64'>),
-             ('gaussian_mean', <... 'numpy.float64'>, (2,)),
-             ('gaussian_cov', <... 'numpy.float64'>, (2, 2)),
-             ('centroid', <... 'numpy.float64'>, (2,))]
-    """
+        # If there is an upper bound, checks to see which are below it.
+        is_upper_bounded_maybe = None
+        if "max" in each_prop_constraints:
+            upper_bound = each_prop_constraints["max"]
+            is_upper_bounded_maybe = (
+                props[each_prop] <= upper_bound
+            )
+        else:
+            is_upper_bounded_maybe = numpy.ones(
+                props.shape, dtype=bool
+            )
 
-    ndim = len(shape)
-    dtype = numpy.dtype(dtype)
-    dtype_type = dtype.type
+        # See whether both or neither bound is satisfied.
+        is_within_bound = is_lower_bounded_maybe & is_upper_bounded_maybe
 
-    neurons_dtype = [("mask", numpy.bool8, shape),
-                     ("contour", numpy.bool8, shape),
-                     ("image", dtype_type, shape),
-                     ("area", numpy.float64),
-                     ("max_F", dtype_type),
-                     ("gaussian_mean", numpy.float64, (ndim,)),
-                     ("gaussian_cov", numpy.float64, (ndim, ndim,)),
-                     ("centroid", numpy.float64, (ndim,))]
+        # Collect the unbounded ones
+        within_bound &= is_within_bound
 
-    return(neurons_dtype)
+    return(within_bound)
 
 
 @prof.log_call(trace_logger)
-def get_empty_neuron(shape, dtype):
+def watershed_components(new_image, new_markers, new_mask, num_threads=1):
     """
-        Gets a numpy structured array using the type from get_neuron_dtype that
-        has no contents.
+        Performs a watershed segmentation of the image (like
+        skimage.morphology.watershed) on each connected component of the mask
+        separately. Each one only uses the crop given by its bounding box and
+        are stitched back together afterwards. As flooding never leaves a
+        connected component of the mask, this gives the same result as doing
+        the whole image at once. However, it is much cheaper when the mask
+        only covers a little of the image.
+
+        Note:
+            If markers start at equal values, the order they are flooded
+            from is arbitrary. So, ties between them may be broken
+            differently than for the whole image.
 
         Args:
-            new_image(numpy.ndarray):     an empty numpy structured array with
-                                          all types needed for a neuron.
+            new_image(numpy.ndarray):           image to flood (lowest values
+                                                first).
+
+            new_markers(numpy.ndarray):         labels to flood from (0 where
+                                                there are none).
+
+            new_mask(numpy.ndarray):            where flooding is allowed.
+
+            num_threads(int):                   number of threads to use for
+                                                segmenting the components.
+                                                (Default 1)
 
         Returns:
-            numpy.ndarray:                a numpy structured array with no
-                                          contents and type from
-                                          get_neuron_dtype.
+            numpy.ndarray:                      the label image from flooding
+                                                (0 outside of the mask).
 
         Examples:
-            >>> get_empty_neuron(
-            ...     (3,), numpy.float64
-            ... ) #doctest: +NORMALIZE_WHITESPACE
-            array([], dtype=[('mask', '?', (3,)),
-                             ('contour', '?', (3,)),
-                             ('image', '<f8', (3,)),
-                             ('area', '<f8'),
-                             ('max_F', '<f8'),
-                             ('gaussian_mean', '<f8', (1,)),
-                             ('gaussian_cov', '<f8', (1, 1)),
-                             ('centroid', '<f8', (1,))])
-
-            >>> get_empty_neuron(
-            ...     (2, 3), numpy.float64
-            ... ) #doctest: +NORMALIZE_WHITESPACE
-            array([], dtype=[('mask', '?', (2, 3)),
-                             ('contour', '?', (2, 3)),
-                             ('image', '<f8', (2, 3)),
-                             ('area', '<f8'),
-                             ('max_F', '<f8'),
-                             ('gaussian_mean', '<f8', (2,)),
-                             ('gaussian_cov', '<f8', (2, 2)),
-                             ('centroid', '<f8', (2,))])
+            >>> a = numpy.array([[3, 2, 3, 0, 0, 0],
+            ...                  [2, 1, 2, 0, 2, 3],
+            ...                  [3, 2, 3, 0, 1, 2]], dtype=float)
+            >>> m = numpy.zeros(a.shape, dtype=int)
+            >>> m[1, 1] = 1
+            >>> m[2, 4] = 2
+            >>> watershed_components(a, m, a > 0)
+            array([[1, 1, 1, 0, 0, 0],
+                   [1, 1, 1, 0, 2, 2],
+                   [1, 1, 1, 0, 2, 2]])
     """
 
-    neurons_dtype = get_neuron_dtype(shape=shape, dtype=dtype)
-    neurons = numpy.zeros((0,), dtype=neurons_dtype)
+    # Flooding uses the same (lowest) connectivity.
+    new_mask_labeled, num_components = scipy.ndimage.label(new_mask)
+    new_mask_slices = scipy.ndimage.find_objects(new_mask_labeled)
 
-    return(neurons)
+    def segment_component(i):
+        each_slice = new_mask_slices[i]
+        each_mask = (new_mask_labeled[each_slice] == (i + 1))
 
+        each_segmentation = skimage.morphology.watershed(
+            new_image[each_slice],
+            new_markers[each_slice] * each_mask,
+            mask=each_mask
+        )
 
-@prof.log_call(trace_logger)
-def get_one_neuron(shape, dtype):
-    """
-        Gets a numpy structured array using the type from get_neuron_dtype that
-        has one neuron with all zeros.
+        return(each_segmentation)
 
-        Args:
-            new_image(numpy.ndarray):     an empty numpy structured array with
-                                          all types needed for a neuron.
+    component_indices = list(iters.irange(num_components))
+    if (num_threads > 1) and (num_components > 1):
+        thread_pool = multiprocessing.pool.ThreadPool(num_threads)
+        try:
+            new_segmentation_components = thread_pool.map(
+                segment_component, component_indices
+            )
+        finally:
+            thread_pool.close()
+            thread_pool.join()
+    else:
+        new_segmentation_components = [
+            segment_component(i) for i in component_indices
+        ]
 
-        Returns:
-            numpy.ndarray:                a numpy structured array with one
-                                          neuron using type from
-                                          get_neuron_dtype.
+    new_segmentation = numpy.zeros(
+        new_markers.shape,
+        dtype=(
+            new_segmentation_components[0].dtype
+            if new_segmentation_components else new_markers.dtype
+        )
+    )
+    for i, each_segmentation in enumerate(new_segmentation_components):
+        each_slice = new_mask_slices[i]
+        each_mask = (new_mask_labeled[each_slice] == (i + 1))
 
-        Examples:
-            >>> numpy.set_printoptions(
-            ...     formatter={"float": lambda x: str(float(x))}
-            ... )
-            >>> get_one_neuron(
-            ...     (3,), numpy.float64
-            ... ) #doctest: +NORMALIZE_WHITESPACE
-            array([ ([False, False, False],
-                     [False, False, False],
-                     [0.0, 0.0, 0.0],
-                     0.0,
-                     0.0,
-                     [0.0],
-                     [[0.0]],
-                     [0.0])],
-                   dtype=[('mask', '?', (3,)),
-                          ('contour', '?', (3,)),
-                          ('image', '<f8', (3,)),
-                          ('area', '<f8'),
-                          ('max_F', '<f8'),
-                          ('gaussian_mean', '<f8', (1,)),
-                          ('gaussian_cov', '<f8', (1, 1)),
-                          ('centroid', '<f8', (1,))])
+        new_segmentation[each_slice][each_mask] = each_segmentation[each_mask]
 
-            >>> get_one_neuron(
-            ...     (2, 3), numpy.float64
-            ... ) #doctest: +NORMALIZE_WHITESPACE
-            array([ ([[False, False, False],
-                      [False, False, False]],
-                     [[False, False, False],
-                      [False, False, False]],
-                     [[0.0, 0.0, 0.0],
-                      [0.0, 0.0, 0.0]],
-                     0.0,
-                     0.0,
-                     [0.0, 0.0],
-                    [[0.0, 0.0],
-                     [0.0, 0.0]],
-                    [0.0, 0.0])],
-                   dtype=[('mask', '?', (2, 3)),
-                          ('contour', '?', (2, 3)),
-                          ('image', '<f8', (2, 3)),
-                          ('area', '<f8'),
-                          ('max_F', '<f8'),
-                          ('gaussian_mean', '<f8', (2,)),
-                          ('gaussian_cov', '<f8', (2, 2)),
-                          ('centroid', '<f8', (2,))])
+    return(new_segmentation)
 
-            >>> numpy.set_printoptions()
+
+@prof.log_class(trace_logger)
+class WaveletDenoisingWorkspace(object):
     """
+        Holds the full frame temporaries used by wavelet_denoising for images
+        of one shape and wavelet scale. Passing the same workspace to each
+        call (e.g. for every basis image in postprocess_data) reuses them
+        instead of allocating them every time.
 
-    neurons_dtype = get_neuron_dtype(shape=shape, dtype=dtype)
-    neurons = numpy.zeros((1,), dtype=neurons_dtype)
+        Note:
+            Anything that is returned by wavelet_denoising is still newly
+            allocated. So, nothing returned refers to the workspace.
+    """
 
-    return(neurons)
+    def __init__(self, shape, wavelet_scale):
+        """
+            Construct a WaveletDenoisingWorkspace instance.
 
+            Args:
+                shape(tuple of ints):           shape of the images.
 
-@prof.log_call(trace_logger)
-def generate_local_maxima_vigra(new_intensity_image):
-    """
-        Creates a mask the same size as the intensity image with local maxima
-        as True and background False. Uses vigra's
-        vigra.analysis.extendedLocalMaxima for 2D and
-        vigra's vigra.analysis.extendedLocalMaxima3D for 3D.
+                wavelet_scale(int or list):     the scale of wavelet
+                                                transform to use (as for
+                                                wavelet_thresholding).
+        """
 
-        Args:
-            new_intensity_image(numpy.ndarray):     The image to find local
-                                                    maxima for (ideally, all
-                                                    axes are spatial; however,
-                                                    it will treat all axes the
-                                                    same).
+        self.shape = tuple(shape)
+        self.wavelet_scale = wavelet_scale
 
-        Returns:
-            numpy.ndarray:                          A mask of the local maxima.
-    """
+        num_scales = int(numpy.max(wavelet_scale))
 
-    local_maxima_mask = None
-    if new_intensity_image.ndim == 2:
-        local_maxima_mask = vigra.analysis.extendedLocalMaxima(
-            new_intensity_image.astype(numpy.float32)).astype(bool)
-    elif new_intensity_image.ndim == 3:
-        local_maxima_mask = vigra.analysis.extendedLocalMaxima3D(
-            new_intensity_image.astype(numpy.float32)).astype(bool)
-    else:
-        assert False
+        self.wavelet_transformed_image = numpy.empty(
+            (num_scales,) + self.shape, dtype=numpy.float32
+        )
+        self.wavelet_transformed_image_significant_mask = numpy.empty(
+            (num_scales,) + self.shape, dtype=bool
+        )
 
-    return(local_maxima_mask)
+        # Scratch space for wavelet.transform and significant_mask.
+        self.wavelet_transform_scratch = (
+            numpy.empty(self.shape, dtype=numpy.float32),
+            numpy.empty(self.shape, dtype=numpy.float32)
+        )
+        self.wavelet_transformed_image_deviations = numpy.empty(
+            (num_scales,) + self.shape, dtype=numpy.float32
+        )
+
+        self.wavelet_image_mask = numpy.empty(self.shape, dtype=bool)
+        self.wavelet_image_denoised = numpy.empty(
+            self.shape, dtype=numpy.float32
+        )
+        self.wavelet_image_denoised_positive = numpy.empty(
+            self.shape, dtype=bool
+        )
+
+        self.wavelet_image_denoised_labeled = numpy.empty(
+            self.shape, dtype=numpy.int32
+        )
+        self.wavelet_image_denoised_label_image = numpy.empty(
+            self.shape, dtype=numpy.int32
+        )
+
+
+    def fits(self, shape, wavelet_scale):
+        """
+            Whether this workspace can be used for the given image shape and
+            wavelet scale.
+
+            Args:
+                shape(tuple of ints):           shape of the images.
+
+                wavelet_scale(int or list):     the scale of wavelet
+                                                transform to use.
+
+            Returns:
+                bool:                           True if it can be used.
+        """
+
+        return(
+            (self.shape == tuple(shape)) and
+            numpy.array_equal(self.wavelet_scale, wavelet_scale)
+        )
 
 
 @prof.log_call(trace_logger)
-def generate_local_maxima_scikit_image(new_intensity_image,
-                                       local_max_neighborhood_size=1):
+@hdf5.record.static_array_debug_recorder
+def wavelet_denoising(new_image,
+                      accepted_region_shape_constraints,
+                      accepted_neuron_shape_constraints,
+                      workspace=None,
+                      **parameters):
     """
-        Creates a mask the same size as the intensity image with local maxima
-        as True and background False. Uses scikit image's
-        skimage.feature.peak_local_max.
+        Performs wavelet denoising on the given dictionary.
 
         Args:
-            new_intensity_image(numpy.ndarray):     The image to find local
-                                                    maxima for (ideally, all
-                                                    axes are spatial; however,
-                                                    it will treat all axes the
-                                                    same).
+            new_image(numpy.ndarray):                   array of data for
+                                                        generating a dictionary
+                                                        (first axis is time).
 
-            local_max_neighborhood_size(int):       Size of the neighborhood to
-                                                    check for a local maxima.
+            accepted_region_shape_constraints(dict):    a dictionary containing
+                                                        properties (that could
+                                                        be passed to
+                                                        region_properties)
+                                                        under this should be a
+                                                        dictionary that
+                                                        contains the keys min
+                                                        and/or max with a value
+                                                        for each.
+
+            accepted_neuron_shape_constraints(dict):    a dictionary containing
+                                                        properties (that could
+                                                        be passed to
+                                                        region_properties)
+                                                        under this should be a
+                                                        dictionary that
+                                                        contains the keys min
+                                                        and/or max with a value
+                                                        for each.
+
+            workspace(WaveletDenoisingWorkspace):       temporaries to reuse
+                                                        (one is made if not
+                                                        provided or it does
+                                                        not fit).
+
+            **parameters(dict):                         additional parameters
+                                                        for various other
+                                                        function calls (and
+                                                        num_threads for the
+                                                        watershed of connected
+                                                        components).
 
         Returns:
-            numpy.ndarray:                          A mask of the local maxima.
+            numpy.ndarray:                              a structured array of
+                                                        candidate neurons.
     """
 
-    local_maxima_neighborhood = numpy.ones(
-        (2 * local_max_neighborhood_size + 1,) * new_intensity_image.ndim
+    neurons = get_empty_neuron(shape=new_image.shape, dtype=new_image.dtype)
+
+    new_wavelet_image_denoised_segmentation = None
+
+    logger.debug("Started wavelet denoising.")
+    logger.debug("Removing noise...")
+
+    wavelet_scale = parameters["wavelet.transform"]["scale"]
+    if (workspace is None) or \
+            (not workspace.fits(new_image.shape, wavelet_scale)):
+        workspace = WaveletDenoisingWorkspace(new_image.shape, wavelet_scale)
+
+    # Contains a bool array with significant values True and noise False.
+    new_wavelet_transformed_image, new_wavelet_transformed_image_significant_mask = wavelet_thresholding(
+        new_image,
+        wavelet_scale=wavelet_scale,
+        noise_threshold=parameters["significant_mask"]["noise_threshold"],
+        out=(
+            workspace.wavelet_transformed_image,
+            workspace.wavelet_transformed_image_significant_mask
+        ),
+        scratch=(
+            workspace.wavelet_transform_scratch,
+            workspace.wavelet_transformed_image_deviations
+        ),
+        **parameters["estimate_noise"]
     )
-    local_maxima_mask = skimage.feature.peak_local_max(
-        new_intensity_image,
-        footprint=local_maxima_neighborhood,
-        labels=(new_intensity_image > 0),
-        indices=False
+
+    new_wavelet_image_mask = workspace.wavelet_image_mask
+    new_wavelet_image_mask[...] = new_wavelet_transformed_image_significant_mask[-1]
+
+    # Creates a new dictionary without the noise
+    new_wavelet_image_denoised = numpy.multiply(
+        new_wavelet_transformed_image[-1],
+        new_wavelet_image_mask,
+        out=workspace.wavelet_image_denoised
     )
 
-    return(local_maxima_mask)
+    wavelet_denoising.recorders.array_debug_recorder["new_wavelet_image_denoised"] = new_wavelet_image_denoised[None]
 
+    logger.debug("Noise removed.")
 
-@prof.log_call(trace_logger)
-def generate_local_maxima(new_intensity_image):
-    """
-        Creates a mask the same size as the intensity image with local maxima
-        as True and background False.
+    if new_wavelet_image_denoised.any():
+        logger.debug("Frame has content other than noise.")
 
-        Args:
-            new_intensity_image(numpy.ndarray):     The image to find local
-                                                    maxima for (ideally, all
-                                                    axes are spatial; however,
-                                                    it will treat all axes the
-                                                    same).
+        logger.debug("Finding the label image...")
 
-        Returns:
-            numpy.ndarray:                          A mask of the local maxima.
-    """
+        # For holding the label image
+        new_wavelet_image_denoised_labeled = workspace.wavelet_image_denoised_labeled
+        scipy.ndimage.label(
+            new_wavelet_image_denoised,
+            output=new_wavelet_image_denoised_labeled
+        )
 
-    return(generate_local_maxima_vigra(new_intensity_image))
+        logger.debug("Found the label image.")
+        logger.debug("Determining the properties of the label image...")
 
+        # For holding the label image properties
+        new_wavelet_image_denoised_labeled_props = region_properties(
+            new_wavelet_image_denoised_labeled,
+            properties=list(accepted_region_shape_constraints.keys())
+        )
 
-@prof.log_call(trace_logger)
-def extended_region_local_maxima_properties(
-        new_intensity_image,
-        new_label_image,
-        **kwargs
-):
-    """
-        Generates local maxima along with other properties for each labeled
-        region (therefore at least one entry per label). Gets a label image if
-        not provided by using the threshold (if not provided is zero).
+        logger.debug("Determined the properties of the label image.")
 
-        Note:
-            This is similar to region_properties. It differs in that it keeps
-            track of all local maxima. So, it is no longer one-to-one in
-            labels, but is one-to-one in local maxima.
+        logger.debug(
+            "Finding regions that fail to meet some shape constraints..."
+        )
 
-        Args:
-            new_intensity_image(numpy.ndarray):     The intensity image to find
-                                                    local maxima for (ideally,
-                                                    all axes are spatial;
-                                                    however, it will treat all
-                                                    axes the same).
+        within_bound = match_regions_properties(
+            new_wavelet_image_denoised_labeled_props,
+            accepted_region_shape_constraints
+        )
 
-            new_label_image(numpy.ndarray):         The label image to find
-                                                    local maxima for (ideally,
-                                                    all axes are spatial;
-                                                    however, it will treat all
-                                                    axes the same).
+        logger.debug("Found regions that fail to meet some shape constraints.")
 
-        Returns:
-            numpy.ndarray:                          A mask of the local maxima.
-    """
+        logger.debug(
+            "Reducing wavelet transform on regions outside of constraints..."
+        )
 
-    # Remove the background
-    new_image_mask = (new_label_image != 0)
-    new_intensity_image_masked = (~new_image_mask * new_intensity_image.min()) + \
-                                 (new_image_mask * new_intensity_image)
+        # Get labels of the unbounded ones
+        labels_not_within_bound = new_wavelet_image_denoised_labeled_props["label"][~within_bound]
 
-    # Get a mask of the local maxima
-    # that only includes local maxima not in the background
-    local_maxima_mask = generate_local_maxima(new_intensity_image_masked)
+        # Fix all of the unbounded ones at once by looking up whether each
+        # pixel's label is rejected.
+        if labels_not_within_bound.size:
+            reject = numpy.zeros(
+                (new_wavelet_image_denoised_labeled.max() + 1,), dtype=bool
+            )
+            reject[labels_not_within_bound] = True
 
-    # Count the local maxima and give them different labels
-    local_maxima_labeled = scipy.ndimage.label(
-        local_maxima_mask
-    )[0]
+            # Get a mask for the unbounded labels
+            rejected_label_mask = reject[new_wavelet_image_denoised_labeled]
 
-    # Generate the properties of the labeled regions
-    labeled_props = region_properties(new_label_image, **kwargs)
+            # Get a lower wavelet mask (only where it will be used)
+            lower_wavelet_mask = new_wavelet_transformed_image_significant_mask[-2][rejected_label_mask]
 
-    # Generate the properties of the local maxima
-    local_maxima_props = region_properties(
-        local_maxima_labeled, properties=["label", "centroid"]
-    )
+            # Overwrite the area in our old labeled mask to match this lower
+            # wavelet transform
+            new_wavelet_image_mask[rejected_label_mask] = lower_wavelet_mask
 
-    # We want to have a few more type present in our NumPy structured array.
-    # To do this, we collect the existing types into a list and
-    # add our new types onto the end. Finally,
-    # we make the new structured array type from the list we have.
-    props_dtype = []
+            # However, overwrite the previously labeled area completely (will
+            # push more things into the background). Zero everything that is
+            # not in the replacement region and then use the lower
+            # transformed wavelet.
+            new_wavelet_image_denoised[rejected_label_mask] = new_wavelet_transformed_image[-2][rejected_label_mask] * lower_wavelet_mask
 
-    # Place on the label props dtype first
-    labeled_props_dtype = xnumpy.numpy_structured_array_dtype_list(
-        labeled_props
-    )
-    props_dtype.extend(labeled_props_dtype)
+        logger.debug(
+            "Reduced wavelet transform on regions outside of constraints..."
+        )
 
-    # Then add new fields.
-    props_dtype.append(("local_max", int, new_intensity_image.ndim))
-    props_dtype.append(("intensity", new_intensity_image.dtype))
+        logger.debug("Finding new label image...")
 
-    # Makes a new properties array that contains enough entries to hold the
-    # old one and has all the types we desire.
-    new_local_maxima_props = numpy.zeros(
-        local_maxima_props.shape, dtype=numpy.dtype(props_dtype)
-    )
+        new_wavelet_image_denoised_label_image = workspace.wavelet_image_denoised_label_image
+        scipy.ndimage.label(
+            numpy.greater(
+                new_wavelet_image_denoised,
+                0,
+                out=workspace.wavelet_image_denoised_positive
+            ),
+            output=new_wavelet_image_denoised_label_image
+        )
 
-    # Take the centroids and old labels as the label and local max
-    new_local_maxima_props["label"] = local_maxima_props["label"]
-    new_local_maxima_props["local_max"] = local_maxima_props["centroid"].round().astype(int)
+        logger.debug("Found new label image.")
 
-    # Replace the old structured array with the enlarged version.
-    local_maxima_props = new_local_maxima_props
+        #ExtendedRegionProps.recorders.array_debug_recorder = hdf5.record.HDF5EnumeratedArrayRecorder(
+        #    wavelet_denoising.recorders.array_debug_recorder.hdf5_handle
+        #)
+        ExtendedRegionProps.recorders.array_debug_recorder = wavelet_denoising.recorders.array_debug_recorder
+        # Both images are only temporaries. So, they need not be copied.
+        local_maxima = ExtendedRegionProps(
+            new_wavelet_image_denoised,
+            new_wavelet_image_denoised_label_image,
+            copy=False
+        )
 
-    # Stores the intensity at the local max for easy retrieval
-    # Replace the labels by using the values from the label image
-    if local_maxima_props.size:
-        local_maxima_props_indices = tuple(local_maxima_props["local_max"].T)
-        local_maxima_props["intensity"] = new_intensity_image[local_maxima_props_indices]
-        local_maxima_props["label"] = new_label_image[local_maxima_props_indices]
+        wavelet_denoising.recorders.array_debug_recorder["local_maxima_label_image"] = local_maxima.label_image[None]
+        if wavelet_denoising.recorders.array_debug_recorder:
+            wavelet_denoising.recorders.array_debug_recorder["local_maxima_label_image_contours"] = xnumpy.generate_labeled_contours(
+                local_maxima.label_image > 0
+            )[None]
 
-    # Now, we want to merge the other properties in with our local maxima
-    # But, we will skip it if there are no local maxima.
-    if local_maxima_props.size:
-        for each_i, each_label in enumerate(labeled_props["label"]):
-            each_label_props_mask = (local_maxima_props["label"] == each_label)
+        local_maxima = remove_low_intensity_local_maxima(
+            local_maxima, **parameters["remove_low_intensity_local_maxima"]
+        )
 
-            for each_new_prop_name, _, __ in labeled_props_dtype:
-                local_maxima_props[each_new_prop_name][each_label_props_mask] = labeled_props[each_new_prop_name][each_i]
+        wavelet_denoising.recorders.array_debug_recorder["local_maxima_label_image"] = local_maxima.label_image[None]
+        if wavelet_denoising.recorders.array_debug_recorder:
+            wavelet_denoising.recorders.array_debug_recorder["local_maxima_label_image_contours"] = xnumpy.generate_labeled_contours(
+                    local_maxima.label_image > 0
+            )[None]
 
-    return(local_maxima_props)
+        local_maxima = remove_too_close_local_maxima(
+            local_maxima, **parameters["remove_too_close_local_maxima"]
+        )
 
+        wavelet_denoising.recorders.array_debug_recorder["local_maxima_label_image"] = local_maxima.label_image[None]
+        if wavelet_denoising.recorders.array_debug_recorder:
+            wavelet_denoising.recorders.array_debug_recorder["local_maxima_label_image_contours"] = xnumpy.generate_labeled_contours(
+                local_maxima.label_image > 0
+        )[None]
 
-@prof.log_class(trace_logger)
-@hdf5.record.class_static_array_debug_recorder
-class ExtendedRegionProps(object):
-    """
-        Using the results of extended_region_local_maxima_properties with given
-        intensity and label images, the ExtendedRegionProps attempts to make it
-        easy to get information about local maxima in the image. Further, it
-        provides methods to allow removal of local maxima. When removing local
-        maxima, it will updated the given label image to reflect labels that
-        have been removed completely and will automatically renumber the label
-        image (as some functions expect a label image with sequential
-        numbering, no missing label number). This provides a simple way to
-        maintain a label image, whose local maxima one is more interested in
-        directly manipulating.
+        if local_maxima.props.size:
+            logger.debug("Entering watershed segmentation.")
 
-        Note:
-            Adding local maxima is not allowed for and wouldn't make sense
-            given its dependency on the intensity image.
-    """
+            # Perform the watershed segmentation.
 
-    def __init__(self,
-                 new_intensity_image,
-                 new_label_image,
-                 properties=["centroid"]):
-        """
-            Construct an ExtendedRegionProps instance.
+            # First perform disc opening on the image.
+            # (Actually, we don't do this according to Ferran.)
+            #new_wavelet_image_denoised_opened = vigra.filters.discOpening(
+            #    new_wavelet_image_denoised.astype(numpy.float32), radius=1
+            #)
 
-            This uses extended_region_local_maxima_properties to determine
-            local maxima and properties for the labeled region. After doing
-            this, it is possible to remove local maxima and update the label
-            image to reflect this change.
+            # We could look for seeds using local maxima.
+            # However, we already know what these should be as these are the
+            # local maxima we have found.
+            new_wavelet_image_denoised_maxima = local_maxima.get_local_max_label_image()
 
-            Args:
-                new_intensity_image(numpy.ndarray):     The intensity image to
-                                                        find local maxima for
-                                                        (ideally, all axes are
-                                                        spatial; however, it
-                                                        will treat all axes
-                                                        the same).
+            # Segment with watershed on minimum image
+            # Use seeds from local maxima as local minima
+            # Also, include mask
+            # (each of its connected components is done on its own crop)
+            new_wavelet_image_denoised_segmentation = watershed_components(
+                local_maxima.intensity_image,
+                new_wavelet_image_denoised_maxima,
+                (local_maxima.intensity_image > 0),
+                num_threads=parameters.get("num_threads", 1)
+            )
 
-                new_label_image(numpy.ndarray):         The label image to find
-                                                        local maxima for (
-                                                        ideally, all axes are
-                                                        spatial; however, it
-                                                        will treat all axes the
-                                                        same).
+            wavelet_denoising.recorders.array_debug_recorder["watershed_segmentation"] = new_wavelet_image_denoised_segmentation[None]
+            if wavelet_denoising.recorders.array_debug_recorder:
+                wavelet_denoising.recorders.array_debug_recorder["watershed_segmentation_contours"] = xnumpy.generate_labeled_contours(
+                        new_wavelet_image_denoised_segmentation
+                )[None]
 
-                properties(list):                       used to generate
-                                                        initial properties.
-        """
+            # The local maxima are no longer needed. So, their intensity
+            # image can be used without copying.
+            watershed_local_maxima = ExtendedRegionProps(
+                local_maxima.intensity_image,
+                new_wavelet_image_denoised_segmentation,
+                properties=["centroid"] + list(accepted_neuron_shape_constraints.keys()),
+                copy=False
+            )
 
-        # Copied to ensure purity. Would not want to change outside values.
-        self.intensity_image = new_intensity_image.copy()
-        self.label_image = new_label_image.copy()
+            wavelet_denoising.recorders.array_debug_recorder["watershed_local_maxima_label_image"] = watershed_local_maxima.label_image[None]
+            if wavelet_denoising.recorders.array_debug_recorder:
+                wavelet_denoising.recorders.array_debug_recorder["watershed_local_maxima_label_image_contours"] = xnumpy.generate_labeled_contours(
+                    watershed_local_maxima.label_image > 0
+                )[None]
 
-        self.image_mask = (self.label_image > 0)
-        self.props = None
-        self.count = None
+            wavelet_denoising.recorders.array_debug_recorder["watershed_local_maxima_props"] = watershed_local_maxima.props
+            wavelet_denoising.recorders.array_debug_recorder["watershed_local_maxima_count"] = watershed_local_maxima.count
 
-        logger.debug("Finding the local maxima and properties...")
+            # Remove duplicates
+            new_watershed_local_maxima_count_duplicates_mask = (
+                watershed_local_maxima.count["count"] > 1
+            )
+            new_watershed_local_maxima_count_duplicate_labels = watershed_local_maxima.count["label"][new_watershed_local_maxima_count_duplicates_mask]
+            new_watershed_local_maxima_props_duplicates_mask = xnumpy.contains(
+                watershed_local_maxima.props["label"], new_watershed_local_maxima_count_duplicate_labels
+            )
+            watershed_local_maxima.remove_prop_mask(
+                new_watershed_local_maxima_props_duplicates_mask
+            )
 
-        self.props = extended_region_local_maxima_properties(
-            self.intensity_image,
-            self.label_image,
-            properties=properties
-        )
+            wavelet_denoising.recorders.array_debug_recorder["watershed_local_maxima_label_image"] = watershed_local_maxima.label_image[None]
+            if wavelet_denoising.recorders.array_debug_recorder:
+                wavelet_denoising.recorders.array_debug_recorder["watershed_local_maxima_label_image_contours"] = xnumpy.generate_labeled_contours(
+                watershed_local_maxima.label_image > 0
+            )[None]
 
-        logger.debug("Found the local maxima and properties.")
+            if watershed_local_maxima.props.size:
+                wavelet_denoising.recorders.array_debug_recorder["watershed_local_maxima_props"] = watershed_local_maxima.props
+            if watershed_local_maxima.count.size:
+                wavelet_denoising.recorders.array_debug_recorder["watershed_local_maxima_count"] = watershed_local_maxima.count
 
-        # Remove maxima in the background
-        background_maxima_mask = (self.props["label"] == 0)
-        if (numpy.any(background_maxima_mask)):
-            # There shouldn't be any maximums in the background. This should
-            # never happen.
-            logger.warning(
-                "Found \"" + (background_maxima_mask).sum() +
-                "\" maximum(s) found in the background (label 0)."
-            )
-            # Remove the 0 labels
-            self.props = self.props[background_maxima_mask]
+            within_bound = match_regions_properties(
+                watershed_local_maxima.props,
+                accepted_neuron_shape_constraints
+            )
 
-        del background_maxima_mask
+            # Get labels outside of bounds and remove them
+            watershed_local_maxima.remove_prop_mask(~within_bound)
 
-        # Stores the number of times a particular label maxima appears.
-        self.count = numpy.empty(
-            (self.label_image.max(),), dtype=[("label", int), ("count", int)])
-        # Get all the labels used in the label image
-        self.count["label"] = numpy.arange(1, self.label_image.max() + 1)
-        # Get the count of those labels (excluding zero as it is background)
-        self.count["count"] = numpy.bincount(
-            self.props["label"], minlength=len(self.count) + 1)[1:]
+            wavelet_denoising.recorders.array_debug_recorder["watershed_local_maxima_label_image"] = watershed_local_maxima.label_image[None]
+            if wavelet_denoising.recorders.array_debug_recorder:
+                wavelet_denoising.recorders.array_debug_recorder["watershed_local_maxima_label_image_contours"] = xnumpy.generate_labeled_contours(
+                        watershed_local_maxima.label_image > 0
+                )[None]
 
-        if self.count.size and numpy.any(self.count["count"] == 0):
-            # All labels should have a local maximum. If they don't, this could
-            # be a problem.
+            if watershed_local_maxima.props.size:
+                wavelet_denoising.recorders.array_debug_recorder["watershed_local_maxima_props"] = watershed_local_maxima.props
+            if watershed_local_maxima.count.size:
+                wavelet_denoising.recorders.array_debug_recorder["watershed_local_maxima_count"] = watershed_local_maxima.count
 
-            failed_labels = self.count["label"][self.count["count"] == 0]
-            failed_labels_list = failed_labels.tolist()
-            failed_label_msg = "Label(s) not found in local maxima." + \
-                               " For labels = " + repr(failed_labels_list) + "."
+            if watershed_local_maxima.props.size:
+                neurons = extract_labeled_neurons(
+                        new_image,
+                        watershed_local_maxima.label_image,
+                        watershed_local_maxima.props["label"]
+                )
+                if len(neurons) > 1:
+                    logger.debug(
+                        "Extracted neurons. Found " +
+                        str(len(neurons)) + " neurons."
+                    )
+                else:
+                    logger.debug(
+                        "Extracted a neuron. Found " +
+                        str(len(neurons)) + " neuron."
+                    )
 
-            logger.warning(failed_label_msg)
+                wavelet_denoising.recorders.array_debug_recorder["new_neuron_set"] = neurons
 
-            ExtendedRegionProps.recorders.array_debug_recorder["intensity_image"] = self.intensity_image[None]
-            ExtendedRegionProps.recorders.array_debug_recorder["label_image"] = self.label_image[None]
+            logger.debug("Exiting watershed segmentation.")
+        else:
+            logger.debug("No local maxima left that are acceptable neurons.")
+    else:
+        logger.debug("Frame is only noise.")
 
-            if self.props.size:
-                ExtendedRegionProps.recorders.array_debug_recorder["props"] = self.props
+    logger.debug("Finished making neurons for the current frame.")
+    return(neurons)
 
-            ExtendedRegionProps.recorders.array_debug_recorder["count"] = self.count
-            if ExtendedRegionProps.recorders.array_debug_recorder:
-                ExtendedRegionProps.recorders.array_debug_recorder["masks"] = \
-                    xnumpy.all_permutations_equal(
-                            failed_labels, self.label_image
-                    )
-            ExtendedRegionProps.recorders.array_debug_recorder["masks_labels"] = failed_labels
 
-            # Renumber labels.
-            # This way there are no labels without local maxima.
-            self.renumber_labels()
+@prof.log_call(trace_logger)
+def _mask_moments(areas, coordinate_sums, coordinate_product_sums):
+    """
+        Finds the mean and (unbiased) covariance of the coordinates in each
+        mask from the sums of its coordinates and their products. The sums
+        are shifted to the nearest pixel to the mean before the covariance is
+        formed. As they are all integers, this is exact. So, there is no
+        cancellation beyond what numpy.cov has.
 
-        logger.debug("Refinined properties for local maxima.")
+        Args:
+            areas(numpy.ndarray):                   number of pixels in each
+                                                    mask.
 
+            coordinate_sums(numpy.ndarray):         sum of the coordinates in
+                                                    each mask (one row per
+                                                    mask).
 
-    def get_local_max_index_array(self):
-        """
-            Gets a numpy style index array from the local maxima present.
+            coordinate_product_sums(numpy.ndarray): sum of the outer product
+                                                    of the coordinates in each
+                                                    mask (one matrix per
+                                                    mask).
 
-            Returns:
-                tuple:      a numpy styled index array, which can be used on
-                            the intensity image, or label image.
-        """
+        Returns:
+            (tuple of numpy.ndarrays):              the mean and covariance of
+                                                    each mask.
+    """
 
-        return(tuple(self.props["local_max"].T))
+    areas = areas.astype(numpy.float64)[:, None]
 
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        means = coordinate_sums / areas
 
-    def get_local_max_mask(self):
-        """
-            Gets a bool numpy array that is True at the locations of the local
-            maxima.
+        # Shift to the closest pixel so the sums stay exact integers.
+        means_rounded = numpy.nan_to_num(means).round()
+        means_shift = means - means_rounded
 
-            Returns:
-                numpy.ndarray:      a bool numpy array that is True where a
-                                    local max is and False everywhere else.
-        """
+        shifted_product_sums = (
+            coordinate_product_sums
+            - means_rounded[:, :, None] * coordinate_sums[:, None, :]
+            - coordinate_sums[:, :, None] * means_rounded[:, None, :]
+            + areas[:, :, None] * (
+                means_rounded[:, :, None] * means_rounded[:, None, :]
+            )
+        )
 
-        # Returns a label image containing each local max and its label.
-        new_local_max_mask = numpy.zeros(
-            self.label_image.shape, dtype=self.label_image.dtype
+        covs = shifted_product_sums - areas[:, :, None] * (
+            means_shift[:, :, None] * means_shift[:, None, :]
         )
+        covs *= numpy.true_divide(1, areas - 1)[:, :, None]
 
-        # Set the given local maxima to be the same as their labels
-        new_local_max_mask[self.get_local_max_index_array()] = True
+    return(means, covs)
 
-        return(new_local_max_mask)
 
+@prof.log_call(trace_logger)
+@hdf5.record.static_array_debug_recorder
+def extract_neurons(new_image, neuron_masks):
+    """
+        Extracts neurons from an image using a stack of masks.
 
-    def get_local_max_label_image(self):
-        """
-            Gets an int numpy array that contains the labels of the local
-            maxima.
+        All neurons are handled at once. Their moments come from products of
+        the masks with the pixel coordinates and their contours from one
+        erosion of the whole stack.
 
-            Returns:
-                numpy.ndarray:      an int numpy array that contains the labels
-                                    of the local maxima and is zero in the
-                                    background.
-        """
+        Args:
+            new_image(numpy.ndarray):           spatial coordinates only (no
+                                                time). May also be a stack
+                                                with one image for each mask.
 
-        # Returns a label image containing each local max and its labels.
-        new_local_max_label_image = numpy.zeros(
-            self.label_image.shape, dtype=self.label_image.dtype
-        )
+            neuron_masks(numpy.ndarray):        first index of denotes which
+                                                mask and all others are spatial
+                                                indices.
 
-        # Set the given local maxima to be the same as their labels
-        new_local_max_label_image[self.get_local_max_index_array()] = self.props["label"]
+        Returns:
+            numpy.ndarray:                      a stack of neurons in the same
+                                                order as the masks.
+    """
 
-        return(new_local_max_label_image)
+    image_shape = neuron_masks.shape[1:]
 
+    assert (new_image.shape[-len(image_shape):] == image_shape)
 
-    def remove_prop_mask(self, remove_prop_indices_mask):
-        """
-            Removes the local maxima by the mask over their indices (only False
-            elements will be kept).
+    neurons = numpy.empty(
+        len(neuron_masks),
+        dtype=get_neuron_dtype(shape=image_shape, dtype=new_image.dtype)
+    )
 
-            Note:
-                If a label is removed completely, the label image, intensity
-                image, and image mask will be updated. Also, the count (of
-                local maxima per label) will be updated, regardless.
+    neurons["mask"] = neuron_masks
+    neurons["image"] = new_image * neurons["mask"]
+    neurons["area"] = xnumpy.array_to_matrix(neurons["mask"]).sum(axis=1)
+    neurons["max_F"] = xnumpy.array_to_matrix(neurons["image"]).max(axis=1)
 
-            Args:
-                remove_prop_indices_mask(numpy.ndarray):     A mask of the
-                                                             indices to drop
-                                                             (True for the ones
-                                                             to remove, and
-                                                             False for the ones
-                                                             to keep).
-        """
+    # Erode each mask (and not across them) with the full neighborhood one
+    # axis at a time. Anything beyond the edge is treated as part of the mask.
+    neuron_masks_eroded = neurons["mask"].copy()
+    for i in iters.irange(1, neuron_masks_eroded.ndim):
+        neuron_masks_shifted = neuron_masks_eroded.copy()
+
+        before = [slice(None)] * neuron_masks_eroded.ndim
+        after = [slice(None)] * neuron_masks_eroded.ndim
+        before[i] = slice(None, -1)
+        after[i] = slice(1, None)
+        before = tuple(before)
+        after = tuple(after)
+
+        neuron_masks_eroded[before] &= neuron_masks_shifted[after]
+        neuron_masks_eroded[after] &= neuron_masks_shifted[before]
+    neurons["contour"] = neurons["mask"] & ~neuron_masks_eroded
+
+    coordinates = xnumpy.array_to_matrix(
+        numpy.indices(image_shape, dtype=numpy.float64)
+    ).T
+    coordinate_products = (
+        coordinates[:, :, None] * coordinates[:, None, :]
+    ).reshape(len(coordinates), -1)
+
+    neuron_masks_matrix = scipy.sparse.csr_matrix(
+        xnumpy.array_to_matrix(neurons["mask"]), dtype=numpy.float64
+    )
 
-        # Get the labels to remove
-        remove_labels = self.props["label"][remove_prop_indices_mask]
-        # Get how many of each label to remove
-        label_count_to_remove = numpy.bincount(
-            remove_labels, minlength=len(self.count) + 1
-        )[1:]
+    neurons["gaussian_mean"], neurons["gaussian_cov"] = _mask_moments(
+        neurons["area"],
+        neuron_masks_matrix.dot(coordinates),
+        neuron_masks_matrix.dot(coordinate_products).reshape(
+            (len(neurons),) + 2 * (len(image_shape),)
+        )
+    )
 
-        # Take a subset of the label props that does not include the removal
-        # mask (copying may not be necessary as the mask may be as effective).
-        self.props = self.props[~remove_prop_indices_mask]
-        # Reduce the count by the number of each label
-        self.count["count"] -= label_count_to_remove
+    neurons["centroid"] = neurons["gaussian_mean"]
 
-        # Mask over self.count to find labels that do not have local maxima
-        inactive_label_count_mask = (self.count["count"] == 0)
+    return(neurons)
 
-        # Are there labels that do not exist now? If so, we will dump them.
-        if inactive_label_count_mask.any():
-            # Find the labels to remove from the label image and mask and
-            # remove them
-            labels_to_remove = self.count["label"][inactive_label_count_mask]
-            labels_to_remove_mask = xnumpy.contains(
-                self.label_image, labels_to_remove
-            )
-            self.label_image[labels_to_remove_mask] = 0
-            self.image_mask[labels_to_remove_mask] = 0
-            self.intensity_image[labels_to_remove_mask] = 0
 
-            # Renumber all labels sequentially starting with the label image
-            self.renumber_labels()
+@prof.log_call(trace_logger)
+@hdf5.record.static_array_debug_recorder
+def extract_labeled_neurons(new_image, label_image, labels=None):
+    """
+        Extracts neurons from an image using a label image (each neuron is
+        all pixels with its label).
 
+        Unlike extract_neurons, the masks are never needed to find the
+        neurons' properties. Their moments are accumulated over the label
+        image with bincount and their contours are all found in one pass over
+        it (a pixel is on a contour if any neighbor has a different label).
 
-    def remove_prop_indices(self, *i):
-        """
-            Removes the local maxima of the indices listed (like
-            remove_prop_mask except with indices).
+        Args:
+            new_image(numpy.ndarray):           spatial coordinates only (no
+                                                time).
 
-            Note:
-                If a label is removed completely, the label image, intensity
-                image, and image mask will be updated. Also, the count (of
-                local maxima per label) will be updated, regardless.
+            label_image(numpy.ndarray):         labels with the same shape as
+                                                the image (0 is background).
 
-            Args:
-                *i(int):     A mask of the indices to drop (True for the ones
-                             to remove, and False for the ones to keep).
-        """
+            labels(numpy.ndarray):              which labels to extract and in
+                                                what order (by default, all
+                                                non-zero labels sorted).
 
-        # A mask of the indices to remove
-        remove_prop_indices_mask = numpy.zeros((len(self.props),), dtype=bool)
-        remove_prop_indices_mask[numpy.array(i)] = True
+        Returns:
+            numpy.ndarray:                      a stack of neurons in the same
+                                                order as the labels.
 
-        self.remove_prop_mask(remove_prop_indices_mask)
+        Examples:
+            >>> a = numpy.array([[1, 1, 0, 0],
+            ...                  [1, 1, 0, 2],
+            ...                  [1, 1, 0, 2]])
+            >>> b = extract_labeled_neurons(
+            ...     numpy.arange(12.0).reshape(3, 4), a
+            ... )
+            >>> b["area"]
+            array([ 6.,  2.])
+            >>> b["max_F"]
+            array([  9.,  11.])
+            >>> b["gaussian_mean"]
+            array([[ 1. ,  0.5],
+                   [ 1.5,  3. ]])
+            >>> b["contour"][0].astype(int)
+            array([[0, 1, 0, 0],
+                   [0, 1, 0, 0],
+                   [0, 1, 0, 0]])
+    """
 
-    def renumber_labels(self):
-        """
-            An internal method to be called after a label is completely removed
-            from the local maxima.
+    label_image = numpy.asarray(label_image)
 
-            Ensures all labels are in sequential order in the label image,
-            count, and that all local maxima have their labels updated.
+    assert (label_image.shape == new_image.shape)
 
+    if labels is None:
+        labels = numpy.unique(label_image)
+        labels = labels[labels != 0]
+    labels = numpy.asarray(labels, dtype=int)
 
-            Note:
-                Calling this externally will not make a difference as long as
-                removal has occurred through the usual mechanisms.
-        """
+    neurons = numpy.empty(
+        len(labels),
+        dtype=get_neuron_dtype(shape=new_image.shape, dtype=new_image.dtype)
+    )
 
-        # Renumber all labels sequentially starting with the label image
-        self.label_image[:], forward_label_mapping, reverse_label_mapping = skimage.segmentation.relabel_sequential(
-            self.label_image
-        )
+    # Index of each pixel's neuron (plus 1) or 0 if it is in none.
+    neuron_indices = xnumpy.remap_labels(label_image, labels).ravel()
+    num_bins = len(labels) + 1
 
-        # Remove zero from the mappings as it is background and remains the
-        # same
-        forward_label_mapping = forward_label_mapping[forward_label_mapping != 0]
-        reverse_label_mapping = reverse_label_mapping[reverse_label_mapping != 0]
+    neurons["mask"] = xnumpy.expand_view(
+        label_image, reps_before=len(labels)
+    ) == xnumpy.expand_view(labels, label_image.shape)
+    neurons["image"] = new_image * neurons["mask"]
+    neurons["area"] = numpy.bincount(neuron_indices, minlength=num_bins)[1:]
+    neurons["max_F"] = xnumpy.array_to_matrix(neurons["image"]).max(axis=1)
 
-        # Find which of the old labels appear in self.props["label"] (skip 0)
-        props_reverse_mapped = xnumpy.all_permutations_equal(
-            reverse_label_mapping, self.props["label"]
+    # Interior pixels only have neighbors with the same label. Anything
+    # beyond the edge is treated as having the same label.
+    neighborhood_shape = (3,) * label_image.ndim
+    contour_image = (
+        scipy.ndimage.minimum_filter(
+            label_image, size=neighborhood_shape, mode="nearest"
+        ) != scipy.ndimage.maximum_filter(
+            label_image, size=neighborhood_shape, mode="nearest"
         )
-        # Get the new labels by noting they must range from 0 to the length of
-        # reverse_label_mapping. Skip zero as it is not necessary to check
-        # for it.
-        new_labels = numpy.arange(1, len(reverse_label_mapping) + 1)
-        # Expand new_labels into a view of the same size as
-        # props_reverse_mapped
-        new_labels_expanded = xnumpy.expand_view(
-            new_labels, reps_after=self.props["label"].shape
-        )
-        # Replace the labels with the matches and combine them
-        self.props["label"] = (
-            props_reverse_mapped * new_labels_expanded
-        ).sum(axis=0)
+    )
+    neurons["contour"] = neurons["mask"] & contour_image
 
-        # Get a mask over the labels to find what is contained
-        new_count_mask = xnumpy.contains(
-            self.count["label"], reverse_label_mapping
-        )
-        # Move the values of the count into the proper lower labels and zero
-        # everything else
-        self.count["count"][:len(reverse_label_mapping)] = self.count["count"][new_count_mask]
-        self.count["count"][len(reverse_label_mapping):] = 0
+    coordinates = xnumpy.array_to_matrix(
+        numpy.indices(new_image.shape, dtype=numpy.float64)
+    )
 
-        # (copying may not be necessary as the slice may be as effective)
-        self.count = self.count[:len(reverse_label_mapping)].copy()
+    coordinate_sums = numpy.empty((len(labels), new_image.ndim))
+    coordinate_product_sums = numpy.empty(
+        (len(labels),) + 2 * (new_image.ndim,)
+    )
+    for i in iters.irange(new_image.ndim):
+        coordinate_sums[:, i] = numpy.bincount(
+            neuron_indices, weights=coordinates[i], minlength=num_bins
+        )[1:]
+        for j in iters.irange(i, new_image.ndim):
+            coordinate_product_sums[:, i, j] = numpy.bincount(
+                neuron_indices,
+                weights=coordinates[i] * coordinates[j],
+                minlength=num_bins
+            )[1:]
+            coordinate_product_sums[:, j, i] = coordinate_product_sums[:, i, j]
+
+    neurons["gaussian_mean"], neurons["gaussian_cov"] = _mask_moments(
+        neurons["area"], coordinate_sums, coordinate_product_sums
+    )
+
+    neurons["centroid"] = neurons["gaussian_mean"]
+
+    return(neurons)
 
 
 @prof.log_call(trace_logger)
-def remove_low_intensity_local_maxima(local_maxima,
-                                      percentage_pixels_below_max,
-                                      **parameters):
+@hdf5.record.static_array_debug_recorder
+def upsample_neurons(neurons, factor, shape=None, new_image=None):
     """
-        Removes the local maxima for regions, which have too many pixels that
-        are below the intensity of their local maxima.
+        Maps neurons found on spatially binned data (e.g. with spatial_bin)
+        back to full resolution. Each mask is upsampled by repeating each
+        pixel ``factor`` times along each axis (and padded along the edge to
+        fill ``shape`` if needed). Then, all other properties are recomputed
+        with extract_neurons at full resolution.
 
         Args:
-            local_maxima(ExtendedRegionProps):      The local maxima to refine
+            neurons(numpy.ndarray):             neurons found on binned data.
+
+            factor(int or tuple of ints):       number of pixels per bin along
+                                                each spatial axis (either one
+                                                for all or one for each).
 
-            percentage_pixels_below_max(float):     The percentage of pixels
-                                                    out of a region that are
-                                                    below the local maxima of
-                                                    the region
+            shape(tuple of ints):               full resolution shape (if not
+                                                provided, assumes no pixels
+                                                were dropped while binning).
 
-            **parameters(dict):                     essentially unused (catches
-                                                    unneeded arguments).
+            new_image(numpy.ndarray):           full resolution image to
+                                                extract the neurons from. If
+                                                not provided, each neuron's
+                                                image is upsampled and used (
+                                                so, it keeps the values of the
+                                                basis image it came from).
 
         Returns:
-            ExtendedRegionProps:                    a new instance with the
-                                                    local maxima removed
+            numpy.ndarray:                      the neurons at full resolution
+                                                in the same order.
+
+        Examples:
+            >>> a = get_one_neuron((2, 2), numpy.float64)
+            >>> a["mask"][0] = [[True, False], [False, False]]
+            >>> a["image"][0] = [[2, 0], [0, 0]]
+            >>> b = upsample_neurons(a, 2, shape=(5, 4))
+            >>> b["mask"][0].astype(int)
+            array([[1, 1, 0, 0],
+                   [1, 1, 0, 0],
+                   [0, 0, 0, 0],
+                   [0, 0, 0, 0],
+                   [0, 0, 0, 0]])
+            >>> b["area"]
+            array([ 4.])
+            >>> b["max_F"]
+            array([ 2.])
+            >>> b["gaussian_mean"]
+            array([[ 0.5,  0.5]])
     """
 
-    # Deleting local maxima that does not exceed the 90th percentile of the
-    # pixel intensities
-    low_intensities__local_maxima_label_mask__to_remove = numpy.zeros(
-        local_maxima.props.shape, dtype=bool
-    )
-    for i in iters.irange(len(local_maxima.props)):
-        # Get the region with the label matching the maximum
-        each_region_image_wavelet_mask = (
-            local_maxima.label_image == local_maxima.props["label"][i]
-        )
-        each_region_image_wavelet = local_maxima.intensity_image[each_region_image_wavelet_mask]
+    spatial_shape = neurons.dtype["mask"].shape
 
-        # Get the number of pixels in that region
-        each_region_image_wavelet_num_pixels = float(
-            each_region_image_wavelet.size
-        )
+    factors = numpy.ones((len(spatial_shape),), dtype=int)
+    factors[...] = factor
+
+    if shape is None:
+        shape = tuple(factors * numpy.array(spatial_shape))
+    shape = tuple(shape)
 
-        # Get the value of the max for that region
-        each_region_image_wavelet_local_max_value = local_maxima.props["intensity"][i]
+    assert (len(shape) == len(spatial_shape))
 
-        # Get a mask of the pixels below that max for that region
-        each_region_image_wavelet_num_pixels_below_max = float(
-            (each_region_image_wavelet < each_region_image_wavelet_local_max_value).sum()
+    # Amount to pad along each axis to account for dropped trailing pixels.
+    pad_width = [(0, 0)] + [
+        (0, each_len - each_factor * each_binned_len)
+        for each_len, each_factor, each_binned_len in zip(
+            shape, factors, spatial_shape
         )
+    ]
+
+    assert all(each_pad_after >= 0 for _, each_pad_after in pad_width)
 
-        # Get a ratio of the number of pixels below that max for that region
-        each_region_image_wavelet_ratio_pixels = each_region_image_wavelet_num_pixels_below_max / \
-            each_region_image_wavelet_num_pixels
+    def upsample(new_array):
+        new_array_upsampled = new_array
+        for each_axis, each_factor in enumerate(factors, start=1):
+            new_array_upsampled = numpy.repeat(
+                new_array_upsampled, each_factor, axis=each_axis
+            )
 
-        # If the ratio clears our threshold, keep this label. Otherwise,
-        # eliminate it.
-        low_intensities__local_maxima_label_mask__to_remove[i] = (
-            each_region_image_wavelet_ratio_pixels < percentage_pixels_below_max
+        new_array_upsampled = numpy.pad(
+            new_array_upsampled, pad_width, mode="edge"
         )
 
-    new_local_maxima = copy.copy(local_maxima)
+        return(new_array_upsampled)
 
-    new_local_maxima.remove_prop_mask(
-        low_intensities__local_maxima_label_mask__to_remove)
+    if new_image is not None:
+        assert (new_image.shape == shape)
 
-    logger.debug("Removed low intensity maxima that are too close.")
+    if not len(neurons):
+        return(get_empty_neuron(
+            shape=shape,
+            dtype=(new_image if new_image is not None else neurons["image"]).dtype
+        ))
 
-    return(new_local_maxima)
+    neuron_masks = upsample(neurons["mask"])
+
+    if new_image is None:
+        new_image = upsample(neurons["image"])
+
+    extract_neurons.recorders.array_debug_recorder = upsample_neurons.recorders.array_debug_recorder
+    neurons_upsampled = extract_neurons(new_image, neuron_masks)
+
+    return(neurons_upsampled)
 
 
 @prof.log_call(trace_logger)
-def remove_too_close_local_maxima(local_maxima,
-                                  min_local_max_distance,
-                                  **parameters):
+def _neuron_bounding_boxes(new_neuron_set):
     """
-        Removes local maxima that are too close to each other.
+        Finds the bounding box of each neuron's mask and image (i.e. the
+        smallest box containing all of its non-zero pixels).
 
         Args:
-            local_maxima(ExtendedRegionProps):      The local maxima to refine
+            new_neuron_set(numpy.ndarray):      numpy structured array (dtype
+                                                get_neuron_dtype) containing
+                                                the neurons.
 
-            min_local_max_distance(float):          The minimum allowed
-                                                    distance between local
-                                                    maxima
+        Returns:
+            (tuple of numpy.ndarrays):          lower (inclusive) and upper
+                                                (exclusive) bounds of each
+                                                neuron along each axis. Empty
+                                                neurons get empty boxes.
 
-            **parameters(dict):                     essentially unused (catches
-                                                    unneeded arguments).
+        Examples:
+            >>> neurons = numpy.zeros(
+            ...     (2,), dtype=get_neuron_dtype((4, 5), float)
+            ... )
+            >>> neurons["mask"][0, 1:3, 2] = True
+            >>> neurons["image"][0, 1:3, 2] = 1
+            >>> lower, upper = _neuron_bounding_boxes(neurons)
+            >>> lower
+            array([[1, 2],
+                   [0, 0]])
+            >>> upper
+            array([[3, 3],
+                   [0, 0]])
+    """
 
-        Returns:
-            ExtendedRegionProps:                    a new instance with the
-                                                    local maxima removed
+    new_neuron_set_support = new_neuron_set["mask"] | (
+        new_neuron_set["image"] != 0
+    )
+
+    lower = numpy.zeros(
+        (len(new_neuron_set), new_neuron_set_support.ndim - 1), dtype=int
+    )
+    upper = numpy.zeros_like(lower)
+
+    for i in iters.irange(lower.shape[1]):
+        # Project the support of each neuron onto this axis.
+        new_neuron_set_support_i = new_neuron_set_support.any(
+            axis=tuple(
+                _ for _ in iters.irange(1, new_neuron_set_support.ndim)
+                if _ != (i + 1)
+            )
+        )
+        new_neuron_set_nonempty = new_neuron_set_support_i.any(axis=1)
+
+        lower[new_neuron_set_nonempty, i] = new_neuron_set_support_i.argmax(
+            axis=1
+        )[new_neuron_set_nonempty]
+        upper[new_neuron_set_nonempty, i] = (
+            new_neuron_set_support_i.shape[1] -
+            new_neuron_set_support_i[:, ::-1].argmax(axis=1)
+        )[new_neuron_set_nonempty]
+
+    return(lower, upper)
+
+
+@prof.log_call(trace_logger)
+def _neuron_norms(neuron, lower, upper, image_type):
     """
+        Finds the L_2 norm of a neuron's image and the L_1 norm of its mask
+        (i.e. its area) only looking within its bounding box.
 
-    # Deleting close local maxima below 16 pixels
-    too_close__local_maxima_label_mask__to_remove = numpy.zeros(
-        local_maxima.props.shape, dtype=bool)
+        Args:
+            neuron(numpy.ndarray):              numpy structured array (dtype
+                                                get_neuron_dtype) containing
+                                                the neuron.
 
-    # Find the distance between every local max (efficiently)
-    local_maxima_pairs = numpy.array(
-        list(itertools.combinations(iters.irange(len(local_maxima.props)), 2)))
-    local_maxima_distances = scipy.spatial.distance.pdist(
-        local_maxima.props["local_max"], metric="euclidean")
+            lower(numpy.ndarray):               lower bound (inclusive) of its
+                                                bounding box.
 
-    too_close_local_maxima_labels_mask = local_maxima_distances < min_local_max_distance
-    too_close_local_maxima_pairs = local_maxima_pairs[
-        too_close_local_maxima_labels_mask]
+            upper(numpy.ndarray):               upper bound (exclusive) of its
+                                                bounding box.
 
-    for each_too_close_local_maxima_pairs in too_close_local_maxima_pairs:
-        first_props_index, second_props_index = each_too_close_local_maxima_pairs
+            image_type(type):                   floating type to use for the
+                                                image.
 
-        if (local_maxima.props["label"][first_props_index] == local_maxima.props["label"][second_props_index]):
-            if local_maxima.props["intensity"][first_props_index] < local_maxima.props["intensity"][second_props_index]:
-                too_close__local_maxima_label_mask__to_remove[first_props_index] = True
-            else:
-                too_close__local_maxima_label_mask__to_remove[second_props_index] = True
+        Returns:
+            (tuple):                            the norm of the image (of
+                                                image_type) and of the mask
+                                                (as numpy.float32).
+    """
 
-    new_local_maxima = copy.copy(local_maxima)
+    window = tuple(iters.imap(slice, lower, upper))
 
-    new_local_maxima.remove_prop_mask(too_close__local_maxima_label_mask__to_remove)
+    image = neuron["image"][window].ravel().astype(image_type)
 
-    logger.debug("Removed local maxima that are too close.")
+    image_norm = numpy.sqrt(numpy.dot(image, image))
+    mask_norm = numpy.float32(numpy.count_nonzero(neuron["mask"][window]))
 
-    return(new_local_maxima)
+    return(image_norm, mask_norm)
 
 
 @prof.log_call(trace_logger)
-@hdf5.record.static_array_debug_recorder
-def wavelet_thresholding(new_image,
-                         significance_threshold,
-                         wavelet_scale,
-                         noise_threshold):
+def _neuron_pair_dot_products(neuron_1, neuron_2, lower, upper, image_type):
     """
-        Finds a thresholding using a noise estimate and the wavelet transform.
+        Finds the dot product of the images and of the masks of two neurons
+        only looking within the given box (e.g. where their bounding boxes
+        overlap).
 
         Args:
-            new_image(numpy.ndarray):                   image to threshold.
+            neuron_1(numpy.ndarray):            numpy structured array (dtype
+                                                get_neuron_dtype) containing
+                                                the first neuron.
 
-            significance_threshold(float):              threshold above which
-                                                        everything is
-                                                        considered significant
-                                                        for the purpose of
-                                                        noise estimation.
+            neuron_2(numpy.ndarray):            numpy structured array (dtype
+                                                get_neuron_dtype) containing
+                                                the second neuron.
 
-            wavelet_scale(int):                         the scale of wavelet
-                                                        transform to use.
+            lower(numpy.ndarray):               lower bound (inclusive) of
+                                                the box.
 
-            noise_threshold(float):                     a ratio to which the
-                                                        noise estimate scales
-                                                        (e.g. 1.0 means the
-                                                        noise computed is the
-                                                        noise used).
+            upper(numpy.ndarray):               upper bound (exclusive) of
+                                                the box.
+
+            image_type(type):                   floating type to use for the
+                                                images.
 
         Returns:
-            tuple of numpy.ndarray:                     a wavelet transformed
-                                                        array and a mask.
+            (tuple):                            the dot product of the images
+                                                (of image_type) and of the
+                                                masks (as numpy.float32).
     """
 
-    new_wavelet_transformed_image = None
-    new_wavelet_transformed_image_significant_mask = None
-
-    # Contains a bool array with significant values True and noise False.
-    new_image_noise_estimate = estimate_noise(
-        new_image,
-        significance_threshold=significance_threshold
-    )
-
-    # Dictionary with wavelet transform applied. Wavelet transform is the
-    # first index.
-    new_wavelet_transformed_image = wavelet.transform(
-        new_image,
-        include_intermediates=False,
-        include_lower_scales=True,
-        scale=wavelet_scale
-    )
-
-    if wavelet_thresholding.recorders.array_debug_recorder:
-        for i in iters.irange(len(new_wavelet_transformed_image)):
-            wavelet_thresholding.recorders.array_debug_recorder["new_wavelet_transformed_image"] = \
-                new_wavelet_transformed_image[i][None]
+    window = tuple(iters.imap(slice, lower, upper))
 
-    # Contains a bool array with significant values True and noise False for
-    # all wavelet transforms.
-    new_wavelet_transformed_image_significant_mask = significant_mask(
-        new_wavelet_transformed_image,
-        noise_estimate=new_image_noise_estimate,
-        noise_threshold=noise_threshold
+    image_dot_product = numpy.dot(
+        neuron_1["image"][window].ravel().astype(image_type),
+        neuron_2["image"][window].ravel().astype(image_type)
     )
+    mask_dot_product = numpy.float32(numpy.count_nonzero(
+        neuron_1["mask"][window] & neuron_2["mask"][window]
+    ))
 
-    return(
-        new_wavelet_transformed_image,
-        new_wavelet_transformed_image_significant_mask
-    )
+    return(image_dot_product, mask_dot_product)
 
 
 @prof.log_call(trace_logger)
-@hdf5.record.static_array_debug_recorder
-def match_regions_properties(props, constraints):
+def _neuron_pair_scores(new_neuron_set_1, new_neuron_set_2):
     """
-        Returns a mask selecting the regions with matching properties.
+        Measures the angle between the images and the overlap between the
+        masks of each pair of neurons from the two sets. Only pairs whose
+        bounding boxes overlap are measured and only on the part their boxes
+        share. All other pairs cannot share any pixels. So, they are scored
+        as zero.
 
         Args:
-            props(numpy.ndarray):           properties of each labeled region.
+            new_neuron_set_1(numpy.ndarray):    numpy structured array (dtype
+                                                get_neuron_dtype) containing
+                                                the first neuron set.
 
-            constraints(dict):              dictionary containing each property
-                                            with optional ``min`` and ``max``
-                                            for each value.
+            new_neuron_set_2(numpy.ndarray):    numpy structured array (dtype
+                                                get_neuron_dtype) containing
+                                                the second neuron set.
 
         Returns:
-            numpy.ndarray:                  mask with each region property that
-                                            matches marked as ``True`` and the
-                                            rest marked as ``False``.
+            (tuple of numpy.ndarrays):          cosine of the angle between
+                                                the images (as
+                                                expanded_numpy.dot_product_normalized
+                                                does with ord = 2) and the
+                                                dot product of the masks
+                                                divided by the area of the
+                                                neuron from the first set
+                                                and from the second set (as
+                                                expanded_numpy.dot_product_partially_normalized
+                                                does with ord = 1).
+
+        Examples:
+            >>> neurons = numpy.zeros(
+            ...     (3,), dtype=get_neuron_dtype((4, 5), float)
+            ... )
+            >>> neurons["mask"][0, 0:2, 0:2] = True
+            >>> neurons["mask"][1, 1:3, 1:3] = True
+            >>> neurons["mask"][2, 3, 3:] = True
+            >>> neurons["image"] = neurons["mask"]
+            >>> angle, overlap_1, overlap_2 = _neuron_pair_scores(
+            ...     neurons[:1], neurons
+            ... )
+            >>> angle
+            array([[ 1.  ,  0.25,  0.  ]])
+            >>> overlap_1
+            array([[ 1.  ,  0.25,  0.  ]], dtype=float32)
     """
 
-    within_bound = numpy.ones(props.shape, dtype=bool)
+    assert (new_neuron_set_1.dtype == new_neuron_set_2.dtype)
 
-    # Go through each property and make sure they are within the bounds
-    for each_prop, each_prop_constraints in constraints.items():
-        # If there is a lower bound, checks to see which are above it.
-        is_lower_bounded_maybe = None
-        if "min" in each_prop_constraints:
-            lower_bound = each_prop_constraints["min"]
-            is_lower_bounded_maybe = (
-                lower_bound <= props[each_prop]
-            )
-        else:
-            is_lower_bounded_maybe = numpy.ones(
-                props.shape, dtype=bool
-            )
+    image_type = numpy.promote_types(
+        new_neuron_set_1["image"].dtype, numpy.float16
+    ).type
 
-        # If there is an upper bound, checks to see which are below it.
-        is_upper_bounded_maybe = None
-        if "max" in each_prop_constraints:
-            upper_bound = each_prop_constraints["max"]
-            is_upper_bounded_maybe = (
-                props[each_prop] <= upper_bound
-            )
-        else:
-            is_upper_bounded_maybe = numpy.ones(
-                props.shape, dtype=bool
-            )
+    def bounding_boxes_and_norms(new_neuron_set):
+        lower, upper = _neuron_bounding_boxes(new_neuron_set)
 
-        # See whether both or neither bound is satisfied.
-        is_within_bound = is_lower_bounded_maybe & is_upper_bounded_maybe
+        new_neuron_set_image_norms = numpy.zeros(
+            (len(new_neuron_set),), dtype=image_type
+        )
+        new_neuron_set_mask_norms = numpy.zeros(
+            (len(new_neuron_set),), dtype=numpy.float32
+        )
+        for i in iters.irange(len(new_neuron_set)):
+            new_neuron_set_image_norms[i], new_neuron_set_mask_norms[i] = \
+                _neuron_norms(new_neuron_set[i], lower[i], upper[i], image_type)
 
-        # Collect the unbounded ones
-        within_bound &= is_within_bound
+        return(
+            lower, upper, new_neuron_set_image_norms, new_neuron_set_mask_norms
+        )
 
-    return(within_bound)
+    new_neuron_set_1_lower, new_neuron_set_1_upper, \
+        new_neuron_set_1_image_norms, new_neuron_set_1_mask_norms = \
+        bounding_boxes_and_norms(new_neuron_set_1)
+    new_neuron_set_2_lower, new_neuron_set_2_upper, \
+        new_neuron_set_2_image_norms, new_neuron_set_2_mask_norms = \
+        bounding_boxes_and_norms(new_neuron_set_2)
+
+    # Find the pairs of neurons whose bounding boxes overlap and where.
+    new_neuron_set_pairs_lower = numpy.maximum(
+        new_neuron_set_1_lower[:, None], new_neuron_set_2_lower[None, :]
+    )
+    new_neuron_set_pairs_upper = numpy.minimum(
+        new_neuron_set_1_upper[:, None], new_neuron_set_2_upper[None, :]
+    )
+    new_neuron_set_pairs_overlapping = (
+        new_neuron_set_pairs_lower < new_neuron_set_pairs_upper
+    ).all(axis=-1)
+
+    new_neuron_set_angle = numpy.zeros(
+        new_neuron_set_pairs_overlapping.shape, dtype=image_type
+    )
+    new_neuron_set_masks_overlaid_1 = numpy.zeros(
+        new_neuron_set_pairs_overlapping.shape, dtype=numpy.float32
+    )
+    new_neuron_set_masks_overlaid_2 = numpy.zeros(
+        new_neuron_set_pairs_overlapping.shape, dtype=numpy.float32
+    )
+
+    # Only overlapping pairs can have non-zero dot products and only on the
+    # part of their bounding boxes that is shared.
+    for i, j in iters.izip(*new_neuron_set_pairs_overlapping.nonzero()):
+        image_dot_product, mask_dot_product = _neuron_pair_dot_products(
+            new_neuron_set_1[i],
+            new_neuron_set_2[j],
+            new_neuron_set_pairs_lower[i, j],
+            new_neuron_set_pairs_upper[i, j],
+            image_type
+        )
+
+        new_neuron_set_angle[i, j] = image_dot_product / (
+            new_neuron_set_1_image_norms[i] * new_neuron_set_2_image_norms[j]
+        )
+        new_neuron_set_masks_overlaid_1[i, j] = (
+            mask_dot_product / new_neuron_set_1_mask_norms[i]
+        )
+        new_neuron_set_masks_overlaid_2[i, j] = (
+            mask_dot_product / new_neuron_set_2_mask_norms[j]
+        )
+
+    return(
+        new_neuron_set_angle,
+        new_neuron_set_masks_overlaid_1,
+        new_neuron_set_masks_overlaid_2
+    )
 
 
 @prof.log_call(trace_logger)
 @hdf5.record.static_array_debug_recorder
-def wavelet_denoising(new_image,
-                      accepted_region_shape_constraints,
-                      accepted_neuron_shape_constraints,
-                      **parameters):
+def fuse_neurons(neuron_1,
+                 neuron_2,
+                 fraction_mean_neuron_max_threshold,
+                 **parameters):
     """
-        Performs wavelet denoising on the given dictionary.
+        Merges the two neurons into one neuron, which is returned.
 
-        Args:
-            new_image(numpy.ndarray):                   array of data for
-                                                        generating a dictionary
-                                                        (first axis is time).
+        Note:
+            The first neuron (neuron_1) is preferred in tie-breaking
+            situations.
 
-            accepted_region_shape_constraints(dict):    a dictionary containing
-                                                        properties (that could
-                                                        be passed to
-                                                        region_properties)
-                                                        under this should be a
-                                                        dictionary that
-                                                        contains the keys min
-                                                        and/or max with a value
-                                                        for each.
+        Args:
+            neuron_1(numpy.ndarray):            numpy structured array (dtype
+                                                get_neuron_dtype) containing
+                                                the first neuron.
 
-            accepted_neuron_shape_constraints(dict):    a dictionary containing
-                                                        properties (that could
-                                                        be passed to
-                                                        region_properties)
-                                                        under this should be a
-                                                        dictionary that
-                                                        contains the keys min
-                                                        and/or max with a value
-                                                        for each.
+            neuron_2(numpy.ndarray):            numpy structured array (dtype
+                                                get_neuron_dtype) containing
+                                                the second neuron.
 
-            **parameters(dict):                         additional parameters
-                                                        for various other
-                                                        function calls.
+            **parameters(dict):                 dictionary of parameters
 
         Returns:
-            numpy.ndarray:                              a structured array of
-                                                        candidate neurons.
+            numpy.ndarray:                      a new neuron that is the result
+                                                of fusing the two.
     """
 
-    neurons = get_empty_neuron(shape=new_image.shape, dtype=new_image.dtype)
-
-    new_wavelet_image_denoised_segmentation = None
+    if fuse_neurons.recorders.array_debug_recorder:
+        fuse_neurons.recorders.array_debug_recorder["neuron_1"] = neuron_1
+        fuse_neurons.recorders.array_debug_recorder["neuron_2"] = neuron_2
 
-    logger.debug("Started wavelet denoising.")
-    logger.debug("Removing noise...")
+    assert (neuron_1.shape == neuron_2.shape == tuple())
+    assert (neuron_1.dtype == neuron_2.dtype)
+    assert issubclass(neuron_1["image"].dtype.type, numpy.floating)
 
-    # Contains a bool array with significant values True and noise False.
-    new_wavelet_transformed_image, new_wavelet_transformed_image_significant_mask = wavelet_thresholding(
-        new_image,
-        significance_threshold=parameters["estimate_noise"]["significance_threshold"],
-        wavelet_scale=parameters["wavelet.transform"]["scale"],
-        noise_threshold=parameters["significant_mask"]["noise_threshold"]
+    # Only the union of the bounding boxes of the two neurons (grown by one
+    # pixel so the contour is found correctly at its edges) can be non-zero.
+    neurons_lower, neurons_upper = _neuron_bounding_boxes(
+        numpy.array([neuron_1, neuron_2])
+    )
+    neurons_nonempty = (neurons_lower < neurons_upper).all(axis=1)
+    if neurons_nonempty.any():
+        neurons_lower = numpy.maximum(
+            neurons_lower[neurons_nonempty].min(axis=0) - 1, 0
+        )
+        neurons_upper = numpy.minimum(
+            neurons_upper[neurons_nonempty].max(axis=0) + 1,
+            neuron_1["mask"].shape
+        )
+    else:
+        neurons_lower = neurons_upper = neurons_lower[0]
+    window = tuple(iters.imap(slice, neurons_lower, neurons_upper))
+    window_is_whole = (
+        (neurons_upper - neurons_lower).prod() == neuron_1["mask"].size
     )
 
-    new_wavelet_image_mask = new_wavelet_transformed_image_significant_mask[-1].copy()
+    mean_neuron = (neuron_1["image"][window] + neuron_2["image"][window]) / 2
+    mean_neuron_max = mean_neuron.max() if mean_neuron.size else 0
+    if not window_is_whole:
+        # Everything outside of the window is zero.
+        mean_neuron_max = max(mean_neuron_max, 0)
+    mean_neuron_threshold = fraction_mean_neuron_max_threshold * mean_neuron_max
+    if not window_is_whole and (0 > mean_neuron_threshold):
+        # Pixels outside of the window would be kept too. So, use everything.
+        window = tuple(iters.imap(slice, neuron_1["mask"].shape))
+        neurons_lower = numpy.zeros_like(neurons_lower)
+        window_is_whole = True
+
+        mean_neuron = (neuron_1["image"] + neuron_2["image"]) / 2
+    mean_neuron_mask = mean_neuron > mean_neuron_threshold
 
-    # Creates a new dictionary without the noise
-    new_wavelet_image_denoised = new_wavelet_transformed_image[-1].copy()
-    new_wavelet_image_denoised *= new_wavelet_image_mask
+    # Gaussian mixture model ??? Skipped this.
 
-    wavelet_denoising.recorders.array_debug_recorder["new_wavelet_image_denoised"] = new_wavelet_image_denoised[None]
+    # Creates a NumPy structure array to store
+    new_neuron = numpy.zeros_like(neuron_1)
 
-    logger.debug("Noise removed.")
+    new_neuron["mask"][window] = mean_neuron_mask
 
-    if new_wavelet_image_denoised.any():
-        logger.debug("Frame has content other than noise.")
+    new_neuron["contour"][window] = xnumpy.generate_contour_fast(
+        mean_neuron_mask
+    )
 
-        logger.debug("Finding the label image...")
+    new_neuron["image"][window] = mean_neuron * mean_neuron_mask
 
-        # For holding the label image
-        new_wavelet_image_denoised_labeled = scipy.ndimage.label(new_wavelet_image_denoised)[0]
+    new_neuron["area"] = mean_neuron_mask.sum()
 
-        logger.debug("Found the label image.")
-        logger.debug("Determining the properties of the label image...")
+    new_neuron_max_F = 0
+    if mean_neuron_mask.size:
+        new_neuron_max_F = new_neuron["image"][window].max()
+    if not window_is_whole:
+        new_neuron_max_F = max(new_neuron_max_F, 0)
+    new_neuron["max_F"] = new_neuron_max_F
 
-        # For holding the label image properties
-        new_wavelet_image_denoised_labeled_props = region_properties(
-            new_wavelet_image_denoised_labeled,
-            properties=list(accepted_region_shape_constraints.keys())
-        )
+    new_neuron_mask_points = numpy.array(mean_neuron_mask.nonzero())
+    new_neuron_mask_points += neurons_lower[:, None]
+    new_neuron["gaussian_mean"] = new_neuron_mask_points.mean(axis=1)
+    new_neuron["gaussian_cov"] = numpy.cov(new_neuron_mask_points)
 
-        logger.debug("Determined the properties of the label image.")
+    new_neuron["centroid"] = new_neuron["gaussian_mean"]
 
-        logger.debug(
-            "Finding regions that fail to meet some shape constraints..."
-        )
+    if fuse_neurons.recorders.array_debug_recorder:
+        fuse_neurons.recorders.array_debug_recorder["new_neuron"] = new_neuron
 
-        within_bound = match_regions_properties(
-            new_wavelet_image_denoised_labeled_props,
-            accepted_region_shape_constraints
-        )
+    return(new_neuron)
 
-        logger.debug("Found regions that fail to meet some shape constraints.")
 
-        logger.debug(
-            "Reducing wavelet transform on regions outside of constraints..."
-        )
+@prof.log_class(trace_logger)
+class NeuronCatalogue(object):
+    """
+        Keeps a growing set of neurons (e.g. those found in each basis image
+        by postprocess_data) along with their bounding boxes and the scores
+        between each overlapping pair of them used for merging (see
+        merge_neuron_catalogue). When neurons are added or changed, they are
+        only compared with the neurons whose bounding boxes overlap theirs.
+        Scores between neurons that have not changed are kept.
 
-        # Get labels of the unbounded ones
-        labels_not_within_bound = new_wavelet_image_denoised_labeled_props["label"][~within_bound]
+        Note:
+            Neurons are kept in storage that grows as needed. So, adding
+            neurons does not copy all of the existing ones each time.
+            Removing neurons leaves holes, which are dropped when the storage
+            next grows. Indices only count the neurons that are kept and they
+            are in the order the neurons were added.
+    """
 
-        # Iterate over the unbounded ones to fix any errors.
-        for each_labels_not_within_bound in labels_not_within_bound:
-            # Get a mask for the current label
-            current_label_mask = (
-                new_wavelet_image_denoised_labeled == each_labels_not_within_bound
-            )
+    def __init__(self, shape, dtype):
+        """
+            Construct a NeuronCatalogue instance.
 
-            # Get a lower wavelet mask
-            lower_wavelet_mask = new_wavelet_transformed_image_significant_mask[-2]
+            Args:
+                shape(tuple of ints):           shape of the neuron images.
 
-            # Replacement mask
-            replacement_mask = current_label_mask & lower_wavelet_mask
+                dtype(type):                    type of the neuron images.
+        """
 
-            # Zero everything that is not in the replacement region and then
-            # use the lower transformed wavelet.
-            new_wavelet_image_denoised_replacement = new_wavelet_transformed_image[-2] * replacement_mask
+        self.shape = tuple(shape)
+        self.dtype = numpy.dtype(dtype)
 
-            # Overwrite the area in our old labeled mask to match this lower
-            # wavelet transform
-            new_wavelet_image_mask[current_label_mask] = lower_wavelet_mask[current_label_mask]
+        self.image_type = numpy.promote_types(
+            self.dtype, numpy.float16
+        ).type
 
-            # However, overwrite the previously labeled area completely (will
-            # push more things into the background)
-            new_wavelet_image_denoised[current_label_mask] = new_wavelet_image_denoised_replacement[current_label_mask]
+        # Number of places used in the storage (including holes).
+        self.size = 0
 
-        logger.debug(
-            "Reduced wavelet transform on regions outside of constraints..."
+        self.neuron_storage = get_empty_neuron(
+            shape=self.shape, dtype=self.dtype
         )
+        self.kept = numpy.zeros((0,), dtype=bool)
+        self.changed = numpy.zeros((0,), dtype=bool)
 
-        logger.debug("Finding new label image...")
+        self.lower = numpy.zeros((0, len(self.shape)), dtype=int)
+        self.upper = numpy.zeros((0, len(self.shape)), dtype=int)
+        self.image_norms = numpy.zeros((0,), dtype=self.image_type)
+        self.mask_norms = numpy.zeros((0,), dtype=numpy.float32)
 
-        new_wavelet_image_denoised_label_image = scipy.ndimage.label(
-            new_wavelet_image_denoised > 0
-        )[0]
+        # Cosine of the angle between the images and dot product of the masks
+        # for each pair of overlapping neurons (by storage index both ways).
+        # Pairs that do not overlap are zero and are not kept.
+        self.pairs = dict()
 
-        logger.debug("Found new label image.")
 
-        #ExtendedRegionProps.recorders.array_debug_recorder = hdf5.record.HDF5EnumeratedArrayRecorder(
-        #    wavelet_denoising.recorders.array_debug_recorder.hdf5_handle
-        #)
-        ExtendedRegionProps.recorders.array_debug_recorder = wavelet_denoising.recorders.array_debug_recorder
-        local_maxima = ExtendedRegionProps(
-            new_wavelet_image_denoised, new_wavelet_image_denoised_label_image
-        )
+    def __len__(self):
+        """
+            Number of neurons kept.
 
-        wavelet_denoising.recorders.array_debug_recorder["local_maxima_label_image"] = local_maxima.label_image[None]
-        if wavelet_denoising.recorders.array_debug_recorder:
-            wavelet_denoising.recorders.array_debug_recorder["local_maxima_label_image_contours"] = xnumpy.generate_labeled_contours(
-                local_maxima.label_image > 0
-            )[None]
+            Returns:
+                int:                            the number of neurons.
+        """
 
-        local_maxima = remove_low_intensity_local_maxima(
-            local_maxima, **parameters["remove_low_intensity_local_maxima"]
-        )
+        return(int(self.kept[:self.size].sum()))
 
-        wavelet_denoising.recorders.array_debug_recorder["local_maxima_label_image"] = local_maxima.label_image[None]
-        if wavelet_denoising.recorders.array_debug_recorder:
-            wavelet_denoising.recorders.array_debug_recorder["local_maxima_label_image_contours"] = xnumpy.generate_labeled_contours(
-                    local_maxima.label_image > 0
-            )[None]
 
-        local_maxima = remove_too_close_local_maxima(
-            local_maxima, **parameters["remove_too_close_local_maxima"]
-        )
+    def __getitem__(self, index):
+        """
+            Gets one neuron (not a copy).
 
-        wavelet_denoising.recorders.array_debug_recorder["local_maxima_label_image"] = local_maxima.label_image[None]
-        if wavelet_denoising.recorders.array_debug_recorder:
-            wavelet_denoising.recorders.array_debug_recorder["local_maxima_label_image_contours"] = xnumpy.generate_labeled_contours(
-                local_maxima.label_image > 0
-        )[None]
+            Args:
+                index(int):                     which neuron.
 
-        if local_maxima.props.size:
-            logger.debug("Entering watershed segmentation.")
+            Returns:
+                numpy.ndarray:                  the neuron.
+        """
 
-            # Perform the watershed segmentation.
+        return(self.neuron_storage[self.indices()[index]])
 
-            # First perform disc opening on the image.
-            # (Actually, we don't do this according to Ferran.)
-            #new_wavelet_image_denoised_opened = vigra.filters.discOpening(
-            #    new_wavelet_image_denoised.astype(numpy.float32), radius=1
-            #)
 
-            # We could look for seeds using local maxima.
-            # However, we already know what these should be as these are the
-            # local maxima we have found.
-            new_wavelet_image_denoised_maxima = local_maxima.get_local_max_label_image()
+    def __setitem__(self, index, neuron):
+        """
+            Replaces one neuron. Its scores are found again as needed.
 
-            # Segment with watershed on minimum image
-            # Use seeds from local maxima as local minima
-            # Also, include mask
-            new_wavelet_image_denoised_segmentation = skimage.morphology.watershed(
-                local_maxima.intensity_image,
-                new_wavelet_image_denoised_maxima,
-                mask=(local_maxima.intensity_image > 0)
-            )
+            Args:
+                index(int):                     which neuron.
 
-            wavelet_denoising.recorders.array_debug_recorder["watershed_segmentation"] = new_wavelet_image_denoised_segmentation[None]
-            if wavelet_denoising.recorders.array_debug_recorder:
-                wavelet_denoising.recorders.array_debug_recorder["watershed_segmentation_contours"] = xnumpy.generate_labeled_contours(
-                        new_wavelet_image_denoised_segmentation
-                )[None]
+                neuron(numpy.ndarray):          the new neuron.
+        """
 
-            watershed_local_maxima = ExtendedRegionProps(
-                local_maxima.intensity_image,
-                new_wavelet_image_denoised_segmentation,
-                properties=["centroid"] + list(accepted_neuron_shape_constraints.keys())
-            )
+        index = self.indices()[index]
 
-            wavelet_denoising.recorders.array_debug_recorder["watershed_local_maxima_label_image"] = watershed_local_maxima.label_image[None]
-            if wavelet_denoising.recorders.array_debug_recorder:
-                wavelet_denoising.recorders.array_debug_recorder["watershed_local_maxima_label_image_contours"] = xnumpy.generate_labeled_contours(
-                    watershed_local_maxima.label_image > 0
-                )[None]
+        self.neuron_storage[index] = neuron
+        self.changed[index] = True
 
-            wavelet_denoising.recorders.array_debug_recorder["watershed_local_maxima_props"] = watershed_local_maxima.props
-            wavelet_denoising.recorders.array_debug_recorder["watershed_local_maxima_count"] = watershed_local_maxima.count
 
-            # Remove duplicates
-            new_watershed_local_maxima_count_duplicates_mask = (
-                watershed_local_maxima.count["count"] > 1
-            )
-            new_watershed_local_maxima_count_duplicate_labels = watershed_local_maxima.count["label"][new_watershed_local_maxima_count_duplicates_mask]
-            new_watershed_local_maxima_props_duplicates_mask = xnumpy.contains(
-                watershed_local_maxima.props["label"], new_watershed_local_maxima_count_duplicate_labels
-            )
-            watershed_local_maxima.remove_prop_mask(
-                new_watershed_local_maxima_props_duplicates_mask
-            )
+    @property
+    def neurons(self):
+        """
+            All neurons kept (as a new array).
 
-            wavelet_denoising.recorders.array_debug_recorder["watershed_local_maxima_label_image"] = watershed_local_maxima.label_image[None]
-            if wavelet_denoising.recorders.array_debug_recorder:
-                wavelet_denoising.recorders.array_debug_recorder["watershed_local_maxima_label_image_contours"] = xnumpy.generate_labeled_contours(
-                watershed_local_maxima.label_image > 0
-            )[None]
+            Returns:
+                numpy.ndarray:                  numpy structured array (dtype
+                                                get_neuron_dtype) containing
+                                                the neurons.
+        """
 
-            if watershed_local_maxima.props.size:
-                wavelet_denoising.recorders.array_debug_recorder["watershed_local_maxima_props"] = watershed_local_maxima.props
-            if watershed_local_maxima.count.size:
-                wavelet_denoising.recorders.array_debug_recorder["watershed_local_maxima_count"] = watershed_local_maxima.count
+        return(self.neuron_storage[self.indices()])
 
-            within_bound = match_regions_properties(
-                watershed_local_maxima.props,
-                accepted_neuron_shape_constraints
-            )
 
-            # Get labels outside of bounds and remove them
-            watershed_local_maxima.remove_prop_mask(~within_bound)
+    def indices(self):
+        """
+            Where the neurons kept are in the storage.
 
-            wavelet_denoising.recorders.array_debug_recorder["watershed_local_maxima_label_image"] = watershed_local_maxima.label_image[None]
-            if wavelet_denoising.recorders.array_debug_recorder:
-                wavelet_denoising.recorders.array_debug_recorder["watershed_local_maxima_label_image_contours"] = xnumpy.generate_labeled_contours(
-                        watershed_local_maxima.label_image > 0
-                )[None]
+            Returns:
+                numpy.ndarray:                  storage index of each neuron.
+        """
 
-            if watershed_local_maxima.props.size:
-                wavelet_denoising.recorders.array_debug_recorder["watershed_local_maxima_props"] = watershed_local_maxima.props
-            if watershed_local_maxima.count.size:
-                wavelet_denoising.recorders.array_debug_recorder["watershed_local_maxima_count"] = watershed_local_maxima.count
+        return(self.kept[:self.size].nonzero()[0])
 
-            if watershed_local_maxima.props.size:
-                neurons = extract_neurons(
-                        new_image,
-                        xnumpy.all_permutations_equal(
-                            watershed_local_maxima.props["label"],
-                            watershed_local_maxima.label_image
-                        )
-                )
-                if len(neurons) > 1:
-                    logger.debug(
-                        "Extracted neurons. Found " +
-                        str(len(neurons)) + " neurons."
-                    )
-                else:
-                    logger.debug(
-                        "Extracted a neuron. Found " +
-                        str(len(neurons)) + " neuron."
-                    )
 
-                wavelet_denoising.recorders.array_debug_recorder["new_neuron_set"] = neurons
+    def reserve(self, num_neurons):
+        """
+            Ensures there is space to add more neurons. If the storage must
+            grow, holes left by removed neurons are dropped.
 
-            logger.debug("Exiting watershed segmentation.")
-        else:
-            logger.debug("No local maxima left that are acceptable neurons.")
-    else:
-        logger.debug("Frame is only noise.")
+            Args:
+                num_neurons(int):               how many neurons will be
+                                                added.
+        """
 
-    logger.debug("Finished making neurons for the current frame.")
-    return(neurons)
+        if (self.size + num_neurons) <= len(self.neuron_storage):
+            return
 
+        indices = self.indices()
 
-@prof.log_call(trace_logger)
-@hdf5.record.static_array_debug_recorder
-def extract_neurons(new_image, neuron_masks):
-    """
-        Extracts neurons from an image using a stack of masks.
+        capacity = 2 * (len(indices) + num_neurons)
 
-        Args:
-            new_image(numpy.ndarray):           spatial coordinates only (no
-                                                time).
+        def grow(old_array, fill=0):
+            new_array = numpy.empty(
+                (capacity,) + old_array.shape[1:], dtype=old_array.dtype
+            )
+            new_array[:len(indices)] = old_array[indices]
+            new_array[len(indices):] = fill
 
-            neuron_masks(numpy.ndarray):        first index of denotes which
-                                                mask and all others are spatial
-                                                indices.
+            return(new_array)
 
-        Returns:
-            numpy.ndarray:                      a stack of neurons in the same
-                                                order as the masks.
-    """
+        # Anything not filled in here is set when the neurons are added.
+        neuron_storage = numpy.empty(
+            (capacity,), dtype=self.neuron_storage.dtype
+        )
+        neuron_storage[:len(indices)] = self.neuron_storage[indices]
+        self.neuron_storage = neuron_storage
+
+        self.kept = grow(self.kept, False)
+        self.changed = grow(self.changed, False)
+
+        self.lower = grow(self.lower)
+        self.upper = grow(self.upper)
+        self.image_norms = grow(self.image_norms)
+        self.mask_norms = grow(self.mask_norms)
+
+        # Only neurons kept have pairs. So, all of them move.
+        new_indices = dict(iters.izip(indices, iters.irange(len(indices))))
+        self.pairs = dict(
+            (
+                new_indices[i],
+                dict((new_indices[j], v) for j, v in each_pairs.items())
+            )
+            for i, each_pairs in self.pairs.items()
+        )
 
-    neurons = numpy.empty(
-        len(neuron_masks),
-        dtype=get_neuron_dtype(shape=new_image.shape, dtype=new_image.dtype)
-    )
+        self.size = len(indices)
 
-    neurons["mask"] = neuron_masks
-    neurons["image"] = new_image * neurons["mask"]
-    neurons["area"] = xnumpy.array_to_matrix(neurons["mask"]).sum(axis=1)
-    neurons["max_F"] = xnumpy.array_to_matrix(neurons["image"]).max(axis=1)
 
-    for i in iters.irange(len(neurons)):
-        neuron_mask_i_points = numpy.array(neurons["mask"][i].nonzero())
+    def append(self, new_neuron_set):
+        """
+            Adds neurons after the existing ones. Their scores are found as
+            needed.
 
-        neurons["contour"][i] = xnumpy.generate_contour_fast(
-                neurons["mask"][i]
-        )
-        neurons["gaussian_mean"][i] = neuron_mask_i_points.mean(axis=1)
-        neurons["gaussian_cov"][i] = numpy.cov(neuron_mask_i_points)
+            Args:
+                new_neuron_set(numpy.ndarray):  numpy structured array (dtype
+                                                get_neuron_dtype) containing
+                                                the neurons to add.
+        """
 
-    neurons["centroid"] = neurons["gaussian_mean"]
+        self.reserve(len(new_neuron_set))
 
-    return(neurons)
+        new_size = self.size + len(new_neuron_set)
 
+        self.neuron_storage[self.size:new_size] = new_neuron_set
+        self.kept[self.size:new_size] = True
+        self.changed[self.size:new_size] = True
 
-@prof.log_call(trace_logger)
-@hdf5.record.static_array_debug_recorder
-def fuse_neurons(neuron_1,
-                 neuron_2,
-                 fraction_mean_neuron_max_threshold,
-                 **parameters):
-    """
-        Merges the two neurons into one neuron, which is returned.
+        self.size = new_size
 
-        Note:
-            The first neuron (neuron_1) is preferred in tie-breaking
-            situations.
 
-        Args:
-            neuron_1(numpy.ndarray):            numpy structured array (dtype
-                                                get_neuron_dtype) containing
-                                                the first neuron.
+    def remove(self, indices):
+        """
+            Removes neurons.
 
-            neuron_2(numpy.ndarray):            numpy structured array (dtype
-                                                get_neuron_dtype) containing
-                                                the second neuron.
+            Args:
+                indices(numpy.ndarray):         which neurons.
+        """
 
-            **parameters(dict):                 dictionary of parameters
+        indices = self.indices()[indices]
+
+        self.kept[indices] = False
+        self.changed[indices] = False
+
+        self.forget_pairs(indices)
 
-        Returns:
-            numpy.ndarray:                      a new neuron that is the result
-                                                of fusing the two.
-    """
 
-    if fuse_neurons.recorders.array_debug_recorder:
-        fuse_neurons.recorders.array_debug_recorder["neuron_1"] = neuron_1
-        fuse_neurons.recorders.array_debug_recorder["neuron_2"] = neuron_2
+    def forget_pairs(self, indices):
+        """
+            Drops the scores of any pair including these neurons.
 
-    assert (neuron_1.shape == neuron_2.shape == tuple())
-    assert (neuron_1.dtype == neuron_2.dtype)
-    assert issubclass(neuron_1["image"].dtype.type, numpy.floating)
+            Args:
+                indices(numpy.ndarray):         storage index of each neuron.
+        """
 
-    mean_neuron = (neuron_1["image"] + neuron_2["image"]) / 2
-    mean_neuron_mask = mean_neuron > (
-        fraction_mean_neuron_max_threshold * mean_neuron.max())
+        for i in indices:
+            for j in self.pairs.pop(i, {}):
+                del self.pairs[j][i]
 
-    # Gaussian mixture model ??? Skipped this.
 
-    # Creates a NumPy structure array to store
-    new_neuron = numpy.empty_like(neuron_1)
+    def scores(self):
+        """
+            Measures the angle between the images and the overlap between
+            the masks of each pair of neurons kept. Only neurons that are new
+            or changed are measured again and only with the neurons whose
+            bounding boxes overlap theirs (on the part the boxes share).
 
-    new_neuron["mask"] = mean_neuron_mask
+            Returns:
+                (tuple of numpy.ndarrays):      each pair of overlapping
+                                                neurons (as positions among
+                                                the neurons kept, in both
+                                                orders), the cosine of the
+                                                angle between their images,
+                                                and the dot product of their
+                                                masks divided by the area of
+                                                the first. All other pairs
+                                                are zero.
+        """
 
-    new_neuron["contour"] = xnumpy.generate_contour_fast(new_neuron["mask"])
+        changed_indices = (
+            self.changed[:self.size] & self.kept[:self.size]
+        ).nonzero()[0]
 
-    new_neuron["image"] = mean_neuron * new_neuron["mask"]
+        self.forget_pairs(changed_indices)
+
+        self.lower[changed_indices], self.upper[changed_indices] = \
+            _neuron_bounding_boxes(self.neuron_storage[changed_indices])
+        for i in changed_indices:
+            self.image_norms[i], self.mask_norms[i] = _neuron_norms(
+                self.neuron_storage[i],
+                self.lower[i],
+                self.upper[i],
+                self.image_type
+            )
 
-    new_neuron["area"] = new_neuron["mask"].sum()
+        indices = self.indices()
+
+        for i in changed_indices:
+            # Find the neurons whose bounding boxes overlap this one. Pairs of
+            # changed neurons are only measured once.
+            pairs_lower = numpy.maximum(self.lower[i], self.lower[indices])
+            pairs_upper = numpy.minimum(self.upper[i], self.upper[indices])
+            pairs_overlapping = (pairs_lower < pairs_upper).all(axis=1)
+            pairs_overlapping &= (indices > i) | ~self.changed[indices]
+
+            for j, each_pair_lower, each_pair_upper in iters.izip(
+                    indices[pairs_overlapping],
+                    pairs_lower[pairs_overlapping],
+                    pairs_upper[pairs_overlapping]
+            ):
+                image_dot_product, mask_dot_product = \
+                    _neuron_pair_dot_products(
+                        self.neuron_storage[i],
+                        self.neuron_storage[j],
+                        each_pair_lower,
+                        each_pair_upper,
+                        self.image_type
+                    )
 
-    new_neuron["max_F"] = new_neuron["image"].max()
+                self.pairs.setdefault(i, dict())[j] = \
+                    self.pairs.setdefault(j, dict())[i] = (
+                        image_dot_product / (
+                            self.image_norms[i] * self.image_norms[j]
+                        ),
+                        mask_dot_product
+                    )
 
-    new_neuron_mask_points = numpy.array(new_neuron["mask"].nonzero())
-    new_neuron["gaussian_mean"] = new_neuron_mask_points.mean(axis=1)
-    new_neuron["gaussian_cov"] = numpy.cov(new_neuron_mask_points)
+        self.changed[changed_indices] = False
+
+        pairs_i = []
+        pairs_j = []
+        pairs_angle = []
+        pairs_masks_overlaid = []
+        for i, each_pairs in self.pairs.items():
+            for j, (each_angle, each_masks_overlaid) in each_pairs.items():
+                pairs_i.append(i)
+                pairs_j.append(j)
+                pairs_angle.append(each_angle)
+                pairs_masks_overlaid.append(each_masks_overlaid)
+
+        pairs_i = numpy.array(pairs_i, dtype=int)
+        pairs_j = numpy.array(pairs_j, dtype=int)
+        pairs_angle = numpy.array(pairs_angle, dtype=self.image_type)
+        pairs_masks_overlaid = numpy.array(
+            pairs_masks_overlaid, dtype=numpy.float32
+        )
 
-    new_neuron["centroid"] = new_neuron["gaussian_mean"]
+        pairs_masks_overlaid_nonzero = (pairs_masks_overlaid != 0)
+        pairs_masks_overlaid[pairs_masks_overlaid_nonzero] /= self.mask_norms[
+            pairs_i[pairs_masks_overlaid_nonzero]
+        ]
 
-    if fuse_neurons.recorders.array_debug_recorder:
-        fuse_neurons.recorders.array_debug_recorder["new_neuron"] = new_neuron
+        # Go from storage indices to positions among the neurons kept.
+        positions = numpy.zeros((self.size,), dtype=int)
+        positions[indices] = numpy.arange(len(indices))
 
-    return(new_neuron)
+        return(
+            positions[pairs_i],
+            positions[pairs_j],
+            pairs_angle,
+            pairs_masks_overlaid
+        )
 
 
 @prof.log_call(trace_logger)
@@ -3161,38 +5748,18 @@ def merge_neuron_sets_once(new_neuron_set_1,
 
         new_neuron_set = new_neuron_set_1.copy()
 
-        new_neuron_set_1_flattened = xnumpy.array_to_matrix(
-            new_neuron_set_1["image"]
-        )
-        new_neuron_set_2_flattened = xnumpy.array_to_matrix(
-            new_neuron_set_2["image"]
-        )
-
-        new_neuron_set_1_flattened_mask = xnumpy.array_to_matrix(
-            new_neuron_set_1["mask"]
-        )
-        new_neuron_set_2_flattened_mask = xnumpy.array_to_matrix(
-            new_neuron_set_2["mask"]
-        )
-
         # Measure the normalized dot product between any two neurons (i.e.
-        # related to the angle of separation)
-        new_neuron_set_angle = xnumpy.dot_product_normalized(
-            new_neuron_set_1_flattened,
-            new_neuron_set_2_flattened,
-            ord=2
-        )
+        # related to the angle of separation) and the distance between the
+        # two masks (note distance relative to the total mask content of each
+        # mask individually). Only pairs of neurons with overlapping bounding
+        # boxes are measured (on the part they share) as all others are zero.
+        new_neuron_set_angle, new_neuron_set_masks_overlaid_1, \
+            new_neuron_set_masks_overlaid_2 = _neuron_pair_scores(
+                new_neuron_set_1, new_neuron_set_2
+            )
 
         merge_neuron_sets_once.recorders.array_debug_recorder["new_neuron_set_angle"] = new_neuron_set_angle
 
-        # Measure the distance between the two masks
-        # (note distance relative to the total mask content of each mask individually)
-        new_neuron_set_masks_overlaid_1, new_neuron_set_masks_overlaid_2 = xnumpy.dot_product_partially_normalized(
-            new_neuron_set_1_flattened_mask.astype(numpy.float32),
-            new_neuron_set_2_flattened_mask.astype(numpy.float32),
-            ord=1
-        )
-
         merge_neuron_sets_once.recorders.array_debug_recorder["new_neuron_set_masks_overlaid_1"] = new_neuron_set_masks_overlaid_1
         merge_neuron_sets_once.recorders.array_debug_recorder["new_neuron_set_masks_overlaid_2"] = new_neuron_set_masks_overlaid_2
 
@@ -3426,7 +5993,12 @@ def merge_neuron_sets_repeatedly(new_neuron_set_1,
 
     assert (new_neuron_set_1.dtype == new_neuron_set_2.dtype)
 
-    new_neuron_set = numpy.hstack([new_neuron_set_1, new_neuron_set_2])
+    new_neuron_catalogue = NeuronCatalogue(
+        shape=new_neuron_set_1.dtype["image"].shape,
+        dtype=new_neuron_set_1.dtype["image"].base
+    )
+    new_neuron_catalogue.append(new_neuron_set_1)
+    new_neuron_catalogue.append(new_neuron_set_2)
 
     if len(new_neuron_set_1) and len(new_neuron_set_2):
         logger.debug("Have 2 sets of neurons to merge.")
@@ -3437,113 +6009,235 @@ def merge_neuron_sets_repeatedly(new_neuron_set_1,
     else:
         logger.debug("Have 0 sets of neurons to merge.")
 
-    original_new_neuron_set_size = 0
+    merge_neuron_catalogue.recorders.array_debug_recorder = merge_neuron_sets_repeatedly.recorders.array_debug_recorder
+    merge_neuron_catalogue(
+        new_neuron_catalogue,
+        alignment_min_threshold,
+        overlap_min_threshold,
+        **parameters
+    )
 
-    while (new_neuron_set.size != 1) and \
-            (original_new_neuron_set_size != new_neuron_set.size):
-        original_new_neuron_set_size = new_neuron_set.size
+    new_neuron_set = new_neuron_catalogue.neurons
 
-        new_neuron_set_flattened_image = xnumpy.array_to_matrix(
-            new_neuron_set["image"]
-        )
+    if new_neuron_set.size:
+        merge_neuron_sets_repeatedly.recorders.array_debug_recorder["new_merged_neurons_set"] = new_neuron_set
 
-        new_neuron_set_flattened_mask = xnumpy.array_to_matrix(
-            new_neuron_set["mask"]
-        )
+    return(new_neuron_set)
+
+
+@prof.log_call(trace_logger)
+def _pairs_argmax(rows, columns, values, size):
+    """
+        Finds the max along each column (and its first row) of a square
+        matrix given only some of its entries (all others are zero), like
+        numpy.argmax with axis=0 on the full matrix.
+
+        Args:
+            rows(numpy.ndarray):                row of each entry (unique with
+                                                columns).
+
+            columns(numpy.ndarray):             column of each entry.
+
+            values(numpy.ndarray):              value of each entry.
+
+            size(int):                          number of rows (and columns).
+
+        Returns:
+            (tuple of numpy.ndarrays):          row of the max in each column
+                                                and the max.
+
+        Examples:
+            >>> _pairs_argmax(
+            ...     numpy.array([0, 1, 2]),
+            ...     numpy.array([1, 1, 2]),
+            ...     numpy.array([0.5, 0.5, -1.0]),
+            ...     3
+            ... )
+            (array([0, 0, 0]), array([ 0. ,  0.5,  0. ]))
+    """
+
+    # Zeros are the same as entries that were not given.
+    nonzero = (values != 0)
+    rows = rows[nonzero]
+    columns = columns[nonzero]
+    values = values[nonzero]
+
+    maxes = numpy.zeros((size,), dtype=values.dtype)
+    maxes_rows = numpy.zeros((size,), dtype=int)
+    maxes_found = numpy.zeros((size,), dtype=bool)
+
+    # The first entry in each column is the largest (and earliest if tied).
+    order = numpy.lexsort((rows, -values, columns))
+    order_first = numpy.ones(order.shape, dtype=bool)
+    order_first[1:] = (columns[order][1:] != columns[order][:-1])
+    order = order[order_first]
+
+    maxes[columns[order]] = values[order]
+    maxes_rows[columns[order]] = rows[order]
+    maxes_found[columns[order]] = True
+
+    # Find the first zero in each column (if any) for those without a
+    # positive max. As the rows in a column are unique, those before the
+    # first zero are the same as their rank in the column.
+    order = numpy.lexsort((rows, columns))
+    columns_counts = numpy.bincount(columns, minlength=size)
+    columns_starts = numpy.cumsum(columns_counts) - columns_counts
+    ranks = numpy.arange(len(order)) - columns_starts[columns[order]]
+    zeros_rows = numpy.bincount(
+        columns[order][rows[order] == ranks], minlength=size
+    )
+
+    use_zeros = (zeros_rows < size) & ~(maxes_found & (maxes > 0))
+    maxes[use_zeros] = 0
+    maxes_rows[use_zeros] = zeros_rows[use_zeros]
+
+    return(maxes_rows, maxes)
+
+
+@prof.log_call(trace_logger)
+@hdf5.record.static_array_debug_recorder
+def merge_neuron_catalogue(new_neuron_catalogue,
+                           alignment_min_threshold,
+                           overlap_min_threshold,
+                           **parameters):
+    """
+        Merges the neurons in the catalogue (in place) until none of them can
+        be merged any more (see merge_neuron_sets_repeatedly).
+
+        As the scores between neurons that have not changed are kept by the
+        catalogue, neurons can be added to it (e.g. from each basis image) and
+        merged after each time. Only the new or changed neurons are compared
+        (with the neurons they overlap) each time.
+
+        Note:
+            Earlier neurons in the catalogue are preferred and treated as the
+            neurons to merge into.
+
+        Args:
+            new_neuron_catalogue(NeuronCatalogue):      the neurons to merge.
+
+            alignment_min_threshold(float):             The minimum required
+                                                        cosine of the angle
+                                                        between two neurons for
+                                                        them to be treated as
+                                                        candidates for merging.
+
+            overlap_min_threshold(numpy.ndarray):       The minimum required
+                                                        dot product (divided by
+                                                        the L1 norm of one of
+                                                        the neurons) for them
+                                                        to be treated as
+                                                        candidates for merging.
+
+            **parameters(dict):                         dictionary of parameters
+    """
+
+    original_new_neuron_set_size = 0
+
+    while (len(new_neuron_catalogue) != 1) and \
+            (original_new_neuron_set_size != len(new_neuron_catalogue)):
+        original_new_neuron_set_size = len(new_neuron_catalogue)
 
         # Measure the normalized dot product between any two neurons (i.e.
-        # related to the angle of separation)
-        new_neuron_set_angle = xnumpy.pair_dot_product_normalized(
-            new_neuron_set_flattened_image,
-            ord=2
-        )
-        new_neuron_set_angle = numpy.triu(new_neuron_set_angle, k=1)
+        # related to the angle of separation) and the distance between the
+        # two masks (note distance relative to the total mask content of each
+        # mask individually). Only new or changed neurons are measured again.
+        # Only overlapping pairs are given as all others are zero.
+        pairs_i, pairs_j, pairs_angle, pairs_masks_overlaid = \
+            new_neuron_catalogue.scores()
 
-        merge_neuron_sets_repeatedly.recorders.array_debug_recorder["new_neuron_set_angle"] = new_neuron_set_angle
+        # Only compare with earlier neurons for the angle.
+        pairs_earlier = (pairs_i < pairs_j)
 
-        # Measure the distance between the two masks
-        # (note distance relative to the total mask content of each mask
-        # individually)
-        new_neuron_set_masks_overlaid = xnumpy.pair_dot_product_partially_normalized(
-            new_neuron_set_flattened_mask,
-            ord=1,
-            float_type=numpy.float32
-        )
-        numpy.fill_diagonal(new_neuron_set_masks_overlaid, 0)
+        if merge_neuron_catalogue.recorders.array_debug_recorder:
+            num_neurons = len(new_neuron_catalogue)
+
+            new_neuron_set_angle = numpy.zeros(
+                (num_neurons, num_neurons), dtype=pairs_angle.dtype
+            )
+            new_neuron_set_angle[
+                pairs_i[pairs_earlier], pairs_j[pairs_earlier]
+            ] = pairs_angle[pairs_earlier]
 
-        new_neuron_set_masks_overlaid_1 = new_neuron_set_masks_overlaid
-        new_neuron_set_masks_overlaid_2 = new_neuron_set_masks_overlaid.T
+            new_neuron_set_masks_overlaid_1 = numpy.zeros(
+                (num_neurons, num_neurons), dtype=pairs_masks_overlaid.dtype
+            )
+            new_neuron_set_masks_overlaid_1[pairs_i, pairs_j] = \
+                pairs_masks_overlaid
+            new_neuron_set_masks_overlaid_2 = new_neuron_set_masks_overlaid_1.T
 
-        merge_neuron_sets_repeatedly.recorders.array_debug_recorder["new_neuron_set_masks_overlaid_1"] = new_neuron_set_masks_overlaid_1
-        merge_neuron_sets_repeatedly.recorders.array_debug_recorder["new_neuron_set_masks_overlaid_2"] = new_neuron_set_masks_overlaid_2
+            merge_neuron_catalogue.recorders.array_debug_recorder["new_neuron_set_angle"] = new_neuron_set_angle
+            merge_neuron_catalogue.recorders.array_debug_recorder["new_neuron_set_masks_overlaid_1"] = new_neuron_set_masks_overlaid_1
+            merge_neuron_catalogue.recorders.array_debug_recorder["new_neuron_set_masks_overlaid_2"] = new_neuron_set_masks_overlaid_2
 
         # Now that the three measures for the correlation method have been
         # found, we want to know, which are the best correlated neurons between
         # the two sets using these measures. This done to find the neuron in
         # new_neuron_set_1 that best matches each neuron in new_neuron_set_2.
-        new_neuron_set_angle_all_optimal_i = new_neuron_set_angle.argmax(
-            axis=0
-        )
-        new_neuron_set_masks_overlaid_1_all_optimal_i = new_neuron_set_masks_overlaid_1.argmax(
-            axis=0
-        )
-        new_neuron_set_masks_overlaid_2_all_optimal_i = new_neuron_set_masks_overlaid_2.argmax(
-            axis=0
-        )
+        new_neuron_set_angle_all_optimal_i, new_neuron_set_angle_maxes = \
+            _pairs_argmax(
+                pairs_i[pairs_earlier],
+                pairs_j[pairs_earlier],
+                pairs_angle[pairs_earlier],
+                len(new_neuron_catalogue)
+            )
+        new_neuron_set_masks_overlaid_1_all_optimal_i, new_neuron_set_masks_overlaid_1_maxes = \
+            _pairs_argmax(
+                pairs_i,
+                pairs_j,
+                pairs_masks_overlaid,
+                len(new_neuron_catalogue)
+            )
+        new_neuron_set_masks_overlaid_2_all_optimal_i, new_neuron_set_masks_overlaid_2_maxes = \
+            _pairs_argmax(
+                pairs_j,
+                pairs_i,
+                pairs_masks_overlaid,
+                len(new_neuron_catalogue)
+            )
 
-        merge_neuron_sets_repeatedly.recorders.array_debug_recorder["new_neuron_set_angle_all_optimal_i"] = new_neuron_set_angle_all_optimal_i
-        merge_neuron_sets_repeatedly.recorders.array_debug_recorder["new_neuron_set_masks_overlaid_1_all_optimal_i"] = \
+        merge_neuron_catalogue.recorders.array_debug_recorder["new_neuron_set_angle_all_optimal_i"] = new_neuron_set_angle_all_optimal_i
+        merge_neuron_catalogue.recorders.array_debug_recorder["new_neuron_set_masks_overlaid_1_all_optimal_i"] = \
             new_neuron_set_masks_overlaid_1_all_optimal_i
-        merge_neuron_sets_repeatedly.recorders.array_debug_recorder["new_neuron_set_masks_overlaid_2_all_optimal_i"] = \
+        merge_neuron_catalogue.recorders.array_debug_recorder["new_neuron_set_masks_overlaid_2_all_optimal_i"] = \
             new_neuron_set_masks_overlaid_2_all_optimal_i
 
         # Get all the j indices
-        new_neuron_set_all_j = numpy.arange(len(new_neuron_set))
+        new_neuron_set_all_j = numpy.arange(len(new_neuron_catalogue))
 
-        merge_neuron_sets_repeatedly.recorders.array_debug_recorder["new_neuron_set_all_j"] = new_neuron_set_all_j
-
-        # Get the maximum corresponding to the best matched pairs from before
-        new_neuron_set_angle_maxes = new_neuron_set_angle[
-            (new_neuron_set_angle_all_optimal_i, new_neuron_set_all_j,)
-        ]
-        new_neuron_set_masks_overlaid_1_maxes = new_neuron_set_masks_overlaid_1[
-            (new_neuron_set_masks_overlaid_1_all_optimal_i, new_neuron_set_all_j,)
-        ]
-        new_neuron_set_masks_overlaid_2_maxes = new_neuron_set_masks_overlaid_2[
-            (new_neuron_set_masks_overlaid_2_all_optimal_i, new_neuron_set_all_j,)
-        ]
+        merge_neuron_catalogue.recorders.array_debug_recorder["new_neuron_set_all_j"] = new_neuron_set_all_j
 
-        merge_neuron_sets_repeatedly.recorders.array_debug_recorder["new_neuron_set_angle_maxes"] = new_neuron_set_angle_maxes
-        merge_neuron_sets_repeatedly.recorders.array_debug_recorder["new_neuron_set_masks_overlaid_1_maxes"] = new_neuron_set_masks_overlaid_1_maxes
-        merge_neuron_sets_repeatedly.recorders.array_debug_recorder["new_neuron_set_masks_overlaid_2_maxes"] = new_neuron_set_masks_overlaid_2_maxes
+        merge_neuron_catalogue.recorders.array_debug_recorder["new_neuron_set_angle_maxes"] = new_neuron_set_angle_maxes
+        merge_neuron_catalogue.recorders.array_debug_recorder["new_neuron_set_masks_overlaid_1_maxes"] = new_neuron_set_masks_overlaid_1_maxes
+        merge_neuron_catalogue.recorders.array_debug_recorder["new_neuron_set_masks_overlaid_2_maxes"] = new_neuron_set_masks_overlaid_2_maxes
 
         # Store a list of the optimal neurons in the existing set to fuse with
         # (by default set all values to -1)
         new_neuron_set_all_optimal_i = numpy.zeros(
-            (len(new_neuron_set),), dtype=int
+            (len(new_neuron_catalogue),), dtype=int
         )
         new_neuron_set_all_optimal_i -= 1
 
-        merge_neuron_sets_repeatedly.recorders.array_debug_recorder["new_neuron_set_all_optimal_i_0"] = new_neuron_set_all_optimal_i
+        merge_neuron_catalogue.recorders.array_debug_recorder["new_neuron_set_all_optimal_i_0"] = new_neuron_set_all_optimal_i
 
         # Create the masks to use for getting the proper indices
         new_neuron_set_angle_maxes_significant = numpy.zeros(
-            (len(new_neuron_set),), dtype=bool
+            (len(new_neuron_catalogue),), dtype=bool
         )
         new_neuron_set_masks_overlaid_1_maxes_significant = numpy.zeros(
-            (len(new_neuron_set),), dtype=bool
+            (len(new_neuron_catalogue),), dtype=bool
         )
         new_neuron_set_masks_overlaid_2_maxes_significant = numpy.zeros(
-            (len(new_neuron_set),), dtype=bool
+            (len(new_neuron_catalogue),), dtype=bool
         )
 
-        merge_neuron_sets_repeatedly.recorders.array_debug_recorder["new_neuron_set_angle_maxes_significant_0"] = new_neuron_set_angle_maxes_significant
-        merge_neuron_sets_repeatedly.recorders.array_debug_recorder["new_neuron_set_masks_overlaid_1_maxes_significant_0"] = \
+        merge_neuron_catalogue.recorders.array_debug_recorder["new_neuron_set_angle_maxes_significant_0"] = new_neuron_set_angle_maxes_significant
+        merge_neuron_catalogue.recorders.array_debug_recorder["new_neuron_set_masks_overlaid_1_maxes_significant_0"] = \
             new_neuron_set_masks_overlaid_1_maxes_significant
-        merge_neuron_sets_repeatedly.recorders.array_debug_recorder["new_neuron_set_masks_overlaid_2_maxes_significant_0"] = \
+        merge_neuron_catalogue.recorders.array_debug_recorder["new_neuron_set_masks_overlaid_2_maxes_significant_0"] = \
             new_neuron_set_masks_overlaid_2_maxes_significant
 
-        already_matched = numpy.zeros((len(new_neuron_set),), dtype=bool)
+        already_matched = numpy.zeros((len(new_neuron_catalogue),), dtype=bool)
 
         # Get masks that indicate which measurements have the best matching
         # neuron
@@ -3569,22 +6263,22 @@ def merge_neuron_sets_repeatedly(new_neuron_set_1,
             (new_neuron_set_masks_overlaid_2_maxes_significant > overlap_min_threshold)
         ] = True
 
-        merge_neuron_sets_repeatedly.recorders.array_debug_recorder["new_neuron_set_angle_maxes_significant_1"] = new_neuron_set_angle_maxes_significant
-        merge_neuron_sets_repeatedly.recorders.array_debug_recorder["new_neuron_set_masks_overlaid_1_maxes_significant_1"] = new_neuron_set_masks_overlaid_1_maxes_significant
-        merge_neuron_sets_repeatedly.recorders.array_debug_recorder["new_neuron_set_masks_overlaid_2_maxes_significant_1"] = new_neuron_set_masks_overlaid_2_maxes_significant
+        merge_neuron_catalogue.recorders.array_debug_recorder["new_neuron_set_angle_maxes_significant_1"] = new_neuron_set_angle_maxes_significant
+        merge_neuron_catalogue.recorders.array_debug_recorder["new_neuron_set_masks_overlaid_1_maxes_significant_1"] = new_neuron_set_masks_overlaid_1_maxes_significant
+        merge_neuron_catalogue.recorders.array_debug_recorder["new_neuron_set_masks_overlaid_2_maxes_significant_1"] = new_neuron_set_masks_overlaid_2_maxes_significant
 
         # Using the masks construct the best match neuron index for each case.
         new_neuron_set_all_optimal_i[new_neuron_set_angle_maxes_significant] = new_neuron_set_angle_all_optimal_i[new_neuron_set_angle_maxes_significant]
 
-        merge_neuron_sets_repeatedly.recorders.array_debug_recorder["new_neuron_set_all_optimal_i_1"] = new_neuron_set_all_optimal_i
+        merge_neuron_catalogue.recorders.array_debug_recorder["new_neuron_set_all_optimal_i_1"] = new_neuron_set_all_optimal_i
 
         new_neuron_set_all_optimal_i[new_neuron_set_masks_overlaid_1_maxes_significant] = new_neuron_set_masks_overlaid_1_all_optimal_i[new_neuron_set_masks_overlaid_1_maxes_significant]
 
-        merge_neuron_sets_repeatedly.recorders.array_debug_recorder["new_neuron_set_all_optimal_i_2"] = new_neuron_set_all_optimal_i
+        merge_neuron_catalogue.recorders.array_debug_recorder["new_neuron_set_all_optimal_i_2"] = new_neuron_set_all_optimal_i
 
         new_neuron_set_all_optimal_i[new_neuron_set_masks_overlaid_2_maxes_significant] = new_neuron_set_masks_overlaid_2_all_optimal_i[new_neuron_set_masks_overlaid_2_maxes_significant]
 
-        merge_neuron_sets_repeatedly.recorders.array_debug_recorder["new_neuron_set_all_optimal_i_3"] = new_neuron_set_all_optimal_i
+        merge_neuron_catalogue.recorders.array_debug_recorder["new_neuron_set_all_optimal_i_3"] = new_neuron_set_all_optimal_i
 
 
         # Separate all the best matches that were found from those that were
@@ -3596,18 +6290,16 @@ def merge_neuron_sets_repeatedly(new_neuron_set_1,
         new_neuron_set_all_j_append = new_neuron_set_all_j[~new_neuron_set_all_optimal_i_found]
         new_neuron_set_all_optimal_i = new_neuron_set_all_optimal_i[new_neuron_set_all_optimal_i_found]
 
-        merge_neuron_sets_repeatedly.recorders.array_debug_recorder["new_neuron_set_all_optimal_i_found"] = new_neuron_set_all_optimal_i_found
+        merge_neuron_catalogue.recorders.array_debug_recorder["new_neuron_set_all_optimal_i_found"] = new_neuron_set_all_optimal_i_found
 
         if new_neuron_set_all_j_fuse.size:
-            merge_neuron_sets_repeatedly.recorders.array_debug_recorder["new_neuron_set_all_j_fuse"] = new_neuron_set_all_j_fuse
+            merge_neuron_catalogue.recorders.array_debug_recorder["new_neuron_set_all_j_fuse"] = new_neuron_set_all_j_fuse
 
         if new_neuron_set_all_j_append.size:
-            merge_neuron_sets_repeatedly.recorders.array_debug_recorder["new_neuron_set_all_j_append"] = new_neuron_set_all_j_append
+            merge_neuron_catalogue.recorders.array_debug_recorder["new_neuron_set_all_j_append"] = new_neuron_set_all_j_append
 
         if new_neuron_set_all_optimal_i.size:
-            merge_neuron_sets_repeatedly.recorders.array_debug_recorder["new_neuron_set_all_optimal_i_3"] = new_neuron_set_all_optimal_i
-
-        new_neuron_set_kept = numpy.ones(new_neuron_set.shape, dtype=bool)
+            merge_neuron_catalogue.recorders.array_debug_recorder["new_neuron_set_all_optimal_i_3"] = new_neuron_set_all_optimal_i
 
         # Fuse all the neurons that can be from new_neuron_set_2 to the
         # new_neuron_set (composed of new_neuron_set_1)
@@ -3615,93 +6307,460 @@ def merge_neuron_sets_repeatedly(new_neuron_set_1,
                 new_neuron_set_all_optimal_i, new_neuron_set_all_j_fuse
         ):
             #fuse_neurons.recorders.array_debug_recorder = hdf5.record.HDF5EnumeratedArrayRecorder(
-            #    merge_neuron_sets_repeatedly.recorders.array_debug_recorder.hdf5_handle
+            #    merge_neuron_catalogue.recorders.array_debug_recorder.hdf5_handle
             #)
-            fuse_neurons.recorders.array_debug_recorder = merge_neuron_sets_repeatedly.recorders.array_debug_recorder
+            fuse_neurons.recorders.array_debug_recorder = merge_neuron_catalogue.recorders.array_debug_recorder
 
-            new_neuron_set[i] = fuse_neurons(
-                new_neuron_set[i],
-                new_neuron_set[j],
+            new_neuron_catalogue[i] = fuse_neurons(
+                new_neuron_catalogue[i],
+                new_neuron_catalogue[j],
                 **parameters["fuse_neurons"]
             )
 
-            new_neuron_set_kept[j] = False
-
-        new_neuron_set = new_neuron_set[new_neuron_set_kept]
+        new_neuron_catalogue.remove(new_neuron_set_all_j_fuse)
 
         logger.debug(
             "Fused \"" + repr(len(new_neuron_set_all_j_fuse)) +
             "\" neurons to the existing set."
         )
 
-    if new_neuron_set.size:
-        merge_neuron_sets_repeatedly.recorders.array_debug_recorder["new_merged_neurons_set"] = new_neuron_set
 
-    return(new_neuron_set)
+@prof.log_call(trace_logger)
+def _images_to_sparse_matrix(images, num_pixels, dtype):
+    """
+        Builds a sparse matrix with each image (only its non-zero pixels) as
+        a row. Images are handled one at a time. So, no dense matrix of all
+        of them is needed.
+
+        Args:
+            images(iterable):                   images to use as rows.
+
+            num_pixels(int):                    number of pixels in an image.
+
+            dtype(type):                        type of the matrix.
+
+        Returns:
+            scipy.sparse.csr_matrix:            images as rows.
+    """
+
+    rows = [numpy.zeros((0,), dtype=int)]
+    columns = [numpy.zeros((0,), dtype=int)]
+    values = [numpy.zeros((0,), dtype=dtype)]
+    num_images = 0
+    for i, each_image in enumerate(images):
+        each_image = numpy.asarray(each_image).ravel()
+        each_columns = numpy.flatnonzero(each_image)
+
+        rows.append(numpy.repeat(i, len(each_columns)))
+        columns.append(each_columns)
+        values.append(each_image[each_columns].astype(dtype))
+
+        num_images += 1
+
+    images_matrix = scipy.sparse.csr_matrix(
+        (
+            numpy.concatenate(values),
+            (numpy.concatenate(rows), numpy.concatenate(columns))
+        ),
+        shape=(num_images, num_pixels)
+    )
+
+    return(images_matrix)
 
 
 @prof.log_call(trace_logger)
 @hdf5.record.static_array_debug_recorder
-def expand_rois(new_data, roi_masks, **parameters):
-    # Find time traces: spatial mean of activity for each ROI
-    # Normalize time traces: subtract mean from each time trace and
-    # normalize each relative to L_2
-    # Compute correlation: Multiply the time traces for each ROI
-    # by the raw data to get an array with the dimensions of
-    # the number of ROIs plus the dimensions of the raw data
+def expand_rois(new_data, roi_masks, block_frame_length=-1, **parameters):
+    """
+        Computes a correlation map for each ROI. Namely, the correlation
+        (over time) of the ROI's mean activity with each pixel's activity
+        (after normalizing each frame).
 
-    # Normalize the data
-    new_data_normalized = normalize_data(
-        new_data,
-        **{"renormalized_images" : {"ord" : 2}}
+        Frames are streamed in blocks through a sparse ROI by pixel matrix.
+        So, the data may be an HDF5 dataset and only the traces and maps of
+        the ROIs are held in memory.
+
+        Args:
+            new_data(numpy.ndarray):            array of data (first axis is
+                                                time). May also be an HDF5
+                                                dataset.
+
+            roi_masks(numpy.ndarray):           masks of each ROI (first axis
+                                                is the ROI).
+
+            block_frame_length(int):            number of frames to read at a
+                                                time. If negative, all frames
+                                                are read at once.
+
+            **parameters(dict):                 essentially unused (catches
+                                                unneeded arguments).
+
+        Returns:
+            numpy.ndarray:                      the correlation map of each
+                                                ROI (first axis is the ROI).
+
+        Examples:
+            >>> a = numpy.zeros((3, 2, 2))
+            >>> a[:, 0, 0] = [1, 2, 3]
+            >>> a[:, 1, 1] = [3, 2, 1]
+            >>> m = numpy.zeros((1, 2, 2), dtype=bool)
+            >>> m[0, 0, 0] = True
+            >>> expand_rois(a, m, block_frame_length=2).round(6)
+            array([[[ 0.58219 , -0.00964 ],
+                    [-0.00964 , -0.562911]]])
+    """
+
+    num_frames = len(new_data)
+    frame_shape = tuple(new_data.shape[1:])
+    num_pixels = int(numpy.prod(frame_shape))
+
+    if block_frame_length <= 0:
+        block_frame_length = num_frames
+
+    float_dtype = numpy.dtype(numpy.float64)
+    if issubclass(new_data.dtype.type, numpy.floating):
+        float_dtype = new_data.dtype
+
+    roi_masks_matrix = _images_to_sparse_matrix(
+        roi_masks, num_pixels, float_dtype
     )
 
     # Compute the area of each ROI in order to
     # properly compute the average activity of each ROI.
-    roi_areas = roi_masks.sum(axis=tuple(iters.irange(1, roi_masks.ndim)))
+    roi_areas = numpy.asarray(roi_masks_matrix.sum(axis=1)).ravel()
 
-    # Add fake dimensions so that both arrays have dimensions number of ROIs
-    # and then tyx or tzyx.
-    new_data_normalized_expanded = xnumpy.expand_view(
-        new_data_normalized, reps_before=len(roi_masks)
-    )
-    roi_masks_expanded = xnumpy.expand_view(
-        roi_masks, reps_before=len(new_data_normalized)
-    ).swapaxes(0, 1)
+    def normalized_frame_blocks():
+        for i in iters.irange(0, num_frames, block_frame_length):
+            new_data_block = numpy.array(
+                new_data[i:i + block_frame_length], dtype=float_dtype
+            )
 
-    # Added time afterwards for dividing time traces.
-    roi_areas_expanded = xnumpy.expand_view(
-        roi_areas, reps_after=len(new_data_normalized)
-    )
+            # Normalize the data
+            new_data_block = normalize_data(
+                new_data_block,
+                out=new_data_block,
+                **{"renormalized_images" : {"ord" : 2}}
+            )
 
-    # Compute the time traces such that they are the average activity inside
-    # the ROI
-    time_traces = new_data_normalized_expanded * roi_masks_expanded
-    time_traces = time_traces.sum(
-        axis=tuple(iters.irange(2, new_data_normalized_expanded.ndim))
-    )
-    time_traces /= roi_areas_expanded
+            # Convert to matrix.
+            new_data_block = xnumpy.array_to_matrix(new_data_block)
+
+            yield (slice(i, i + len(new_data_block)), new_data_block)
+
+    # Find time traces: spatial mean of activity for each ROI
+    time_traces = numpy.zeros((len(roi_areas), num_frames), dtype=float_dtype)
+    for each_slice, each_block in normalized_frame_blocks():
+        time_traces[:, each_slice] = roi_masks_matrix.dot(each_block.T)
+    time_traces /= roi_areas[:, None]
 
-    # Normalize the time traces
+    # Normalize time traces: subtract mean from each time trace and
+    # normalize each relative to L_2
     normalized_time_traces = normalize_data(
         time_traces,
+        out=time_traces,
         **{"renormalized_images" : {"ord" : 2}}
     )
 
-    # Convert to matrix.
-    new_data_normalized_matrix = xnumpy.array_to_matrix(new_data_normalized)
-
-    # Compute the correlation map
-    correlation_map = numpy.dot(
-        normalized_time_traces, new_data_normalized_matrix
+    # Compute correlation: Multiply the time traces for each ROI
+    # by the normalized data (accumulated over blocks of frames)
+    correlation_map = numpy.zeros(
+        (len(roi_areas), num_pixels), dtype=float_dtype
     )
+    for each_slice, each_block in normalized_frame_blocks():
+        correlation_map += normalized_time_traces[:, each_slice].dot(
+            each_block
+        )
+
     correlation_map = correlation_map.reshape(
-        roi_masks.shape[:1] + new_data_normalized.shape[1:]
+        (len(roi_areas),) + frame_shape
     )
 
     return(correlation_map)
 
 
+@prof.log_call(trace_logger)
+def extract_traces(new_data,
+                   neurons,
+                   method="mean",
+                   weights="mask",
+                   regularization=0.0,
+                   block_frame_length=-1):
+    """
+        Extracts the fluorescence trace of each neuron from the data.
+
+        Each neuron's weights (its mask or its image within its mask) form a
+        row of a sparse neuron by pixel matrix. Frames are then streamed in
+        blocks through it. So, the data may be an HDF5 dataset and there may
+        be many neurons. With ``method="mean"``, each trace is the weighted
+        mean over the neuron. With ``method="least_squares"``, the traces are
+        found together such that they best reconstruct each frame, which
+        demixes overlapping neurons. If that system is singular (e.g. an
+        empty neuron or two neurons with the same weights), the least squares
+        solution with the smallest norm is used.
+
+        Args:
+            new_data(numpy.ndarray):            array of data (first axis is
+                                                time). May also be an HDF5
+                                                dataset.
+
+            neurons(numpy.ndarray):             structured array of neurons
+                                                (e.g. from postprocess_data).
+
+            method(str):                        either "mean" or
+                                                "least_squares".
+
+            weights(str):                       either "mask" (uniform
+                                                weights) or "image" (the
+                                                neuron's image within its
+                                                mask).
+
+            regularization(float):              added to the diagonal of the
+                                                least squares system (to
+                                                damp nearly identical
+                                                neurons).
+
+            block_frame_length(int):            number of frames to read at a
+                                                time. If negative, all frames
+                                                are read at once.
+
+        Returns:
+            numpy.ndarray:                      traces for each neuron (first
+                                                axis is the neuron, second is
+                                                time).
+
+        Examples:
+            >>> n = numpy.zeros((2,), dtype=get_neuron_dtype((2, 3), float))
+            >>> n["mask"][0, 0, :2] = True
+            >>> n["mask"][1, 0, 1:] = True
+            >>> n["image"] = n["mask"]
+
+            >>> a = numpy.zeros((2, 2, 3))
+            >>> a[0, 0] = [1, 1, 0]
+            >>> a[1, 0] = [0, 2, 2]
+
+            >>> extract_traces(a, n)
+            array([[ 1. ,  1. ],
+                   [ 0.5,  2. ]])
+
+            >>> extract_traces(a, n, method="least_squares")
+            array([[ 1.,  0.],
+                   [ 0.,  2.]])
+
+            >>> extract_traces(a, n[[0, 0]], method="least_squares")
+            array([[ 0.5,  0.5],
+                   [ 0.5,  0.5]])
+    """
+
+    assert (method in ["mean", "least_squares"]), \
+        "`method` must be either \"mean\" or \"least_squares\"."
+    assert (weights in ["mask", "image"]), \
+        "`weights` must be either \"mask\" or \"image\"."
+
+    num_frames = len(new_data)
+    num_pixels = int(numpy.prod(new_data.shape[1:]))
+
+    if block_frame_length <= 0:
+        block_frame_length = num_frames
+
+    float_dtype = numpy.dtype(numpy.float64)
+    if issubclass(new_data.dtype.type, numpy.floating):
+        float_dtype = new_data.dtype
+
+    # Build the neuron by pixel matrix one neuron at a time to keep it sparse.
+    if weights == "mask":
+        neuron_weights = _images_to_sparse_matrix(
+            neurons["mask"], num_pixels, float_dtype
+        )
+    else:
+        neuron_weights = _images_to_sparse_matrix(
+            (_n["image"] * _n["mask"] for _n in neurons),
+            num_pixels,
+            float_dtype
+        )
+
+    if method == "mean":
+        neuron_weights_totals = numpy.asarray(
+            neuron_weights.sum(axis=1)
+        ).ravel()
+        neuron_weights_totals[neuron_weights_totals == 0] = 1
+    else:
+        # Only overlapping neurons couple. So, this stays sparse.
+        neuron_weights_gram = neuron_weights.dot(neuron_weights.T)
+        neuron_weights_gram = neuron_weights_gram + regularization * scipy.sparse.identity(
+            len(neurons), dtype=float_dtype
+        )
+        try:
+            neuron_weights_gram_solve = scipy.sparse.linalg.splu(
+                scipy.sparse.csc_matrix(neuron_weights_gram)
+            ).solve
+        except RuntimeError:
+            logger.debug(
+                "The least squares system is singular. So, using the "
+                "pseudoinverse of each group of overlapping neurons instead."
+            )
+
+            # Groups of overlapping neurons are independent of each other.
+            num_groups, groups = scipy.sparse.csgraph.connected_components(
+                neuron_weights_gram, directed=False
+            )
+            groups_order = numpy.argsort(groups, kind="mergesort")
+            groups_order = numpy.split(
+                groups_order,
+                numpy.cumsum(numpy.bincount(groups, minlength=num_groups))[:-1]
+            )
+
+            neuron_weights_gram = scipy.sparse.csr_matrix(neuron_weights_gram)
+            groups_pinv = []
+            for each_group in groups_order:
+                groups_pinv.append((
+                    each_group,
+                    numpy.linalg.pinv(
+                        neuron_weights_gram[each_group][:, each_group].toarray()
+                    )
+                ))
+
+            def neuron_weights_gram_solve(b):
+                x = numpy.empty_like(b)
+                for each_group, each_group_pinv in groups_pinv:
+                    x[each_group] = each_group_pinv.dot(b[each_group])
+
+                return(x)
+
+    traces = numpy.zeros((len(neurons), num_frames), dtype=float_dtype)
+    for i in iters.irange(0, num_frames, block_frame_length):
+        new_data_block = numpy.asarray(
+            new_data[i:i + block_frame_length], dtype=float_dtype
+        )
+        new_data_block = new_data_block.reshape(len(new_data_block), -1)
+
+        traces_block = neuron_weights.dot(new_data_block.T)
+
+        if method == "mean":
+            traces_block /= neuron_weights_totals[:, None]
+        else:
+            traces_block = neuron_weights_gram_solve(traces_block)
+
+        traces[:, i:i + len(new_data_block)] = traces_block
+
+    return(traces)
+
+
+@prof.log_call(trace_logger)
+@hdf5.record.static_array_debug_recorder
+def prune_dictionary(new_dictionary,
+                     min_sparsity=None,
+                     min_compactness=None,
+                     compactness_threshold=0.5,
+                     max_correlation=None):
+    """
+        Drops basis images from the dictionary that are unlikely to add any
+        neurons. Namely, those that are empty, look like noise, or nearly
+        duplicate another basis image. This is cheap compared to finding
+        neurons in each basis image.
+
+        Sparsity is the Hoyer measure (1 when one pixel holds everything, 0
+        when all pixels are equal). Compactness is the fraction of the
+        energy (sum of squares) in pixels that are at least
+        ``compactness_threshold`` times the max. Of basis images correlated
+        beyond ``max_correlation``, the sparsest is kept. Any constraint
+        left as None is not checked.
+
+        Args:
+            new_dictionary(numpy.ndarray):      dictionary of basis images.
+
+            min_sparsity(float):                least sparsity to keep.
+
+            min_compactness(float):             least compactness to keep.
+
+            compactness_threshold(float):       fraction of the max that
+                                                pixels must reach to count
+                                                for compactness.
+
+            max_correlation(float):             largest correlation between
+                                                basis images kept.
+
+        Returns:
+            numpy.ndarray:                      the basis images kept (in
+                                                their original order).
+
+        Examples:
+            >>> a = numpy.zeros((4, 3, 3))
+            >>> a[0, 1, 1] = 1
+            >>> a[1, 1, 1] = 2
+            >>> a[1, 0, 0] = 0.1
+            >>> a[2] = 1
+            >>> prune_dictionary(a, min_sparsity=0.5).shape
+            (2, 3, 3)
+            >>> prune_dictionary(a, max_correlation=0.9).shape
+            (2, 3, 3)
+            >>> prune_dictionary(a, max_correlation=0.9)[:, 1, 1]
+            array([ 1.,  1.])
+    """
+
+    new_dictionary_matrix = xnumpy.array_to_matrix(
+        numpy.asarray(new_dictionary, dtype=float)
+    )
+
+    num_pixels = new_dictionary_matrix.shape[1]
+
+    # Empty basis images cannot yield any neurons.
+    norms_l1 = numpy.abs(new_dictionary_matrix).sum(axis=1)
+    norms_l2 = numpy.sqrt((new_dictionary_matrix ** 2).sum(axis=1))
+    keep = (norms_l2 > 0)
+
+    norms_l2_safe = numpy.where(keep, norms_l2, 1)
+    sparsities = (
+        numpy.sqrt(num_pixels) - norms_l1 / norms_l2_safe
+    ) / max(numpy.sqrt(num_pixels) - 1, 1)
+    sparsities[~keep] = 0
+
+    if min_sparsity is not None:
+        keep &= (sparsities >= min_sparsity)
+
+    if min_compactness is not None:
+        maxes = new_dictionary_matrix.max(axis=1)
+        compact_pixels = (
+            new_dictionary_matrix >=
+            (compactness_threshold * maxes)[:, None]
+        ) & (new_dictionary_matrix > 0)
+        compactnesses = (
+            (new_dictionary_matrix ** 2) * compact_pixels
+        ).sum(axis=1) / (norms_l2_safe ** 2)
+
+        keep &= (compactnesses >= min_compactness)
+
+    if (max_correlation is not None) and keep.any():
+        # Greedily keep the sparsest of any correlated basis images.
+        candidates = keep.nonzero()[0]
+        candidates = candidates[
+            numpy.argsort(-sparsities[candidates], kind="mergesort")
+        ]
+
+        correlations = xnumpy.pair_dot_product_normalized(
+            new_dictionary_matrix[candidates]
+        )
+
+        kept_candidates = []
+        for i in iters.irange(len(candidates)):
+            if (correlations[i, kept_candidates] < max_correlation).all():
+                kept_candidates.append(i)
+            else:
+                keep[candidates[i]] = False
+
+    if not keep.all():
+        logger.debug(
+            "Dropped " + str((~keep).sum()) + " of " + str(len(keep)) +
+            " basis images."
+        )
+
+        prune_dictionary.recorders.array_debug_recorder["dropped_basis_images"] = new_dictionary[~keep]
+        prune_dictionary.recorders.array_debug_recorder["dropped_basis_images_indices"] = (~keep).nonzero()[0]
+
+    new_dictionary_pruned = new_dictionary[keep]
+
+    return(new_dictionary_pruned)
+
+
 @prof.log_call(trace_logger)
 @hdf5.record.static_array_debug_recorder
 def postprocess_data(new_dictionary, **parameters):
@@ -3712,7 +6771,10 @@ def postprocess_data(new_dictionary, **parameters):
             new_dictionary(numpy.ndarray):        dictionary of basis images to
                                                   analyze for neurons.
 
-            **parameters(dict):                   dictionary of parameters
+            **parameters(dict):                   dictionary of parameters. If
+                                                  ``prune_dictionary`` is
+                                                  included, basis images are
+                                                  pruned with it first.
 
         Returns:
             numpy.ndarray:                        structured array with
@@ -3722,6 +6784,17 @@ def postprocess_data(new_dictionary, **parameters):
 
     new_neurons_set = None
 
+    neuron_shape = new_dictionary.shape[1:]
+    neuron_dtype = new_dictionary.dtype
+
+    # Drop basis images that are not worth analyzing.
+    if "prune_dictionary" in parameters:
+        prune_dictionary.recorders.array_debug_recorder = postprocess_data.recorders.array_debug_recorder
+        new_dictionary = prune_dictionary(
+            new_dictionary,
+            **parameters["prune_dictionary"]
+        )
+
     # TODO: Remove this as it is already accomplished using the HDF5EnumeratedArrayRecorder.
     # Puts each dictionary basis debug log into a separate group depending on
     # which basis image it was a part of.
@@ -3733,19 +6806,29 @@ def postprocess_data(new_dictionary, **parameters):
             neuron_sets_array_debug_recorder[i_str] = None
             yield ((i, each, neuron_sets_array_debug_recorder[i_str]))
 
-    # Get all neurons for all images
-    new_neurons_set = get_empty_neuron(
-        shape=new_dictionary[0].shape, dtype=new_dictionary[0].dtype
+    # Get all neurons for all images. Neurons from each image are only
+    # compared with the existing ones they overlap when merging.
+    new_neurons_catalogue = NeuronCatalogue(
+        shape=neuron_shape, dtype=neuron_dtype
     )
     unmerged_neuron_set = None
     if postprocess_data.recorders.array_debug_recorder:
         unmerged_neuron_set = get_empty_neuron(
-            shape=new_dictionary[0].shape, dtype=new_dictionary[0].dtype
+            shape=neuron_shape, dtype=neuron_dtype
         )
+
+    # All basis images have the same shape. So, the same temporaries can be
+    # reused to find neurons in each of them.
+    wavelet_denoising_workspace = WaveletDenoisingWorkspace(
+        neuron_shape,
+        parameters["wavelet_denoising"]["wavelet.transform"]["scale"]
+    )
+
     for i, each_new_dictionary_image, each_array_debug_recorder in array_debug_recorder_enumerator(new_dictionary):
         wavelet_denoising.recorders.array_debug_recorder = postprocess_data.recorders.array_debug_recorder
         each_new_neuron_set = wavelet_denoising(
             each_new_dictionary_image,
+            workspace=wavelet_denoising_workspace,
             **parameters["wavelet_denoising"]
         )
 
@@ -3759,10 +6842,11 @@ def postprocess_data(new_dictionary, **parameters):
                 [unmerged_neuron_set, each_new_neuron_set]
             )
 
-        merge_neuron_sets.recorders.array_debug_recorder = postprocess_data.recorders.array_debug_recorder
-        new_neurons_set = merge_neuron_sets(
-            new_neurons_set,
-            each_new_neuron_set,
+        new_neurons_catalogue.append(each_new_neuron_set)
+
+        merge_neuron_catalogue.recorders.array_debug_recorder = postprocess_data.recorders.array_debug_recorder
+        merge_neuron_catalogue(
+            new_neurons_catalogue,
             **parameters["merge_neuron_sets"]
         )
 
@@ -3771,6 +6855,11 @@ def postprocess_data(new_dictionary, **parameters):
             str(i + 1) + " of " + str(len(new_dictionary)) + "."
         )
 
+    new_neurons_set = new_neurons_catalogue.neurons
+
+    # None of the label images of these basis images will be seen again.
+    clear_region_features()
+
     if postprocess_data.recorders.array_debug_recorder:
         if unmerged_neuron_set.size:
             postprocess_data.recorders.array_debug_recorder["unmerged_neuron_set"] = unmerged_neuron_set
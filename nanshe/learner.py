@@ -26,6 +26,8 @@ __date__ = "$Apr 09, 2014 16:00:40 EDT$"
 
 
 import os
+import copy
+import functools
 import json
 import itertools
 import multiprocessing
@@ -176,11 +178,36 @@ def generate_neurons_a_block(input_filename,
             overwrite=True
         )
 
+        # Find a dictionary to seed dictionary learning with (if any). Either
+        # from an HDF5 path or, only when flagged (by
+        # generate_neurons_blocks), one already placed in the output group.
+        generate_neurons_parameters = dict(parameters["generate_neurons"])
+        initial_dictionary_from_output = generate_neurons_parameters.pop(
+            "initial_dictionary_from_output", False
+        )
+        initial_dictionary = generate_neurons_parameters.get(
+            "initial_dictionary", None
+        )
+        if isinstance(initial_dictionary, str):
+            initial_dictionary_filename_ext, initial_dictionary_dataset_name = hdf5.serializers.split_hdf5_path(
+                initial_dictionary
+            )
+            with h5py.File(initial_dictionary_filename_ext, "r") as initial_dictionary_file_handle:
+                initial_dictionary = hdf5.serializers.read_numpy_structured_array_from_HDF5(
+                    initial_dictionary_file_handle,
+                    initial_dictionary_dataset_name
+                )
+        elif (initial_dictionary is None) and initial_dictionary_from_output:
+            initial_dictionary = hdf5.serializers.read_numpy_structured_array_from_HDF5(
+                output_group, "initial_dictionary"
+            )
+        generate_neurons_parameters["initial_dictionary"] = initial_dictionary
+
         # Generate the neurons and attempt to resume if possible
         generate_neurons.resume_logger = resume_logger
         generate_neurons.recorders.array_debug_recorder = array_debug_recorder
         generate_neurons(
-            original_images=original_images, **parameters["generate_neurons"]
+            original_images=original_images, **generate_neurons_parameters
         )
 
         # Save the configuration parameters in the attributes as a string.
@@ -191,6 +218,90 @@ def generate_neurons_a_block(input_filename,
             )
 
 
+@prof.log_call(trace_logger)
+def split_cores(num_workers, cores=None):
+    """
+        Splits the cores available between workers so that each gets its own
+        contiguous run of cores (typically on the same socket). If there are
+        more workers than cores, some cores are shared.
+
+        Args:
+            num_workers(int):                   number of workers running at
+                                                the same time.
+
+            cores(iterable of ints):            cores to split (defaults to
+                                                those this process may use).
+
+        Returns:
+            list of tuples:                     cores for each worker.
+
+        Examples:
+            >>> split_cores(2, [0, 1, 2, 3, 4])
+            [(0, 1), (2, 3)]
+
+            >>> split_cores(3, [0, 1])
+            [(0,), (1,), (0,)]
+    """
+
+    if cores is None:
+        try:
+            cores = os.sched_getaffinity(0)
+        except AttributeError:
+            cores = iters.irange(multiprocessing.cpu_count())
+
+    cores = sorted(cores)
+
+    num_cores_worker = max(1, len(cores) // num_workers)
+
+    worker_cores = []
+    for i in iters.irange(num_workers):
+        worker_cores.append(tuple(
+            cores[(i * num_cores_worker + j) % len(cores)]
+            for j in iters.irange(num_cores_worker)
+        ))
+
+    return(worker_cores)
+
+
+@prof.log_call(trace_logger)
+def thread_limited_environment(num_threads, environment=None):
+    """
+        Copies the environment limiting the threads that OpenMP and common
+        BLAS implementations will start.
+
+        Args:
+            num_threads(int):                   number of threads to allow.
+
+            environment(dict):                  environment to copy (defaults
+                                                to os.environ).
+
+        Returns:
+            dict:                               the limited environment.
+
+        Examples:
+            >>> e = thread_limited_environment(2, {"HOME" : "/home/user"})
+            >>> e["HOME"]
+            '/home/user'
+            >>> e["OMP_NUM_THREADS"]
+            '2'
+            >>> e["OPENBLAS_NUM_THREADS"]
+            '2'
+    """
+
+    if environment is None:
+        environment = os.environ
+
+    environment = dict(environment)
+    for each_variable in ["OMP_NUM_THREADS",
+                          "OPENBLAS_NUM_THREADS",
+                          "MKL_NUM_THREADS",
+                          "VECLIB_MAXIMUM_THREADS",
+                          "NUMEXPR_NUM_THREADS"]:
+        environment[each_variable] = str(num_threads)
+
+    return(environment)
+
+
 @prof.log_call(trace_logger)
 def generate_neurons_blocks(input_filename,
                             output_filename,
@@ -424,10 +535,50 @@ def generate_neurons_blocks(input_filename,
 
     intermediate_config = intermediate_output_dir + "/" + "config.json"
 
+    # A dictionary to seed each block with is cropped to each block's window.
+    # So, each block gets its own in place of the one provided.
+    initial_dictionary = None
+    intermediate_parameters = copy.deepcopy(parameters)
+    if "initial_dictionary" in parameters["generate_neurons"]:
+        initial_dictionary = intermediate_parameters["generate_neurons"].pop(
+            "initial_dictionary"
+        )
+
+        initial_dictionary_filename_ext, initial_dictionary_dataset_name = hdf5.serializers.split_hdf5_path(
+            initial_dictionary
+        )
+        with h5py.File(initial_dictionary_filename_ext, "r") as initial_dictionary_file_handle:
+            initial_dictionary = hdf5.serializers.read_numpy_structured_array_from_HDF5(
+                initial_dictionary_file_handle,
+                initial_dictionary_dataset_name
+            )
+
+        # Must cover the same field of view as the original images.
+        assert (initial_dictionary.shape[1:] == tuple(original_images_shape_array[1:]))
+
+        # Each block reads its own from its output group.
+        intermediate_parameters["generate_neurons"]["initial_dictionary_from_output"] = True
+
+    # Split the cores between the blocks running at the same time. So, each
+    # limits its threads (SPAMS, BLAS, and OpenMP) to avoid oversubscribing.
+    block_cores = []
+    num_threads_block = num_drmaa_cores
+    if not use_drmaa:
+        block_cores = split_cores(num_processes)
+        num_threads_block = len(block_cores[0])
+
+    spams_parameters = intermediate_parameters["generate_neurons"].get(
+        "generate_dictionary", {}
+    ).get("spams.trainDL", None)
+    if spams_parameters is not None:
+        num_threads_spams = spams_parameters.get("numThreads", -1)
+        if (num_threads_spams < 1) or (num_threads_spams > num_threads_block):
+            spams_parameters["numThreads"] = num_threads_block
+
     # Overwrite the config file always
     with open(intermediate_config, "w") as fid:
         json.dump(
-            dict(list(parameters.items()) + list({"debug" : debug}.items())),
+            dict(list(intermediate_parameters.items()) + list({"debug" : debug}.items())),
             fid,
             indent=4,
             separators=(",", " : ")
@@ -509,6 +660,23 @@ def generate_neurons_blocks(input_filename,
                         block_i.name
                     )
 
+                if initial_dictionary is not None:
+                    initial_dictionary_i = initial_dictionary[
+                        (slice(None),) + slice_i[1:]
+                    ]
+
+                    # Cropped atoms are no longer normalized.
+                    initial_dictionary_i = segment.renormalized_images(
+                        initial_dictionary_i
+                    )
+
+                    hdf5.serializers.create_numpy_structured_array_in_HDF5(
+                        each_block_file_handle,
+                        "initial_dictionary",
+                        initial_dictionary_i,
+                        overwrite=True
+                    )
+
                 input_filename_block.append(
                     each_block_file_handle.filename + "/" + "original_images"
                 )
@@ -590,7 +758,9 @@ def generate_neurons_blocks(input_filename,
             ) + "-" + os.path.basename(each_arg_pack[3].split(".h5")[0])
             ready_processes[-1][1].remoteCommand = each_arg_pack[0]
             ready_processes[-1][1].args = each_arg_pack[1:-2]
-            ready_processes[-1][1].jobEnvironment = os.environ
+            ready_processes[-1][1].jobEnvironment = thread_limited_environment(
+                num_drmaa_cores
+            )
             ready_processes[-1][1].inputPath = "localhost:" + os.devnull
             ready_processes[-1][1].outputPath = "localhost:" + each_arg_pack[-2]
             ready_processes[-1][1].errorPath = "localhost:" + each_arg_pack[-1]
@@ -646,13 +816,26 @@ def generate_neurons_blocks(input_filename,
                 try:
                     each_arg_pack = next(block_process_args_gen)
                     each_arg_pack, each_stdout_filename, each_stderr_filename = each_arg_pack[:-2], each_arg_pack[-2], each_arg_pack[-1]
+
+                    # Pin the process to cores no other running one uses.
+                    each_cores = block_cores.pop(0)
+                    each_set_affinity = None
+                    if hasattr(os, "sched_setaffinity"):
+                        each_set_affinity = functools.partial(
+                            os.sched_setaffinity, 0, each_cores
+                        )
+
                     each_process = subprocess.Popen(
                         each_arg_pack,
                         stdout=open(each_stdout_filename, "w"),
-                        stderr=open(each_stderr_filename, "w")
+                        stderr=open(each_stderr_filename, "w"),
+                        env=thread_limited_environment(len(each_cores)),
+                        preexec_fn=each_set_affinity
                     )
 
-                    running_processes.append((each_arg_pack, each_process,))
+                    running_processes.append(
+                        (each_arg_pack, each_process, each_cores,)
+                    )
 
                     logger.info(
                         "Started new process ( \"" + " ".join(each_arg_pack) + "\" )."
@@ -674,6 +857,7 @@ def generate_neurons_blocks(input_filename,
                         )
 
                         #finished_processes.append(running_processes[i])
+                        block_cores.append(running_processes[i][2])
                         del running_processes[i]
                     else:
                         time.sleep(1)
@@ -824,7 +1008,11 @@ def generate_neurons_blocks(input_filename,
 @prof.log_call(trace_logger)
 @hdf5.record.static_subgrouping_array_recorders(array_debug_recorder=hdf5.record.EmptyArrayRecorder())
 @wrappers.static_variables(resume_logger=hdf5.record.EmptyArrayRecorder())
-def generate_neurons(original_images, run_stage="all", **parameters):
+def generate_neurons(original_images,
+                     run_stage="all",
+                     initial_dictionary=None,
+                     warm_start=False,
+                     **parameters):
     if "original_images_max_projection" not in generate_neurons.recorders.array_debug_recorder:
         generate_neurons.recorders.array_debug_recorder["original_images_max_projection"] = xnumpy.add_singleton_op(
             numpy.max,
@@ -846,7 +1034,17 @@ def generate_neurons(original_images, run_stage="all", **parameters):
     if (new_preprocessed_images is None) or \
             (run_stage == "preprocessing") or \
             (run_stage == "all"):
-        new_preprocessed_images = original_images.copy()
+        if "spams.trainDL" in parameters["generate_dictionary"]:
+            # Preprocess in shared memory laid out like SPAMS wants. So, it
+            # can be used directly without making more copies.
+            import nanshe.box.spams_sandbox
+
+            new_preprocessed_images = nanshe.box.spams_sandbox.shared_frames(
+                original_images.shape, original_images.dtype
+            )
+            new_preprocessed_images[...] = original_images
+        else:
+            new_preprocessed_images = original_images.copy()
         segment.preprocess_data.recorders.array_debug_recorder = generate_neurons.recorders.array_debug_recorder
         new_preprocessed_images = segment.preprocess_data(
             new_preprocessed_images,
@@ -870,9 +1068,14 @@ def generate_neurons(original_images, run_stage="all", **parameters):
     if (new_dictionary is None) or \
             (run_stage == "dictionary") or \
             (run_stage == "all"):
+        # Seed with the last dictionary found (if any) to converge faster.
+        if warm_start and (new_dictionary is not None):
+            initial_dictionary = new_dictionary
+
         segment.generate_dictionary.recorders.array_debug_recorder = generate_neurons.recorders.array_debug_recorder
         new_dictionary = segment.generate_dictionary(
             new_preprocessed_images,
+            initial_dictionary=initial_dictionary,
             **parameters["generate_dictionary"]
         )
         generate_neurons.resume_logger["dictionary"] = new_dictionary
@@ -899,6 +1102,17 @@ def generate_neurons(original_images, run_stage="all", **parameters):
             **parameters["postprocess_data"]
         )
 
+        # Map neurons found on spatially binned data back to full resolution.
+        # Their images are upsampled from the basis images they came from.
+        # So, like without binning, they (and max_F) are dictionary values.
+        if "spatial_bin" in parameters["preprocess_data"]:
+            segment.upsample_neurons.recorders.array_debug_recorder = generate_neurons.recorders.array_debug_recorder
+            new_neurons = segment.upsample_neurons(
+                new_neurons,
+                parameters["preprocess_data"]["spatial_bin"]["factor"],
+                shape=original_images.shape[1:]
+            )
+
         if new_neurons.size:
             generate_neurons.resume_logger["neurons"] = new_neurons
 
@@ -84,6 +84,70 @@ except TypeError:
 trace_logger = prof.getTraceLogger(__name__)
 
 
+@prof.log_call(trace_logger)
+def remap_labels(new_array, old_labels, new_labels=None):
+    """
+        Replaces each of the old labels in an array of labels with the
+        matching new label. Anything else becomes background (0). This uses a
+        lookup table indexed by label. So, it only needs memory on the order
+        of the array and the largest label (not the number of labels times
+        the size of the array).
+
+        Args:
+            new_array(numpy.ndarray):           array of (non-negative)
+                                                labels.
+
+            old_labels(numpy.ndarray):          labels to replace.
+
+            new_labels(numpy.ndarray):          labels to replace them with
+                                                (by default, 1 to the number
+                                                of old labels).
+
+        Returns:
+            (numpy.ndarray):                    the array with the labels
+                                                replaced.
+
+        Examples:
+            >>> remap_labels(numpy.array([0, 2, 5, 7]), numpy.array([2, 7]))
+            array([0, 1, 0, 2])
+
+            >>> remap_labels(
+            ...     numpy.array([[0, 2], [5, 7]]),
+            ...     numpy.array([2, 5, 7]),
+            ...     numpy.array([3, 3, 1])
+            ... )
+            array([[0, 3],
+                   [3, 1]])
+
+            >>> remap_labels(numpy.array([1, 3]), numpy.array([], dtype=int))
+            array([0, 0])
+    """
+
+    new_array = numpy.asarray(new_array)
+    old_labels = numpy.asarray(old_labels, dtype=int)
+
+    if new_labels is None:
+        new_labels = numpy.arange(1, len(old_labels) + 1)
+    new_labels = numpy.asarray(new_labels)
+
+    # Make a table big enough for any label found.
+    num_table_labels = 1
+    if new_array.size:
+        num_table_labels = max(num_table_labels, int(new_array.max()) + 1)
+    if old_labels.size:
+        num_table_labels = max(num_table_labels, int(old_labels.max()) + 1)
+
+    label_mapping = numpy.zeros(
+        (num_table_labels,),
+        dtype=numpy.promote_types(new_array.dtype, new_labels.dtype)
+    )
+    label_mapping[old_labels] = new_labels
+
+    new_array_relabeled = label_mapping[new_array]
+
+    return(new_array_relabeled)
+
+
 @prof.log_call(trace_logger)
 def renumber_label_image(new_array):
     """
@@ -141,18 +205,8 @@ def renumber_label_image(new_array):
     )
     forward_label_mapping[old_labels] = new_labels
 
-    # Get masks for each old label
-    new_array_label_masks = all_permutations_equal(old_labels, new_array)
-
-    # Create tiled where each label is expanded to the size of the new_array
-    new_labels_tiled_view = expand_view(new_labels, new_array.shape)
-
-    # Take every mask and make sure it has the appropriate sequential label
-    # Then combine each of these parts of the label image together into a new
-    # sequential label image
-    new_array_relabeled = (
-        new_array_label_masks * new_labels_tiled_view
-    ).sum(axis=0)
+    # Give each old label its sequential label using a lookup table
+    new_array_relabeled = remap_labels(new_array, old_labels, new_labels)
 
     return((new_array_relabeled, forward_label_mapping, reverse_label_mapping))
 
@@ -4504,10 +4558,24 @@ def get_quantiles(probs):
     return(probs_array)
 
 
-def quantile(data, probs, axis=None):
+def quantile(data,
+             probs,
+             axis=None,
+             backend="mquantiles",
+             block_length=-1,
+             num_sketch_points=1001):
     """
         Determines the quantiles for given data much like MATLAB's function.
 
+        There are a few different backends available. The default,
+        ``"mquantiles"``, uses ``scipy.stats.mstats.mquantiles``. The
+        ``"partition"`` backend computes the same exact quantiles using
+        ``numpy.partition``, which avoids the masked array machinery (masked
+        data with masked values falls back to ``"mquantiles"``). The
+        ``"approximate"`` backend streams over blocks of the first axis using
+        a ``QuantileSketch``, which makes it suitable for out-of-core data
+        (e.g. ``h5py.Dataset``) when ``axis`` is ``None``.
+
         Args:
             data(numpy.ndarray):                        to find the quantiles
                                                         of.
@@ -4528,6 +4596,28 @@ def quantile(data, probs, axis=None):
                                                         all, otherwise only on
                                                         a particular axis.
 
+            backend(str):                               which implementation to
+                                                        use. One of
+                                                        ``"mquantiles"``,
+                                                        ``"partition"``, or
+                                                        ``"approximate"``.
+                                                        (Default
+                                                        ``"mquantiles"``)
+
+            block_length(int):                          number of entries along
+                                                        the first axis to load
+                                                        at a time for the
+                                                        ``"approximate"``
+                                                        backend. By default
+                                                        all. (Default -1)
+
+            num_sketch_points(int):                     number of points the
+                                                        ``QuantileSketch``
+                                                        keeps for the
+                                                        ``"approximate"``
+                                                        backend.
+                                                        (Default 1001)
+
         Returns:
             (numpy.ma.MaskedArray):                     an array with the
                                                         quantiles (the first
@@ -4573,13 +4663,77 @@ def quantile(data, probs, axis=None):
              False,
                    fill_value = nan)
             <BLANKLINE>
+
+            >>> quantile(a, 2, axis = 0, backend="partition")
+            masked_array(data =
+             [[-0.22875 -0.2064  -0.14005  0.6465 ]
+             [ 0.9604  -0.13155  0.03715  1.17655]],
+                         mask =
+             False,
+                   fill_value = nan)
+            <BLANKLINE>
+
+            >>> quantile(a, 2, axis = 1, backend="partition")
+            masked_array(data =
+             [[-0.43885     0.0811    ]
+             [-0.01336667  1.30508333]
+             [ 0.00648333  0.4991    ]],
+                         mask =
+             False,
+                   fill_value = nan)
+            <BLANKLINE>
+
+            >>> quantile(numpy.array([ 1.,  2.,  3.]), 3, backend="partition")
+            masked_array(data = [ 1.25  2.    2.75],
+                         mask = False,
+                   fill_value = nan)
+            <BLANKLINE>
+
+            >>> quantile(
+            ...     numpy.array([ 1.,  2.,  3.]), 3, backend="approximate"
+            ... )
+            masked_array(data = [ 1.25  2.    2.75],
+                         mask = False,
+                   fill_value = nan)
+            <BLANKLINE>
+
+            >>> quantile(a, 2, backend="approximate", block_length=1)
+            masked_array(data = [-0.13155  0.5635 ],
+                         mask = False,
+                   fill_value = nan)
+            <BLANKLINE>
     """
 
     probs_array = get_quantiles(probs)
 
-    new_quantiles = scipy.stats.mstats.mquantiles(
-        data, probs_array, alphap=0.5, betap=0.5, axis=axis
-    )
+    new_quantiles = None
+    if (backend == "partition") and \
+            not numpy.ma.getmask(data).any():
+        new_quantiles = _partition_quantiles(
+            numpy.ma.getdata(data), probs_array, axis=axis
+        )
+    elif backend in ["partition", "mquantiles"]:
+        new_quantiles = scipy.stats.mstats.mquantiles(
+            data, probs_array, alphap=0.5, betap=0.5, axis=axis
+        )
+    elif backend == "approximate":
+        if axis is not None:
+            raise Exception(
+                "The \"approximate\" backend only supports `axis=None`."
+            )
+
+        if block_length == -1:
+            block_length = max(len(data), 1)
+
+        data_sketch = QuantileSketch(num_sketch_points)
+        for range_ij in iters.subrange(0, len(data), block_length):
+            data_sketch.update(data[range_ij.start:range_ij.stop])
+
+        new_quantiles = data_sketch.quantile(probs_array)
+    else:
+        raise Exception(
+            "Unknown quantile backend " + repr(backend) + "."
+        )
 
     if not isinstance(new_quantiles, numpy.ma.MaskedArray):
         new_quantiles = numpy.ma.MaskedArray(new_quantiles)
@@ -4589,6 +4743,242 @@ def quantile(data, probs, axis=None):
     return(new_quantiles)
 
 
+@prof.log_call(trace_logger)
+def _partition_quantiles(data, probs_array, axis=None):
+    """
+        Determines the quantiles using a partial sort.
+
+        Uses the same plotting positions as ``quantile`` (i.e.
+        ``alphap=0.5`` and ``betap=0.5`` in
+        ``scipy.stats.mstats.mquantiles``), but only finds the order
+        statistics needed by partitioning.
+
+        Args:
+            data(numpy.ndarray):                        to find the quantiles
+                                                        of (no masked values).
+
+            probs_array(numpy.ndarray):                 which quantiles to
+                                                        get in the range
+                                                        (0, 1).
+
+            axis(int or None):                          the axis to perform the
+                                                        calculation on (if
+                                                        None then all).
+
+        Returns:
+            (numpy.ndarray):                            an array with the
+                                                        quantiles in place of
+                                                        the axis used.
+
+        Examples:
+            >>> _partition_quantiles(
+            ...     numpy.array([3., 1., 2.]), numpy.array([0.25, 0.5])
+            ... )
+            array([ 1.25,  2.  ])
+
+            >>> _partition_quantiles(
+            ...     numpy.array([[3., 1., 2.], [0., 4., 8.]]),
+            ...     numpy.array([0.5]),
+            ...     axis=1
+            ... )
+            array([[ 2.],
+                   [ 4.]])
+    """
+
+    data = numpy.asarray(data)
+    if axis is None:
+        data = data.ravel()
+        axis = 0
+
+    # Work along the first axis.
+    data = numpy.moveaxis(data, axis, 0)
+
+    num_values = len(data)
+
+    # Positions (1-based) of each quantile.
+    # Same as ``scipy.stats.mstats.mquantiles`` with ``alphap=betap=0.5``.
+    aleph = num_values * probs_array + 0.5
+    k = numpy.floor(
+        numpy.clip(aleph, 1, max(num_values - 1, 1))
+    ).astype(int)
+    gamma = numpy.clip(aleph - k, 0, 1)
+
+    # Only need the order statistics at and just after each position.
+    # Partitioning on the first of these is enough as the next one is the
+    # smallest value after it (i.e. before the next partition point).
+    kth = numpy.unique(k - 1)
+    data_partitioned = numpy.partition(data, kth, axis=0)
+
+    new_quantiles = numpy.empty(
+        probs_array.shape + data.shape[1:],
+        dtype=numpy.result_type(data.dtype, numpy.float64)
+    )
+    for i, (k_i, gamma_i) in enumerate(iters.izip(k, gamma)):
+        lower_i = data_partitioned[k_i - 1]
+
+        upper_i = lower_i
+        if k_i < num_values:
+            next_kth_i = kth[kth >= k_i]
+            next_kth_i = next_kth_i[0] if len(next_kth_i) else num_values - 1
+            upper_i = data_partitioned[k_i:next_kth_i + 1].min(axis=0)
+
+        new_quantiles[i] = (1.0 - gamma_i) * lower_i + gamma_i * upper_i
+
+    # Put the quantiles where the axis was.
+    new_quantiles = numpy.moveaxis(new_quantiles, 0, axis)
+
+    return(new_quantiles)
+
+
+@prof.log_class(trace_logger)
+class QuantileSketch(object):
+    """
+        Approximates quantiles of data that is provided a block at a time.
+
+        Keeps a bounded number of weighted points that summarize the
+        distribution of the data seen so far. Each block added is summarized
+        by evenly spaced order statistics (found with a partial sort), which
+        are merged with the existing summary. Quantiles are then found by
+        interpolating over the cumulative weight of the points. If all of the
+        data fits within the summary, the result is the same as ``quantile``.
+
+        Examples:
+            >>> s = QuantileSketch()
+            >>> s.update(numpy.array([3., 1.]))
+            >>> s.update(numpy.array([2.]))
+            >>> s.quantile(numpy.array([0.25, 0.5, 0.75]))
+            array([ 1.25,  2.  ,  2.75])
+
+            >>> s.count
+            3.0
+
+            >>> s = QuantileSketch(11)
+            >>> for i in range(100):
+            ...     s.update(numpy.arange(i * 100, (i + 1) * 100))
+            >>> len(s.values) <= 22
+            True
+            >>> abs(s.quantile(numpy.array([0.5]))[0] - 5000) < 100
+            True
+    """
+
+    def __init__(self, num_points=1001):
+        """
+            Construct an empty QuantileSketch instance.
+
+            Args:
+                num_points(int):        number of points to summarize each
+                                        block (and the merged result) with.
+        """
+
+        assert num_points >= 2
+
+        self.num_points = num_points
+        self.values = numpy.zeros((0,), dtype=numpy.float64)
+        self.weights = numpy.zeros((0,), dtype=numpy.float64)
+        self.count = 0.0
+
+
+    def update(self, new_data):
+        """
+            Adds a block of data to the summary.
+
+            Args:
+                new_data(numpy.ndarray):        data to add (masked values
+                                                are skipped).
+        """
+
+        new_data = numpy.ma.asarray(new_data)
+        new_values = new_data.compressed().astype(numpy.float64)
+
+        num_values = len(new_values)
+        if not num_values:
+            return
+
+        new_weights = None
+        if num_values <= self.num_points:
+            new_weights = numpy.ones((num_values,), dtype=numpy.float64)
+        else:
+            # Take evenly spaced order statistics.
+            new_ranks = numpy.unique(numpy.round(
+                numpy.linspace(0, num_values - 1, self.num_points)
+            ).astype(int))
+            new_values = numpy.partition(new_values, new_ranks)[new_ranks]
+
+            # Each takes the weight of the ranks closest to it.
+            new_rank_bounds = numpy.concatenate([
+                [-0.5],
+                (new_ranks[1:] + new_ranks[:-1]) / 2.0,
+                [num_values - 0.5]
+            ])
+            new_weights = numpy.diff(new_rank_bounds)
+
+        self.values = numpy.concatenate([self.values, new_values])
+        self.weights = numpy.concatenate([self.weights, new_weights])
+        self.count += num_values
+
+        # Keep the summary bounded.
+        if len(self.values) > 2 * self.num_points:
+            self.compress()
+
+
+    def compress(self):
+        """
+            Resamples the summary to use num_points equally weighted points.
+        """
+
+        centers, values = self._cumulative_centers()
+
+        new_centers = (
+            numpy.arange(self.num_points) + 0.5
+        ) * (self.count / self.num_points)
+
+        self.values = numpy.interp(new_centers, centers, values)
+        self.weights = numpy.empty((self.num_points,), dtype=numpy.float64)
+        self.weights[:] = self.count / self.num_points
+
+
+    def quantile(self, probs_array):
+        """
+            Finds the approximate quantiles of the data seen so far.
+
+            Args:
+                probs_array(numpy.ndarray):     which quantiles to get in the
+                                                range (0, 1).
+
+            Returns:
+                (numpy.ndarray):                the approximate quantiles
+                                                (NaN if no data was seen).
+        """
+
+        probs_array = numpy.asarray(probs_array, dtype=numpy.float64)
+
+        if not self.count:
+            return(numpy.nan * numpy.ones(probs_array.shape))
+
+        centers, values = self._cumulative_centers()
+
+        return(numpy.interp(self.count * probs_array, centers, values))
+
+
+    def _cumulative_centers(self):
+        """
+            Sorts the summary and finds the rank at the center of each point.
+
+            Returns:
+                (numpy.ndarray, numpy.ndarray):     the center of each point
+                                                    in rank and the value of
+                                                    each point (sorted).
+        """
+
+        order = numpy.argsort(self.values, kind="mergesort")
+        values = self.values[order]
+        weights = self.weights[order]
+
+        centers = numpy.cumsum(weights) - weights / 2.0
+
+        return(centers, values)
+
+
 @prof.log_call(trace_logger)
 def binomial_coefficients(n):
     """
@@ -730,6 +730,79 @@ class TestSpamsSandbox(object):
 
         assert (len(unmatched_g3) == 0)
 
+    def test_shared_frames_1(self):
+        a = nanshe.box.spams_sandbox.shared_frames((4, 3, 2), float)
+        a[...] = numpy.arange(a.size).reshape(a.shape)
+
+        b = numpy.asfortranarray(a.reshape(len(a), -1).transpose())
+
+        assert (b.shape == (6, 4))
+        assert (b == numpy.arange(a.size).reshape(4, 6).T).all()
+
+        assert (nanshe.box.spams_sandbox._get_shared_array(b) is not None)
+        assert (nanshe.box.spams_sandbox._get_shared_array(b.copy()) is None)
+        assert (nanshe.box.spams_sandbox._get_shared_array(b[:3]) is None)
+        assert (nanshe.box.spams_sandbox._get_shared_array(b[:, :3]) is not None)
+        assert (nanshe.box.spams_sandbox._get_shared_array(b[:, 1:]) is None)
+
+    def test_call_multiprocessing_array_spams_trainDL_3(self):
+        if not has_spams:
+            raise nose.SkipTest(
+                "Cannot run this test without SPAMS being installed."
+            )
+
+        g = numpy.asarray(self.g.transpose())
+        g = g.reshape((len(g),) + tuple(self.space))
+
+        g_shared = nanshe.box.spams_sandbox.shared_frames(g.shape, float)
+        g_shared[...] = g
+
+        d = nanshe.box.spams_sandbox.call_multiprocessing_array_spams_trainDL(
+            numpy.asfortranarray(
+                g_shared.reshape((len(g_shared), -1)).transpose()
+            ),
+            **{
+                "gamma2" : 0,
+                "gamma1" : 0,
+                "numThreads" : 1,
+                "K" : self.g.shape[1],
+                "iter" : 10,
+                "modeD" : 0,
+                "posAlpha" : True,
+                "clean" : True,
+                "posD" : True,
+                "batchsize" : 256,
+                "lambda1" : 0.2,
+                "lambda2" : 0,
+                "mode" : 2
+            }
+        )
+        d = (d != 0)
+
+        self.g = self.g.transpose()
+        d = d.transpose()
+
+        assert (self.g.shape == d.shape)
+
+        assert (self.g.astype(bool).max(axis=0) == d.astype(bool).max(axis=0)).all()
+
+        unmatched_g = range(len(self.g))
+        matched = dict()
+
+        for i in irange(len(d)):
+            new_unmatched_g = []
+            for j in unmatched_g:
+                if not (d[i] == self.g[j]).all():
+                    new_unmatched_g.append(j)
+                else:
+                    matched[i] = j
+
+            unmatched_g = new_unmatched_g
+
+        print(unmatched_g)
+
+        assert (len(unmatched_g) == 0)
+
     def test_run_multiprocessing_array_spams_trainDL_3(self):
         if not has_spams:
             raise nose.SkipTest(
@@ -533,3 +533,108 @@ class TestSegment(object):
         assert all([(_1 == _2).all() for _1, _2 in nanshe.util.iters.izip(e.get_local_max_label_image().nonzero(), tuple(p.T))])
 
         assert (e.get_local_max_label_image()[e.get_local_max_label_image().nonzero()] == numpy.arange(1, len(m) + 1)).all()
+
+    def test_ExtendedRegionProps_11(self):
+        space = numpy.array((100, 100))
+        radii = numpy.array((5, 10))
+        magnitudes = numpy.array((1, 1), dtype=float)
+        points = numpy.array([[23, 36],
+                              [58, 64]])
+
+        masks = nanshe.syn.data.generate_hypersphere_masks(
+            space, points, radii
+        )
+        images = nanshe.syn.data.generate_gaussian_images(
+            space, points, radii/3.0, magnitudes
+        ) * masks
+        labels = nanshe.util.xnumpy.enumerate_masks_max(masks, axis=0)[0]
+
+        e = nanshe.imp.segment.ExtendedRegionProps(
+            images.max(axis=0), labels, properties=["area", "centroid"]
+        )
+
+        e.remove_prop_mask(e.props["label"] == 1)
+
+        # Carried over from the features of the original label image.
+        assert (nanshe.imp.segment._region_features(e.label_image, cached_only=True) is not None)
+
+        props_kept = nanshe.imp.segment.region_properties(
+            e.label_image, properties=["area", "centroid"]
+        )
+
+        nanshe.imp.segment._region_features.cache.clear()
+
+        props = nanshe.imp.segment.region_properties(
+            e.label_image, properties=["area", "centroid"]
+        )
+
+        assert (len(props) == 1)
+
+        assert (props["area"] == masks[1].sum()).all()
+
+        assert (props_kept == props).all()
+
+    def test_ExtendedRegionProps_12(self):
+        p = numpy.array([[27, 51],
+                         [66, 85],
+                         [77, 45]])
+
+        space = numpy.array((100, 100))
+        radii = numpy.array((5, 6, 7))
+        magnitudes = numpy.array((1, 1, 1), dtype=float)
+
+        g = nanshe.syn.data.generate_gaussian_images(space, p, radii/3.0, magnitudes/3)
+        m = (g > 0.00065)
+        g *= m
+
+        intensity_image = g.max(axis=0)
+        label_image = nanshe.util.xnumpy.enumerate_masks_max(m, axis=0)[0]
+
+        e = nanshe.imp.segment.ExtendedRegionProps(
+            intensity_image, label_image, copy=False
+        )
+
+        assert (e.intensity_image is intensity_image)
+
+        assert (e.label_image is label_image)
+
+        e.remove_prop_indices(0)
+
+        m = m[1:]
+
+        assert (label_image == nanshe.util.xnumpy.enumerate_masks_max(m, axis=0)[0]).all()
+
+        assert (intensity_image == (g * m.max(axis=0)).max(axis=0)).all()
+
+    def test_ExtendedRegionProps_13(self):
+        space = numpy.array((100, 100))
+        radii = numpy.array((5, 10))
+        points = numpy.array([[23, 36],
+                              [58, 64]])
+
+        masks = nanshe.syn.data.generate_hypersphere_masks(
+            space, points, radii
+        )
+        labels = nanshe.util.xnumpy.enumerate_masks_max(masks, axis=0)[0]
+
+        props = nanshe.imp.segment.region_properties(
+            labels, properties=["area"]
+        )
+
+        assert (props["area"] == masks.sum(axis=(1, 2))).all()
+
+        # Changing the same label image (same shape) does not reuse its old
+        # features.
+        labels[masks[1]] = 1
+
+        props = nanshe.imp.segment.region_properties(
+            labels, properties=["area"]
+        )
+
+        assert (len(props) == 1)
+
+        assert (props["area"] == masks.max(axis=0).sum()).all()
+
+        nanshe.imp.segment.clear_region_features()
+
+        assert (nanshe.imp.segment._region_features(labels, cached_only=True) is None)
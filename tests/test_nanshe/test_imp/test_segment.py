@@ -10,6 +10,7 @@ import imp
 import nose
 import nose.plugins
 import nose.plugins.attrib
+import nose.tools
 
 import numpy
 import scipy
@@ -19,6 +20,9 @@ import scipy.spatial.distance
 
 import scipy.stats
 
+import skimage
+import skimage.morphology
+
 import nanshe.util.iters
 import nanshe.util.xnumpy
 
@@ -530,6 +534,68 @@ class TestSegment(object):
         # Turns out that a difference greater than 0.1 will be over 10 standard deviations away.
         assert (((a - 100.0*b) < 0.1).all())
 
+    def test_spatial_bin_1(self):
+        a = numpy.random.random((5, 21, 22)).astype(numpy.float32)
+
+        b = nanshe.imp.segment.spatial_bin(a, 2)
+
+        b_expected = a[:, :20, :22].reshape(
+            (5, 10, 2, 11, 2)
+        ).mean(axis=4).mean(axis=2)
+
+        assert (b.shape == b_expected.shape)
+        assert (b.dtype == a.dtype)
+        assert numpy.allclose(b, b_expected)
+
+    def test_spatial_bin_2(self):
+        a = numpy.random.random((5, 21, 22, 23))
+
+        b = numpy.zeros((5, 7, 11, 23))
+        b_out = nanshe.imp.segment.spatial_bin(
+            a, (3, 2, 1), method="max", block_frame_length=2, out=b
+        )
+
+        b_expected = a.reshape(
+            (5, 7, 3, 11, 2, 23)
+        ).max(axis=4).max(axis=2)
+
+        assert (id(b) == id(b_out))
+        assert (b == b_expected).all()
+
+    def test_temporal_bin_1(self):
+        a = numpy.random.random((21, 10, 11)).astype(numpy.float32)
+
+        b = nanshe.imp.segment.temporal_bin(a, 4)
+
+        b_expected = a[:20].reshape((5, 4,) + a.shape[1:]).mean(axis=1)
+
+        assert (b.shape == b_expected.shape)
+        assert (b.dtype == a.dtype)
+        assert numpy.allclose(b, b_expected)
+
+    def test_temporal_bin_2(self):
+        a = numpy.random.random((21, 10, 11))
+
+        b = nanshe.imp.segment.temporal_bin(a, 3, method="max")
+
+        b_expected = a.reshape((7, 3,) + a.shape[1:]).max(axis=1)
+
+        assert (b.shape == b_expected.shape)
+        assert (b == b_expected).all()
+
+    def test_temporal_bin_3(self):
+        a = numpy.random.randint(0, 100, (21, 10, 11))
+
+        b = numpy.zeros((5,) + a.shape[1:])
+        b_out = nanshe.imp.segment.temporal_bin(
+            a, 4, block_frame_length=7, out=b
+        )
+
+        b_expected = a[:20].reshape((5, 4,) + a.shape[1:]).mean(axis=1)
+
+        assert (id(b) == id(b_out))
+        assert numpy.allclose(b, b_expected)
+
     def test_preprocess_data_1(self):
         ## Does NOT test accuracy.
 
@@ -826,6 +892,139 @@ class TestSegment(object):
 
         nanshe.imp.segment.preprocess_data(image_stack, **config)
 
+    def test_preprocess_data_8(self):
+        ## Does NOT test accuracy.
+
+        config = {
+            "normalize_data" : {
+                "renormalized_images" : {
+                    "ord" : 2
+                }
+            },
+            "temporal_bin" : {
+                "factor" : 4,
+                "method" : "mean"
+            },
+            "extract_f0" : {
+                "spatial_smoothing_gaussian_filter_stdev" : 5.0,
+                "spatial_smoothing_gaussian_filter_window_size" : 5.0,
+                "which_quantile" : 0.5,
+                "temporal_smoothing_gaussian_filter_stdev" : 5.0,
+                "temporal_smoothing_gaussian_filter_window_size" : 5.0,
+                "half_window_size" : 10,
+                "bias" : 100
+            }
+        }
+
+        space = numpy.array([100, 100, 100])
+        radii = numpy.array([5, 6])
+        magnitudes = numpy.array([15, 16])
+        points = numpy.array([[20, 30, 24],
+                              [70, 59, 65]])
+
+        masks = nanshe.syn.data.generate_hypersphere_masks(
+            space, points, radii
+        )
+        images = nanshe.syn.data.generate_gaussian_images(
+            space, points, radii/3.0, magnitudes
+        ) * masks
+        image_stack = images.max(axis=0)
+
+        preprocessed_image_stack = nanshe.imp.segment.preprocess_data(
+            image_stack, **config
+        )
+
+        assert (len(preprocessed_image_stack) == 25)
+        assert (preprocessed_image_stack.shape[1:] == image_stack.shape[1:])
+
+    def test_preprocess_data_9(self):
+        ## Does NOT test accuracy.
+
+        config = {
+            "normalize_data" : {
+                "renormalized_images" : {
+                    "ord" : 2
+                }
+            },
+            "temporal_bin" : {
+                "factor" : 3,
+                "method" : "max",
+                "after_extract_f0" : True
+            },
+            "extract_f0" : {
+                "spatial_smoothing_gaussian_filter_stdev" : 5.0,
+                "spatial_smoothing_gaussian_filter_window_size" : 5.0,
+                "which_quantile" : 0.5,
+                "temporal_smoothing_gaussian_filter_stdev" : 5.0,
+                "temporal_smoothing_gaussian_filter_window_size" : 5.0,
+                "half_window_size" : 20,
+                "bias" : 100
+            }
+        }
+
+        space = numpy.array([100, 100, 100])
+        radii = numpy.array([5, 6])
+        magnitudes = numpy.array([15, 16])
+        points = numpy.array([[20, 30, 24],
+                              [70, 59, 65]])
+
+        masks = nanshe.syn.data.generate_hypersphere_masks(
+            space, points, radii
+        )
+        images = nanshe.syn.data.generate_gaussian_images(
+            space, points, radii/3.0, magnitudes
+        ) * masks
+        image_stack = images.max(axis=0)
+
+        preprocessed_image_stack = nanshe.imp.segment.preprocess_data(
+            image_stack, **config
+        )
+
+        assert (len(preprocessed_image_stack) == 33)
+        assert (preprocessed_image_stack.shape[1:] == image_stack.shape[1:])
+
+    def test_preprocess_data_10(self):
+        ## Does NOT test accuracy.
+
+        config = {
+            "normalize_data" : {
+                "renormalized_images" : {
+                    "ord" : 2
+                }
+            },
+            "spatial_bin" : {
+                "factor" : 2,
+                "method" : "mean"
+            },
+            "wavelet.transform" : {
+                "scale" : [
+                    3,
+                    4,
+                    4
+                ]
+            }
+        }
+
+        space = numpy.array([100, 100, 100])
+        radii = numpy.array([5, 6])
+        magnitudes = numpy.array([15, 16])
+        points = numpy.array([[20, 30, 24],
+                              [70, 59, 65]])
+
+        masks = nanshe.syn.data.generate_hypersphere_masks(
+            space, points, radii
+        )
+        images = nanshe.syn.data.generate_gaussian_images(
+            space, points, radii/3.0, magnitudes
+        ) * masks
+        image_stack = images.max(axis=0)
+
+        preprocessed_image_stack = nanshe.imp.segment.preprocess_data(
+            image_stack, **config
+        )
+
+        assert (preprocessed_image_stack.shape == (100, 50, 50))
+
     def test_generate_dictionary_00(self):
         if not has_spams:
             raise nose.SkipTest(
@@ -1494,137 +1693,645 @@ class TestSegment(object):
 
         assert (g.astype(bool) == d.astype(bool)).all()
 
-    def test_generate_local_maxima_vigra_1(self):
+    def test_generate_dictionary_13(self):
         p = numpy.array([[27, 51],
                          [66, 85],
                          [77, 45]])
 
         space = numpy.array((100, 100))
         radii = numpy.array((5, 6, 7))
-        magnitudes = numpy.array((1, 1, 1), dtype=float)
-
-        g = nanshe.syn.data.generate_gaussian_images(
-            space, p, radii/3.0, magnitudes/3
-        )
-        m = nanshe.imp.segment.generate_local_maxima_vigra(g.max(axis=0))
-
-        assert (numpy.array(m.nonzero()) == p.T).all()
-
-    @nose.plugins.attrib.attr("3D")
-    def test_generate_local_maxima_vigra_2(self):
-        p = numpy.array([[27, 51, 87],
-                         [66, 85, 55],
-                         [77, 45, 26]])
 
-        space = numpy.array((100, 100, 100))
-        radii = numpy.array((5, 6, 7))
-        magnitudes = numpy.array((1, 1, 1), dtype=float)
+        g = nanshe.syn.data.generate_hypersphere_masks(space, p, radii)
 
-        g = nanshe.syn.data.generate_gaussian_images(
-            space, p, radii/3.0, magnitudes/3
+        d = nanshe.imp.segment.generate_dictionary(
+            g.astype(float),
+            g.astype(float),
+            len(g),
+            **{
+                "sklearn.decomposition.MiniBatchDictionaryLearning" : {
+                    "n_jobs" : 1,
+                    "batch_size" : 256,
+                    "alpha" : 0.2
+                }
+            }
         )
-        m = nanshe.imp.segment.generate_local_maxima_vigra(g.max(axis=0))
+        d = (d != 0)
 
-        assert (numpy.array(m.nonzero()) == p.T).all()
+        assert (g.shape == d.shape)
 
-    def test_generate_local_maxima_scikit_image_1(self):
+        assert (g.astype(bool) == d.astype(bool)).all()
+
+    def test_generate_dictionary_14(self):
         p = numpy.array([[27, 51],
                          [66, 85],
                          [77, 45]])
 
         space = numpy.array((100, 100))
         radii = numpy.array((5, 6, 7))
-        magnitudes = numpy.array((1, 1, 1), dtype=float)
-
-        g = nanshe.syn.data.generate_gaussian_images(
-            space, p, radii/3.0, magnitudes/3
-        )
-        m = nanshe.imp.segment.generate_local_maxima_scikit_image(g.max(axis=0))
 
-    @nose.plugins.attrib.attr("3D")
-    def test_generate_local_maxima_scikit_image_2(self):
-        p = numpy.array([[27, 51, 87],
-                         [66, 85, 55],
-                         [77, 45, 26]])
+        g = nanshe.syn.data.generate_hypersphere_masks(space, p, radii)
 
-        space = numpy.array((100, 100, 100))
-        radii = numpy.array((5, 6, 7))
-        magnitudes = numpy.array((1, 1, 1), dtype=float)
+        # Stream repeated frames in blocks.
+        a = numpy.concatenate(10 * [g]).astype(float)
 
-        g = nanshe.syn.data.generate_gaussian_images(
-            space, p, radii/3.0, magnitudes/3
+        d = nanshe.imp.segment.generate_dictionary(
+            a,
+            g.astype(float),
+            len(g),
+            **{
+                "sklearn.decomposition.MiniBatchDictionaryLearning" : {
+                    "n_jobs" : 1,
+                    "batch_size" : 6,
+                    "alpha" : 0.2,
+                    "block_frame_length" : 12,
+                    "num_epochs" : 3
+                }
+            }
         )
-        m = nanshe.imp.segment.generate_local_maxima_scikit_image(g.max(axis=0))
+        d = (d != 0)
 
-        assert (numpy.array(m.nonzero()) == p.T).all()
+        assert (g.shape == d.shape)
 
-    def test_generate_local_maxima_1(self):
-        p = numpy.array([[27, 51],
-                         [66, 85],
-                         [77, 45]])
+        assert (g.astype(bool) == d.astype(bool)).all()
 
-        space = numpy.array((100, 100))
-        radii = numpy.array((5, 6, 7))
-        magnitudes = numpy.array((1, 1, 1), dtype=float)
+    def test_generate_dictionary_15(self):
+        def first_frames(new_data, initial_dictionary, K):
+            assert (initial_dictionary is None)
 
-        g = nanshe.syn.data.generate_gaussian_images(
-            space, p, radii/3.0, magnitudes/3
-        )
-        m = nanshe.imp.segment.generate_local_maxima(g.max(axis=0))
+            return(new_data[:K])
 
-        assert (numpy.array(m.nonzero()) == p.T).all()
+        nanshe.imp.segment.register_dictionary_learning_backend(
+            "first_frames", "K"
+        )(first_frames)
 
-    @nose.plugins.attrib.attr("3D")
-    def test_generate_local_maxima_2(self):
-        p = numpy.array([[27, 51, 87],
-                         [66, 85, 55],
-                         [77, 45, 26]])
+        try:
+            g = numpy.random.random((5, 10, 11)).astype(numpy.float32)
 
-        space = numpy.array((100, 100, 100))
-        radii = numpy.array((5, 6, 7))
-        magnitudes = numpy.array((1, 1, 1), dtype=float)
+            d = nanshe.imp.segment.generate_dictionary(
+                g, n_components=3, **{"first_frames" : {}}
+            )
 
-        g = nanshe.syn.data.generate_gaussian_images(
-            space, p, radii/3.0, magnitudes/3
-        )
-        m = nanshe.imp.segment.generate_local_maxima(g.max(axis=0))
+            assert (d.dtype == g.dtype)
+            assert (d == g[:3]).all()
+        finally:
+            del nanshe.imp.segment.generate_dictionary.backends["first_frames"]
+
+    def test_generate_dictionary_16(self):
+        def first_frames(new_data, initial_dictionary, K):
+            assert (new_data.shape == (6, 10 * 11))
+
+            return(new_data[:K])
+
+        nanshe.imp.segment.register_dictionary_learning_backend(
+            "first_frames", "K"
+        )(first_frames)
+
+        try:
+            g = numpy.random.random((50, 3)).dot(
+                numpy.random.random((3, 10 * 11))
+            ).reshape(50, 10, 11).astype(numpy.float32)
+
+            d = nanshe.imp.segment.generate_dictionary(
+                g,
+                n_components=4,
+                **{
+                    "reduce_rank" : {
+                        "rank" : 3,
+                        "block_frame_length" : 7
+                    },
+                    "first_frames" : {}
+                }
+            )
 
-        assert (numpy.array(m.nonzero()) == p.T).all()
+            assert (d.shape == (4,) + g.shape[1:])
+            assert (d.dtype == g.dtype)
 
-    def test_extended_region_local_maxima_properties_1(self):
-        p = numpy.array([[27, 51],
-                         [66, 85],
-                         [77, 45]])
+            d_m = d[:3].reshape(3, -1)
+            g_m = g.reshape(len(g), -1)
+            d_m_norms = numpy.linalg.norm(d_m, axis=1)
+            assert numpy.allclose((d_m_norms ** 2).mean(), 1, atol=1e-5)
+            assert (d_m_norms[:-1] >= d_m_norms[1:]).all()
 
-        space = numpy.array((100, 100))
-        radii = numpy.array((5, 6, 7))
-        magnitudes = numpy.array((1, 1, 1), dtype=float)
+            d_m = d_m / d_m_norms[:, None]
+            assert numpy.allclose(
+                g_m - g_m.dot(d_m.T).dot(d_m), 0, atol=1e-3
+            )
+            assert numpy.allclose(d[3], -d[0])
+        finally:
+            del nanshe.imp.segment.generate_dictionary.backends["first_frames"]
 
-        g = nanshe.syn.data.generate_gaussian_images(
-            space, p, radii/3.0, magnitudes/3
-        )
-        m = (g > 0.00065)
-        g *= m
+    def test_generate_dictionary_17(self):
+        chunks = []
 
-        e = nanshe.imp.segment.extended_region_local_maxima_properties(
-            g.max(axis=0),
-            nanshe.util.xnumpy.enumerate_masks_max(m, axis=0)[0]
-        )
+        def first_frames(new_data, initial_dictionary, K, iter):
+            assert (len(new_data) == 40)
 
-        assert (numpy.bincount(e["label"])[1:]  == 1).all()
+            chunks.append(iter)
 
-        assert (len(e) == len(p))
+            return(new_data[:K])
 
-        assert (e["local_max"] == p).all()
+        nanshe.imp.segment.register_dictionary_learning_backend(
+            "first_frames", "K", "iter"
+        )(first_frames)
 
-        assert (e["area"] == numpy.apply_over_axes(numpy.sum, m, axes=range(1, m.ndim)).squeeze().astype(float)).all()
+        try:
+            g = numpy.random.random((50, 10, 11)).astype(numpy.float32)
 
-        assert (e["centroid"] == e["local_max"]).all()
+            d = nanshe.imp.segment.generate_dictionary(
+                g,
+                n_components=3,
+                **{
+                    "first_frames" : {"iter" : 25},
+                    "early_stopping" : {
+                        "num_iterations" : 10,
+                        "num_held_out_frames" : 10
+                    }
+                }
+            )
 
-        assert (e["intensity"] == g.max(axis=0)[tuple(p.T)]).all()
+            assert (d.shape == (3,) + g.shape[1:])
+            assert (chunks == [10, 10])
 
-    def test_extended_region_local_maxima_properties_2(self):
-        p = numpy.array([[27, 51],
+            del chunks[:]
+
+            d = nanshe.imp.segment.generate_dictionary(
+                g,
+                n_components=3,
+                **{
+                    "first_frames" : {"iter" : 25},
+                    "early_stopping" : {
+                        "num_iterations" : 10,
+                        "num_held_out_frames" : 10,
+                        "tolerance" : -1.0
+                    }
+                }
+            )
+
+            assert (chunks == [10, 10, 5])
+        finally:
+            del nanshe.imp.segment.generate_dictionary.backends["first_frames"]
+
+    def test_generate_dictionary_18(self):
+        # Least squares with fewer basis images than the rank of the data
+        # finds the leading components. So, the reduced data must keep how
+        # much each component weighs to learn the same basis images.
+        def leading_components(new_data, initial_dictionary, K):
+            return(numpy.linalg.svd(new_data, full_matrices=False)[2][:K])
+
+        nanshe.imp.segment.register_dictionary_learning_backend(
+            "leading_components", "K"
+        )(leading_components)
+
+        try:
+            g = numpy.random.random((100, 3)).dot(
+                numpy.diag([9.0, 3.0, 1.0])
+            ).dot(
+                numpy.linalg.qr(numpy.random.random((10 * 11, 3)))[0].T
+            ).reshape(100, 10, 11)
+
+            d_1 = nanshe.imp.segment.generate_dictionary(
+                g, n_components=2, **{"leading_components" : {}}
+            )
+            d_2 = nanshe.imp.segment.generate_dictionary(
+                g,
+                n_components=2,
+                **{
+                    "reduce_rank" : {
+                        "rank" : 3,
+                        "block_frame_length" : 7
+                    },
+                    "leading_components" : {}
+                }
+            )
+
+            d_1_m = d_1.reshape(len(d_1), -1)
+            d_2_m = d_2.reshape(len(d_2), -1)
+
+            assert numpy.allclose(
+                numpy.abs(d_1_m.dot(d_2_m.T)), numpy.eye(2), atol=1e-6
+            )
+        finally:
+            del nanshe.imp.segment.generate_dictionary.backends["leading_components"]
+
+    def test_generate_dictionary_19(self):
+        states = []
+        frames = []
+
+        def first_frames(new_data,
+                         initial_dictionary,
+                         K,
+                         iter,
+                         state=None,
+                         return_state=False):
+            assert return_state
+
+            states.append(state)
+            frames.append(new_data.copy())
+
+            state = (0 if state is None else state) + iter
+
+            return(new_data[:K], state)
+
+        nanshe.imp.segment.register_dictionary_learning_backend(
+            "first_frames", "K", "iter", resumable=True
+        )(first_frames)
+
+        try:
+            g = numpy.random.random((50, 10, 11)).astype(numpy.float32)
+            g_original = g.copy()
+
+            d = nanshe.imp.segment.generate_dictionary(
+                g,
+                n_components=3,
+                **{
+                    "first_frames" : {"iter" : 25},
+                    "early_stopping" : {
+                        "num_iterations" : 10,
+                        "num_held_out_frames" : 10,
+                        "tolerance" : -1.0
+                    }
+                }
+            )
+
+            assert (d.shape == (3,) + g.shape[1:])
+            assert (states == [None, 10, 20])
+
+            # Training frames are distinct frames of the data.
+            matches = (
+                frames[0][:, None] == g.reshape(1, len(g), -1)
+            ).all(axis=2)
+            assert (matches.shape == (40, 50))
+            assert (matches.sum(axis=1) == 1).all()
+            assert (matches.sum(axis=0) <= 1).all()
+
+            # The data is left as it was.
+            assert (g == g_original).all()
+        finally:
+            del nanshe.imp.segment.generate_dictionary.backends["first_frames"]
+
+    @nose.tools.raises(AssertionError)
+    def test_generate_dictionary_20(self):
+        g = numpy.random.random((50, 10, 11))
+
+        nanshe.imp.segment.generate_dictionary(
+            g,
+            n_components=3,
+            **{
+                "sklearn.decomposition.MiniBatchDictionaryLearning" : {
+                    "n_jobs" : 1,
+                    "num_epochs" : 4
+                },
+                "early_stopping" : {
+                    "num_iterations" : 1,
+                    "num_held_out_frames" : 10
+                }
+            }
+        )
+
+    def test_generate_dictionary_21(self):
+        components = []
+        held_out = []
+
+        def first_components(new_data, initial_dictionary, K, iter):
+            components.append(new_data.copy())
+
+            return(new_data[:K])
+
+        def record_objective(new_data, new_dictionary, **parameters):
+            held_out.append(new_data.copy())
+
+            return(0.0)
+
+        nanshe.imp.segment.register_dictionary_learning_backend(
+            "first_components", "K", "iter"
+        )(first_components)
+
+        dictionary_objective = nanshe.imp.segment.dictionary_objective
+        nanshe.imp.segment.dictionary_objective = record_objective
+
+        try:
+            g = numpy.random.random((50, 10, 11))
+            g_m = g.reshape(len(g), -1)
+
+            nanshe.imp.segment.generate_dictionary(
+                g,
+                n_components=3,
+                **{
+                    "first_components" : {"iter" : 20},
+                    "reduce_rank" : {"rank" : 3},
+                    "early_stopping" : {
+                        "num_iterations" : 10,
+                        "num_held_out_frames" : 10
+                    }
+                }
+            )
+
+            # Held out frames are distinct frames of the data.
+            matches = (held_out[0][:, None] == g_m[None]).all(axis=2)
+            assert (matches.shape == (10, 50))
+            assert (matches.sum(axis=1) == 1).all()
+            assert (matches.sum(axis=0) <= 1).all()
+
+            # Training components only come from the other frames.
+            assert (components[0].shape == (6, g_m.shape[1]))
+
+            g_training = g_m[~matches.any(axis=0)]
+            residual = components[0] - components[0].dot(
+                numpy.linalg.pinv(g_training)
+            ).dot(g_training)
+            assert numpy.allclose(residual, 0)
+        finally:
+            nanshe.imp.segment.dictionary_objective = dictionary_objective
+            del nanshe.imp.segment.generate_dictionary.backends["first_components"]
+
+    def test_dictionary_objective_1(self):
+        a = numpy.random.random((20, 4, 5))
+        d = numpy.random.random((3, 4, 5))
+
+        o_1 = nanshe.imp.segment.dictionary_objective(a, d)
+        o_2 = nanshe.imp.segment.dictionary_objective(a, d, lambda1=0.1)
+        o_3 = nanshe.imp.segment.dictionary_objective(
+            a, d, num_code_iterations=1000
+        )
+
+        a_m = a.reshape(len(a), -1)
+        d_m = d.reshape(len(d), -1)
+        c = numpy.linalg.lstsq(d_m.T, a_m.T, rcond=None)[0].T
+        o_expected = 0.5 * ((a_m - c.dot(d_m)) ** 2).sum(axis=1).mean()
+
+        assert (o_1 >= o_expected - 1e-8)
+        assert (o_2 > o_1)
+        assert numpy.isclose(o_3, o_expected, rtol=1e-4)
+
+        assert nanshe.imp.segment.dictionary_objective(
+            a, numpy.zeros_like(d)
+        ) == 0.5 * (a_m ** 2).sum(axis=1).mean()
+
+    def test_reduce_rank_1(self):
+        a = numpy.random.random((100, 5)).dot(
+            numpy.random.random((5, 8 * 9))
+        ).reshape(100, 8, 9)
+        a += 1e-4 * numpy.random.random(a.shape)
+
+        b = nanshe.imp.segment.reduce_rank(
+            a, 5, include_negatives=False, block_frame_length=16
+        )
+
+        a_m = a.reshape(len(a), -1)
+        b_m = b.reshape(len(b), -1)
+
+        s_expected, v_expected = numpy.linalg.svd(a_m, full_matrices=False)[1:]
+
+        assert (b.shape == (5,) + a.shape[1:])
+        assert numpy.allclose(
+            numpy.linalg.norm(b_m, axis=1),
+            s_expected[:5] / numpy.sqrt((s_expected[:5] ** 2).mean()),
+            rtol=1e-3
+        )
+
+        b_m = b_m / numpy.linalg.norm(b_m, axis=1)[:, None]
+        assert numpy.allclose(
+            numpy.abs(b_m.dot(v_expected[:5].T)), numpy.eye(5), atol=1e-3
+        )
+
+    def test_correlation_image_1(self):
+        a = numpy.random.random((50, 6, 7)).cumsum(axis=0)
+
+        b = nanshe.imp.segment.correlation_image(a, block_frame_length=7)
+
+        b_expected = numpy.zeros(a.shape[1:])
+        for each_point in numpy.ndindex(*a.shape[1:]):
+            each_point = numpy.array(each_point)
+
+            each_corrs = []
+            for each_offset in [[-1, 0], [1, 0], [0, -1], [0, 1]]:
+                each_neighbor = each_point + each_offset
+                if ((0 <= each_neighbor) & (each_neighbor < a.shape[1:])).all():
+                    each_corrs.append(numpy.corrcoef(
+                        a[(slice(None),) + tuple(each_point)],
+                        a[(slice(None),) + tuple(each_neighbor)]
+                    )[0, 1])
+
+            b_expected[tuple(each_point)] = numpy.mean(each_corrs)
+
+        assert numpy.allclose(b, b_expected)
+
+    def test_initialize_dictionary_1(self):
+        p = numpy.array([[27, 51],
+                         [66, 85],
+                         [77, 45]])
+
+        space = numpy.array((100, 100))
+        radii = numpy.array((5, 6, 7))
+
+        g = nanshe.syn.data.generate_hypersphere_masks(space, p, radii)
+
+        activity = numpy.random.random((200, len(g))) ** 4
+        a = numpy.tensordot(activity, g.astype(float), axes=1)
+        a += 0.05 * numpy.random.random(a.shape)
+        a = a.astype(numpy.float32)
+
+        d = nanshe.imp.segment.initialize_dictionary(
+            a, len(g) + 2, min_peak_distance=15.0, block_frame_length=64
+        )
+
+        assert (d.shape == (len(g) + 2,) + a.shape[1:])
+        assert (d.dtype == a.dtype)
+
+        assert numpy.allclose(
+            numpy.sqrt((d.reshape(len(d), -1) ** 2).sum(axis=1)), 1.0
+        )
+
+        # Each cell seeds its own basis image.
+        d_maxes = numpy.array([
+            numpy.unravel_index(each_d.argmax(), each_d.shape)
+            for each_d in d[:len(g)]
+        ])
+        d_maxes_cells = g[(slice(None),) + tuple(d_maxes.T)]
+
+        assert (d_maxes_cells.sum(axis=0) == 1).all()
+        assert (d_maxes_cells.sum(axis=1) == 1).all()
+
+    def test_generate_dictionary_12(self):
+        p = numpy.array([[27, 51],
+                         [66, 85],
+                         [77, 45]])
+
+        space = numpy.array((100, 100))
+        radii = numpy.array((5, 6, 7))
+
+        g = nanshe.syn.data.generate_hypersphere_masks(space, p, radii)
+
+        d = nanshe.imp.segment.generate_dictionary(
+            g.astype(float),
+            **{
+                "initialize_dictionary" : {
+                    "summary_image" : "max_projection",
+                    "min_peak_distance" : 10.0
+                },
+                "sklearn.decomposition.dict_learning_online" : {
+                    "n_jobs" : 1,
+                    "n_components" : len(g),
+                    "n_iter" : 20,
+                    "batch_size" : 256,
+                    "alpha" : 0.2
+                }
+            }
+        )
+        d = (d != 0)
+
+        assert (g.shape == d.shape)
+
+        assert (g.astype(bool).max(axis=0) == d.astype(bool).max(axis=0)).all()
+
+        unmatched_g = range(len(g))
+        matched = dict()
+
+        for i in nanshe.util.iters.irange(len(d)):
+            new_unmatched_g = []
+            for j in unmatched_g:
+                if not (d[i] == g[j]).all():
+                    new_unmatched_g.append(j)
+                else:
+                    matched[i] = j
+
+            unmatched_g = new_unmatched_g
+
+        print(unmatched_g)
+
+        assert (len(unmatched_g) == 0)
+
+    def test_generate_local_maxima_vigra_1(self):
+        p = numpy.array([[27, 51],
+                         [66, 85],
+                         [77, 45]])
+
+        space = numpy.array((100, 100))
+        radii = numpy.array((5, 6, 7))
+        magnitudes = numpy.array((1, 1, 1), dtype=float)
+
+        g = nanshe.syn.data.generate_gaussian_images(
+            space, p, radii/3.0, magnitudes/3
+        )
+        m = nanshe.imp.segment.generate_local_maxima_vigra(g.max(axis=0))
+
+        assert (numpy.array(m.nonzero()) == p.T).all()
+
+    @nose.plugins.attrib.attr("3D")
+    def test_generate_local_maxima_vigra_2(self):
+        p = numpy.array([[27, 51, 87],
+                         [66, 85, 55],
+                         [77, 45, 26]])
+
+        space = numpy.array((100, 100, 100))
+        radii = numpy.array((5, 6, 7))
+        magnitudes = numpy.array((1, 1, 1), dtype=float)
+
+        g = nanshe.syn.data.generate_gaussian_images(
+            space, p, radii/3.0, magnitudes/3
+        )
+        m = nanshe.imp.segment.generate_local_maxima_vigra(g.max(axis=0))
+
+        assert (numpy.array(m.nonzero()) == p.T).all()
+
+    def test_generate_local_maxima_scikit_image_1(self):
+        p = numpy.array([[27, 51],
+                         [66, 85],
+                         [77, 45]])
+
+        space = numpy.array((100, 100))
+        radii = numpy.array((5, 6, 7))
+        magnitudes = numpy.array((1, 1, 1), dtype=float)
+
+        g = nanshe.syn.data.generate_gaussian_images(
+            space, p, radii/3.0, magnitudes/3
+        )
+        m = nanshe.imp.segment.generate_local_maxima_scikit_image(g.max(axis=0))
+
+    @nose.plugins.attrib.attr("3D")
+    def test_generate_local_maxima_scikit_image_2(self):
+        p = numpy.array([[27, 51, 87],
+                         [66, 85, 55],
+                         [77, 45, 26]])
+
+        space = numpy.array((100, 100, 100))
+        radii = numpy.array((5, 6, 7))
+        magnitudes = numpy.array((1, 1, 1), dtype=float)
+
+        g = nanshe.syn.data.generate_gaussian_images(
+            space, p, radii/3.0, magnitudes/3
+        )
+        m = nanshe.imp.segment.generate_local_maxima_scikit_image(g.max(axis=0))
+
+        assert (numpy.array(m.nonzero()) == p.T).all()
+
+    def test_generate_local_maxima_1(self):
+        p = numpy.array([[27, 51],
+                         [66, 85],
+                         [77, 45]])
+
+        space = numpy.array((100, 100))
+        radii = numpy.array((5, 6, 7))
+        magnitudes = numpy.array((1, 1, 1), dtype=float)
+
+        g = nanshe.syn.data.generate_gaussian_images(
+            space, p, radii/3.0, magnitudes/3
+        )
+        m = nanshe.imp.segment.generate_local_maxima(g.max(axis=0))
+
+        assert (numpy.array(m.nonzero()) == p.T).all()
+
+    @nose.plugins.attrib.attr("3D")
+    def test_generate_local_maxima_2(self):
+        p = numpy.array([[27, 51, 87],
+                         [66, 85, 55],
+                         [77, 45, 26]])
+
+        space = numpy.array((100, 100, 100))
+        radii = numpy.array((5, 6, 7))
+        magnitudes = numpy.array((1, 1, 1), dtype=float)
+
+        g = nanshe.syn.data.generate_gaussian_images(
+            space, p, radii/3.0, magnitudes/3
+        )
+        m = nanshe.imp.segment.generate_local_maxima(g.max(axis=0))
+
+        assert (numpy.array(m.nonzero()) == p.T).all()
+
+    def test_extended_region_local_maxima_properties_1(self):
+        p = numpy.array([[27, 51],
+                         [66, 85],
+                         [77, 45]])
+
+        space = numpy.array((100, 100))
+        radii = numpy.array((5, 6, 7))
+        magnitudes = numpy.array((1, 1, 1), dtype=float)
+
+        g = nanshe.syn.data.generate_gaussian_images(
+            space, p, radii/3.0, magnitudes/3
+        )
+        m = (g > 0.00065)
+        g *= m
+
+        e = nanshe.imp.segment.extended_region_local_maxima_properties(
+            g.max(axis=0),
+            nanshe.util.xnumpy.enumerate_masks_max(m, axis=0)[0]
+        )
+
+        assert (numpy.bincount(e["label"])[1:]  == 1).all()
+
+        assert (len(e) == len(p))
+
+        assert (e["local_max"] == p).all()
+
+        assert (e["area"] == numpy.apply_over_axes(numpy.sum, m, axes=range(1, m.ndim)).squeeze().astype(float)).all()
+
+        assert (e["centroid"] == e["local_max"]).all()
+
+        assert (e["intensity"] == g.max(axis=0)[tuple(p.T)]).all()
+
+    def test_extended_region_local_maxima_properties_2(self):
+        p = numpy.array([[27, 51],
                          [32, 53],
                          [77, 45]])
 
@@ -2270,6 +2977,41 @@ class TestSegment(object):
         assert len(matches) == len(props)
         assert (matches == numpy.array([ True, False,  True])).all()
 
+    def test_watershed_components_1(self):
+        space = numpy.array((100, 100))
+        radii = numpy.array((5, 6, 7))
+        magnitudes = numpy.array((1, 1, 1), dtype=float)
+        points = numpy.array([[20, 30],
+                              [24, 36],
+                              [70, 60]])
+
+        masks = nanshe.syn.data.generate_hypersphere_masks(
+            space, points, radii
+        )
+        images = nanshe.syn.data.generate_gaussian_images(
+            space, points, radii/3.0, magnitudes
+        ) * masks
+        image = images.max(axis=0)
+
+        markers = numpy.zeros(image.shape, dtype=int)
+        markers[tuple(points.T)] = numpy.arange(1, len(points) + 1)
+
+        segmentation = skimage.morphology.watershed(
+            -image, markers, mask=(image > 0)
+        )
+
+        segmentation_components = nanshe.imp.segment.watershed_components(
+            -image, markers, (image > 0)
+        )
+
+        segmentation_components_threaded = nanshe.imp.segment.watershed_components(
+            -image, markers, (image > 0), num_threads=2
+        )
+
+        assert (segmentation == segmentation_components).all()
+
+        assert (segmentation == segmentation_components_threaded).all()
+
     def test_wavelet_denoising_1(self):
         params = {
             "remove_low_intensity_local_maxima" : {
@@ -2479,6 +3221,60 @@ class TestSegment(object):
         assert (numpy.abs(neurons["image"].max(axis=0) - neuron_images.max(axis=0)).max() < 1.0e-6)
         assert (numpy.abs(neurons["image"] - neuron_images).max() < 1.0e-6)
 
+    def test_wavelet_denoising_4(self):
+        params = {
+            "remove_low_intensity_local_maxima" : {
+                "percentage_pixels_below_max" : 0
+            },
+            "wavelet.transform" : {
+                "scale" : 5
+            },
+            "accepted_region_shape_constraints" : {
+                "major_axis_length" : {
+                    "max" : 25.0,
+                    "min" : 0.0
+                }
+            },
+            "accepted_neuron_shape_constraints" : {
+                "eccentricity" : {
+                    "max" : 0.9,
+                    "min" : 0.0
+                },
+                "area" : {
+                    "max" : 600,
+                    "min" : 30
+                }
+            },
+            "estimate_noise" : {
+                "significance_threshold" : 3.0
+            },
+            "significant_mask" : {
+                "noise_threshold" : 3.0
+            },
+            "remove_too_close_local_maxima" : {
+                "min_local_max_distance" : 100.0
+            },
+            "use_watershed" : True
+        }
+
+        shape = numpy.array((500, 500))
+
+        workspace = nanshe.imp.segment.WaveletDenoisingWorkspace(
+            shape, params["wavelet.transform"]["scale"]
+        )
+
+        for neuron_centers in [numpy.array([[177,  52], [127, 202], [343, 271]]),
+                               numpy.array([[197,  72], [147, 222], [363, 291]])]:
+            original_neuron_image = nanshe.syn.data.generate_gaussian_images(shape, neuron_centers, (50.0/3.0,)*len(neuron_centers), (1.0/3.0,)*len(neuron_centers)).sum(axis=0)
+
+            neurons_expected = nanshe.imp.segment.wavelet_denoising(original_neuron_image, **params)
+
+            neurons = nanshe.imp.segment.wavelet_denoising(original_neuron_image, workspace=workspace, **params)
+
+            assert (len(neuron_centers) == len(neurons))
+            assert (neurons_expected["mask"] == neurons["mask"]).all()
+            assert (neurons_expected["image"] == neurons["image"]).all()
+
     def test_extract_neurons_1(self):
         image = 5 * numpy.ones((100, 100))
 
@@ -2566,6 +3362,141 @@ class TestSegment(object):
 
         assert (neurons["centroid"] == neurons["gaussian_mean"]).all()
 
+    def test_extract_labeled_neurons_1(self):
+        image = 5 * numpy.ones((100, 100))
+
+        xy = numpy.indices(image.shape)
+
+        circle_centers = numpy.array([[25, 25], [74, 74]])
+
+        circle_radii = numpy.array([25, 25])
+
+        circle_offsets = nanshe.util.xnumpy.expand_view(circle_centers, image.shape) - \
+        nanshe.util.xnumpy.expand_view(xy, reps_before=len(circle_centers))
+
+        circle_offsets_squared = circle_offsets**2
+
+        circle_masks = (circle_offsets_squared.sum(axis=1)**.5 < nanshe.util.xnumpy.expand_view(circle_radii, image.shape))
+
+        circle_labels = numpy.array([7, 3])
+        circle_label_image = (
+            nanshe.util.xnumpy.expand_view(circle_labels, image.shape) *
+            circle_masks
+        ).max(axis=0)
+
+        neurons_expected = nanshe.imp.segment.extract_neurons(image, circle_masks)
+
+        neurons = nanshe.imp.segment.extract_labeled_neurons(
+            image, circle_label_image, circle_labels
+        )
+
+        assert (len(circle_masks) == len(neurons))
+
+        assert (circle_masks == neurons["mask"]).all()
+
+        assert (neurons_expected["contour"] == neurons["contour"]).all()
+
+        assert (neurons_expected["image"] == neurons["image"]).all()
+
+        assert (neurons_expected["area"] == neurons["area"]).all()
+
+        assert (neurons_expected["max_F"] == neurons["max_F"]).all()
+
+        assert (neurons_expected["gaussian_mean"] == neurons["gaussian_mean"]).all()
+
+        assert (neurons_expected["gaussian_cov"] == neurons["gaussian_cov"]).all()
+
+        assert (neurons["centroid"] == neurons["gaussian_mean"]).all()
+
+    def test_upsample_neurons_1(self):
+        image = 5 * numpy.ones((100, 100))
+
+        xy = numpy.indices(image.shape)
+
+        circle_centers = numpy.array([[25, 25], [74, 74]])
+
+        circle_radii = numpy.array([25, 25])
+
+        circle_offsets = nanshe.util.xnumpy.expand_view(circle_centers, image.shape) - \
+        nanshe.util.xnumpy.expand_view(xy, reps_before=len(circle_centers))
+
+        circle_offsets_squared = circle_offsets**2
+
+        circle_masks = (circle_offsets_squared.sum(axis=1)**.5 < nanshe.util.xnumpy.expand_view(circle_radii, image.shape))
+
+        binned_image = nanshe.imp.segment.spatial_bin(image[None], 2)[0]
+        binned_circle_masks = nanshe.imp.segment.spatial_bin(
+            circle_masks, 2, method="max"
+        )
+
+        binned_neurons = nanshe.imp.segment.extract_neurons(
+            binned_image, binned_circle_masks
+        )
+
+        neurons = nanshe.imp.segment.upsample_neurons(
+            binned_neurons, 2, shape=image.shape
+        )
+
+        assert (len(circle_masks) == len(neurons))
+        assert (neurons["mask"].shape == circle_masks.shape)
+
+        # Upsampled masks cover the originals and little else.
+        assert (neurons["mask"] >= circle_masks).all()
+        assert (neurons["area"] < 1.1 * circle_masks.sum(axis=2).sum(axis=1)).all()
+
+        assert (neurons["image"] == neurons["mask"] * image).all()
+        assert (neurons["max_F"] == 5).all()
+
+        assert (numpy.abs(neurons["gaussian_mean"] - circle_centers) < 1.0).all()
+        assert (neurons["centroid"] == neurons["gaussian_mean"]).all()
+
+    def test_upsample_neurons_2(self):
+        image = numpy.random.random((9, 11, 13))
+
+        binned_neurons = nanshe.imp.segment.get_one_neuron(
+            shape=(4, 5, 6), dtype=image.dtype
+        )
+        binned_neurons["mask"][0, 1:3, 2:4, 3:5] = True
+
+        neurons = nanshe.imp.segment.upsample_neurons(
+            binned_neurons, 2, shape=image.shape, new_image=image
+        )
+
+        mask_expected = numpy.zeros(image.shape, dtype=bool)
+        mask_expected[2:6, 4:8, 6:10] = True
+
+        assert (neurons["mask"][0] == mask_expected).all()
+        assert (neurons["area"][0] == mask_expected.sum())
+        assert (neurons["image"][0] == mask_expected * image).all()
+        assert numpy.allclose(neurons["gaussian_mean"][0], [3.5, 5.5, 7.5])
+
+    def test_upsample_neurons_3(self):
+        binned_neurons = numpy.zeros(
+            (2,), dtype=nanshe.imp.segment.get_neuron_dtype((4, 5), float)
+        )
+        binned_neurons["mask"][0, :2, :3] = True
+        binned_neurons["mask"][1, 1:3, 2:4] = True
+        binned_neurons["image"][0] = 1 + numpy.random.random((4, 5))
+        binned_neurons["image"][1] = 3 + numpy.random.random((4, 5))
+        binned_neurons["image"] *= binned_neurons["mask"]
+
+        neurons = nanshe.imp.segment.upsample_neurons(
+            binned_neurons, 2, shape=(9, 10)
+        )
+
+        # Each neuron keeps its own image (even where they overlap).
+        for i in nanshe.util.iters.irange(len(binned_neurons)):
+            image_expected = numpy.repeat(
+                numpy.repeat(binned_neurons["image"][i], 2, axis=0), 2, axis=1
+            )
+            image_expected = numpy.pad(
+                image_expected, [(0, 1), (0, 0)], mode="edge"
+            )
+
+            assert (neurons["image"][i] == image_expected).all()
+            assert (neurons["max_F"][i] == binned_neurons["image"][i].max())
+            assert (neurons["area"][i] == 4 * binned_neurons["mask"][i].sum())
+
     def test_fuse_neurons_1(self):
         fraction_mean_neuron_max_threshold = 0.01
 
@@ -2653,6 +3584,39 @@ class TestSegment(object):
 
         assert (fused_neurons["centroid"] == fused_neurons["gaussian_mean"]).all()
 
+    def test_fuse_neurons_3(self):
+        fraction_mean_neuron_max_threshold = 0.01
+
+        image = 5 * numpy.ones((100, 100))
+
+        square_masks = numpy.zeros((2,) + image.shape, dtype=bool)
+        square_masks[0, :20, 10:30] = True
+        square_masks[1, 10:30, 20:40] = True
+
+        neurons = nanshe.imp.segment.extract_neurons(image, square_masks)
+
+        fused_neurons = nanshe.imp.segment.fuse_neurons(neurons[0], neurons[1],
+                                                        fraction_mean_neuron_max_threshold)
+
+        fused_mask = square_masks.any(axis=0)
+        fused_mask_points = numpy.array(fused_mask.nonzero())
+
+        assert (fused_mask == fused_neurons["mask"]).all()
+
+        assert (nanshe.util.xnumpy.generate_contour_fast(fused_mask) == fused_neurons["contour"]).all()
+
+        assert (neurons["image"].mean(axis=0) * fused_mask == fused_neurons["image"]).all()
+
+        assert (numpy.array(fused_mask.sum()) == fused_neurons["area"])
+
+        assert (fused_neurons["image"].max() == fused_neurons["max_F"])
+
+        assert (fused_mask_points.mean(axis=1) == fused_neurons["gaussian_mean"]).all()
+
+        assert (numpy.cov(fused_mask_points) == fused_neurons["gaussian_cov"]).all()
+
+        assert (fused_neurons["centroid"] == fused_neurons["gaussian_mean"]).all()
+
     def test_merge_neuron_sets_1(self):
         alignment_min_threshold = 0.6
         overlap_min_threshold = 0.6
@@ -2767,6 +3731,208 @@ class TestSegment(object):
 
         assert (neurons == merged_neurons).all()
 
+    def test_merge_neuron_catalogue_1(self):
+        alignment_min_threshold = 0.6
+        overlap_min_threshold = 0.6
+        fuse_neurons = {"fraction_mean_neuron_max_threshold" : 0.01}
+
+        image = 5 * numpy.ones((100, 100))
+
+        xy = numpy.indices(image.shape)
+
+        circle_centers = numpy.array([[25, 25], [74, 74], [25, 74], [26, 26]])
+
+        circle_radii = numpy.array([15, 15, 10, 15])
+
+        circle_offsets = nanshe.util.xnumpy.expand_view(circle_centers, image.shape) - \
+        nanshe.util.xnumpy.expand_view(xy, reps_before=len(circle_centers))
+
+        circle_offsets_squared = circle_offsets**2
+
+        circle_masks = (circle_offsets_squared.sum(axis=1)**.5 < nanshe.util.xnumpy.expand_view(circle_radii, image.shape))
+
+        neurons = nanshe.imp.segment.extract_neurons(image, circle_masks)
+
+        neuron_sets = [neurons[:2], neurons[2:3], neurons[3:], neurons[:0]]
+
+        neuron_catalogue = nanshe.imp.segment.NeuronCatalogue(image.shape, image.dtype)
+
+        merged_neurons = nanshe.imp.segment.get_empty_neuron(image.shape, image.dtype)
+        for each_neuron_set in neuron_sets:
+            neuron_catalogue.append(each_neuron_set)
+            nanshe.imp.segment.merge_neuron_catalogue(neuron_catalogue, alignment_min_threshold, overlap_min_threshold, fuse_neurons=fuse_neurons)
+
+            merged_neurons = nanshe.imp.segment.merge_neuron_sets(merged_neurons, each_neuron_set, alignment_min_threshold, overlap_min_threshold, fuse_neurons=fuse_neurons)
+
+            assert (len(neuron_catalogue) == len(merged_neurons))
+
+            assert (neuron_catalogue.neurons == merged_neurons).all()
+
+        assert (len(neuron_catalogue) == 3)
+
+        assert (neuron_catalogue.neurons[1:] == neurons[1:3]).all()
+
+        assert (neuron_catalogue[0]["mask"] == (circle_masks[0] | circle_masks[3])).all()
+
+    def test_merge_neuron_catalogue_2(self):
+        alignment_min_threshold = 0.6
+        overlap_min_threshold = 0.6
+        fuse_neurons = {"fraction_mean_neuron_max_threshold" : 0.01}
+
+        image = numpy.random.random((50, 50)) + 1
+
+        masks = numpy.zeros((10,) + image.shape, dtype=bool)
+        for i in nanshe.util.iters.irange(len(masks)):
+            masks[i, 5 * i:5 * i + 4, 5 * i:5 * i + 4] = True
+
+        neurons = nanshe.imp.segment.extract_neurons(image, masks)
+
+        neuron_catalogue = nanshe.imp.segment.NeuronCatalogue(image.shape, image.dtype)
+        neuron_catalogue.append(neurons)
+        nanshe.imp.segment.merge_neuron_catalogue(neuron_catalogue, alignment_min_threshold, overlap_min_threshold, fuse_neurons=fuse_neurons)
+
+        assert (len(neuron_catalogue) == len(neurons))
+
+        # Only overlapping neurons have scores kept.
+        assert (neuron_catalogue.pairs == {})
+
+        pairs_i, pairs_j, pairs_angle, pairs_masks_overlaid = neuron_catalogue.scores()
+
+        assert (len(pairs_i) == len(pairs_j) == 0)
+        assert (len(pairs_angle) == len(pairs_masks_overlaid) == 0)
+
+        neuron_catalogue.append(neurons[3:4])
+        nanshe.imp.segment.merge_neuron_catalogue(neuron_catalogue, alignment_min_threshold, overlap_min_threshold, fuse_neurons=fuse_neurons)
+
+        assert (len(neuron_catalogue) == len(neurons))
+        assert (neuron_catalogue.neurons["mask"] == masks).all()
+        assert (neuron_catalogue.pairs == {})
+
+    def test_expand_rois_1(self):
+        a = numpy.random.random((30, 12, 13))
+        m = numpy.random.random((5, 12, 13)) > 0.7
+
+        b = nanshe.imp.segment.expand_rois(a, m, block_frame_length=7)
+
+        a_m = a.reshape(len(a), -1)
+        a_m = a_m - a_m.mean(axis=1)[:, None]
+        a_m /= numpy.linalg.norm(a_m, axis=1)[:, None]
+
+        t = numpy.array([a_m[:, each_m.ravel()].mean(axis=1) for each_m in m])
+        t = t - t.mean(axis=1)[:, None]
+        t /= numpy.linalg.norm(t, axis=1)[:, None]
+
+        b_expected = t.dot(a_m).reshape(m.shape)
+
+        assert (b.shape == m.shape)
+        assert numpy.allclose(b, b_expected)
+
+    def test_extract_traces_1(self):
+        space = numpy.array((50, 50))
+        p = numpy.array([[15, 15], [20, 18], [35, 30]])
+        radii = numpy.array((5, 6, 4))
+
+        g = nanshe.syn.data.generate_hypersphere_masks(space, p, radii)
+
+        neurons = numpy.zeros(
+            (len(g),),
+            dtype=nanshe.imp.segment.get_neuron_dtype(g.shape[1:], float)
+        )
+        neurons["mask"] = g
+        neurons["image"] = g * numpy.random.random(g.shape)
+
+        traces = numpy.random.random((len(g), 40))
+
+        a = numpy.tensordot(traces.T, neurons["image"], axes=1)
+
+        b = nanshe.imp.segment.extract_traces(
+            a,
+            neurons,
+            method="least_squares",
+            weights="image",
+            block_frame_length=7
+        )
+
+        assert (b.shape == traces.shape)
+        assert numpy.allclose(b, traces)
+
+        b = nanshe.imp.segment.extract_traces(a, neurons, block_frame_length=7)
+
+        b_expected = numpy.array([a[:, each_g].mean(axis=1) for each_g in g])
+
+        assert (b.shape == traces.shape)
+        assert numpy.allclose(b, b_expected)
+
+    def test_extract_traces_2(self):
+        space = numpy.array((50, 50))
+        p = numpy.array([[15, 15], [20, 18], [35, 30]])
+        radii = numpy.array((5, 6, 4))
+
+        g = nanshe.syn.data.generate_hypersphere_masks(space, p, radii)
+
+        # Add an empty neuron and a duplicate of the last one.
+        g = numpy.concatenate([g, numpy.zeros_like(g[:1]), g[-1:]])
+
+        neurons = numpy.zeros(
+            (len(g),),
+            dtype=nanshe.imp.segment.get_neuron_dtype(g.shape[1:], float)
+        )
+        neurons["mask"] = g
+        neurons["image"] = g
+
+        traces = numpy.random.random((len(g), 40))
+        traces[3] = 0
+        traces[4] = traces[2]
+
+        a = numpy.tensordot(traces.T, neurons["image"], axes=1)
+
+        b = nanshe.imp.segment.extract_traces(
+            a,
+            neurons,
+            method="least_squares",
+            block_frame_length=7
+        )
+
+        # The duplicates split their combined trace evenly.
+        assert (b.shape == traces.shape)
+        assert numpy.isfinite(b).all()
+        assert numpy.allclose(b, traces)
+
+    def test_prune_dictionary_1(self):
+        space = numpy.array((50, 50))
+        p = numpy.array([[15, 15], [35, 30]])
+        radii = numpy.array((5, 6))
+
+        g = nanshe.syn.data.generate_hypersphere_masks(space, p, radii)
+        g = g.astype(float)
+
+        noise = numpy.random.standard_normal((1,) + tuple(space))
+        duplicate = g[:1] + 0.01 * numpy.random.random((1,) + tuple(space))
+
+        d = numpy.concatenate([g, noise, duplicate, numpy.zeros_like(g[:1])])
+
+        b = nanshe.imp.segment.prune_dictionary(d)
+
+        assert (b.shape == (len(d) - 1,) + g.shape[1:])
+        assert (b == d[:-1]).all()
+
+        b = nanshe.imp.segment.prune_dictionary(d, min_compactness=0.5)
+
+        assert (b.shape == (len(d) - 2,) + g.shape[1:])
+        assert (b == d[[0, 1, 3]]).all()
+
+        b = nanshe.imp.segment.prune_dictionary(d, max_correlation=0.9)
+
+        assert (b.shape == (len(d) - 2,) + g.shape[1:])
+        assert (b == d[[0, 1, 2]]).all()
+
+        b = nanshe.imp.segment.prune_dictionary(
+            d, min_compactness=0.5, max_correlation=0.9
+        )
+
+        assert (b.shape == g.shape)
+        assert (b == g).all()
+
     def test_postprocess_data_1(self):
         config = {
             "wavelet_denoising" : {
@@ -21,6 +21,8 @@ import nanshe.util.xnumpy
 import nanshe.util.wrappers
 import nanshe.io.hdf5.record
 
+import nanshe.imp.segment
+
 import nanshe.syn.data
 
 import nanshe.learner
@@ -1553,6 +1555,101 @@ def test_generate_neurons_a_block_2():
     assert (len(unmatched_points) == 0)
 
 
+@nanshe.util.wrappers.with_setup_state(setup_2d, teardown_2d)
+def test_generate_neurons_a_block_3():
+    # Record the dictionary each run is seeded with.
+    initial_dictionaries = []
+    backends = nanshe.imp.segment.generate_dictionary.backends
+    backend_name = "sklearn.decomposition.dict_learning_online"
+    backend_entry = backends[backend_name]
+
+    def recorded_backend(new_data, initial_dictionary, **parameters):
+        initial_dictionaries.append(initial_dictionary)
+
+        return(backend_entry[0](new_data, initial_dictionary, **parameters))
+
+    # A stale seed left in the output group must not be used.
+    with h5py.File(test_generate_neurons_a_block_3.hdf5_output_filename, "a") as fid:
+        fid["initial_dictionary"] = numpy.ones((10, 110, 110), dtype=numpy.float32)
+
+    backends[backend_name] = (recorded_backend,) + backend_entry[1:]
+
+    try:
+        nanshe.learner.generate_neurons_a_block(test_generate_neurons_a_block_3.hdf5_input_filepath, test_generate_neurons_a_block_3.hdf5_output_filepath, **test_generate_neurons_a_block_3.config_a_block)
+
+        with h5py.File(test_generate_neurons_a_block_3.hdf5_output_filename, "r") as fid:
+            assert ("dictionary" in fid)
+
+            dictionary = fid["dictionary"][...]
+
+        # Rerun from the last dictionary found with far fewer iterations.
+        config_a_block = json.loads(json.dumps(
+            test_generate_neurons_a_block_3.config_a_block
+        ))
+        config_a_block["generate_neurons"]["warm_start"] = True
+        config_a_block["generate_neurons"]["generate_dictionary"][backend_name]["n_iter"] = 10
+
+        nanshe.learner.generate_neurons_a_block(test_generate_neurons_a_block_3.hdf5_input_filepath, test_generate_neurons_a_block_3.hdf5_output_filepath, **config_a_block)
+    finally:
+        backends[backend_name] = backend_entry
+
+    assert (len(initial_dictionaries) == 2)
+    assert (initial_dictionaries[0] is None)
+    assert (initial_dictionaries[1] == dictionary.reshape(len(dictionary), -1)).all()
+
+    with h5py.File(test_generate_neurons_a_block_3.hdf5_output_filename, "r") as fid:
+        assert ("neurons" in fid)
+
+        assert (fid["dictionary"].shape == dictionary.shape)
+
+        neurons = fid["neurons"][...]
+
+    assert (len(test_generate_neurons_a_block_3.points) == len(neurons))
+
+    neuron_maxes = (neurons["image"] == nanshe.util.xnumpy.expand_view(neurons["max_F"], neurons["image"].shape[1:]))
+
+    neuron_max_points = []
+    for i in nanshe.util.iters.irange(len(neuron_maxes)):
+        neuron_max_points.append(
+            numpy.array(neuron_maxes[i].nonzero()).mean(axis=1).round().astype(int)
+        )
+    neuron_max_points = numpy.array(neuron_max_points)
+
+    matched = dict()
+    unmatched_points = numpy.arange(len(test_generate_neurons_a_block_3.points))
+    for i in nanshe.util.iters.irange(len(neuron_max_points)):
+        new_unmatched_points = []
+        for j in unmatched_points:
+            if not (neuron_max_points[i] == test_generate_neurons_a_block_3.points[j]).all():
+                new_unmatched_points.append(j)
+            else:
+                matched[i] = j
+
+        unmatched_points = new_unmatched_points
+
+    assert (len(unmatched_points) == 0)
+
+
+def test_split_cores_1():
+    cores = nanshe.learner.split_cores(3, range(8))
+
+    assert (cores == [(0, 1), (2, 3), (4, 5)])
+
+    cores = nanshe.learner.split_cores(4)
+
+    assert (len(cores) == 4)
+    assert (len(set(len(_) for _ in cores)) == 1)
+
+
+def test_thread_limited_environment_1():
+    env = nanshe.learner.thread_limited_environment(3)
+
+    assert (env is not os.environ)
+    assert (env["OMP_NUM_THREADS"] == "3")
+    assert (env["MKL_NUM_THREADS"] == "3")
+    assert (set(os.environ.keys()) <= set(env.keys()))
+
+
 @nanshe.util.wrappers.with_setup_state(setup_2d, teardown_2d)
 def test_generate_neurons_blocks_1():
     if not has_spams:
@@ -1764,6 +1861,65 @@ def test_generate_neurons_blocks_4():
     assert (len(unmatched_points) == 0)
 
 
+@nanshe.util.wrappers.with_setup_state(setup_2d, teardown_2d)
+def test_generate_neurons_blocks_5():
+    if not has_spams:
+        raise nose.SkipTest(
+            "Cannot run this test without SPAMS being installed."
+        )
+
+    # Seed with a dictionary covering the whole field of view.
+    initial_dictionary = numpy.random.random((10, 110, 110)).astype(numpy.float32)
+
+    initial_dictionary_filename = os.path.join(
+        test_generate_neurons_blocks_5.temp_dir, "initial_dictionary.h5"
+    )
+    with h5py.File(initial_dictionary_filename, "w") as fid:
+        fid["dictionary"] = initial_dictionary
+
+    config_blocks = json.loads(json.dumps(
+        test_generate_neurons_blocks_5.config_blocks
+    ))
+    config_blocks["generate_neurons_blocks"]["generate_neurons"]["initial_dictionary"] = initial_dictionary_filename + "/" + "dictionary"
+
+    nanshe.learner.generate_neurons_blocks(test_generate_neurons_blocks_5.hdf5_input_filepath, test_generate_neurons_blocks_5.hdf5_output_filepath, **config_blocks["generate_neurons_blocks"])
+
+    intermediate_output_dir = os.path.join(
+        test_generate_neurons_blocks_5.temp_dir, "output_blocks"
+    )
+
+    with h5py.File(test_generate_neurons_blocks_5.hdf5_output_filename, "r") as fid:
+        assert ("neurons" in fid)
+
+        blocks = fid["blocks"]
+        assert (len(blocks) == 4)
+
+        for each_block_name in blocks:
+            each_slice = eval(blocks[each_block_name].attrs["slice"])
+
+            # Each block is seeded with its crop (renormalized).
+            initial_dictionary_block = initial_dictionary[
+                (slice(None),) + each_slice[1:]
+            ]
+            initial_dictionary_block = initial_dictionary_block / numpy.sqrt(
+                (initial_dictionary_block ** 2).sum(axis=(1, 2))
+            )[:, None, None]
+
+            with h5py.File(os.path.join(intermediate_output_dir, each_block_name + os.extsep + "h5"), "r") as each_block_fid:
+                assert numpy.allclose(
+                    each_block_fid["initial_dictionary"][...],
+                    initial_dictionary_block,
+                    rtol=1e-5
+                )
+
+    # The seed is not read by the blocks unless configured.
+    with open(os.path.join(intermediate_output_dir, "config.json"), "r") as fid:
+        intermediate_config = json.load(fid)
+
+    assert intermediate_config["generate_neurons"]["initial_dictionary_from_output"]
+    assert ("initial_dictionary" not in intermediate_config["generate_neurons"])
+
+
 @nanshe.util.wrappers.with_setup_state(setup_2d, teardown_2d)
 def test_generate_neurons_1():
     image_stack = None
@@ -1901,3 +2057,120 @@ def test_generate_neurons_2():
         unmatched_points = new_unmatched_points
 
     assert (len(unmatched_points) == 0)
+
+
+@nanshe.util.wrappers.with_setup_state(setup_2d, teardown_2d)
+def test_generate_neurons_3():
+    image_stack = None
+    with h5py.File(test_generate_neurons_3.hdf5_input_filename, "r") as input_file_handle:
+        image_stack = input_file_handle["images"][...]
+
+    # Find the neurons on data binned 2x2 and map them back.
+    config = {
+        "postprocess_data" : {
+            "wavelet_denoising" : {
+                "remove_low_intensity_local_maxima" : {
+                    "percentage_pixels_below_max" : 0.8
+                },
+                "wavelet.transform" : {
+                    "scale" : 2
+                },
+                "accepted_region_shape_constraints" : {
+                    "major_axis_length" : {
+                        "max" : 12.5,
+                        "min" : 0.0
+                    }
+                },
+                "accepted_neuron_shape_constraints" : {
+                    "eccentricity" : {
+                        "max" : 0.9,
+                        "min" : 0.0
+                    },
+                    "area" : {
+                        "max" : 150,
+                        "min" : 6
+                    }
+                },
+                "estimate_noise" : {
+                    "significance_threshold" : 3.0
+                },
+                "significant_mask" : {
+                    "noise_threshold" : 2.0
+                },
+                "remove_too_close_local_maxima" : {
+                    "min_local_max_distance" : 8.0
+                },
+                "use_watershed" : True
+            },
+            "merge_neuron_sets" : {
+                "alignment_min_threshold" : 0.6,
+                "fuse_neurons" : {
+                    "fraction_mean_neuron_max_threshold" : 0.01
+                },
+                "overlap_min_threshold" : 0.6
+            }
+        },
+        "run_stage" : "all",
+        "preprocess_data" : {
+            "spatial_bin" : {
+                "factor" : 2
+            },
+            "normalize_data" : {
+                "renormalized_images" : {
+                    "ord" : 2
+                }
+            }
+        },
+        "generate_dictionary" : {
+            "sklearn.decomposition.MiniBatchDictionaryLearning" : {
+                "n_jobs" : 1,
+                "n_components" : 10,
+                "batch_size" : 256,
+                "alpha" : 0.2
+            }
+        }
+    }
+
+    with h5py.File(test_generate_neurons_3.hdf5_output_filename, "a") as output_file_handle:
+        output_group = output_file_handle["/"]
+
+        # Saves intermediate result to make resuming easier
+        resume_logger = nanshe.io.hdf5.record.generate_HDF5_array_recorder(
+            output_group,
+            recorder_constructor=nanshe.io.hdf5.record.HDF5ArrayRecorder,
+            overwrite=True
+        )
+
+        nanshe.learner.generate_neurons.resume_logger = resume_logger
+        nanshe.learner.generate_neurons.recorders.array_debug_recorder = nanshe.io.hdf5.record.EmptyArrayRecorder()
+        nanshe.learner.generate_neurons(image_stack, **config)
+
+    with h5py.File(test_generate_neurons_3.hdf5_output_filename, "r") as fid:
+        assert ("neurons" in fid)
+
+        neurons = fid["neurons"].value
+        dictionary = fid["dictionary"][...]
+
+    assert (len(neurons) > 0)
+    assert (neurons["mask"].shape[1:] == image_stack.shape[1:])
+
+    # Images are upsampled from the basis images (as without binning). So,
+    # they are constant over each bin and are dictionary values.
+    neuron_images_binned = neurons["image"][:, ::2, ::2]
+    assert (
+        neurons["image"] == numpy.repeat(
+            numpy.repeat(neuron_images_binned, 2, axis=1), 2, axis=2
+        )
+    ).all()
+    assert (neurons["image"].max() <= dictionary.max())
+    assert numpy.allclose(
+        neurons["max_F"],
+        neurons["image"].reshape(len(neurons), -1).max(axis=1)
+    )
+
+    # Each neuron found covers one of the neurons in the data.
+    for each_neuron in neurons:
+        assert any(
+            each_neuron["mask"][tuple(each_point)]
+            for each_point in test_generate_neurons_3.points
+        )